@@ -0,0 +1,136 @@
+"""Confidence-driven OCR: a cheap pass first, more work only where it's unsure.
+
+A single Tesseract call at 300 DPI after one global Otsu threshold gives
+clean invoices more pixels than they need and poor scans too little help.
+Here each page is first read at FAST_DPI, and Tesseract's word confidences
+decide what happens next:
+
+- every word at MIN_WORD_CONFIDENCE or above: the fast text is kept;
+- a few unsure words: only those words are cut from the full-resolution
+  page, thresholded adaptively (which copes with the shadows, stains and
+  uneven lighting one page-wide threshold doesn't) and read again on their
+  own. A re-read replaces the word only when Tesseract is more confident;
+- a mostly unsure page (mean confidence below MIN_PAGE_CONFIDENCE or more
+  than MAX_UNSURE_WORDS unsure words): the whole page is thresholded
+  adaptively, cleared of specks, deskewed and read again at full
+  resolution, and the more confident of the two passes is kept.
+
+A page whose fast threshold is mostly noise goes straight to the careful
+pass: Tesseract can spend minutes trying to read thousands of specks.
+
+Tesseract's LSTM scales every text line to a fixed height before reading
+it, so below 300 DPI only layout analysis gets cheaper; much below FAST_DPI
+the downscaling starts costing characters (INV- read as [NV-) that
+Tesseract is still confident about. Re-reading whole lines rather than
+words cost more than the fast pass saved.
+
+Confidences are Tesseract's, 0-100; a page's is the mean over its words.
+Importing this module is cheap: all image work goes through the Preprocessor.
+"""
+# Resolution of the first pass; pages are decoded at the preprocessor's target_dpi
+FAST_DPI = 250
+
+# Tesseract page segmentation modes for whole pages and re-read words (as in layout_regions)
+PSM_AUTO = 3
+PSM_WORD = 8
+
+# Words below this are re-read
+MIN_WORD_CONFIDENCE = 80
+# A page whose fast pass averages below this, or has more unsure words, is re-read whole
+MIN_PAGE_CONFIDENCE = 75
+MAX_UNSURE_WORDS = 20
+
+# Separate blobs of ink (per megapixel, counted on every other pixel of the fast pass image)
+# beyond which a page is taken for noise; clean invoices stay under 1000
+MAX_BLOBS_PER_MEGAPIXEL = 20000
+
+# Files below this are worth checking by hand; the app and the CLI point them out
+REVIEW_CONFIDENCE = 80
+
+# Padding (pixels at full resolution) kept around a word that is re-read
+WORD_PADDING = 8
+
+# Short description of this strategy for the extraction cache key
+SETTINGS = (f"adaptive:{FAST_DPI}dpi-psm{PSM_AUTO},word<{MIN_WORD_CONFIDENCE}:unspeckled-psm{PSM_WORD},"
+            f"page<{MIN_PAGE_CONFIDENCE}|words>{MAX_UNSURE_WORDS}:deskew-psm{PSM_AUTO}")
+
+
+def _lines(words):
+    """Words grouped by (block, paragraph, line), in reading order"""
+    lines = {}
+    for word in words:
+        lines.setdefault((word["block"], word["par"], word["line"]), []).append(word)
+    return lines
+
+
+def _text(lines):
+    # Laid out like Tesseract's own text output: a blank line between paragraphs
+    parts = []
+    paragraph = None
+    for (block, par, _), words in lines.items():
+        if paragraph is not None and (block, par) != paragraph:
+            parts.append("")
+        paragraph = (block, par)
+        parts.append(" ".join(word["text"] for word in words))
+    return "".join(part + "\n" for part in parts)
+
+
+def confidence(words):
+    """Mean word confidence, or None when there are no words"""
+    if not words:
+        return None
+    return sum(word["conf"] for word in words) / len(words)
+
+
+def _reread_word(backend, gray, word, scale, preprocessor):
+    left = max(0, round(word["left"] / scale) - WORD_PADDING)
+    top = max(0, round(word["top"] / scale) - WORD_PADDING)
+    right = round((word["left"] + word["width"]) / scale) + WORD_PADDING
+    bottom = round((word["top"] + word["height"]) / scale) + WORD_PADDING
+    crop = gray[top:bottom, left:right]
+    if crop.size == 0:
+        return None
+    return backend.image_to_data(preprocessor.binarize(crop, adaptive=True, deskew=False, despeckle=False),
+                                  psm=PSM_WORD)
+
+
+def _noisy(binary):
+    import cv2
+
+    sample = cv2.bitwise_not(binary[::2, ::2])
+    blobs = cv2.connectedComponents(sample, ltype=cv2.CV_32S)[0] - 1
+    return blobs > MAX_BLOBS_PER_MEGAPIXEL * sample.size / 1e6
+
+
+def read_page(gray, preprocessor, backend):
+    """``(text, confidence, words)`` of a grayscale page decoded at ``preprocessor.target_dpi``.
+
+    ``confidence`` is None when no text was found at all. ``words`` are the
+    boxes of the pass the text came from, as ``image_to_data`` returns them
+    (re-read words keep their box from the fast pass).
+    """
+    fast = preprocessor.downscale(gray, FAST_DPI)
+    scale = fast.shape[1] / gray.shape[1]
+    binary = preprocessor.binarize(fast)
+    if _noisy(binary):
+        words = []
+        unsure = mean = None
+    else:
+        words = backend.image_to_data(binary, psm=PSM_AUTO)
+        unsure = [index for index, word in enumerate(words) if word["conf"] < MIN_WORD_CONFIDENCE]
+        mean = confidence(words)
+        if not unsure:
+            return _text(_lines(words)), mean, words
+
+    if mean is None or mean < MIN_PAGE_CONFIDENCE or len(unsure) > MAX_UNSURE_WORDS:
+        careful = backend.image_to_data(preprocessor.binarize(gray, adaptive=True, deskew=True), psm=PSM_AUTO)
+        if careful and (mean is None or confidence(careful) > mean):
+            return _text(_lines(careful)), confidence(careful), careful
+        return _text(_lines(words)), mean, words
+
+    for index in unsure:
+        reread = _reread_word(backend, gray, words[index], scale, preprocessor)
+        if reread and confidence(reread) > words[index]["conf"]:
+            words[index] = dict(words[index], text=" ".join(word["text"] for word in reread),
+                                conf=confidence(reread))
+    return _text(_lines(words)), confidence(words), words
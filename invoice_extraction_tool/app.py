@@ -1,19 +1,22 @@
 import streamlit as st
-import pandas as pd
 import os
-import tempfile
-import cv2
-import numpy as np
-import pytesseract
-from PIL import Image
-import pdfplumber
-import re
+import sqlite3
 from datetime import datetime
-import uuid
-import io
-import sys
-import platform
-import subprocess
+from adaptive_ocr import REVIEW_CONFIDENCE
+from archive_ingest import archive_kind, expand_archives
+from extraction import (
+    detect_tesseract,
+    ocr_backend_name,
+    invoice_columns,
+    read_head,
+)
+from extraction_cache import ExtractionCache
+from batch_extraction import BatchExtractor
+from exporters import EXPORT_FORMATS, export_to_file
+from invoice_store import DEFAULT_PAGE_SIZE, InvoiceStore
+from invoice_table import InvoiceTable
+from tracing import TraceCollector
+from vendor_templates import learn_from_source
 
 # Set page configuration
 st.set_page_config(
@@ -22,75 +25,22 @@ st.set_page_config(
    # layout="wide"
 )
 
-# Check if tesseract is installed and configure it
-def check_tesseract():
-    try:
-        # Try to get tesseract version
-        pytesseract.get_tesseract_version()
-        return True
-    except Exception as e:
-        return False
-
-# Configure tesseract path based on platform
-def configure_tesseract():
-    system = platform.system()
-    try:
-        if system == 'Windows':
-            # Common Windows Tesseract install paths
-            windows_paths = [
-                r'C:\Program Files\Tesseract-OCR\tesseract.exe',
-                r'C:\Program Files (x86)\Tesseract-OCR\tesseract.exe'
-            ]
-            for path in windows_paths:
-                if os.path.exists(path):
-                    pytesseract.pytesseract.tesseract_cmd ='usr/bin/tesseract'
-                    return True
-        elif system == 'Linux':
-            # Check if tesseract is in PATH on Linux
-            try:
-                subprocess.run(['tesseract', '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                return True
-            except:
-                # Try common Linux paths
-                linux_paths = [
-                    '/usr/bin/tesseract',
-                    '/usr/local/bin/tesseract'
-                ]
-                for path in linux_paths:
-                    if os.path.exists(path):
-                        pytesseract.pytesseract.tesseract_cmd ='usr/bin/tesseract'
-                        return True
-        elif system == 'Darwin':  # macOS
-            # Check common macOS paths
-            mac_paths = [
-                '/usr/local/bin/tesseract',
-                '/opt/homebrew/bin/tesseract'
-            ]
-            for path in mac_paths:
-                if os.path.exists(path):
-                    pytesseract.pytesseract.tesseract_cmd ='usr/bin/tesseract'
-                    return True
-        
-        # Could not configure tesseract automatically
-        return False
-    except Exception as e:
-        st.error(f"Error configuring Tesseract: {e}")
-        return False
-
 # App title and description
 st.title("Invoice Data Extractor")
-st.markdown("Upload PDF or image invoices to extract data and export to Excel")
+st.markdown("Upload PDF or image invoices to extract data and export to Excel, CSV or Parquet")
 
-# Check if tesseract is available
-tesseract_available = check_tesseract()
-if not tesseract_available:
-    tesseract_available = configure_tesseract()
+# Check if tesseract is available; done once per server process rather than on every rerun
+@st.cache_resource
+def get_tesseract_status():
+    return detect_tesseract(), ocr_backend_name()
+
+tesseract_available, ocr_backend = get_tesseract_status()
 
 if not tesseract_available:
     st.warning("""
     ⚠️ Tesseract OCR is not available or properly configured.
     
-    Image-based extraction will use simple text detection without OCR.
+    Images can't be read without OCR and are reported as errors.
     For best results, please install Tesseract OCR:
     
     - On Windows: Download and install from https://github.com/UB-Mannheim/tesseract/wiki
@@ -101,215 +51,236 @@ if not tesseract_available:
     PDF extraction will still work.
     """)
 
-# Define columns for the fields we want to extract
-invoice_columns = [
-    "Invoice Number", 
-    "Invoice Date", 
-    "Due Date", 
-    "Vendor Name", 
-    "Total Amount", 
-    "Tax Amount",
-    "Currency",
-    "Invoice Items",
-    "Source File"
-]
-
 # Initialize the dataframe to store extracted data if it doesn't exist in session state
 if 'extracted_data' not in st.session_state:
-    st.session_state.extracted_data = pd.DataFrame(columns=invoice_columns)
+    st.session_state.extracted_data = InvoiceTable(invoice_columns)
 
-# Function to extract text from PDF files
-def extract_text_from_pdf(file):
-    text = ""
-    try:
-        with pdfplumber.open(file) as pdf:
-            for page in pdf.pages:
-                text += page.extract_text() + "\n"
-    except Exception as e:
-        st.error(f"Error extracting text from PDF: {e}")
-    return text
+# Uploads already added to the table, so reruns don't append duplicate rows
+if 'processed_files' not in st.session_state:
+    st.session_state.processed_files = set()
+
+# Upload each extracted file came from, so a confirmed row can teach its vendor's layout
+if 'source_uploads' not in st.session_state:
+    st.session_state.source_uploads = {}
+
+# Rows confirmed in the results grid, whose vendor layouts have been learned
+if 'confirmed_rows' not in st.session_state:
+    st.session_state.confirmed_rows = set()
+
+# SHA-256 of the file behind each table row, so corrections made in the grid reach the invoice store
+if 'row_hashes' not in st.session_state:
+    st.session_state.row_hashes = []
+
+# Stage timings of the files this session extracted, for the performance panel
+if 'traces' not in st.session_state:
+    st.session_state.traces = TraceCollector()
 
-# Function to extract text from image files with fallback
-def extract_text_from_image(file):
+# Shared extraction cache, kept for the lifetime of the server process
+@st.cache_resource
+def get_extraction_cache():
+    return ExtractionCache()
+
+# Results of every session, kept on disk across restarts; None if the database can't be opened
+@st.cache_resource
+def get_invoice_store():
     try:
-        # Read the image
-        image = Image.open(file)
-        
-        # If tesseract is available, use it with preprocessing
-        if tesseract_available:
-            # Convert to OpenCV format
-            img_cv = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-            
-            # Preprocessing for better OCR results
-            gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-            thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
-            
-            # Extract text using pytesseract
-            text = pytesseract.image_to_string(thresh)
-            return text
-        else:
-            # Fallback method without Tesseract
-            # Use a simple method to extract text
-            st.info("Using fallback method for image text extraction. Results may be limited.")
-            
-            # Try using PIL's built-in image to string (very limited)
-            # This is just a placeholder - without Tesseract OCR, image text extraction will be poor
-            try:
-                # Convert to grayscale for simpler processing
-                img_gray = image.convert('L')
-                # Return a message about the limitation
-                return "[Image text extraction requires Tesseract OCR. Install Tesseract for better results.]"
-            except Exception as e:
-                st.error(f"Error in fallback image processing: {e}")
-                return ""
-    except Exception as e:
-        st.error(f"Error extracting text from image: {e}")
-        return ""
+        return InvoiceStore()
+    except (OSError, sqlite3.Error):
+        return None
 
-# Function to extract invoice details using regex patterns
-def extract_invoice_details(text, filename):
-    details = {}
-    
-    # Initialize default values
-    for col in invoice_columns:
-        details[col] = ""
-    
-    # Set the source filename
-    details["Source File"] = filename
-    
-    # Extract invoice number (various formats)
-    invoice_num_patterns = [
-        r'(?i)Invoice\s*(?:#|No|Number|Num)[:.\s]*([A-Z0-9\-_]+)',
-        r'(?i)Invoice\s*ID[:.\s]*([A-Z0-9\-_]+)',
-        r'(?i)Invoice[:.\s]*([A-Z0-9\-_]+)',
-    ]
-    
-    for pattern in invoice_num_patterns:
-        match = re.search(pattern, text)
-        if match:
-            details["Invoice Number"] = match.group(1).strip()
-            break
-    
-    # Extract invoice date
-    date_patterns = [
-        r'(?i)Invoice\s*Date[:.\s]*(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
-        r'(?i)Date[:.\s]*(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
-        r'(?i)Date\s*Issued[:.\s]*(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
-        r'(?i)Issued\s*Date[:.\s]*(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
-    ]
-    
-    for pattern in date_patterns:
-        match = re.search(pattern, text)
-        if match:
-            details["Invoice Date"] = match.group(1).strip()
-            break
-    
-    # Extract due date
-    due_date_patterns = [
-        r'(?i)Due\s*Date[:.\s]*(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
-        r'(?i)Payment\s*Due[:.\s]*(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
-    ]
-    
-    for pattern in due_date_patterns:
-        match = re.search(pattern, text)
-        if match:
-            details["Due Date"] = match.group(1).strip()
-            break
-    
-    # Extract vendor name
-    vendor_patterns = [
-        r'(?i)Vendor\s*Name[:.\s]*([A-Za-z0-9\s\.,&\-\']+)(?=\n)',
-        r'(?i)Supplier[:.\s]*([A-Za-z0-9\s\.,&\-\']+)(?=\n)',
-        r'(?i)From[:.\s]*([A-Za-z0-9\s\.,&\-\']+)(?=\n)',
-        r'(?i)Seller[:.\s]*([A-Za-z0-9\s\.,&\-\']+)(?=\n)',
-    ]
-    
-    for pattern in vendor_patterns:
-        match = re.search(pattern, text)
-        if match:
-            details["Vendor Name"] = match.group(1).strip()
-            break
-    
-    # If no vendor name found, try to find it from the top of the invoice
-    if not details["Vendor Name"]:
-        lines = text.split('\n')
-        for i in range(min(5, len(lines))):  # Check first 5 lines
-            if lines[i] and not any(keyword in lines[i].lower() for keyword in ['invoice', 'bill', 'receipt', 'statement']):
-                details["Vendor Name"] = lines[i].strip()
-                break
-    
-    # Extract total amount
-    total_patterns = [
-        r'(?i)Total(?:\s*Amount)?[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
-        r'(?i)Amount\s*Due[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
-        r'(?i)Grand\s*Total[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
-        r'(?i)Balance\s*Due[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
-    ]
-    
-    for pattern in total_patterns:
-        match = re.search(pattern, text)
-        if match:
-            details["Total Amount"] = match.group(1).strip()
-            break
-    
-    # Extract tax amount
-    tax_patterns = [
-        r'(?i)Tax(?:\s*Amount)?[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
-        r'(?i)VAT[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
-        r'(?i)GST[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
-        r'(?i)Sales\s*Tax[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
-    ]
-    
-    for pattern in tax_patterns:
-        match = re.search(pattern, text)
-        if match:
-            details["Tax Amount"] = match.group(1).strip()
-            break
-    
-    # Extract currency
-    currency_patterns = [
-        r'(?i)Currency[:.\s]*([A-Z]{3})',
-        r'[\$\€\£\¥]',  # Currency symbols
-    ]
-    
-    for pattern in currency_patterns:
-        match = re.search(pattern, text)
-        if match:
-            if match.group(0) == '$':
-                details["Currency"] = 'USD'
-            elif match.group(0) == '€':
-                details["Currency"] = 'EUR'
-            elif match.group(0) == '£':
-                details["Currency"] = 'GBP'
-            elif match.group(0) == '¥':
-                details["Currency"] = 'JPY'
-            else:
-                details["Currency"] = match.group(1).strip()
-            break
-    
-    # Try to extract items
-    # Look for patterns that might indicate item tables in invoices
-    items_text = ""
-    items_patterns = [
-        r'(?i)Item\s*Description(.*?)(?:Total|Balance|Due)',
-        r'(?i)Description\s*Quantity\s*Rate(.*?)(?:Total|Balance|Due)',
-        r'(?i)Product\s*Description(.*?)(?:Total|Balance|Due)',
-    ]
-    
-    for pattern in items_patterns:
-        match = re.search(pattern, text, re.DOTALL)
-        if match:
-            items_text = match.group(1).strip()
-            break
-    
-    # Simplify items text - just grab a few lines
-    if items_text:
-        items_lines = items_text.split('\n')
-        items_text = '\n'.join(items_lines[:min(5, len(items_lines))])
-        
-    details["Invoice Items"] = items_text
-    
-    return details
+# Worker pool shared by all sessions; rebuilt only when the worker count changes.
+# Results are saved to the invoice store as they come in.
+@st.cache_resource
+def get_batch_extractor(max_workers, ocr_regions=False, profile=False, dedup=False, templates=False):
+    store = get_invoice_store()
+    return BatchExtractor(max_workers=max_workers, task_timeout=300, cache=get_extraction_cache(),
+                          ocr_regions=ocr_regions, profile=profile, store=store,
+                          dedup=dedup and store is not None, templates=templates and store is not None)
+
+# Bytes of an extracted file, from its upload or the archive it was a member of; None once it's gone
+def source_bytes(uploaded_files, name):
+    upload_id = st.session_state.source_uploads.get(name)
+    for uploaded_file in uploaded_files or []:
+        if (getattr(uploaded_file, "file_id", None) or uploaded_file.name) != upload_id:
+            continue
+        if uploaded_file.name == name:
+            return uploaded_file.getvalue()
+        for member_name, member in expand_archives([(uploaded_file.name, uploaded_file)]):
+            if member_name == name:
+                return member.read()
+    return None
+
+# Learn the vendor layout template of a row the user has just confirmed
+def learn_vendor_template(store, uploaded_files, details):
+    name = details["Source File"]
+    source = source_bytes(uploaded_files, name)
+    if source is None:
+        st.info(f"No vendor template learned: {name} is no longer uploaded")
+        return
+    with st.spinner(f"Learning the layout of {details['Vendor Name'] or name}..."):
+        try:
+            learn_from_source(store, name, source, details)
+        except ValueError as e:
+            st.info(f"No vendor template learned from {name}: {e}")
+            return
+    st.success(f"Learned the layout of {details['Vendor Name']}: its next scans are read from the same boxes")
+
+# Say which earlier invoice a result duplicates, if any
+def show_duplicate(result):
+    duplicate = result.metadata.get("duplicate_of")
+    if duplicate is None:
+        return
+    reason = {"exact": "is the same file as", "fields": "has the same vendor, number and total as"}
+    st.warning(f"{result.name} {reason[duplicate['match']]} {duplicate['file']}")
+
+# Point out results whose OCR was unsure, so their fields get checked
+def show_low_confidence(result):
+    confidence = result.metadata.get("ocr_confidence")
+    if confidence is not None and confidence < REVIEW_CONFIDENCE:
+        st.info(f"{result.name}: low OCR confidence ({confidence:.0f}/100), please check the extracted fields")
+
+# Point out results whose line items don't add up to the extracted total
+def show_unbalanced_items(result):
+    items_check = result.metadata.get("line_items")
+    if items_check is not None and items_check["balanced"] is False:
+        st.info(f"{result.name}: the line items add up to {items_check['sum']:.2f}, "
+                f"not the total {result.details.get('Total Amount')}")
+
+# Write cells corrected in the grid to the stored invoices, so searches and duplicate checks see them
+def save_corrections(store, applied):
+    corrected = {}
+    for edit in applied:
+        corrected.setdefault(edit["Row"], {})[edit["Column"]] = edit["New"]
+    for index, values in corrected.items():
+        file_hash = st.session_state.row_hashes[index]
+        if file_hash is not None:
+            store.update_fields(file_hash, values)
+
+# The session's results, filtered, sorted and paged here so only the page on screen goes to the browser.
+# Cells are edited in place and only the ones that changed are written back, each logged
+def show_results_grid(table, store, uploaded_files, use_templates):
+    filter_col, sort_col, order_col = st.columns([2, 2, 1])
+    text = filter_col.text_input("Filter rows", help="Rows containing this text in any column")
+    sort_labels = {"Order added": None, **{col: col for col in invoice_columns}}
+    sort_by = sort_labels[sort_col.selectbox("Sort rows by", list(sort_labels))]
+    descending = order_col.checkbox("Descending")
+    rows = table.view(text, sort_by, descending)
+    size_col, page_col = st.columns(2)
+    page_size = size_col.selectbox("Rows per page", [25, DEFAULT_PAGE_SIZE, 100, 250], index=1, key="grid_page_size")
+    pages = max(1, -(-len(rows) // page_size))
+    # Keyed by the page count, so it starts over at page 1 when that changes
+    page = page_col.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1,
+                                 key=f"grid_page_{pages}")
+    window = rows[(page - 1) * page_size:page * page_size]
+    st.caption(f"{len(rows)} of {len(table)} rows match")
+
+    frame = table.window(window)
+    column_config = {}
+    for col, dtype in table.dtypes.items():
+        if dtype == "datetime64[ns]":
+            column_config[col] = st.column_config.DateColumn(format="YYYY-MM-DD")
+        elif dtype == "Float64":
+            column_config[col] = st.column_config.NumberColumn(format="%.2f")
+    if use_templates:
+        frame.insert(0, "Confirmed", [index in st.session_state.confirmed_rows for index in window])
+        column_config["Confirmed"] = st.column_config.CheckboxColumn(
+            help="Tick once a row is right to learn its vendor's layout")
+    # A new widget for every page and view, so its edits (kept by position) never land on other rows
+    key = f"results_grid_{table.rows_version}_{text}_{sort_by}_{descending}_{page_size}_{page}"
+    st.data_editor(frame, key=key, disabled=["Source File"], column_config=column_config, use_container_width=True)
+
+    # Every edit made in this widget so far; cells already holding their value are skipped
+    changes = {}
+    confirmed = []
+    for position, values in st.session_state[key]["edited_rows"].items():
+        index = window[int(position)]
+        values = dict(values)
+        if values.pop("Confirmed", False) and index not in st.session_state.confirmed_rows:
+            confirmed.append(index)
+        if values:
+            changes[index] = values
+    applied = table.apply_edits(changes)
+    if applied:
+        if store is not None:
+            save_corrections(store, applied)
+        st.success(f"Updated {len(applied)} cells")
+    for index in confirmed:
+        st.session_state.confirmed_rows.add(index)
+        learn_vendor_template(store, uploaded_files, table.row(index))
+
+    if table.edits:
+        with st.expander(f"Edit log ({len(table.edits)} changes)"):
+            st.dataframe(table.edits[-250:][::-1], hide_index=True)
+
+# Search over the stored invoices; only the page on screen is fetched from the database
+def show_stored_invoices(store):
+    total_stored = store.count()
+    if not total_stored:
+        return
+    st.subheader("Stored Invoices")
+    search_col, vendor_col, number_col = st.columns(3)
+    filters = {
+        "query": search_col.text_input("Search invoice text"),
+        "vendor": vendor_col.text_input("Vendor starts with"),
+        "invoice_number": number_col.text_input("Invoice number starts with"),
+    }
+    if st.checkbox(f"Only invoices with OCR confidence below {REVIEW_CONFIDENCE}"):
+        filters["max_confidence"] = REVIEW_CONFIDENCE
+    sort_col, size_col, page_col = st.columns(3)
+    sort_labels = {"Processed (newest first)": "processed_at", "Invoice date": "invoice_date",
+                   "Due date": "due_date", "Total": "total", "Vendor": "vendor",
+                   "Invoice number": "invoice_number"}
+    order_by = sort_labels[sort_col.selectbox("Sort by", list(sort_labels))]
+    page_size = size_col.selectbox("Rows per page", [25, DEFAULT_PAGE_SIZE, 100, 250], index=1)
+    matching = store.count(**filters)
+    pages = max(1, -(-matching // page_size))
+    page = page_col.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1)
+    rows = store.search(limit=page_size, offset=(page - 1) * page_size, order_by=order_by,
+                        descending=order_by == "processed_at", **filters)
+    st.caption(f"{matching} of {total_stored} stored invoices match")
+    st.dataframe(rows, hide_index=True)
+    if rows:
+        labels = {f"{row['Source File']} (#{row['id']})": row["id"] for row in rows}
+        selected = st.selectbox("Show extracted text for", ["", *labels])
+        if selected:
+            record = store.get(labels[selected])
+            if record["line_items"]:
+                st.dataframe(record["line_items"], hide_index=True)
+            st.text(record["raw_text"])
+
+# Sidebar panel with where the time went: per-stage totals, slowest files and exports
+def show_performance_panel(traces):
+    with st.sidebar.expander("Performance"):
+        stages = traces.stage_summary()
+        if not stages:
+            st.caption("Stage timings appear here once files have been extracted.")
+            return
+        st.dataframe(stages, hide_index=True)
+        slowest = [
+            {"file": record["file"], "seconds": round(record["wall"], 2),
+             "slowest stage": max(record["stages"], key=lambda name: record["stages"][name]["wall"], default="")}
+            for record in traces.slowest(5)
+        ]
+        if slowest:
+            st.caption("Slowest files")
+            st.dataframe(slowest, hide_index=True)
+        st.download_button("Prometheus metrics", traces.prometheus_text(), file_name="invoice_metrics.prom",
+                           mime="text/plain")
+        st.download_button("JSONL trace", traces.jsonl_text(), file_name="invoice_trace.jsonl",
+                           mime="application/x-ndjson")
+        for record in traces.profiles():
+            folded = "".join(f"{stack} {count}\n" for stack, count in sorted(record["profile"].items()))
+            st.download_button(f"Profile: {record['file']} ({record['wall']:.1f}s)", folded,
+                               file_name=f"{os.path.basename(record['file'])}.folded", mime="text/plain")
+
+# Delete the session's prepared export file, if any
+def discard_export():
+    export = st.session_state.pop("export", None)
+    if export is not None:
+        try:
+            os.remove(export["path"])
+        except OSError:
+            pass
 
 # Main functionality
 def main():
@@ -318,14 +289,41 @@ def main():
     
     # Display Tesseract status
     if tesseract_available:
-        st.sidebar.success("✅ Tesseract OCR is available")
+        st.sidebar.success(f"✅ Tesseract OCR is available ({ocr_backend} backend)")
     else:
         st.sidebar.warning("⚠️ Tesseract OCR not available")
         st.sidebar.info("PDF extraction will work, but image extraction will be limited.")
     
-    # File uploader
-    uploaded_files = st.file_uploader("Upload Invoice Files (PDF or Image)", 
-                                      type=["pdf", "jpg", "jpeg", "png"], 
+    worker_count = st.sidebar.number_input(
+        "Worker processes", min_value=1, max_value=max(1, os.cpu_count() or 1),
+        value=max(1, os.cpu_count() or 1)
+    )
+    ocr_regions = st.sidebar.checkbox(
+        "Region OCR (faster)", value=False,
+        help="OCR only the header, invoice details and totals blocks; "
+             "pages missing a field are OCR'd in full"
+    )
+    profile = st.sidebar.checkbox(
+        "Profile slowest files", value=False,
+        help="Sample the workers' call stacks and keep flame graph data for the slowest files"
+    )
+    store = get_invoice_store()
+    if store is None:
+        st.sidebar.warning("⚠️ The invoice store could not be opened; results are kept for this session only")
+    dedup = store is not None and st.sidebar.checkbox(
+        "Skip known duplicates", value=True,
+        help="Reuse stored results for files seen before, region-OCR scans that look like a stored page "
+             "and flag invoices with a stored vendor, number and total"
+    )
+    use_templates = store is not None and st.sidebar.checkbox(
+        "Use vendor templates", value=True,
+        help="Read scans laid out like an invoice confirmed in the results grid from the same field boxes "
+             "only; ticking a row's Confirmed box learns its vendor's layout"
+    )
+    
+    # File uploader; archives are read a member at a time
+    uploaded_files = st.file_uploader("Upload Invoice Files (PDF, Image or ZIP/TAR archive)", 
+                                      type=["pdf", "jpg", "jpeg", "png", "zip", "tar", "gz", "tgz", "bz2", "xz"], 
                                       accept_multiple_files=True)
     
     # If files are uploaded
@@ -333,90 +331,145 @@ def main():
         progress_bar = st.progress(0)
         status_text = st.empty()
         
-        # Process each uploaded file
-        for i, uploaded_file in enumerate(uploaded_files):
-            status_text.text(f"Processing {uploaded_file.name}...")
+        # Every widget interaction reruns the script; skip files already in the table
+        pending = []
+        for uploaded_file in uploaded_files:
+            upload_id = getattr(uploaded_file, "file_id", None) or uploaded_file.name
+            if upload_id not in st.session_state.processed_files:
+                pending.append((upload_id, uploaded_file))
+        
+        def update_progress(completed, total):
+            # Unknown while archives are still being read
+            if total is None:
+                status_text.text(f"Processed {completed} files...")
+                return
+            progress_bar.progress(completed / total)
+            status_text.text(f"Processed {completed} of {total} files...")
+        
+        if pending:
+            status_text.text(f"Processing {len(pending)} files...")
+            extractor = get_batch_extractor(worker_count, ocr_regions, profile, dedup, use_templates)
             
-            # Process file directly from memory instead of writing to disk
-            if uploaded_file.name.lower().endswith(('.jpg', '.jpeg', '.png')):
-                extracted_text = extract_text_from_image(uploaded_file)
-            elif uploaded_file.name.lower().endswith('.pdf'):
-                extracted_text = extract_text_from_pdf(uploaded_file)
-            else:
-                st.warning(f"Unsupported file type: {uploaded_file.name}")
-                continue
+            # Upload of each file handed to the extractor, how many of its results are outstanding,
+            # and the uploads read to the end; an archive counts as processed once all its members are
+            upload_ids = []
+            outstanding = {}
+            expanded = set()
+            skipped = []
+            
+            def note_skipped(name, reason):
+                skipped.append({"File": name, "Reason": reason})
+            
+            def upload_files():
+                for upload_id, uploaded_file in pending:
+                    members = expand_archives([(uploaded_file.name, uploaded_file)], on_error=st.error,
+                                              on_skip=note_skipped)
+                    for name, source in members:
+                        upload_ids.append(upload_id)
+                        outstanding[upload_id] = outstanding.get(upload_id, 0) + 1
+                        yield name, source
+                    expanded.add(upload_id)
+            
+            # Plain uploads are listed up front so progress has a total; archives are only counted as they are read
+            files = upload_files()
+            if not any(archive_kind(read_head(uploaded_file, 512)) for _, uploaded_file in pending):
+                files = list(files)
+            
+            # Results arrive in upload order
+            page_strategies = []
+            for result in extractor.run(files, progress=update_progress):
+                upload_id = upload_ids[result.index]
+                st.session_state.source_uploads[result.name] = upload_id
+                for message in result.errors:
+                    st.error(message)
+                show_duplicate(result)
+                show_low_confidence(result)
+                show_unbalanced_items(result)
+                
+                # Add to session state table
+                st.session_state.extracted_data.append(result.details)
+                st.session_state.row_hashes.append(result.digest)
+                outstanding[upload_id] -= 1
+                if upload_id in expanded and not outstanding[upload_id]:
+                    st.session_state.processed_files.add(upload_id)
+                st.session_state.traces.add(result.trace)
+                
+                for page in result.metadata.get("pages", []):
+                    page_strategies.append({"Source File": result.name, **page})
+            
+            # Uploads whose last result came back before they were read to the end, or that held no invoice
+            for upload_id in expanded:
+                if not outstanding.get(upload_id):
+                    st.session_state.processed_files.add(upload_id)
             
-            # Extract invoice details
-            invoice_details = extract_invoice_details(extracted_text, uploaded_file.name)
+            if skipped:
+                with st.expander(f"Skipped {len(skipped)} archive members"):
+                    st.dataframe(skipped)
             
-            # Add to session state dataframe
-            st.session_state.extracted_data = pd.concat([
-                st.session_state.extracted_data,
-                pd.DataFrame([invoice_details])
-            ], ignore_index=True)
+            # The extractor saves results in batched transactions; write the remainder now
+            if store is not None:
+                store.flush()
             
-            # Update progress
-            progress_bar.progress((i + 1) / len(uploaded_files))
+            # Which PDF pages used the text layer and which needed OCR
+            if page_strategies:
+                with st.expander("PDF page extraction"):
+                    st.dataframe(page_strategies)
+            
+            with st.sidebar.expander("Worker throughput"):
+                st.dataframe(extractor.worker_stats())
         
         status_text.text("Processing complete!")
         progress_bar.empty()
     
+    show_performance_panel(st.session_state.traces)
+    
     # Display extracted data
     if not st.session_state.extracted_data.empty:
         st.subheader("Extracted Invoice Data")
-        st.dataframe(st.session_state.extracted_data)
+        show_results_grid(st.session_state.extracted_data, store, uploaded_files, use_templates)
         
-        # Manual editing functionality
-        if st.checkbox("Enable Manual Editing"):
-            st.info("Select a row to edit its details")
-            
-            # Select row to edit
-            row_indices = st.session_state.extracted_data.index.tolist()
-            selected_row = st.selectbox("Select invoice to edit", row_indices)
-            
-            if selected_row is not None:
-                with st.form("edit_form"):
-                    st.subheader(f"Edit Invoice: {st.session_state.extracted_data.loc[selected_row, 'Source File']}")
-                    
-                    edited_data = {}
-                    for col in invoice_columns:
-                        if col != "Source File" and col != "Invoice Items":
-                            edited_data[col] = st.text_input(col, st.session_state.extracted_data.loc[selected_row, col])
-                    
-                    edited_data["Invoice Items"] = st.text_area("Invoice Items", st.session_state.extracted_data.loc[selected_row, "Invoice Items"])
-                    
-                    # Submit button
-                    if st.form_submit_button("Update Invoice Data"):
-                        for col in edited_data:
-                            st.session_state.extracted_data.loc[selected_row, col] = edited_data[col]
-                        st.success("Invoice data updated!")
+        # Export: streamed to a temporary file only when asked for, and reused until the table changes
+        export_labels = {"Excel": "xlsx", "CSV": "csv", "Parquet": "parquet"}
+        export_label = st.selectbox("Export format", list(export_labels))
+        export_format = export_labels[export_label]
+        extension, mime = EXPORT_FORMATS[export_format]
+        export_filename = st.text_input("Export filename", f"invoice_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}{extension}")
+        if not export_filename.endswith(extension):
+            export_filename += extension
         
-        # Export to Excel
-        export_filename = st.text_input("Excel filename", f"invoice_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx")
+        table = st.session_state.extracted_data
+        export = st.session_state.get("export")
+        if export is not None and (export["version"], export["format"]) != (table.version, export_format):
+            discard_export()
+            export = None
         
-        if st.button("Export to Excel"):
-            if not export_filename.endswith('.xlsx'):
-                export_filename += '.xlsx'
-                
-            # Create Excel in memory
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                st.session_state.extracted_data.to_excel(writer, index=False)
-            
-            # Provide download link
-            st.download_button(
-                label="Download Excel File",
-                data=buffer,
-                file_name=export_filename,
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
-            
-            st.success(f"Data exported to {export_filename} successfully!")
+        if export is None and st.button(f"Export to {export_label}"):
+            try:
+                path = export_to_file(export_format, table.iter_rows(), invoice_columns)
+            except ImportError as e:
+                st.error(f"{export_label} export needs the {e.name} package: pip install {e.name}")
+            else:
+                export = st.session_state.export = {"version": table.version, "format": export_format, "path": path}
+                st.success(f"Exported {len(table)} rows to {export_label}")
+        
+        if export is not None:
+            with open(export["path"], "rb") as export_file:
+                st.download_button(
+                    label=f"Download {export_label} File",
+                    data=export_file,
+                    file_name=export_filename,
+                    mime=mime
+                )
         
         # Clear data button
         if st.sidebar.button("Clear All Data"):
-            st.session_state.extracted_data = pd.DataFrame(columns=invoice_columns)
+            st.session_state.extracted_data.clear()
+            st.session_state.row_hashes.clear()
+            st.session_state.confirmed_rows.clear()
             st.rerun()
+    
+    if store is not None:
+        show_stored_invoices(store)
 
 # Run the main function
 if __name__ == "__main__":
@@ -0,0 +1,275 @@
+"""Read invoices out of ZIP and TAR archives without unpacking them.
+
+``expand_archives`` takes the ``(name, source)`` pairs BatchExtractor.run
+accepts and replaces each archive among them with its members, read one at
+a time as the extractor asks for the next file. A member is routed by its
+content (extraction.sniff_kind), not its name: PDFs and PNG/JPEG images are
+passed on as ``("archive.zip/path/in/archive.pdf", file)``; anything else is
+skipped and reported, nested archives included, which are never opened.
+
+Each member is copied into a SpooledTemporaryFile that stays in memory up
+to SPOOL_MEMORY_BYTES and spills to a temporary file beyond it, so memory
+doesn't grow with the archive or its members. The file is closed when the
+next member is read: consume members as they come (BatchExtractor.run
+spools each one before it asks for the next), don't collect them in a list.
+
+Archives are untrusted input. A member whose uncompressed size exceeds
+MAX_MEMBER_BYTES is skipped; an archive with more than MAX_MEMBERS members,
+more than MAX_TOTAL_BYTES uncompressed or a compression ratio above
+MAX_RATIO (a decompression bomb) is rejected where that is found, keeping
+the members already passed on. ZIP entries are checked against their
+declared sizes before anything is decompressed, and the byte counts are
+enforced while reading in case the headers lie. TAR archives are read as a
+stream (``r|*``, gzip, bzip2 or xz), so their ratio is checked on the bytes
+actually decompressed, including members that are only skipped.
+"""
+import itertools
+import logging
+import os
+import tarfile
+import tempfile
+import zipfile
+import zlib
+
+from extraction import SNIFF_BYTES, read_head, sniff_kind
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+MAX_MEMBERS = 10000
+MAX_MEMBER_BYTES = 100 * 1024 * 1024
+MAX_TOTAL_BYTES = 4 * 1024 * 1024 * 1024
+# Uncompressed to compressed; PDFs and images rarely compress even 10:1
+MAX_RATIO = 100
+# Below this much uncompressed data the ratio isn't checked: a few small text files compress well
+RATIO_MIN_BYTES = 1024 * 1024
+
+# Members up to this size stay in memory
+SPOOL_MEMORY_BYTES = 4 * 1024 * 1024
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Stream magic numbers of gzip, bzip2 and xz, which tarfile's r|* reads
+_COMPRESSED_MAGIC = (b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00")
+
+
+def archive_kind(head):
+    """'zip', 'tar' or None from the first bytes of a file.
+
+    Compressed streams count as TAR: that's the only kind read from them.
+    """
+    if head.startswith((b"PK\x03\x04", b"PK\x05\x06")):
+        return "zip"
+    if head.startswith(_COMPRESSED_MAGIC) or head[257:262] == b"ustar":
+        return "tar"
+    return None
+
+
+def is_archive_name(name):
+    """True for file names with an archive extension (directory walks use this)"""
+    return name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+class _CountingReader:
+    # Counts the compressed bytes tarfile pulls from the source
+    def __init__(self, raw):
+        self.raw = raw
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.count += len(data)
+        return data
+
+
+class _Budget:
+    """Uncompressed bytes and members read from one archive, against its limits"""
+
+    def __init__(self, name, max_members, max_total, max_ratio):
+        self.name = name
+        self.max_members = max_members
+        self.max_total = max_total
+        self.max_ratio = max_ratio
+        self.members = 0
+        self.total = 0
+
+    def member(self):
+        self.members += 1
+        if self.members > self.max_members:
+            raise ValueError(f"{self.name} has more than {self.max_members} members")
+
+    def spend(self, size, compressed):
+        """Count ``size`` more bytes read, ``compressed`` bytes having been taken from the archive so far"""
+        self.check(self.total + size, compressed)
+
+    def check(self, total, compressed):
+        self.total = total
+        if total > self.max_total:
+            raise ValueError(f"{self.name} holds more than {self.max_total // 2 ** 20} MB uncompressed")
+        if total > RATIO_MIN_BYTES and total > self.max_ratio * max(compressed, 1):
+            raise ValueError(f"{self.name} expands more than {self.max_ratio}:1; not reading a decompression bomb")
+
+
+def _read_member(head, stream, limit, budget, compressed):
+    """The member (``head``, then the rest of ``stream``) in a SpooledTemporaryFile.
+
+    None when it runs past ``limit``, or always when ``limit`` is None; the
+    member is read to its end either way so the budget sees every byte.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES) if limit is not None else None
+    size = 0
+    for chunk in itertools.chain((head,), iter(lambda: stream.read(_CHUNK_SIZE), b"")):
+        size += len(chunk)
+        budget.spend(len(chunk), compressed())
+        if spool is None:
+            continue
+        if size > limit:
+            spool.close()
+            spool = None
+        else:
+            spool.write(chunk)
+    if spool is not None:
+        spool.seek(0)
+    return spool
+
+
+def _skip_reason(head):
+    if archive_kind(head) is not None:
+        return "nested archive"
+    if sniff_kind(head) is None:
+        return "not a PDF or image"
+    return None
+
+
+def _too_large(limit):
+    return f"larger than {limit // 2 ** 20} MB"
+
+
+def _zip_members(name, source, limits, on_skip):
+    budget = _Budget(name, limits["max_members"], limits["max_total"], limits["max_ratio"])
+    with zipfile.ZipFile(source) as archive:
+        infos = [info for info in archive.infolist() if not info.is_dir()]
+        # Declared sizes first, so a bomb is turned away before anything is inflated. Entries
+        # sharing one compressed block (overlapping-file bombs) add up to a huge declared size too
+        budget.check(sum(info.file_size for info in infos), sum(info.compress_size for info in infos))
+        # Counted again, as actually read, member by member
+        budget.total = 0
+
+        compressed = 0
+        for info in infos:
+            budget.member()
+            member_name = f"{name}/{info.filename}"
+            if info.flag_bits & 0x1:
+                on_skip(member_name, "encrypted")
+                continue
+            if info.file_size > limits["max_member"]:
+                on_skip(member_name, _too_large(limits["max_member"]))
+                continue
+            compressed += info.compress_size
+            with archive.open(info) as stream:
+                head = stream.read(SNIFF_BYTES)
+                reason = _skip_reason(head)
+                if reason is not None:
+                    on_skip(member_name, reason)
+                    continue
+                member = _read_member(head, stream, limits["max_member"], budget, lambda: compressed)
+            if member is None:
+                on_skip(member_name, _too_large(limits["max_member"]))
+                continue
+            try:
+                yield member_name, member
+            finally:
+                member.close()
+
+
+def _tar_members(name, source, limits, on_skip):
+    budget = _Budget(name, limits["max_members"], limits["max_total"], limits["max_ratio"])
+    is_path = isinstance(source, (str, os.PathLike))
+    raw = open(source, "rb") if is_path else source
+    try:
+        if not is_path:
+            raw.seek(0)
+        counter = _CountingReader(raw)
+        with tarfile.open(fileobj=counter, mode="r|*") as archive:
+            for info in archive:
+                # Stream mode keeps every header it has read; nothing here goes back to them
+                archive.members = []
+                budget.member()
+                if not info.isfile():
+                    continue
+                member_name = f"{name}/{info.name}"
+                stream = archive.extractfile(info)
+                head = stream.read(SNIFF_BYTES)
+                reason = _skip_reason(head)
+                if reason is None and info.size > limits["max_member"]:
+                    reason = _too_large(limits["max_member"])
+                # A stream can't seek: skipped members are read through too, and counted
+                limit = limits["max_member"] if reason is None else None
+                member = _read_member(head, stream, limit, budget, lambda: counter.count)
+                if member is None:
+                    on_skip(member_name, reason or _too_large(limits["max_member"]))
+                    continue
+                try:
+                    yield member_name, member
+                finally:
+                    member.close()
+    finally:
+        if is_path:
+            raw.close()
+
+
+def iter_archive(name, source, on_skip=None, max_members=MAX_MEMBERS, max_member_bytes=MAX_MEMBER_BYTES,
+                 max_total_bytes=MAX_TOTAL_BYTES, max_ratio=MAX_RATIO):
+    """Yield ``(member name, file)`` for the PDFs and images in a ZIP or TAR archive.
+
+    ``source`` is a path or a seekable binary file object (bytes are wrapped).
+    Each file is closed once the next member is asked for. ``on_skip(name,
+    reason)`` hears about members that aren't passed on (logged otherwise).
+    Raises ValueError when the archive breaks a limit or can't be read; the
+    members already yielded stand.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        import io
+
+        source = io.BytesIO(source)
+    if on_skip is None:
+        def on_skip(member_name, reason):
+            logger.info("Skipped %s: %s", member_name, reason)
+    limits = {"max_members": max_members, "max_member": max_member_bytes, "max_total": max_total_bytes,
+              "max_ratio": max_ratio}
+    kind = archive_kind(read_head(source, 512))
+    if kind is None:
+        raise ValueError(f"{name} is not a ZIP or TAR archive")
+    members = _zip_members if kind == "zip" else _tar_members
+    try:
+        yield from members(name, source, limits, on_skip)
+    except (zipfile.BadZipFile, tarfile.TarError, zlib.error, EOFError, OSError) as e:
+        raise ValueError(f"Cannot read archive {name}: {e}") from e
+
+
+def expand_archives(files, on_error=None, on_skip=None, **limits):
+    """``files`` with every ZIP or TAR archive among them replaced by its invoices.
+
+    ``files`` is an iterable of ``(name, source)`` pairs as BatchExtractor.run
+    takes them; other files pass through untouched, and everything stays lazy.
+    An archive that is rejected or unreadable is reported through
+    ``on_error(message)`` (logged otherwise) and the next file follows.
+    ``limits`` are iter_archive's ``max_*`` keywords.
+    """
+    for name, source in files:
+        try:
+            kind = archive_kind(read_head(source, 512))
+        except OSError:
+            # Let the extractor report the unreadable file
+            kind = None
+        if kind is None:
+            yield name, source
+            continue
+        try:
+            yield from iter_archive(name, source, on_skip=on_skip, **limits)
+        except ValueError as e:
+            if on_error is not None:
+                on_error(str(e))
+            else:
+                logger.error(str(e))
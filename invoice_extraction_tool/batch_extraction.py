@@ -0,0 +1,752 @@
+"""Parallel batch extraction over a process pool.
+
+Files are split into tasks (one per image, one per range of PDF pages) and
+spread over worker processes. Sources that aren't already files on disk are
+spooled to a temporary directory, so workers open them by path instead of
+receiving pickled bytes. The number of tasks in flight is bounded, results
+are yielded in the order the files were submitted, and a long PDF stops
+submitting page tasks once its leading pages have settled every field.
+
+With an InvoiceStore, results are saved to it as they are yielded, and
+``dedup`` checks each file against it first (see dedup.py): files whose
+bytes are already stored reuse the stored result, pages that look like a
+stored page get a hashing task and then only region OCR, and results with a
+stored (vendor, invoice number, total) are flagged with ``duplicate_of``.
+
+``templates`` loads the store's vendor layout templates (vendor_templates.py)
+into an index. Every file then gets the same first-page task, which also
+fingerprints the page's layout; a file whose layout matches templates has
+its first page read from the field boxes of the first one whose fields
+they read back as, and falls back to full OCR in the worker otherwise.
+
+Each result also carries the file's line items (line_items.py), and its
+metadata says whether their amounts add up to the extracted total.
+"""
+import os
+import shutil
+import tempfile
+import time
+import multiprocessing
+import threading
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from batch_scheduler import (
+    TaskCancelled,
+    TaskScheduler,
+    default_memory_budget,
+    file_profile,
+    init_worker,
+    running_task,
+    task_features,
+)
+from dedup import match_key, normalized_page, page_hashes
+from extraction import (
+    DEFAULT_PDF_OCR_DPI,
+    detect_tesseract,
+    extract_invoice_details,
+    extract_image_page,
+    extract_pdf_pages,
+    extraction_settings,
+    invoice_columns,
+    pdf_layout,
+    source_kind,
+)
+from extraction_cache import cache_key, file_digest
+from field_extractor import get_field_extractor
+from line_items import check_total
+from preprocessing import get_preprocessor
+from tracing import FileTrace, stage, trace_file, use_trace
+from vendor_templates import TemplateIndex, layout_fingerprint
+
+DEFAULT_PAGES_PER_TASK = 4
+# Files read ahead of the oldest one not yet yielded, for the scheduler to choose from
+DEFAULT_LOOKAHEAD = 64
+
+# How often a run wakes up to look for timed out tasks and cancellation
+_TIMEOUT_POLL_SECONDS = 0.5
+
+_SPOOL_CHUNK_SIZE = 1024 * 1024
+
+
+class BatchResult:
+    """Outcome of extracting one file"""
+
+    def __init__(self, index, name, details, errors=None, cached=False, elapsed=0.0, metadata=None, trace=None,
+                 text="", digest=None, image_hash=None, items=None, key=None):
+        self.index = index
+        self.name = name
+        self.details = details
+        # Text the fields were parsed from (PDF text layer and/or OCR output)
+        self.text = text
+        # SHA-256 of the file contents; None when the file couldn't be read
+        self.digest = digest
+        # extraction_cache.cache_key of the file and the settings it was extracted with
+        self.key = key
+        # (dhash, phash) of the first page when deduplicating scans; see dedup.image_hashes
+        self.image_hash = image_hash
+        # Line items of every page: [{"description", "quantity", "unit_price", "amount"}, ...]
+        self.items = items or []
+        self.errors = errors or []
+        # e.g. {"pages": [{"page": 1, "strategy": "text"}, ...]} for PDFs, "ocr_confidence" (0-100, that
+        # of the least confident OCR'd page), "line_items" ({"count", "sum", "balanced"}, see
+        # line_items.check_total) and {"duplicate_of": {"file": ..., "file_hash": ..., "match": "exact" or "fields"}}
+        self.metadata = metadata or {}
+        self.cached = cached
+        self.elapsed = elapsed
+        # Per-stage timings (tracing.FileTrace.to_dict()); not cached with the result
+        self.trace = trace
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __repr__(self):
+        return f"BatchResult({self.index}, {self.name!r}, cached={self.cached}, errors={self.errors!r})"
+
+
+# Copy bytes or a binary file object into ``directory`` without holding a second copy in memory
+def _spool(source, directory, name):
+    fd, path = tempfile.mkstemp(dir=directory, suffix=os.path.splitext(name)[1])
+    with os.fdopen(fd, "wb") as f:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            f.write(source)
+        else:
+            source.seek(0)
+            shutil.copyfileobj(source, f, _SPOOL_CHUNK_SIZE)
+    return path
+
+
+# Runs once in each worker process
+def _init_worker(table=None):
+    init_worker(table)
+    detect_tesseract()
+
+
+# Runs in a worker process: extract text for one image or one range of PDF pages
+def _run_task(task_id, kind, path, start, stop, pdf_ocr_dpi=DEFAULT_PDF_OCR_DPI, ocr_regions=False,
+              preprocessing=None, profile=False, templates=None):
+    with running_task(task_id), trace_file(path, profile=profile) as trace:
+        outcome = _extract_task(kind, path, start, stop, pdf_ocr_dpi, ocr_regions, preprocessing, templates)
+    outcome["trace"] = trace.to_dict()
+    return outcome
+
+
+# Runs in a worker process: image hashes and/or layout fingerprint of a file's first page,
+# ahead of its OCR tasks
+def _hash_task(task_id, kind, path, profile=False, hashes=True, fingerprint=False):
+    outcome = {"hashes": None, "fingerprint": None}
+    with running_task(task_id), trace_file(path, profile=profile) as trace:
+        with stage("image_hash"):
+            page = normalized_page(path, kind)
+            if page is not None and hashes:
+                outcome["hashes"] = page_hashes(page[0])
+        if page is not None and fingerprint:
+            with stage("layout_fingerprint"):
+                outcome["fingerprint"] = layout_fingerprint(page[1])
+    outcome["trace"] = trace.to_dict()
+    return outcome
+
+
+def _extract_task(kind, path, start, stop, pdf_ocr_dpi, ocr_regions, preprocessing, templates=None):
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    errors = []
+    strategies = []
+    if kind == "image":
+        record = extract_image_page(path, on_error=errors.append, ocr_regions=ocr_regions, ocr_workers=1,
+                                    preprocessing=preprocessing, templates=templates)
+        page_records = [record]
+        text = record["text"]
+        confidences = [record.get("confidence")]
+        items = record["items"]
+        pages = 1
+    else:
+        # Pages are already spread over processes, so OCR them on this one
+        page_records = extract_pdf_pages(path, start, stop, dpi=pdf_ocr_dpi,
+                                         ocr_workers=1, on_error=errors.append, ocr_regions=ocr_regions,
+                                         preprocessing=preprocessing, templates=templates)
+        text = "".join(record["text"] + "\n" for record in page_records)
+        strategies = [{"page": record["page"], "strategy": record["strategy"]} for record in page_records]
+        for entry, record in zip(strategies, page_records):
+            if record.get("confidence") is not None:
+                entry["confidence"] = round(record["confidence"], 1)
+        confidences = [record.get("confidence") for record in page_records]
+        items = [item for record in page_records for item in record["items"]]
+        pages = len(page_records)
+    return {
+        "pid": os.getpid(),
+        "text": text,
+        "errors": errors,
+        "pages": pages,
+        "strategies": strategies,
+        "confidences": [confidence for confidence in confidences if confidence is not None],
+        "items": items,
+        # Position of the vendor template that read the first page, and the fields read from its boxes
+        "template": next((record["template"] for record in page_records if "template" in record), None),
+        "fields": next((record["fields"] for record in page_records if record.get("fields")), None),
+        "elapsed": time.perf_counter() - started,
+        "cpu": time.process_time() - cpu_started,
+    }
+
+
+class _FileState:
+    def __init__(self, index, name, key, task_count, path=None, spooled=False, digest=None, ocr_regions=False):
+        self.index = index
+        self.name = name
+        self.key = key
+        self.path = path
+        self.spooled = spooled
+        self.digest = digest
+        self.ocr_regions = ocr_regions
+        # What its tasks are costed from (batch_scheduler.file_profile), its place in the scheduler's
+        # queue, its ScheduledTasks and when the first of them started running (time.time())
+        self.profile = None
+        self.priority = 0.0
+        self.scheduled = []
+        self.first_started = None
+        # Tasks held back until the image hash has been looked up, and what it matched
+        self.tasks = []
+        self.image_hash = None
+        self.similar = None
+        # [(template, distance), ...] the first page's layout matched (TemplateIndex.match), the
+        # position of the one that read it and the fields read through it
+        self.templates = []
+        self.template = None
+        self.fields = {}
+        self.pieces = [""] * task_count
+        self.strategies = [[] for _ in range(task_count)]
+        self.confidences = [[] for _ in range(task_count)]
+        self.items = [[] for _ in range(task_count)]
+        self.done = [False] * task_count
+        self.remaining = task_count
+        # Leading pieces that have all come back, and when to next test them for settledness
+        self.prefix = 0
+        self.next_check = 2
+        self.finished = False
+        self.errors = []
+        self.trace = FileTrace(name)
+        self.started = time.perf_counter()
+
+    def advance_prefix(self):
+        """Extend the run of finished leading pieces; True if it grew"""
+        before = self.prefix
+        while self.prefix < len(self.done) and self.done[self.prefix]:
+            self.prefix += 1
+        return self.prefix > before
+
+
+class BatchExtractor:
+    """Extract many invoices in parallel.
+
+    ``max_workers`` sizes the process pool (defaults to the CPU count),
+    ``max_in_flight`` bounds how many tasks are handed to it at once across
+    all runs (one more than the worker count by default), ``task_timeout``
+    is the number of seconds a single task may run, and ``file_timeout``
+    those all of a file's tasks may take from the first one's start, before
+    they are stopped and the file reported as failed. PDFs are split into
+    tasks of ``pages_per_task`` pages. Tasks are costed and ordered by a
+    batch_scheduler.TaskScheduler. ``memory_budget`` caps the estimated
+    memory of the tasks in flight, in bytes. It defaults to half the physical
+    memory; 0 means no cap. ``cost_model`` is a batch_scheduler.CostModel,
+    ``schedule_log`` a JSONL file every scheduling decision is appended to,
+    and ``lookahead`` how many files a run reads ahead to pick the cheapest
+    from. Scanned PDF pages are OCR'd at ``pdf_ocr_dpi``,
+    and ``ocr_regions`` OCRs only the header, meta and totals blocks of a page.
+    ``preprocessing`` holds Preprocessor options (target_dpi, deskew, denoise).
+    When a ``cache`` is given, files whose content hash is already cached skip
+    the pool entirely. In-memory sources are spooled under ``spool_dir``
+    (the system temp directory by default). Every result carries a per-stage
+    trace; ``profile`` also samples the workers' stacks into it. Results are
+    saved to ``store`` (an InvoiceStore) if given, ``dedup`` checks files
+    against it for duplicates first and ``templates`` reads pages matching
+    one of its vendor templates from their field boxes.
+    """
+
+    def __init__(self, max_workers=None, max_in_flight=None, task_timeout=None,
+                 pages_per_task=DEFAULT_PAGES_PER_TASK, cache=None, mp_context="spawn",
+                 pdf_ocr_dpi=DEFAULT_PDF_OCR_DPI, spool_dir=None, ocr_regions=False, preprocessing=None,
+                 profile=False, store=None, dedup=False, templates=False, file_timeout=None, memory_budget=None,
+                 cost_model=None, schedule_log=None, lookahead=None):
+        if dedup and store is None:
+            raise ValueError("dedup needs an invoice store to look duplicates up in")
+        if templates and store is None:
+            raise ValueError("templates need an invoice store to load them from")
+        self.max_workers = max_workers or os.cpu_count() or 1
+        # Just enough to keep every worker busy, so the scheduler rather than the pool's queue picks what runs next
+        self.max_in_flight = max_in_flight or self.max_workers + 1
+        self.task_timeout = task_timeout
+        self.file_timeout = file_timeout
+        self.lookahead = lookahead or max(DEFAULT_LOOKAHEAD, self.max_in_flight * 4)
+        self.memory_budget = default_memory_budget() if memory_budget is None else (memory_budget or None)
+        self.pages_per_task = max(1, pages_per_task)
+        self.cache = cache
+        self.mp_context = mp_context
+        self.pdf_ocr_dpi = pdf_ocr_dpi
+        self.ocr_regions = ocr_regions
+        self.preprocessing = dict(preprocessing or {})
+        self.spool_dir = spool_dir
+        self.profile = profile
+        self.store = store
+        self.dedup = dedup
+        self.templates = templates
+        # (store templates_version, TemplateIndex), reloaded when templates are learned
+        self._template_index = (None, None)
+        self._template_lock = threading.Lock()
+        self._scheduler = TaskScheduler(self.max_in_flight, self.memory_budget, cost_model, schedule_log)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._worker_stats = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_executor(self):
+        # One extractor may serve several Streamlit sessions at once
+        with self._executor_lock:
+            if self._executor is None:
+                context = multiprocessing.get_context(self.mp_context)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=context,
+                    initializer=_init_worker,
+                    initargs=self._scheduler.worker_args(context),
+                )
+            return self._executor
+
+    def _discard_executor(self, broken):
+        # A worker died; the next submission starts a fresh pool
+        with self._executor_lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def close(self, wait_for_tasks=True):
+        """Shut the worker pool down"""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait_for_tasks, cancel_futures=not wait_for_tasks)
+        self._scheduler.close_log()
+
+    def result_key(self, digest):
+        """Cache key of a file's result under this extractor's settings (not region-OCR'd as a near duplicate)"""
+        return cache_key(digest, extraction_settings(pdf_ocr_dpi=self.pdf_ocr_dpi, ocr_regions=self.ocr_regions,
+                                                     preprocessing=self.preprocessing))
+
+    def worker_stats(self):
+        """Per-worker throughput: tasks, pages, busy time and rates"""
+        stats = []
+        for pid, entry in sorted(self._worker_stats.items()):
+            busy = entry["busy_seconds"]
+            stats.append(dict(
+                entry,
+                pid=pid,
+                tasks_per_second=entry["tasks"] / busy if busy else 0.0,
+                pages_per_second=entry["pages"] / busy if busy else 0.0,
+            ))
+        return stats
+
+    def _load_templates(self):
+        if not self.templates:
+            return TemplateIndex()
+        version = self.store.templates_version()
+        with self._template_lock:
+            if self._template_index[0] != version:
+                self._template_index = (version, TemplateIndex(self.store.templates()))
+            return self._template_index[1]
+
+    def _record_worker(self, outcome):
+        entry = self._worker_stats.setdefault(
+            outcome["pid"], {"tasks": 0, "pages": 0, "busy_seconds": 0.0, "cpu_seconds": 0.0}
+        )
+        entry["tasks"] += 1
+        entry["pages"] += outcome["pages"]
+        entry["busy_seconds"] += outcome["elapsed"]
+        entry["cpu_seconds"] += outcome["cpu"]
+
+    def _record_result(self, result):
+        # Runs as results are yielded, so the first copy yielded is the one stored first
+        if self.store is None:
+            return result
+        duplicate = result.metadata.get("duplicate_of")
+        if self.dedup and duplicate is None and result.ok:
+            # An earlier copy in the same run wasn't stored yet when this file was submitted
+            original = self.store.find_by_hash(result.digest, result.key) if result.digest else None
+            match = "exact"
+            if original is None:
+                key = match_key(result.details)
+                original = self.store.find_by_match_key(key, exclude_hash=result.digest) if key else None
+                match = "fields"
+            if original is not None:
+                duplicate = {"file": original["Source File"], "file_hash": original["file_hash"], "match": match}
+                result.metadata = dict(result.metadata, duplicate_of=duplicate)
+        # A byte-identical file is already stored under the same hash
+        if duplicate is None or duplicate["match"] != "exact":
+            self.store.add(result)
+        return result
+
+    def _plan_tasks(self, kind, path):
+        """A file's tasks and, for a PDF, its extraction.pdf_layout (None when unreadable)"""
+        if kind == "image":
+            return [("image", 0, 1)], None
+        try:
+            layout = pdf_layout(path)
+        except Exception:
+            # Let the worker hit (and report) the same error
+            return [("pdf", 0, None)], None
+        page_count = layout["pages"]
+        if page_count == 0:
+            return [("pdf", 0, 0)], layout
+        return [
+            ("pdf", start, min(start + self.pages_per_task, page_count))
+            for start in range(0, page_count, self.pages_per_task)
+        ], layout
+
+    def run(self, files, progress=None, ordered=True, cancel=None):
+        """Extract ``files``, an iterable of ``(name, source)`` pairs.
+
+        ``source`` is a file path, bytes or a binary file object such as a
+        Streamlit UploadedFile. Yields a BatchResult per file: in submission
+        order, or as each file finishes when ``ordered`` is False. Up to
+        ``lookahead`` files are read ahead, and their tasks run cheapest file
+        first. ``progress`` is called as ``progress(completed, total)``
+        whenever a file finishes; ``total`` is None when ``files`` has no
+        length. Setting ``cancel`` (a threading.Event) stops the run: its
+        running tasks are stopped, no more files are read, and the files
+        already read are yielded with an error.
+        """
+        total = len(files) if hasattr(files, "__len__") else None
+        settings = extraction_settings(pdf_ocr_dpi=self.pdf_ocr_dpi, ocr_regions=self.ocr_regions,
+                                       preprocessing=self.preprocessing)
+        # Files that look like a stored page are only region-OCR'd, and cached under these settings
+        region_settings = extraction_settings(pdf_ocr_dpi=self.pdf_ocr_dpi, ocr_regions=True,
+                                              preprocessing=self.preprocessing)
+        # Templates learned meanwhile apply from the next run on
+        template_index = self._load_templates()
+        first_page_task = self.dedup or len(template_index) > 0
+        field_extractor = get_field_extractor()
+        # Reads image headers to cost them; the workers decode with their own
+        preprocessor = get_preprocessor(**self.preprocessing)
+        scheduler = self._scheduler
+        queue = scheduler.open()
+        spool_dir = None
+        file_iter = iter(enumerate(files))
+        in_flight = {}  # future -> ScheduledTask
+        tasks = {}  # ScheduledTask id -> (state, task_index), task_index None for the first-page task
+        active = {}  # index -> _FileState of the files still being extracted
+        finished = {}
+        next_index = 0
+        taken = yielded = 0
+        completed = 0
+        exhausted = False
+        cancelled = False
+
+        def finish(state, details, metadata=None, text="", items=None):
+            nonlocal completed
+            state.finished = True
+            active.pop(state.index, None)
+            # Queued tasks are dropped; running ones (after an early stop) are no longer needed
+            for task in state.scheduled:
+                scheduler.discard(task)
+            if state.spooled:
+                try:
+                    os.remove(state.path)
+                except OSError:
+                    pass
+            elapsed = time.perf_counter() - state.started
+            state.trace.finish(elapsed)
+            finished[state.index] = BatchResult(state.index, state.name, details, state.errors,
+                                                elapsed=elapsed, metadata=metadata, trace=state.trace.to_dict(),
+                                                text=text, digest=state.digest, image_hash=state.image_hash,
+                                                items=items, key=state.key)
+            completed += 1
+            if progress is not None:
+                progress(completed, total)
+
+        def reuse(index, name, details, metadata, text, digest, items, key):
+            # A result that needed no extraction: from the cache or the store
+            nonlocal completed
+            trace = FileTrace(name)
+            trace.cached = True
+            trace.finish()
+            finished[index] = BatchResult(index, name, dict(details, **{"Source File": name}), cached=True,
+                                          metadata=metadata, trace=trace.to_dict(), text=text, digest=digest,
+                                          items=items, key=key)
+            completed += 1
+            if progress is not None:
+                progress(completed, total)
+
+        def finish_pieces(state, count):
+            text = "".join(state.pieces[:count])
+            items = [item for piece in state.items[:count] for item in piece]
+            with use_trace(state.trace):
+                details = extract_invoice_details(text, state.name, items, state.fields)
+            metadata = {}
+            if state.templates:
+                template, distance = state.templates[state.template or 0]
+                metadata["template"] = {"id": template["id"], "vendor": template["vendor"], "distance": distance,
+                                        "hit": state.template is not None}
+            page_strategies = [entry for piece in state.strategies[:count] for entry in piece]
+            if page_strategies:
+                metadata["pages"] = page_strategies
+            # A file is only as readable as its worst OCR'd page
+            confidences = [value for piece in state.confidences[:count] for value in piece]
+            if confidences:
+                metadata["ocr_confidence"] = round(min(confidences), 1)
+            items_check = check_total(items, details)
+            if items_check is not None:
+                metadata["line_items"] = items_check
+            if count < len(state.pieces):
+                metadata["stopped_early"] = True
+            if not state.errors and self.cache is not None:
+                self.cache.put(state.key, {"details": details, "metadata": metadata, "text": text, "items": items})
+            if state.similar is not None:
+                metadata["similar_to"] = state.similar
+            finish(state, details, metadata, text, items)
+
+        def features(state, task_index, start=0, stop=None):
+            return task_features(state.profile, start, stop, dpi=self.pdf_ocr_dpi,
+                                 target_dpi=preprocessor.target_dpi, first_page=task_index is None)
+
+        def schedule(state, task_index, task, retried=None):
+            if retried is not None:
+                scheduled = scheduler.retry(retried)
+                state.scheduled.append(scheduled)
+                tasks[scheduled.id] = (state, task_index)
+                return
+            kind, start, stop = task
+            if task_index is None:
+                def submit(task_id):
+                    executor = self._get_executor()
+                    return executor.submit(_hash_task, task_id, kind, state.path, self.profile, self.dedup,
+                                           len(template_index) > 0), executor
+
+                scheduled = scheduler.add(queue, {"file": state.name, "task": "first_page"},
+                                          features(state, None), state.priority, submit)
+            else:
+                def submit(task_id):
+                    templates = None
+                    if start == 0:
+                        templates = [template["template"] for template, _ in state.templates]
+                    executor = self._get_executor()
+                    return executor.submit(_run_task, task_id, kind, state.path, start, stop, self.pdf_ocr_dpi,
+                                           state.ocr_regions, self.preprocessing, self.profile,
+                                           templates), executor
+
+                scheduled = scheduler.add(queue, {"file": state.name, "task": [start, stop]},
+                                          features(state, task_index, start, stop), state.priority, submit)
+            state.scheduled.append(scheduled)
+            tasks[scheduled.id] = (state, task_index)
+
+        def stop_file(state, message):
+            state.errors.append(message)
+            for task in state.scheduled:
+                scheduler.cancel(task, message)
+            finish_pieces(state, len(state.pieces))
+
+        try:
+            while True:
+                # Read ahead so the cheapest of the waiting files can go first
+                while not exhausted and taken - yielded < self.lookahead:
+                    if cancel is not None and cancel.is_set():
+                        break
+                    try:
+                        index, (name, source) = next(file_iter)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    taken += 1
+
+                    try:
+                        digest = file_digest(source)
+                    except OSError as e:
+                        state = _FileState(index, name, None, 0)
+                        state.errors.append(f"Cannot read {name}: {e}")
+                        finish(state, extract_invoice_details("", name))
+                        continue
+                    key = cache_key(digest, settings)
+                    # Only a row extracted with these settings: not one read without OCR, by region or by template
+                    stored = self.store.find_by_hash(digest, key) if self.dedup else None
+                    if stored is not None:
+                        duplicate = {"file": stored["Source File"], "file_hash": digest, "match": "exact"}
+                        reuse(index, name, {field: stored[field] or "" for field in invoice_columns},
+                              dict(stored["metadata"], duplicate_of=duplicate), stored["raw_text"], digest,
+                              stored["line_items"], key)
+                        continue
+                    cached = self.cache.get(key) if self.cache is not None else None
+                    if cached is not None:
+                        reuse(index, name, cached["details"], cached["metadata"], cached["text"], digest,
+                              cached["items"], key)
+                        continue
+
+                    # By content: archive members and renamed uploads can't be trusted by extension
+                    kind = source_kind(name, source)
+                    if kind is None:
+                        state = _FileState(index, name, key, 0, digest=digest)
+                        state.errors.append(f"Unsupported file type: {name}")
+                        finish(state, extract_invoice_details("", name))
+                        continue
+
+                    if isinstance(source, (str, os.PathLike)):
+                        path, spooled = os.fspath(source), False
+                    else:
+                        if spool_dir is None:
+                            spool_dir = tempfile.mkdtemp(prefix="invoice-batch-", dir=self.spool_dir)
+                        path, spooled = _spool(source, spool_dir, name), True
+                    planned, layout = self._plan_tasks(kind, path)
+                    state = _FileState(index, name, key, len(planned), path, spooled, digest, self.ocr_regions)
+                    try:
+                        size = os.path.getsize(path)
+                    except OSError:
+                        size = 0
+                    state.profile = file_profile(kind, path, size, preprocessor, layout)
+                    # The file's place in line: its arrival plus the estimated seconds of all its tasks
+                    seconds = sum(scheduler.estimate(features(state, task_index, start, stop))[0]
+                                  for task_index, (_, start, stop) in enumerate(planned))
+                    if first_page_task:
+                        seconds += scheduler.estimate(features(state, None))[0]
+                    state.priority = scheduler.priority(seconds)
+                    active[index] = state
+                    if first_page_task:
+                        state.tasks = planned
+                        schedule(state, None, (kind, 0, 0))
+                    else:
+                        for task_index, task in enumerate(planned):
+                            schedule(state, task_index, task)
+                    # Idle workers start on what has been read so far
+                    scheduler.dispatch()
+
+                if cancel is not None and cancel.is_set() and not cancelled:
+                    cancelled = exhausted = True
+                    for state in list(active.values()):
+                        stop_file(state, f"Cancelled before {state.name} was extracted")
+
+                scheduler.dispatch()
+                for task in queue.take():
+                    in_flight[task.future] = task
+
+                if ordered:
+                    ready = []
+                    while next_index in finished:
+                        ready.append(finished.pop(next_index))
+                        next_index += 1
+                else:
+                    ready = list(finished.values())
+                    finished.clear()
+                for result in ready:
+                    yielded += 1
+                    yield self._record_result(result)
+
+                if not active:
+                    if exhausted:
+                        break
+                    continue
+
+                timed = self.task_timeout or self.file_timeout or cancel is not None
+                wake = queue.wake
+                done, _ = wait(list(in_flight) + [wake], timeout=_TIMEOUT_POLL_SECONDS if timed else None,
+                               return_when=FIRST_COMPLETED)
+
+                if self.task_timeout or self.file_timeout:
+                    now = time.time()
+                    for task in in_flight.values():
+                        state, _ = tasks[task.id]
+                        started = scheduler.started(task)
+                        if started is None or state.finished or task.future in done:
+                            continue
+                        if state.first_started is None or started[0] < state.first_started:
+                            state.first_started = started[0]
+                        if self.task_timeout and now - started[0] > self.task_timeout:
+                            scheduler.cancel(task, f"Timed out after {self.task_timeout}s processing {state.name}")
+                    if self.file_timeout:
+                        for state in list(active.values()):
+                            if state.first_started is not None and now - state.first_started > self.file_timeout:
+                                stop_file(state, f"Timed out after {self.file_timeout}s processing {state.name}")
+
+                for future in done:
+                    if future is wake:
+                        continue
+                    task = in_flight.pop(future)
+                    state, task_index = tasks.pop(task.id)
+                    if state.finished:
+                        continue
+                    if task_index is None:
+                        # Hashing only picks the OCR mode; if it fails the file is OCR'd as usual
+                        fingerprint = None
+                        try:
+                            outcome = future.result()
+                        except BrokenProcessPool:
+                            self._discard_executor(task.executor)
+                            if scheduler.lost(task):
+                                schedule(state, None, None, retried=task)
+                                continue
+                        except (Exception, TaskCancelled):
+                            pass
+                        else:
+                            state.trace.merge(outcome["trace"])
+                            state.image_hash = outcome["hashes"]
+                            fingerprint = outcome["fingerprint"]
+                        state.templates = template_index.match(fingerprint)
+                        if state.templates:
+                            # Cached apart from full OCR; a re-learned template gets a new id
+                            state.key = cache_key(state.digest, dict(
+                                settings, templates=[template["id"] for template, _ in state.templates]))
+                        if state.image_hash is not None:
+                            similar = self.store.find_similar(*state.image_hash, exclude_hash=state.digest)
+                            if similar is not None:
+                                state.similar = {"file": similar["Source File"], "file_hash": similar["file_hash"],
+                                                 "distance": similar["distance"]}
+                                if not state.ocr_regions and not state.templates:
+                                    state.ocr_regions = True
+                                    state.key = cache_key(state.digest, region_settings)
+                        for task_index, planned_task in enumerate(state.tasks):
+                            schedule(state, task_index, planned_task)
+                        continue
+                    try:
+                        outcome = future.result()
+                    except BrokenProcessPool as e:
+                        self._discard_executor(task.executor)
+                        if scheduler.lost(task):
+                            # Its worker was killed over another task; run it again
+                            schedule(state, task_index, None, retried=task)
+                            continue
+                        state.errors.append(task.reason or f"Extraction failed for {state.name}: {e}")
+                    except (TaskCancelled, CancelledError):
+                        state.errors.append(task.reason or f"Extraction of {state.name} was cancelled")
+                    except Exception as e:
+                        state.errors.append(f"Extraction failed for {state.name}: {e}")
+                    else:
+                        self._record_worker(outcome)
+                        state.trace.merge(outcome["trace"])
+                        state.pieces[task_index] = outcome["text"]
+                        state.strategies[task_index] = outcome["strategies"]
+                        state.confidences[task_index] = outcome["confidences"]
+                        state.items[task_index] = outcome["items"]
+                        state.fields.update(outcome["fields"] or {})
+                        if outcome["template"] is not None:
+                            state.template = outcome["template"]
+                        state.errors.extend(outcome["errors"])
+
+                    state.done[task_index] = True
+                    state.remaining -= 1
+                    if state.remaining == 0:
+                        finish_pieces(state, len(state.pieces))
+                    elif state.advance_prefix() and state.prefix >= state.next_check and not state.errors:
+                        # Tested after 2, 4, 8, ... leading pieces so the checks stay linear overall
+                        while state.next_check <= state.prefix:
+                            state.next_check *= 2
+                        text = "".join(state.pieces[:state.prefix])
+                        boundary = len(text) - len(state.pieces[state.prefix - 1])
+                        if field_extractor.settled(text, boundary):
+                            finish_pieces(state, state.prefix)
+        finally:
+            # Stops the tasks of a run abandoned early (the generator closed, an exception in the consumer)
+            scheduler.close(queue)
+            if self.store is not None:
+                self.store.flush()
+            if spool_dir is not None:
+                shutil.rmtree(spool_dir, ignore_errors=True)
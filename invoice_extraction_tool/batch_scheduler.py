@@ -0,0 +1,610 @@
+"""Cost-aware scheduling of extraction tasks over the worker pool.
+
+Every task is costed before it runs. CostModel.estimate turns a task's
+features into the seconds it should take and the memory it should need. The
+features are the file's size, the pages in the task, whether a PDF has a text
+layer, and the pixels of the page as decoded or rendered and as OCR'd. They
+come from the file's header and first page only (see file_profile).
+
+One TaskScheduler is shared by every run of a BatchExtractor, so concurrent
+runs (Streamlit sessions, service jobs) compete for the pool on the same
+terms. Tasks wait in a heap ordered by their file's arrival plus its
+estimated seconds. A batch that arrives at once is run cheapest file first,
+which minimizes mean completion time. A large file only waits behind files
+that arrived less than its own estimate after it. A task is dispatched only
+while the estimated memory of the tasks in flight stays within
+``memory_budget``. The first task that doesn't fit holds back those behind it
+until enough has finished. A task larger than the whole budget runs alone.
+
+Workers note the start of every task in a table in shared memory, so
+timeouts count from when a task starts rather than from when it was
+submitted. A task is stopped by signalling its worker, which raises
+TaskCancelled in the task. A task that doesn't stop within
+``cancel_grace`` seconds (stuck in a long C call) has its worker killed.
+The tasks the pool loses along with it are run again.
+
+With ``log_path`` every decision is appended to a JSONL file:
+
+- ``dispatch``: with the task's features, estimate and queueing time
+- ``hold``: a task waiting for memory
+- ``finish``: with the measured wall time, CPU time and memory growth
+- ``cancel`` and ``kill``
+
+fit_cost_model turns the finish records into new coefficients.
+"""
+import heapq
+import itertools
+import json
+import logging
+import os
+import signal
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CANCEL_GRACE_SECONDS = 10
+
+# Slots of the shared start table, indexed by task id; far more than can be in flight at once
+_SLOTS = 1 << 16
+# Per slot: task id, worker pid, start (microseconds since the epoch) and the id of a task to stop
+_FIELDS = 4
+
+# Assumed when a file's header can't be read: an A4 page
+_PAGE_POINTS = (595.0, 842.0)
+
+# How often a worker checks that the process that started it is still alive
+_PARENT_CHECK_SECONDS = 1.0
+
+# Signal that stops a worker's task; Windows has none, so tasks there are stopped by killing the worker
+_CANCEL_SIGNAL = getattr(signal, "SIGUSR1", None)
+
+
+class TaskCancelled(BaseException):
+    """Raised in a worker whose task is stopped.
+
+    A BaseException, so the extraction code's ``except Exception`` handlers
+    let it through.
+    """
+
+
+def default_memory_budget():
+    """Half the machine's physical memory in bytes, or None where it can't be read"""
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+# Worker side
+
+_table = None
+_current_task = None
+
+
+def init_worker(table):
+    """Pool initializer: keep the shared start table, stop tasks on the cancel signal and exit with the parent"""
+    global _table
+    _table = table
+    if _CANCEL_SIGNAL is not None:
+        signal.signal(_CANCEL_SIGNAL, _on_cancel_signal)
+    threading.Thread(target=_exit_with_parent, args=(os.getppid(),), name="parent-watch", daemon=True).start()
+
+
+def _exit_with_parent(parent):
+    # A parent killed outright (SIGKILL, OOM killer) leaves its idle workers waiting on the task queue forever
+    while True:
+        time.sleep(_PARENT_CHECK_SECONDS)
+        if os.getppid() != parent:
+            os._exit(1)
+
+
+def _on_cancel_signal(signum, frame):
+    task_id = _current_task
+    # The worker may have moved on to another task since the signal was sent
+    if task_id is not None and _table[(task_id % _SLOTS) * _FIELDS + 3] == task_id:
+        raise TaskCancelled(task_id)
+
+
+@contextmanager
+def running_task(task_id):
+    """Run the enclosed block in a worker as task ``task_id``, noting its start"""
+    global _current_task
+    if _table is None:
+        yield
+        return
+    slot = (task_id % _SLOTS) * _FIELDS
+    _table[slot + 1] = os.getpid()
+    _table[slot + 2] = int(time.time() * 1e6)
+    # Written last: the parent reads the slot only once it holds this task's id
+    _table[slot] = task_id
+    if _table[slot + 3] == task_id:
+        raise TaskCancelled(task_id)
+    _current_task = task_id
+    try:
+        yield
+    finally:
+        _current_task = None
+
+
+# Cost model
+
+def file_profile(kind, path, size, preprocessor=None, pdf_layout=None):
+    """What a file's tasks are costed from, read from its header or first page.
+
+    ``kind`` is "image" or "pdf", ``size`` its length in bytes. Images need a
+    ``preprocessor`` (preprocessing.Preprocessor) to tell how large they are
+    decoded; PDFs their ``pdf_layout`` (extraction.pdf_layout), or None when
+    it couldn't be read.
+    """
+    profile = {"kind": kind, "bytes": size}
+    if kind == "image":
+        pixels = None
+        if preprocessor is not None:
+            try:
+                with open(path, "rb") as f:
+                    pixels = preprocessor.decoded_size(f.read(256 * 1024))
+            except OSError:
+                pass
+        if pixels is None:
+            target_dpi = preprocessor.target_dpi if preprocessor is not None else 300
+            page = _page_pixels(_PAGE_POINTS, target_dpi)
+            pixels = (page, page)
+        profile["decode_pixels"], profile["ocr_pixels"] = pixels
+    else:
+        layout = pdf_layout or {"pages": 1, "width": _PAGE_POINTS[0], "height": _PAGE_POINTS[1],
+                                "text_layer": False}
+        profile.update(pages=layout["pages"], text_layer=layout["text_layer"],
+                       page_points=(layout["width"] or _PAGE_POINTS[0], layout["height"] or _PAGE_POINTS[1]))
+    return profile
+
+
+def _page_pixels(points, dpi):
+    return round(points[0] / 72 * dpi) * round(points[1] / 72 * dpi)
+
+
+def task_features(profile, start=0, stop=None, dpi=300, target_dpi=300, first_page=False):
+    """Features of the task reading pages ``[start, stop)`` of a profiled file.
+
+    ``first_page`` is the task that hashes and fingerprints the first page
+    ahead of OCR, which decodes it but reads no text. PDF pages are rendered
+    at ``dpi`` and OCR'd at ``target_dpi``.
+    """
+    features = {"bytes": profile["bytes"], "pages": 1, "text_pages": 0, "scan_pages": 1,
+                "decode_pixels": 0, "render_pixels": 0, "ocr_pixels": 0}
+    if profile["kind"] == "image":
+        features["decode_pixels"] = profile["decode_pixels"]
+        features["ocr_pixels"] = 0 if first_page else profile["ocr_pixels"]
+        return features
+    last = profile["pages"] if stop is None else min(stop, profile["pages"])
+    pages = 1 if first_page else max(0, last - start)
+    features["pages"] = pages
+    if profile["text_layer"]:
+        features.update(text_pages=pages, scan_pages=0)
+    else:
+        features.update(scan_pages=pages, render_pixels=_page_pixels(profile["page_points"], dpi),
+                        ocr_pixels=0 if first_page else _page_pixels(profile["page_points"], target_dpi))
+    return features
+
+
+class CostModel:
+    """Estimated seconds and memory of a task from its features (see task_features).
+
+    seconds = task_seconds + text_page_seconds * text pages + scanned pages
+              * (decode, render and OCR seconds per megapixel * megapixels)
+    memory = task_memory + file_bytes * file size + the bytes per pixel of
+             one page decoded or rendered and OCR'd
+
+    A page is held in memory one at a time, so only time grows with the
+    page count. The defaults were measured on 300 DPI A4 scans with one
+    Tesseract thread; load_cost_model reads coefficients fitted to a
+    scheduling log (fit_cost_model).
+    """
+
+    DEFAULTS = {
+        "task_seconds": 0.005,
+        "text_page_seconds": 0.03,
+        "decode_seconds_per_mp": 0.02,
+        "render_seconds_per_mp": 0.02,
+        "ocr_seconds_per_mp": 0.1,
+        "task_memory": 8 * 2 ** 20,
+        "file_bytes": 1.0,
+        "decode_bytes_per_pixel": 1.0,
+        "render_bytes_per_pixel": 3.0,
+        "ocr_bytes_per_pixel": 4.0,
+    }
+
+    def __init__(self, **coefficients):
+        unknown = set(coefficients) - set(self.DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown cost model coefficients: {', '.join(sorted(unknown))}")
+        self.coefficients = dict(self.DEFAULTS, **coefficients)
+
+    def to_dict(self):
+        return dict(self.coefficients)
+
+    def estimate(self, features):
+        """``(seconds, memory bytes)`` of a task"""
+        c = self.coefficients
+        scanned = features["scan_pages"]
+        seconds = (c["task_seconds"] + c["text_page_seconds"] * features["text_pages"]
+                   + scanned * (c["decode_seconds_per_mp"] * features["decode_pixels"]
+                                + c["render_seconds_per_mp"] * features["render_pixels"]
+                                + c["ocr_seconds_per_mp"] * features["ocr_pixels"]) / 1e6)
+        memory = c["task_memory"] + c["file_bytes"] * features["bytes"]
+        if scanned:
+            memory += (c["decode_bytes_per_pixel"] * features["decode_pixels"]
+                       + c["render_bytes_per_pixel"] * features["render_pixels"]
+                       + c["ocr_bytes_per_pixel"] * features["ocr_pixels"])
+        return seconds, int(memory)
+
+
+def load_cost_model(path):
+    """CostModel with the coefficients in a JSON file (as fit_cost_model returns them)"""
+    with open(path, encoding="utf-8") as f:
+        return CostModel(**json.load(f))
+
+
+def read_schedule_log(path):
+    """Records of a scheduling log, skipping a torn last line"""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def fit_cost_model(records, base=None):
+    """Coefficients fitted to the ``finish`` records of a scheduling log.
+
+    Seconds are fitted by non-negative least squares over the finished
+    tasks. Memory has too few repeated shapes for a fit, so each per-byte and
+    per-pixel coefficient of ``base`` (a CostModel, the defaults if None) is
+    scaled by the 95th percentile of measured over estimated memory, keeping
+    the estimates on the safe side. Coefficients without data are kept.
+    """
+    import numpy as np
+
+    base = base or CostModel()
+    finished = [record for record in records if record.get("event") == "finish" and record.get("status") == "done"]
+    fitted = base.to_dict()
+    if not finished:
+        return fitted
+
+    names = ("task_seconds", "text_page_seconds", "decode_seconds_per_mp", "render_seconds_per_mp",
+             "ocr_seconds_per_mp")
+    rows = []
+    for record in finished:
+        features = record["features"]
+        scanned = features["scan_pages"]
+        rows.append([1.0, features["text_pages"], scanned * features["decode_pixels"] / 1e6,
+                     scanned * features["render_pixels"] / 1e6, scanned * features["ocr_pixels"] / 1e6])
+    matrix = np.array(rows)
+    seconds = np.array([record["wall"] for record in finished])
+    # Columns no task exercised keep their coefficient; the rest are fitted, dropping negatives until none are left
+    active = [index for index in range(len(names)) if matrix[:, index].any()]
+    while active:
+        solution = np.linalg.lstsq(matrix[:, active], seconds, rcond=None)[0]
+        negative = [column for column, value in zip(active, solution) if value < 0]
+        if not negative:
+            for column, value in zip(active, solution):
+                fitted[names[column]] = round(float(value), 6)
+            break
+        active = [column for column in active if column not in negative]
+        for column in negative:
+            fitted[names[column]] = 0.0
+
+    ratios = [record["memory"] / record["estimate"]["memory"] for record in finished
+              if record.get("memory") and record["estimate"]["memory"]]
+    if ratios:
+        scale = float(np.percentile(ratios, 95))
+        for name in ("file_bytes", "decode_bytes_per_pixel", "render_bytes_per_pixel", "ocr_bytes_per_pixel",
+                     "task_memory"):
+            fitted[name] = round(base.coefficients[name] * scale, 3)
+    return fitted
+
+
+# Scheduling
+
+class ScheduledTask:
+    """One task waiting for, or holding, a place in the pool"""
+
+    def __init__(self, task_id, owner, label, features, estimate, priority, submit):
+        self.id = task_id
+        self.owner = owner
+        # {"file": ..., "task": [start, stop] or "first_page"} for the log
+        self.label = label
+        self.features = features
+        self.seconds, self.memory = estimate
+        self.priority = priority
+        # submit(task_id) -> (future, executor)
+        self.submit = submit
+        self.future = None
+        self.executor = None
+        self.queued_at = time.perf_counter()
+        self.dispatched_at = None
+        # Why the task was stopped, reported as its file's error; None if it wasn't
+        self.reason = None
+        self.dropped = False
+        self.held = False
+        self.stopping = False
+
+
+class RunQueue:
+    """A run's handle on the scheduler: tasks dispatched for it, and a future set when there are some"""
+
+    def __init__(self):
+        self.queued = 0
+        self.closed = False
+        self.wake = Future()
+        self._delivered = []
+        self._lock = threading.RLock()
+
+    def take(self):
+        """Tasks dispatched since the last call; re-arms ``wake``"""
+        with self._lock:
+            delivered, self._delivered = self._delivered, []
+            if self.wake.done():
+                self.wake = Future()
+            return delivered
+
+    def _deliver(self, task):
+        with self._lock:
+            self._delivered.append(task)
+            self._notify()
+
+    def _notify(self):
+        with self._lock:
+            if not self.wake.done():
+                self.wake.set_result(None)
+
+
+class TaskScheduler:
+    """Orders and admits the tasks of every run sharing one worker pool (see the module docstring).
+
+    ``max_in_flight`` bounds the tasks handed to the pool at once,
+    ``memory_budget`` (bytes, None for no limit) the estimated memory they
+    may need together.
+    """
+
+    def __init__(self, max_in_flight, memory_budget=None, cost_model=None, log_path=None,
+                 cancel_grace=DEFAULT_CANCEL_GRACE_SECONDS):
+        self.max_in_flight = max(1, max_in_flight)
+        self.memory_budget = memory_budget
+        self.cost_model = cost_model or CostModel()
+        self.cancel_grace = cancel_grace if _CANCEL_SIGNAL is not None else 0
+        self.memory_in_flight = 0
+        self._lock = threading.RLock()
+        self._heap = []
+        self._in_flight = {}
+        self._runs = weakref.WeakSet()
+        self._ids = itertools.count(1)
+        self._epoch = time.perf_counter()
+        self._table = None
+        self._killed = weakref.WeakSet()
+        self.log_path = log_path
+        self._log = None
+
+    def worker_args(self, context):
+        """initargs for the pool's init_worker: the shared start table"""
+        if self._table is None:
+            self._table = context.RawArray("q", _SLOTS * _FIELDS)
+        return (self._table,)
+
+    def open(self):
+        """A RunQueue for a new run"""
+        run = RunQueue()
+        with self._lock:
+            self._runs.add(run)
+        return run
+
+    def close(self, run):
+        """Drop a finished or abandoned run's waiting tasks and stop its running ones"""
+        with self._lock:
+            run.closed = True
+            for task in list(self._in_flight.values()):
+                if task.owner is run:
+                    self.cancel(task, kill=False)
+            run.queued = 0
+
+    def priority(self, seconds):
+        """Heap key of a file estimated to take ``seconds``, arriving now"""
+        return time.perf_counter() - self._epoch + seconds
+
+    def estimate(self, features):
+        return self.cost_model.estimate(features)
+
+    def add(self, run, label, features, priority, submit, estimate=None):
+        """Queue a task; ``priority`` is its file's (see priority), ``submit(task_id)`` hands it to the pool"""
+        with self._lock:
+            task = ScheduledTask(next(self._ids), run, label, features, estimate or self.estimate(features),
+                                 priority, submit)
+            heapq.heappush(self._heap, (priority, task.id, task))
+            run.queued += 1
+            return task
+
+    def retry(self, task):
+        """Queue a task again after the pool lost it"""
+        return self.add(task.owner, task.label, task.features, task.priority, task.submit,
+                        (task.seconds, task.memory))
+
+    def discard(self, task):
+        """Drop a task whose result is no longer needed: unqueue it, or stop it without killing its worker"""
+        with self._lock:
+            if task.future is None:
+                if not task.dropped:
+                    task.dropped = True
+                    task.owner.queued -= 1
+            else:
+                self.cancel(task, kill=False)
+
+    def dispatch(self):
+        """Hand waiting tasks to the pool in priority order while there is room and memory"""
+        dispatched = []
+        with self._lock:
+            while self._heap and len(self._in_flight) < self.max_in_flight:
+                task = self._heap[0][2]
+                if task.dropped or task.owner.closed:
+                    heapq.heappop(self._heap)
+                    continue
+                if (self.memory_budget is not None and self._in_flight
+                        and self.memory_in_flight + task.memory > self.memory_budget):
+                    if not task.held:
+                        task.held = True
+                        self._write("hold", task, memory_in_flight=self.memory_in_flight,
+                                    memory_budget=self.memory_budget, in_flight=len(self._in_flight))
+                    break
+                heapq.heappop(self._heap)
+                task.owner.queued -= 1
+                task.dispatched_at = time.perf_counter()
+                try:
+                    task.future, task.executor = task.submit(task.id)
+                except Exception as e:
+                    # A broken or closed pool; the run handles the failed future like a failed task
+                    task.future = Future()
+                    task.future.set_exception(e)
+                self._in_flight[task.id] = task
+                self.memory_in_flight += task.memory
+                self._write("dispatch", task, priority=round(task.priority, 3),
+                            queued=round(task.dispatched_at - task.queued_at, 4),
+                            memory_in_flight=self.memory_in_flight, in_flight=len(self._in_flight))
+                task.owner._deliver(task)
+                dispatched.append(task)
+        # Outside the lock: a future that is already done runs its callback right away
+        for task in dispatched:
+            task.future.add_done_callback(lambda future, task=task: self._finished(task, future))
+        return dispatched
+
+    def _finished(self, task, future):
+        with self._lock:
+            if self._in_flight.pop(task.id, None) is None:
+                return
+            self.memory_in_flight -= task.memory
+            fields = {}
+            if future.cancelled():
+                status = "cancelled"
+            elif future.exception() is not None:
+                status = "cancelled" if isinstance(future.exception(), TaskCancelled) else "failed"
+            else:
+                status = "done"
+                trace = future.result().get("trace") or {}
+                stages = trace.get("stages", {}).values()
+                fields.update(wall=round(trace.get("wall", 0.0), 4),
+                              cpu=round(sum(entry["cpu"] for entry in stages), 4),
+                              memory=max((entry["memory"] for entry in stages), default=0))
+            self._write("finish", task, status=status, reason=task.reason,
+                        turnaround=round(time.perf_counter() - task.queued_at, 4), **fields)
+            # Room for the runs still waiting; they dispatch from their own threads
+            for run in list(self._runs):
+                if run.queued and not run.closed:
+                    run._notify()
+
+    def started(self, task):
+        """``(start time, pid)`` of a dispatched task once its worker has begun it, else None"""
+        if self._table is None or task.future is None:
+            return None
+        slot = (task.id % _SLOTS) * _FIELDS
+        if self._table[slot] != task.id:
+            return None
+        return self._table[slot + 2] / 1e6, self._table[slot + 1]
+
+    def cancel(self, task, reason=None, kill=True):
+        """Stop a task, reporting ``reason`` as its file's error.
+
+        A queued task is dropped. A running one gets the cancel signal and,
+        with ``kill``, loses its worker if it is still running
+        ``cancel_grace`` seconds later.
+        """
+        with self._lock:
+            if task.reason is None:
+                task.reason = reason
+            if task.future is None:
+                if not task.dropped:
+                    task.dropped = True
+                    task.owner.queued -= 1
+                return
+            if task.stopping or task.future.done() or task.future.cancel():
+                return
+            task.stopping = True
+            if self._table is not None:
+                # Checked by the worker when the task starts, and by its signal handler
+                self._table[(task.id % _SLOTS) * _FIELDS + 3] = task.id
+        self._write("cancel", task, reason=reason)
+        started = self.started(task)
+        if started is not None and _CANCEL_SIGNAL is not None:
+            try:
+                os.kill(started[1], _CANCEL_SIGNAL)
+            except OSError:
+                pass
+        if kill:
+            timer = threading.Timer(self.cancel_grace, self._kill_if_running, (task,))
+            timer.daemon = True
+            timer.start()
+
+    def _kill_if_running(self, task):
+        started = self.started(task)
+        if task.future.done() or started is None:
+            return
+        with self._lock:
+            if task.executor is not None:
+                self._killed.add(task.executor)
+        self._write("kill", task, pid=started[1])
+        logger.warning("Killed worker %d: %s did not stop", started[1], task.label["file"])
+        try:
+            os.kill(started[1], getattr(signal, "SIGKILL", signal.SIGTERM))
+        except OSError:
+            pass
+
+    def lost(self, task):
+        """True if a task failed only because the scheduler killed its worker over another task"""
+        return task.reason is None and task.executor in self._killed
+
+    def _write(self, event, task, **fields):
+        logger.debug("%s %s %s %s", event, task.label["file"], task.label["task"], fields)
+        if self.log_path is None:
+            return
+        record = {"event": event, "time": round(time.time(), 3), "id": task.id, **task.label,
+                  "features": task.features, "estimate": {"seconds": round(task.seconds, 4), "memory": task.memory}}
+        record.update(fields)
+        with self._lock:
+            if self._log is None:
+                self._log = open(self.log_path, "a", encoding="utf-8", buffering=1)
+            self._log.write(json.dumps(record) + "\n")
+
+    def close_log(self):
+        """Close the log file; it is reopened on the next decision"""
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+
+# Command-line options shared by invoice_extract, invoice_service and watch_folder
+
+def add_scheduling_arguments(parser):
+    parser.add_argument("--file-timeout", type=float, metavar="SECONDS",
+                        help="seconds all of a file's tasks may take from the first one's start (default: no limit)")
+    parser.add_argument("--memory-budget-mb", type=float, metavar="MB",
+                        help="estimated memory the tasks in flight may need together; files that don't fit wait "
+                             "(default: half the physical memory, 0 for no limit)")
+    parser.add_argument("--schedule-log", metavar="FILE",
+                        help="append every scheduling decision, with estimated and measured costs, to this JSONL file")
+    parser.add_argument("--cost-model", metavar="FILE",
+                        help="JSON cost model coefficients (from python -m benchmarks.bench_scheduler --fit)")
+
+
+def scheduling_options(args):
+    """BatchExtractor keyword arguments from the options add_scheduling_arguments adds"""
+    budget = args.memory_budget_mb
+    return {
+        "file_timeout": args.file_timeout,
+        "memory_budget": None if budget is None else int(budget * 2 ** 20),
+        "cost_model": load_cost_model(args.cost_model) if args.cost_model else None,
+        "schedule_log": args.schedule_log,
+    }
@@ -0,0 +1,134 @@
+"""Measure archive ingestion: member throughput, peak memory and bomb rejection.
+
+For each of ``--members`` a ZIP and a gzipped TAR holding that many
+``--member-kb`` invoices (incompressible PDF-headed bytes, like scans) are
+written to a temporary directory and read back through expand_archives the
+way BatchExtractor consumes them, one member at a time. Reported: MB/s,
+members/s and the peak of Python allocations (tracemalloc), which should stay
+flat however large the archive gets.
+
+Then decompression bombs of ``--bomb-mb`` zeros (one member as ZIP and as
+TAR.GZ, and a ZIP of many 4 MB members) are offered and the time until
+they are rejected is reported.
+
+    python -m benchmarks.bench_archive --members 10 100 1000 --member-kb 200 --bomb-mb 2000
+"""
+import argparse
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+PDF_HEADER = b"%PDF-1.4\n"
+
+
+def write_archives(directory, members, member_kb):
+    """Paths of a ZIP and a TAR.GZ of ``members`` random PDF-headed files"""
+    zip_path = os.path.join(directory, f"invoices_{members}.zip")
+    tar_path = os.path.join(directory, f"invoices_{members}.tar.gz")
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as archive, \
+            tarfile.open(tar_path, "w:gz", compresslevel=1) as tar:
+        for index in range(members):
+            data = PDF_HEADER + os.urandom(member_kb * 1024)
+            name = f"scans/invoice_{index:05d}.pdf"
+            archive.writestr(name, data)
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return zip_path, tar_path
+
+
+def write_bombs(directory, bomb_mb):
+    """(label, path) of decompression bombs expanding to ``bomb_mb`` MB of zeros"""
+    chunk = b"\0" * (1024 * 1024)
+    zip_path = os.path.join(directory, "bomb.zip")
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        with archive.open("invoice.pdf", "w", force_zip64=True) as f:
+            f.write(PDF_HEADER)
+            for _ in range(bomb_mb):
+                f.write(chunk)
+    tar_path = os.path.join(directory, "bomb.tar.gz")
+    with tarfile.open(tar_path, "w:gz") as tar:
+        info = tarfile.TarInfo("invoice.pdf")
+        info.size = bomb_mb * len(chunk)
+        tar.addfile(info, _Zeros(info.size))
+    many_path = os.path.join(directory, "bomb_many.zip")
+    with zipfile.ZipFile(many_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        data = PDF_HEADER + b"\0" * (4 * 1024 * 1024)
+        for index in range(max(1, bomb_mb // 4)):
+            archive.writestr(f"invoice_{index:05d}.pdf", data)
+    return [("zip, one member", zip_path), ("tar.gz, one member", tar_path), ("zip, 4 MB members", many_path)]
+
+
+class _Zeros:
+    def __init__(self, size):
+        self.left = size
+
+    def read(self, size=-1):
+        size = self.left if size < 0 else min(size, self.left)
+        self.left -= size
+        return b"\0" * size
+
+
+def consume(path):
+    """(members, bytes) read from an archive the way BatchExtractor takes them, and errors reported"""
+    from archive_ingest import expand_archives
+
+    errors = []
+    members = size = 0
+    for _, source in expand_archives([(path, path)], on_error=errors.append):
+        for chunk in iter(lambda: source.read(1024 * 1024), b""):
+            size += len(chunk)
+        members += 1
+    return members, size, errors
+
+
+def bench_throughput(member_counts, member_kb):
+    import archive_ingest  # noqa: F401  (imported ahead of the first timing)
+
+    print(f"archive ingestion ({member_kb} KB members)")
+    with tempfile.TemporaryDirectory() as directory:
+        for members in member_counts:
+            for path in write_archives(directory, members, member_kb):
+                archive_mb = os.path.getsize(path) / 2 ** 20
+                tracemalloc.start()
+                started = time.perf_counter()
+                read, size, _ = consume(path)
+                elapsed = time.perf_counter() - started
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                label = os.path.basename(path).split(".", 1)[1]
+                print(f"  {members:5d} members  {label:<7} {archive_mb:8.1f} MB  {size / 2 ** 20 / elapsed:7.1f} MB/s  "
+                      f"{read / elapsed:7.0f} members/s  peak {peak / 2 ** 20:5.1f} MB")
+
+
+def bench_bombs(bomb_mb):
+    print(f"decompression bombs ({bomb_mb} MB uncompressed)")
+    with tempfile.TemporaryDirectory() as directory:
+        for label, path in write_bombs(directory, bomb_mb):
+            archive_mb = os.path.getsize(path) / 2 ** 20
+            started = time.perf_counter()
+            read, _, errors = consume(path)
+            elapsed = time.perf_counter() - started
+            outcome = errors[0] if errors else f"NOT rejected ({read} members read)"
+            print(f"  {label:<20} {archive_mb:6.1f} MB  {elapsed * 1e3:8.1f} ms  {outcome}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--member-kb", type=int, default=200)
+    parser.add_argument("--bomb-mb", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    bench_throughput(args.members, args.member_kb)
+    bench_bombs(args.bomb_mb)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
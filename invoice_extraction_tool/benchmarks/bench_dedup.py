@@ -0,0 +1,152 @@
+"""Measure duplicate detection: store lookup latency and image hash recall.
+
+``--rows`` stored invoices are written to a fresh database, their page
+hashes drawn around a few hundred template hashes so the pHash bands are as
+crowded as they get on a real archive, and each InvoiceStore lookup dedup
+uses is timed (median and p99 of ``--repeat`` runs, hits and misses).
+
+With ``--corpus N``, N synthetic invoices are each rendered twice with
+different scan artefacts and saved as PNG and scanned PDF, and the image
+hash distances between copies of one invoice and between different
+invoices are reported.
+
+    python -m benchmarks.bench_dedup --rows 1000000 --corpus 50
+"""
+import argparse
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+TEMPLATES = 300
+
+
+def _near(rng, value, flips):
+    for bit in rng.sample(range(64), flips):
+        value ^= 1 << bit
+    return value
+
+
+def make_results(rows, seed=0):
+    from batch_extraction import BatchResult
+    from benchmarks.bench_store import VENDORS
+
+    rng = random.Random(seed)
+    templates = [(rng.getrandbits(64), rng.getrandbits(64)) for _ in range(TEMPLATES)]
+    for i in range(rows):
+        dhash, phash = rng.choice(templates)
+        details = {
+            "Invoice Number": f"INV-{i:07d}",
+            "Vendor Name": rng.choice(VENDORS),
+            "Total Amount": f"{rng.uniform(10, 5000):.2f}",
+            "Source File": f"scan_{i:07d}.png",
+        }
+        yield BatchResult(i, details["Source File"], details, digest=f"{seed:04d}{i:060d}",
+                          image_hash=(_near(rng, dhash, rng.randint(0, 6)), _near(rng, phash, rng.randint(0, 6))))
+
+
+def _timed(function, arguments, repeat):
+    timings = []
+    for argument in itertools.islice(itertools.cycle(arguments), repeat):
+        started = time.perf_counter()
+        function(*argument)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return statistics.median(timings) * 1e3, timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1e3
+
+
+def bench_lookups(rows, repeat):
+    from dedup import match_key
+    from invoice_store import InvoiceStore
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "dedup.sqlite3")
+        results = list(make_results(rows))
+        started = time.perf_counter()
+        with InvoiceStore(path) as store:
+            for result in results:
+                store.add(result)
+        print(f"ingest {rows} rows: {rows / (time.perf_counter() - started):.0f} rows/s")
+
+        rng = random.Random(1)
+        sample = rng.sample(results, min(repeat, len(results)))
+        del results
+        store = InvoiceStore(path)
+        lookups = {
+            "exact hash, hit": (store.find_by_hash, [(r.digest,) for r in sample]),
+            "exact hash, miss": (store.find_by_hash, [(f"{i:064x}",) for i in range(repeat)]),
+            "fields block, hit": (store.find_by_match_key,
+                                  [(match_key(dict(r.details, **{"Vendor Name": r.details["Vendor Name"].upper()})),
+                                    "other") for r in sample]),
+            "fields block, miss": (store.find_by_match_key, [(f"acme|inv{i}|100", None) for i in range(repeat)]),
+            "similar page, hit": (store.find_similar,
+                                  [(_near(rng, r.image_hash[0], 2), _near(rng, r.image_hash[1], 2)) for r in sample]),
+            "similar page, miss": (store.find_similar,
+                                   [(rng.getrandbits(64), rng.getrandbits(64)) for _ in range(repeat)]),
+        }
+        print(f"lookups at {rows} rows (median / p99 of {repeat})")
+        for label, (function, arguments) in lookups.items():
+            median, p99 = _timed(function, arguments, repeat)
+            print(f"  {label:<22} {median:8.3f} ms  {p99:8.3f} ms")
+        store.close()
+
+
+def bench_recall(count, seed=0):
+    from dedup import DEFAULT_MAX_DISTANCE, hamming, image_hashes
+    from invoice_corpus import CORPUS_TODAY, RENDER_DPI, degrade, random_degradation
+    from sample_invoice import invoice_drawing, random_invoice, render_invoice_image
+
+    hashes = {}
+    elapsed = 0.0
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(count):
+            rng = random.Random(f"{seed}:{i}")
+            page = render_invoice_image(invoice_drawing(random_invoice(rng, None, today=CORPUS_TODAY)))
+            for copy in range(2):
+                scanned = degrade(page, random_degradation(rng))
+                png = os.path.join(directory, f"{i}_{copy}.png")
+                pdf = os.path.join(directory, f"{i}_{copy}.pdf")
+                scanned.save(png, dpi=(RENDER_DPI, RENDER_DPI))
+                scanned.convert("L").save(pdf, "PDF", resolution=RENDER_DPI, quality=85)
+                for kind, path in (("image", png), ("pdf", pdf)):
+                    started = time.perf_counter()
+                    hashes[i, copy, kind] = image_hashes(path, kind)
+                    elapsed += time.perf_counter() - started
+
+    def distance(a, b):
+        return max(hamming(a[0], b[0]), hamming(a[1], b[1]))
+
+    same = [distance(hashes[i, 0, a], hashes[i, 1, b])
+            for i in range(count) for a in ("image", "pdf") for b in ("image", "pdf")]
+    same += [distance(hashes[i, copy, "image"], hashes[i, copy, "pdf"]) for i in range(count) for copy in range(2)]
+    different = [distance(hashes[i, 0, "image"], hashes[j, 1, "pdf"])
+                 for i, j in itertools.permutations(range(count), 2)]
+    same.sort()
+    different.sort()
+    print(f"image hashes of {count} invoices x 2 scans x PNG/PDF: {elapsed / len(hashes) * 1e3:.1f} ms per file")
+    print(f"  same invoice       max distance {same[-1]:3d}  p90 {same[int(len(same) * 0.9)]:3d}  "
+          f"within {DEFAULT_MAX_DISTANCE}: {sum(d <= DEFAULT_MAX_DISTANCE for d in same) / len(same):.1%}")
+    print(f"  different invoices min distance {different[0]:3d}  p50 {different[len(different) // 2]:3d}  "
+          f"within {DEFAULT_MAX_DISTANCE}: {sum(d <= DEFAULT_MAX_DISTANCE for d in different) / len(different):.1%}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--corpus", type=int, default=0, metavar="N",
+                        help="also measure image hash distances over N synthetic invoices")
+    args = parser.parse_args(argv)
+
+    if args.rows:
+        bench_lookups(args.rows, args.repeat)
+    if args.corpus:
+        bench_recall(args.corpus)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""Compare the in-memory pandas Excel export with the streaming exporters.
+
+An InvoiceTable is filled with ``--rows`` synthetic extracted rows, then each
+export runs in a fresh process so its peak RSS growth beyond the filled table
+is measured on its own (most precise on Linux, where the peak can be reset).
+
+    python -m benchmarks.bench_export --rows 100000
+"""
+import argparse
+import importlib.util
+import io
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+
+def fill_table(rows):
+    from extraction import invoice_columns
+    from invoice_table import InvoiceTable
+
+    rng = random.Random(0)
+    table = InvoiceTable(invoice_columns)
+    for i in range(rows):
+        table.append({
+            "Invoice Number": f"INV-{i:07d}",
+            "Invoice Date": f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/2025",
+            "Due Date": f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/2025",
+            "Vendor Name": rng.choice(["TechSupplies Inc.", "Office Solutions Ltd.", "Global Services Corp."]),
+            "Total Amount": f"{rng.uniform(10, 5000):.2f}",
+            "Tax Amount": f"{rng.uniform(1, 500):.2f}",
+            "Currency": "USD",
+            "Invoice Items": "; ".join(f"Item {rng.randint(1, 999)} x{rng.randint(1, 9)}" for _ in range(3)),
+            "Source File": f"scan_{i:07d}.pdf",
+        })
+    return table
+
+
+# What app.py did before exporters.export_to_file
+def pandas_excel(table, directory):
+    import pandas as pd
+
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        table.to_dataframe().to_excel(writer, index=False)
+    return len(buffer.getvalue())
+
+
+def streamed(fmt):
+    def export(table, directory):
+        from exporters import export_to_file
+
+        path = export_to_file(fmt, table.iter_rows(), table.columns, directory=directory)
+        return os.path.getsize(path)
+    return export
+
+
+EXPORTS = {
+    "pandas-openpyxl": pandas_excel,
+    "xlsx": streamed("xlsx"),
+    "csv": streamed("csv"),
+    "parquet": streamed("parquet"),
+}
+
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _measure(name, rows, results):
+    table = fill_table(rows)
+    import openpyxl  # noqa: F401  (imports are not part of the export's footprint)
+    if name == "pandas-openpyxl":
+        import pandas  # noqa: F401
+    with tempfile.TemporaryDirectory() as directory:
+        _reset_peak_rss()
+        baseline = _peak_rss_kb()
+        started = time.perf_counter()
+        size = EXPORTS[name](table, directory)
+        results.put((name, time.perf_counter() - started, _peak_rss_kb() - baseline, size))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    print(f"{args.rows} rows; xlsx engine: "
+          f"{'xlsxwriter' if importlib.util.find_spec('xlsxwriter') else 'openpyxl'}")
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    for name in EXPORTS:
+        if name == "parquet" and not importlib.util.find_spec("pyarrow"):
+            print(f"{name:>16}: skipped (pyarrow not installed)")
+            continue
+        process = context.Process(target=_measure, args=(name, args.rows, results))
+        process.start()
+        name, seconds, peak_kb, size = results.get()
+        process.join()
+        print(f"{name:>16}: {seconds:7.2f} s  peak RSS +{peak_kb / 1024:7.1f} MB  file {size / 1e6:6.1f} MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,293 @@
+"""Benchmark the single-pass FieldExtractor against the original regex cascade.
+
+Texts come from generate_sample_invoice layouts: synthesized directly from
+random sample invoices, optionally OCR'd from real generated PNGs (--ocr N,
+needs Tesseract), and concatenated into long multi-page documents. Every text
+is run through both implementations and any difference in output fails the
+run.
+
+    python -m benchmarks.bench_field_extractor --invoices 500 --pages 50
+"""
+import argparse
+import random
+import re
+import sys
+import tempfile
+import os
+import time
+from datetime import datetime, timedelta
+
+from field_extractor import FieldExtractor
+
+invoice_columns = [
+    "Invoice Number", 
+    "Invoice Date", 
+    "Due Date", 
+    "Vendor Name", 
+    "Total Amount", 
+    "Tax Amount",
+    "Currency",
+    "Invoice Items",
+    "Source File"
+]
+
+
+# The original pattern-by-pattern cascade, kept verbatim as the reference
+def reference_extract_invoice_details(text, filename):
+    details = {}
+    
+    # Initialize default values
+    for col in invoice_columns:
+        details[col] = ""
+    
+    # Set the source filename
+    details["Source File"] = filename
+    
+    # Extract invoice number (various formats)
+    invoice_num_patterns = [
+        r'(?i)Invoice\s*(?:#|No|Number|Num)[:.\s]*([A-Z0-9\-_]+)',
+        r'(?i)Invoice\s*ID[:.\s]*([A-Z0-9\-_]+)',
+        r'(?i)Invoice[:.\s]*([A-Z0-9\-_]+)',
+    ]
+    
+    for pattern in invoice_num_patterns:
+        match = re.search(pattern, text)
+        if match:
+            details["Invoice Number"] = match.group(1).strip()
+            break
+    
+    # Extract invoice date
+    date_patterns = [
+        r'(?i)Invoice\s*Date[:.\s]*(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
+        r'(?i)Date[:.\s]*(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
+        r'(?i)Date\s*Issued[:.\s]*(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
+        r'(?i)Issued\s*Date[:.\s]*(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
+    ]
+    
+    for pattern in date_patterns:
+        match = re.search(pattern, text)
+        if match:
+            details["Invoice Date"] = match.group(1).strip()
+            break
+    
+    # Extract due date
+    due_date_patterns = [
+        r'(?i)Due\s*Date[:.\s]*(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
+        r'(?i)Payment\s*Due[:.\s]*(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
+    ]
+    
+    for pattern in due_date_patterns:
+        match = re.search(pattern, text)
+        if match:
+            details["Due Date"] = match.group(1).strip()
+            break
+    
+    # Extract vendor name
+    vendor_patterns = [
+        r'(?i)Vendor\s*Name[:.\s]*([A-Za-z0-9\s\.,&\-\']+)(?=\n)',
+        r'(?i)Supplier[:.\s]*([A-Za-z0-9\s\.,&\-\']+)(?=\n)',
+        r'(?i)From[:.\s]*([A-Za-z0-9\s\.,&\-\']+)(?=\n)',
+        r'(?i)Seller[:.\s]*([A-Za-z0-9\s\.,&\-\']+)(?=\n)',
+    ]
+    
+    for pattern in vendor_patterns:
+        match = re.search(pattern, text)
+        if match:
+            details["Vendor Name"] = match.group(1).strip()
+            break
+    
+    # If no vendor name found, try to find it from the top of the invoice
+    if not details["Vendor Name"]:
+        lines = text.split('\n')
+        for i in range(min(5, len(lines))):  # Check first 5 lines
+            if lines[i] and not any(keyword in lines[i].lower() for keyword in ['invoice', 'bill', 'receipt', 'statement']):
+                details["Vendor Name"] = lines[i].strip()
+                break
+    
+    # Extract total amount
+    total_patterns = [
+        r'(?i)Total(?:\s*Amount)?[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
+        r'(?i)Amount\s*Due[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
+        r'(?i)Grand\s*Total[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
+        r'(?i)Balance\s*Due[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
+    ]
+    
+    for pattern in total_patterns:
+        match = re.search(pattern, text)
+        if match:
+            details["Total Amount"] = match.group(1).strip()
+            break
+    
+    # Extract tax amount
+    tax_patterns = [
+        r'(?i)Tax(?:\s*Amount)?[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
+        r'(?i)VAT[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
+        r'(?i)GST[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
+        r'(?i)Sales\s*Tax[:.\s]*[\$\€\£]?\s*([\d,]+\.\d{2})',
+    ]
+    
+    for pattern in tax_patterns:
+        match = re.search(pattern, text)
+        if match:
+            details["Tax Amount"] = match.group(1).strip()
+            break
+    
+    # Extract currency
+    currency_patterns = [
+        r'(?i)Currency[:.\s]*([A-Z]{3})',
+        r'[\$\€\£\¥]',  # Currency symbols
+    ]
+    
+    for pattern in currency_patterns:
+        match = re.search(pattern, text)
+        if match:
+            if match.group(0) == '$':
+                details["Currency"] = 'USD'
+            elif match.group(0) == '€':
+                details["Currency"] = 'EUR'
+            elif match.group(0) == '£':
+                details["Currency"] = 'GBP'
+            elif match.group(0) == '¥':
+                details["Currency"] = 'JPY'
+            else:
+                details["Currency"] = match.group(1).strip()
+            break
+    
+    # Try to extract items
+    # Look for patterns that might indicate item tables in invoices
+    items_text = ""
+    items_patterns = [
+        r'(?i)Item\s*Description(.*?)(?:Total|Balance|Due)',
+        r'(?i)Description\s*Quantity\s*Rate(.*?)(?:Total|Balance|Due)',
+        r'(?i)Product\s*Description(.*?)(?:Total|Balance|Due)',
+    ]
+    
+    for pattern in items_patterns:
+        match = re.search(pattern, text, re.DOTALL)
+        if match:
+            items_text = match.group(1).strip()
+            break
+    
+    # Simplify items text - just grab a few lines
+    if items_text:
+        items_lines = items_text.split('\n')
+        items_text = '\n'.join(items_lines[:min(5, len(items_lines))])
+        
+    details["Invoice Items"] = items_text
+    
+    return details
+
+
+VENDORS = ["TechSupplies Inc.", "Office Solutions Ltd.", "Global Services Corp.", "ProEquip Industries", "SmartBusiness LLC"]
+ITEMS = ["Office Desk Chair", "Laptop Stand", "Wireless Mouse", "USB-C Hub", "Monitor"]
+
+
+# Text in the reading order of generate_sample_invoice's drawing, with layout variations
+def synthesize_invoice_text(rng):
+    invoice_date = datetime(2025, 1, 1) + timedelta(days=rng.randint(0, 364))
+    due_date = invoice_date + timedelta(days=30)
+    vendor = rng.choice(VENDORS)
+    symbol = rng.choice(["$", "$", "€", "£"])
+    items = [(name, rng.randint(1, 9), rng.uniform(10, 500)) for name in ITEMS[:rng.randint(1, 5)]]
+    subtotal = sum(qty * price for _, qty, price in items)
+    tax = subtotal * 0.08
+    number_label = rng.choice(["Invoice #:", "Invoice No.", "Invoice Number:", "INVOICE ID:", "Invoice"])
+    lines = [
+        rng.choice([vendor, f"Vendor Name: {vendor}", f"From: {vendor}"]),
+        "123 Business St., Suite 456",
+        "Anytown, ST 12345",
+        "Phone: (555) 123-4567",
+        "INVOICE",
+        f"{number_label} INV-{rng.randint(1000, 9999)}",
+        f"Invoice Date: {invoice_date:%m/%d/%Y}",
+        rng.choice([f"Due Date: {due_date:%m/%d/%Y}", f"Payment Due: {due_date:%d-%m-%Y}", ""]),
+        "Bill To:",
+        "Sample Customer",
+        rng.choice(["Item Description Quantity Unit Price Amount", "Description Quantity Rate Amount",
+                    "Description Quantity Unit Price Amount"]),
+    ]
+    for name, qty, price in items:
+        lines.append(f"{name} {qty} {symbol}{price:.2f} {symbol}{qty * price:,.2f}")
+    lines += [
+        f"Subtotal: {symbol}{subtotal:,.2f}",
+        rng.choice([f"Tax (8%): {symbol}{tax:,.2f}", f"VAT: {tax:,.2f}", f"Sales Tax {symbol}{tax:.2f}"]),
+        rng.choice([f"Total: {symbol}{subtotal + tax:,.2f}", f"Balance Due: {subtotal + tax:.2f}",
+                    f"Grand Total {symbol}{subtotal + tax:.2f}"]),
+        rng.choice(["", "Currency: EUR", "currency usd"]),
+        "Payment Terms:",
+        f"Net 30 days. Please make checks payable to {vendor}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def ocr_sample_invoices(count):
+    from sample_invoice import generate_sample_invoice
+    from extraction import extract_text_from_image
+
+    texts = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(count):
+            path = os.path.join(tmp, f"invoice_{i}.png")
+            generate_sample_invoice(path)
+            texts.append(extract_text_from_image(path))
+    return texts
+
+
+def time_per_call(func, texts, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for i, text in enumerate(texts):
+            func(text, f"file_{i}")
+        best = min(best, time.perf_counter() - started)
+    return best / len(texts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--invoices", type=int, default=300, help="synthetic invoices to generate")
+    parser.add_argument("--pages", type=int, default=40, help="pages in each long multi-page document")
+    parser.add_argument("--ocr", type=int, default=0, help="also OCR this many generated PNGs")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    single = [synthesize_invoice_text(rng) for _ in range(args.invoices)]
+    if args.ocr:
+        single += ocr_sample_invoices(args.ocr)
+    long_docs = [
+        "".join(rng.choice(single) for _ in range(args.pages))
+        for _ in range(max(1, args.invoices // args.pages))
+    ]
+    # Pages of body text before the header, the worst case for the cascade
+    filler = "Terms and conditions apply to all orders shipped.\n" * 50
+    long_docs += [filler * args.pages + text for text in single[:10]]
+    # Repeated item headers with no closing total make the lazy DOTALL patterns rescan the tail
+    long_docs.append("Item Description\nWidget 1 $5.00\n" * (args.pages * 10))
+
+    extractor = FieldExtractor()
+
+    def single_pass(text, filename):
+        return extractor.extract(text, filename, invoice_columns)
+
+    mismatches = 0
+    for i, text in enumerate(single + long_docs):
+        expected = reference_extract_invoice_details(text, f"file_{i}")
+        actual = single_pass(text, f"file_{i}")
+        if expected != actual:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"Mismatch on text {i}:\n  reference: {expected}\n  single-pass: {actual}")
+
+    print(f"{len(single)} invoices, {len(long_docs)} multi-page documents, {mismatches} mismatches")
+    for label, texts in (("single invoice", single), ("multi-page", long_docs)):
+        reference = time_per_call(reference_extract_invoice_details, texts, args.repeat)
+        compiled = time_per_call(single_pass, texts, args.repeat)
+        print(f"{label:>15}: reference {reference * 1e6:9.1f} us  single-pass {compiled * 1e6:9.1f} us"
+              f"  speedup {reference / compiled:5.2f}x")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""Compare per-row ingest cost of InvoiceTable with the old pd.concat-per-file loop.
+
+Each run appends N rows (one upload batch) and then builds the DataFrame the
+results view displays, reporting the cost per row. InvoiceTable's per-row
+cost should stay flat from 100 to 10k rows while pd.concat grows with the
+table. ``--rerun-every`` also builds the frame every N rows, as happens when
+the batch is spread over many reruns.
+
+``--grid`` times the results grid instead: a rerun that shows one page
+and writes back an edited cell (cached view, page window, apply_edits),
+and a change of filter or sort, which rebuilds the view. A rerun should
+cost the same at 50k rows as at 50.
+
+    python -m benchmarks.bench_invoice_table --sizes 100 1000 10000
+    python -m benchmarks.bench_invoice_table --grid --sizes 50 5000 50000
+"""
+import argparse
+import random
+import sys
+import time
+
+import pandas as pd
+
+from invoice_table import InvoiceTable
+
+invoice_columns = [
+    "Invoice Number",
+    "Invoice Date",
+    "Due Date",
+    "Vendor Name",
+    "Total Amount",
+    "Tax Amount",
+    "Currency",
+    "Invoice Items",
+    "Source File"
+]
+
+
+def make_rows(count, seed=0):
+    rng = random.Random(seed)
+    return [
+        {
+            "Invoice Number": f"INV-{rng.randint(1000, 9999)}",
+            "Invoice Date": "01/15/2025",
+            "Due Date": "02/14/2025",
+            "Vendor Name": rng.choice(["TechSupplies Inc.", "Office Solutions Ltd."]),
+            "Total Amount": f"{rng.uniform(10, 5000):.2f}",
+            "Tax Amount": f"{rng.uniform(1, 400):.2f}",
+            "Currency": "USD",
+            "Invoice Items": "Laptop Stand 2 $45.00 $90.00",
+            "Source File": f"invoice_{i}.png",
+        }
+        for i in range(count)
+    ]
+
+
+def ingest_concat(rows, rerun_every):
+    frame = pd.DataFrame(columns=invoice_columns)
+    for i, row in enumerate(rows, 1):
+        frame = pd.concat([frame, pd.DataFrame([row])], ignore_index=True)
+        if rerun_every and i % rerun_every == 0:
+            len(frame)
+    return frame
+
+
+def ingest_table(rows, rerun_every):
+    table = InvoiceTable(invoice_columns)
+    for i, row in enumerate(rows, 1):
+        table.append(row)
+        if rerun_every and i % rerun_every == 0:
+            table.to_dataframe()
+    return table.to_dataframe()
+
+
+def _best_of(repeat, run):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def bench_grid(sizes, page_size=50, repeat=20):
+    for size in sizes:
+        table = InvoiceTable(invoice_columns)
+        table.extend(make_rows(size))
+        edits = iter(range(10 ** 9))
+
+        def rerun():
+            rows = table.view("office", "Total Amount", True)
+            window = rows[:page_size]
+            table.window(window)
+            if window:
+                table.apply_edits({window[0]: {"Invoice Number": f"INV-{next(edits)}"}})
+
+        filters = iter(["offic", "offi"] * repeat)
+
+        def change_view():
+            # Alternating filters, so every call misses the cached view
+            table.view(next(filters), "Total Amount", True)
+
+        rerun()
+        print(f"{size:>7} rows: rerun with an edit {_best_of(repeat, rerun) * 1e3:7.2f} ms   "
+              f"new filter or sort {_best_of(repeat, change_view) * 1e3:7.2f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--rerun-every", type=int, default=0,
+                        help="also build the DataFrame every N rows (default: only at the end)")
+    parser.add_argument("--skip-concat-above", type=int, default=10000,
+                        help="don't time pd.concat for larger sizes (it is quadratic)")
+    parser.add_argument("--grid", action="store_true", help="time results grid reruns instead of ingest")
+    args = parser.parse_args(argv)
+
+    if args.grid:
+        bench_grid(args.sizes)
+        return 0
+    baseline = None
+    for size in args.sizes:
+        rows = make_rows(size)
+        started = time.perf_counter()
+        ingest_table(rows, args.rerun_every)
+        table_per_row = (time.perf_counter() - started) / size
+        baseline = baseline or table_per_row
+
+        concat_note = "skipped"
+        if size <= args.skip_concat_above:
+            started = time.perf_counter()
+            ingest_concat(rows, args.rerun_every)
+            concat_note = f"{(time.perf_counter() - started) / size * 1e6:9.1f} us/row"
+
+        print(f"{size:>7} rows: InvoiceTable {table_per_row * 1e6:7.1f} us/row "
+              f"({table_per_row / baseline:4.1f}x smallest)  pd.concat {concat_note}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
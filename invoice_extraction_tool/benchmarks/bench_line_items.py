@@ -0,0 +1,203 @@
+"""Measure line item extraction: speed on long tables and accuracy on a corpus.
+
+For each of ``--rows`` a page with that many line items (description,
+quantity, unit price and amount under a header, rows packed tightly) is
+drawn and read back: find_line_items on the drawn word boxes, pdf_page_items
+on a text-layer PDF of the page (its text already extracted, as the
+pipeline has it) and, with ``--ocr``, find_line_items on the
+adaptive OCR words of the rendered page (OCR time reported apart). Tables
+too long for one page are only read from word boxes. Each read is checked
+against the items drawn.
+
+With ``--corpus DIR`` every file of an invoice_corpus directory goes
+through extraction as the pipeline runs it, and its items are compared with
+the sidecar's: files with every item right, per-column accuracy and how
+many balanced against the extracted total.
+
+    python -m benchmarks.bench_line_items --rows 10 100 1000 --ocr --corpus corpus/
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# Rows that fit on one page at the packed row pitch
+MAX_PAGE_ROWS = 100
+ROW_PITCH = 26
+ROW_SIZE = 18
+COLUMNS = (100, 1000, 1300, 1600)
+
+
+def table_invoice(rows, seed=0):
+    """(drawing operations, expected items) of a page holding ``rows`` line items"""
+    from sample_invoice import ITEM_CATALOG
+
+    rng = random.Random(seed)
+    ops = [("text", x, 100, label, 30) for x, label in zip(COLUMNS, ("Description", "Qty", "Unit Price", "Amount"))]
+    ops.append(("line", 100, 140, 2000, 140, 2))
+    items = []
+    y = 160
+    for row in range(rows):
+        description, low_qty, high_qty, low_price, high_price = rng.choice(ITEM_CATALOG)
+        description = f"{description} {row + 1}"
+        quantity = rng.randint(low_qty, high_qty)
+        price = round(rng.uniform(low_price, high_price), 2)
+        amount = round(quantity * price, 2)
+        for x, value in zip(COLUMNS, (description, str(quantity), f"${price:,.2f}", f"${amount:,.2f}")):
+            ops.append(("text", x, y, value, ROW_SIZE))
+        items.append({"description": description, "quantity": quantity, "unit_price": price, "amount": amount})
+        y += ROW_PITCH
+    ops.append(("text", COLUMNS[2] - 100, y + 40, "Subtotal:", 30))
+    ops.append(("text", COLUMNS[3], y + 40, f"${sum(item['amount'] for item in items):,.2f}", 30))
+    return ops, items
+
+
+def drawn_words(ops):
+    """Word boxes of text drawing operations, measured with the font they are drawn in"""
+    from sample_invoice import load_font
+
+    words = []
+    for op in ops:
+        if op[0] != "text":
+            continue
+        _, x, y, value, size = op
+        font = load_font(size)
+        offset = 0
+        for word in value.split(" "):
+            words.append({"text": word, "left": x + font.getlength(value[:offset]), "top": y,
+                          "width": font.getlength(word), "height": size})
+            offset += len(word) + 1
+    return words
+
+
+def compare(items, expected):
+    """(all right, per-column hits) of read items against expected ones"""
+    columns = ("description", "quantity", "unit_price", "amount")
+    hits = dict.fromkeys(columns, 0)
+    for item, truth in zip(items, expected):
+        for column in columns:
+            value = truth[column]
+            if column != "description":
+                value = float(value)
+            hits[column] += item[column] == value
+    correct = len(items) == len(expected) and all(count == len(expected) for count in hits.values())
+    return correct, hits
+
+
+def _timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started)
+    return result, statistics.median(timings) * 1e3
+
+
+def bench_tables(row_counts, repeat, ocr):
+    import pdfplumber
+
+    from invoice_corpus import write_text_pdf
+    from line_items import find_line_items, pdf_page_items
+
+    print(f"line item tables (median of {repeat} runs)")
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in row_counts:
+            ops, expected = table_invoice(rows)
+            words = drawn_words(ops)
+            items, elapsed = _timed(lambda: find_line_items(words), repeat)
+            print(f"  {rows:5d} rows  word boxes  {elapsed:8.2f} ms  correct: {compare(items, expected)[0]}")
+            if rows > MAX_PAGE_ROWS:
+                continue
+
+            path = os.path.join(directory, f"table_{rows}.pdf")
+            write_text_pdf(path, ops)
+
+            with pdfplumber.open(path) as pdf:
+                page = pdf.pages[0]
+                text = page.extract_text()
+                # pdfplumber caches a page's characters; reading them once is part of the text layer
+                items, elapsed = _timed(lambda: pdf_page_items(page, text), repeat)
+            print(f"  {rows:5d} rows  text PDF    {elapsed:8.2f} ms  correct: {compare(items, expected)[0]}"
+                  "  (text layer read apart)")
+            if ocr:
+                _ocr_table(ops, expected, rows, repeat)
+
+
+def _ocr_table(ops, expected, rows, repeat):
+    from adaptive_ocr import read_page
+    from extraction import detect_tesseract
+    from line_items import find_line_items
+    from ocr_backend import get_ocr_backend
+    from preprocessing import get_preprocessor
+    from sample_invoice import render_invoice_image
+
+    if not detect_tesseract():
+        print("  (no Tesseract; OCR skipped)")
+        return
+    preprocessor = get_preprocessor()
+    # Rendered at the corpus's resolution, like its PNGs
+    gray = preprocessor.gray_from_image(render_invoice_image(ops).convert("L"), 254).copy()
+    started = time.perf_counter()
+    _, _, words = read_page(gray, preprocessor, get_ocr_backend())
+    ocr_ms = (time.perf_counter() - started) * 1e3
+    items, elapsed = _timed(lambda: find_line_items(words), repeat)
+    correct, hits = compare(items, expected)
+    print(f"  {rows:5d} rows  OCR words   {elapsed:8.2f} ms  correct: {correct}  "
+          f"(OCR {ocr_ms:.0f} ms; {len(items)} of {rows} rows read, {hits['amount']} amounts right)")
+
+
+def bench_corpus(corpus_dir):
+    from extraction import extract_image_page, extract_invoice_details, extract_pdf_pages, file_kind
+    from invoice_corpus import load_corpus
+    from line_items import check_total
+    from tracing import trace_file
+
+    records = load_corpus(corpus_dir)
+    by_format = {}
+    for record in records:
+        with trace_file(record["file"]) as trace:
+            if file_kind(record["path"]) == "pdf":
+                pages = extract_pdf_pages(record["path"], ocr_workers=1)
+            else:
+                pages = [extract_image_page(record["path"], ocr_workers=1)]
+        items = [item for page in pages for item in page["items"]]
+        details = extract_invoice_details("".join(page["text"] + "\n" for page in pages), record["file"], items)
+        correct, hits = compare(items, record["items"])
+        check = check_total(items, details)
+        entry = by_format.setdefault(record["format"], {"files": 0, "correct": 0, "balanced": 0, "items": 0,
+                                                        "hits": dict.fromkeys(hits, 0), "seconds": []})
+        entry["files"] += 1
+        entry["correct"] += correct
+        entry["balanced"] += bool(check and check["balanced"])
+        entry["items"] += len(record["items"])
+        for column, count in hits.items():
+            entry["hits"][column] += count
+        entry["seconds"].append(trace.stages.get("items", {}).get("wall", 0.0))
+
+    print(f"line items on {len(records)} corpus files")
+    for fmt, entry in sorted(by_format.items()):
+        columns = "  ".join(f"{column} {count / entry['items']:.0%}" for column, count in entry["hits"].items())
+        print(f"  {fmt:<9} all items right {entry['correct']}/{entry['files']}  "
+              f"balanced {entry['balanced']}/{entry['files']}  {columns}  "
+              f"items stage {statistics.mean(entry['seconds']) * 1e3:.2f} ms/file")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--ocr", action="store_true", help="also OCR the one-page tables")
+    parser.add_argument("--corpus", metavar="DIR", help="score line items over an invoice_corpus directory")
+    args = parser.parse_args(argv)
+
+    bench_tables(args.rows, args.repeat, args.ocr)
+    if args.corpus:
+        bench_corpus(args.corpus)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""Compare per-image OCR latency of the available OCR backends.
+
+Generates sample invoice PNGs, preprocesses them once, then OCRs each one
+with every backend that loads here (pytesseract always, tesserocr when it is
+installed). The first call per backend is timed separately since it pays for
+loading the engine.
+
+    python -m benchmarks.bench_ocr_backend --images 10
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from extraction import preprocess_for_ocr
+from ocr_backend import BACKENDS
+from sample_invoice import generate_sample_invoice
+
+
+def make_images(count):
+    images = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(count):
+            path = os.path.join(tmp, f"invoice_{i}.png")
+            generate_sample_invoice(path)
+            with Image.open(path) as image:
+                # The preprocessed array is a reused buffer, so keep a copy
+                images.append(preprocess_for_ocr(image.convert("RGB")).copy())
+    return images
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    images = make_images(args.images)
+    texts = {}
+    for name, backend_class in BACKENDS.items():
+        started = time.perf_counter()
+        try:
+            backend = backend_class().check()
+            first = backend.image_to_string(images[0])
+        except Exception as e:
+            print(f"{name:>12}: unavailable ({e})")
+            continue
+        first_call = time.perf_counter() - started
+
+        started = time.perf_counter()
+        texts[name] = [first] + [backend.image_to_string(image) for image in images[1:]]
+        per_image = (time.perf_counter() - started) / max(1, len(images) - 1)
+        backend.close()
+        print(f"{name:>12}: first call {first_call * 1e3:8.1f} ms  then {per_image * 1e3:8.1f} ms/image")
+
+    if len(texts) > 1:
+        baseline, *others = texts.values()
+        differing = sum(
+            any(a.strip() != b.strip() for a, b in zip(baseline, other)) for other in others
+        )
+        print(f"{differing} backend(s) produced different text from {next(iter(texts))}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
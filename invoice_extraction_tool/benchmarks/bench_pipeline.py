@@ -0,0 +1,401 @@
+"""End-to-end extraction benchmark over a synthetic invoice corpus.
+
+Runs every file of an invoice_corpus directory through the extraction
+pipeline and reports files/sec, p50/p95/p99 latency per stage, CPU seconds
+per file (Tesseract included), peak RSS, OCR confidence and field-level
+accuracy against the ground-truth sidecars. The stages are:
+
+- ``decode``: reading the image down to grayscale at the target resolution,
+  or reading a PDF page's text layer / rasterizing a scanned page
+- ``preprocess``: scaling rasterized pages; with ``--single-pass`` also
+  denoise, threshold and deskew
+- ``ocr``: adaptive OCR (adaptive_ocr.py, thresholding included), or one
+  Tesseract call per page with ``--single-pass`` (skipped, and those files
+  left unscored, without Tesseract)
+- ``parse``: field extraction from the text
+
+Each run is written to ``benchmarks/results/`` as JSON. ``--compare latest``
+(or a path) prints the change against an earlier run.
+
+    python -m benchmarks.bench_pipeline corpus/ --generate 200 --jobs 4 --compare latest
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+import pdfplumber
+
+from adaptive_ocr import REVIEW_CONFIDENCE
+from extraction import (
+    DEFAULT_PDF_OCR_DPI,
+    detect_tesseract,
+    extract_invoice_details,
+    extraction_settings,
+    file_kind,
+    ocr_binary,
+    ocr_gray,
+)
+from invoice_corpus import FORMATS, generate_corpus, load_corpus
+from preprocessing import get_preprocessor
+
+STAGES = ("decode", "preprocess", "ocr", "parse")
+SCORED_FIELDS = ("Invoice Number", "Invoice Date", "Due Date", "Vendor Name",
+                 "Total Amount", "Tax Amount", "Currency")
+AMOUNT_FIELDS = ("Total Amount", "Tax Amount")
+PERCENTILES = (50, 95, 99)
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+class _Timer:
+    """Accumulates seconds per stage for one file"""
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage, started):
+        self.stages[stage] = self.stages.get(stage, 0.0) + time.perf_counter() - started
+
+
+def _ocr(gray, preprocessor, timer, ocr_regions, single_pass, confidences):
+    if single_pass:
+        started = time.perf_counter()
+        binary = preprocessor.binarize(gray)
+        timer.add("preprocess", started)
+        started = time.perf_counter()
+        text = ocr_binary(binary, ocr_regions)
+    else:
+        started = time.perf_counter()
+        text, confidence, _ = ocr_gray(gray, preprocessor, ocr_regions)
+        if confidence is not None:
+            confidences.append(confidence)
+    timer.add("ocr", started)
+    return text
+
+
+def _image_text(path, timer, ocr, ocr_regions, preprocessing, single_pass, confidences):
+    preprocessor = get_preprocessor(**preprocessing)
+    started = time.perf_counter()
+    gray = preprocessor.decode(path)
+    timer.add("decode", started)
+    if not ocr:
+        return None
+    return _ocr(gray, preprocessor, timer, ocr_regions, single_pass, confidences)
+
+
+def _pdf_text(path, timer, ocr, ocr_regions, preprocessing, dpi, single_pass, confidences):
+    # The same per-page steps as iter_pdf_pages, run inline so each can be timed
+    preprocessor = get_preprocessor(**preprocessing)
+    texts = []
+    with pdfplumber.open(path) as pdf:
+        for page in pdf.pages:
+            started = time.perf_counter()
+            try:
+                text = page.extract_text() or ""
+                image = None if text.strip() else page.to_image(resolution=dpi).original
+            finally:
+                page.close()
+            timer.add("decode", started)
+            if image is not None:
+                if not ocr:
+                    return None
+                started = time.perf_counter()
+                gray = preprocessor.gray_from_image(image, dpi)
+                timer.add("preprocess", started)
+                text = _ocr(gray, preprocessor, timer, ocr_regions, single_pass, confidences)
+            texts.append(text)
+    return "".join(text + "\n" for text in texts)
+
+
+def _cpu_seconds():
+    # Children cover pytesseract's tesseract processes
+    times = os.times()
+    return time.process_time() + times.children_user + times.children_system
+
+
+def _normalise(field, value):
+    value = str(value or "").strip()
+    if field in AMOUNT_FIELDS:
+        value = value.replace(",", "").lstrip("$€£ ")
+    return value
+
+
+def measure_file(record, ocr_regions=False, preprocessing=None, dpi=DEFAULT_PDF_OCR_DPI, single_pass=False):
+    """Run one corpus file through the pipeline; returns its stage times, CPU, confidence and field matches"""
+    preprocessing = preprocessing or {}
+    ocr = detect_tesseract()
+    timer = _Timer()
+    confidences = []
+    started = time.perf_counter()
+    cpu_started = _cpu_seconds()
+    error = None
+    text = None
+    try:
+        if file_kind(record["path"]) == "pdf":
+            text = _pdf_text(record["path"], timer, ocr, ocr_regions, preprocessing, dpi, single_pass,
+                             confidences)
+        else:
+            text = _image_text(record["path"], timer, ocr, ocr_regions, preprocessing, single_pass, confidences)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    matches = None
+    if text is not None:
+        parse_started = time.perf_counter()
+        details = extract_invoice_details(text, record["file"])
+        timer.add("parse", parse_started)
+        matches = {
+            field: _normalise(field, details.get(field)) == _normalise(field, expected)
+            for field, expected in record["fields"].items() if field in SCORED_FIELDS
+        }
+    return {
+        "file": record["file"],
+        "format": record["format"],
+        "seconds": time.perf_counter() - started,
+        "cpu_seconds": _cpu_seconds() - cpu_started,
+        "stages": timer.stages,
+        "ocr_confidence": min(confidences) if confidences else None,
+        "matches": matches,
+        "error": error,
+    }
+
+
+def _measure_args(args):
+    return measure_file(*args)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of ``values``"""
+    ordered = sorted(values)
+    index = max(0, -(-len(ordered) * pct // 100) - 1)
+    return ordered[int(index)]
+
+
+def _latency(values):
+    if not values:
+        return None
+    summary = {f"p{pct}_ms": percentile(values, pct) * 1e3 for pct in PERCENTILES}
+    summary["mean_ms"] = sum(values) / len(values) * 1e3
+    summary["count"] = len(values)
+    return summary
+
+
+def _accuracy(measurements):
+    scored = [m["matches"] for m in measurements if m["matches"] is not None]
+    if not scored:
+        return None
+    fields = {
+        field: sum(matches[field] for matches in scored if field in matches) / len(scored)
+        for field in SCORED_FIELDS
+    }
+    return {
+        "files": len(scored),
+        "fields": fields,
+        "exact_files": sum(all(matches.values()) for matches in scored) / len(scored),
+    }
+
+
+def _peak_rss_mb():
+    # ru_maxrss is kilobytes on Linux and bytes on macOS; children are the largest reaped worker
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / divisor
+    return {"self": round(own, 1), "largest_worker": round(children, 1)}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(RESULTS_DIR), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_benchmark(records, jobs=1, ocr_regions=False, preprocessing=None, dpi=DEFAULT_PDF_OCR_DPI,
+                  single_pass=False):
+    """Measure every record; returns the result document that gets stored"""
+    tasks = [(record, ocr_regions, preprocessing, dpi, single_pass) for record in records]
+    started = time.perf_counter()
+    if jobs == 1:
+        measurements = [_measure_args(task) for task in tasks]
+    else:
+        # Spawned workers like BatchExtractor's, so each pays for its own imports and engine
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=get_context("spawn")) as executor:
+            measurements = list(executor.map(_measure_args, tasks, chunksize=max(1, len(tasks) // (jobs * 8))))
+    wall = time.perf_counter() - started
+
+    formats = sorted({m["format"] for m in measurements})
+    settings = dict(extraction_settings(dpi, ocr_regions, preprocessing), jobs=jobs)
+    if single_pass:
+        settings["ocr_config"] = "single-pass"
+    confidences = [m["ocr_confidence"] for m in measurements if m["ocr_confidence"] is not None]
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "settings": settings,
+        "files": len(measurements),
+        "errors": [f"{m['file']}: {m['error']}" for m in measurements if m["error"]],
+        "wall_seconds": wall,
+        "files_per_second": len(measurements) / wall if wall else 0.0,
+        "peak_rss_mb": _peak_rss_mb(),
+        "cpu_ms_per_file": sum(m["cpu_seconds"] for m in measurements) / len(measurements) * 1e3,
+        "ocr_confidence": {
+            "mean": sum(confidences) / len(confidences),
+            "below_review": sum(c < REVIEW_CONFIDENCE for c in confidences) / len(confidences),
+        } if confidences else None,
+        "latency": {
+            "total": _latency([m["seconds"] for m in measurements]),
+            **{stage: _latency([m["stages"][stage] for m in measurements if stage in m["stages"]])
+               for stage in STAGES},
+        },
+        "latency_by_format": {
+            fmt: _latency([m["seconds"] for m in measurements if m["format"] == fmt]) for fmt in formats
+        },
+        "accuracy": _accuracy(measurements),
+        "accuracy_by_format": {
+            fmt: _accuracy([m for m in measurements if m["format"] == fmt]) for fmt in formats
+        },
+    }
+
+
+def save_result(result, directory=RESULTS_DIR):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"pipeline-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    return path
+
+
+def latest_result(directory=RESULTS_DIR):
+    names = sorted(name for name in os.listdir(directory)
+                   if name.startswith("pipeline-") and name.endswith(".json")) if os.path.isdir(directory) else []
+    return os.path.join(directory, names[-1]) if names else None
+
+
+def _format_ms(summary):
+    if summary is None:
+        return "-"
+    return "  ".join(f"p{pct} {summary[f'p{pct}_ms']:8.1f}" for pct in PERCENTILES) + f"  (n={summary['count']})"
+
+
+def print_result(result):
+    settings = result["settings"]
+    print(f"{result['files']} files in {result['wall_seconds']:.1f}s: {result['files_per_second']:.2f} files/sec "
+          f"({settings['jobs']} jobs, backend {settings['ocr_backend']}, regions {settings['ocr_regions']})")
+    rss = result["peak_rss_mb"]
+    print(f"peak RSS: {rss['self']:.0f} MB this process, {rss['largest_worker']:.0f} MB largest worker")
+    if result.get("cpu_ms_per_file") is not None:
+        print(f"CPU: {result['cpu_ms_per_file']:.0f} ms per file ({'single-pass' if settings['ocr_config'] == 'single-pass' else 'adaptive'} OCR)")
+    if result.get("ocr_confidence"):
+        confidence = result["ocr_confidence"]
+        print(f"OCR confidence: mean {confidence['mean']:.1f}, "
+              f"{confidence['below_review']:.0%} of OCR'd files below {REVIEW_CONFIDENCE}")
+    if not settings["tesseract"]:
+        print("Tesseract not available: OCR skipped, images and scanned PDFs are not scored")
+    print("latency (ms)")
+    for stage, summary in result["latency"].items():
+        print(f"  {stage:>10}  {_format_ms(summary)}")
+    for fmt, summary in result["latency_by_format"].items():
+        print(f"  {fmt:>10}  {_format_ms(summary)}")
+    for fmt, accuracy in [("all", result["accuracy"])] + sorted(result["accuracy_by_format"].items()):
+        if accuracy is None:
+            continue
+        fields = "  ".join(f"{field} {value:.0%}" for field, value in accuracy["fields"].items())
+        print(f"accuracy {fmt} ({accuracy['files']} files, {accuracy['exact_files']:.0%} fully correct): {fields}")
+    for error in result["errors"][:10]:
+        print("error:", error)
+
+
+def _delta(label, old, new, unit="", higher_is_better=False):
+    if old is None or new is None:
+        return
+    change = (new - old) / old * 100 if old else 0.0
+    better = change > 0 if higher_is_better else change < 0
+    flag = "" if abs(change) < 5 else ("  better" if better else "  WORSE")
+    print(f"  {label:<28} {old:10.2f}{unit} -> {new:10.2f}{unit}  {change:+6.1f}%{flag}")
+
+
+def compare_results(old, new):
+    """Print how ``new`` moved against ``old`` (changes within 5% are not flagged)"""
+    print(f"compared with {old.get('created')} (commit {old.get('commit')}):")
+    changed = sorted(key for key in set(old["settings"]) | set(new["settings"])
+                     if old["settings"].get(key) != new["settings"].get(key))
+    if changed or old["files"] != new["files"]:
+        print(f"  note: runs differ in {', '.join(changed + (['file count'] if old['files'] != new['files'] else []))}")
+    _delta("files/sec", old["files_per_second"], new["files_per_second"], higher_is_better=True)
+    _delta("CPU per file", old.get("cpu_ms_per_file"), new.get("cpu_ms_per_file"), " ms")
+    _delta("peak RSS largest worker", old["peak_rss_mb"]["largest_worker"] or old["peak_rss_mb"]["self"],
+           new["peak_rss_mb"]["largest_worker"] or new["peak_rss_mb"]["self"], " MB")
+    for stage in ("total",) + STAGES:
+        before, after = old["latency"].get(stage), new["latency"].get(stage)
+        if before and after:
+            for pct in (50, 95):
+                _delta(f"{stage} p{pct}", before[f"p{pct}_ms"], after[f"p{pct}_ms"], " ms")
+    before, after = old.get("accuracy"), new.get("accuracy")
+    if before and after:
+        for field in SCORED_FIELDS:
+            if field in before["fields"] and field in after["fields"]:
+                _delta(f"accuracy {field}", before["fields"][field] * 100, after["fields"][field] * 100, " %",
+                       higher_is_better=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("corpus", help="invoice_corpus directory")
+    parser.add_argument("--generate", type=int, metavar="N",
+                        help="generate an N-invoice corpus there first if it has no manifest")
+    parser.add_argument("--seed", type=int, default=0, help="seed for --generate")
+    parser.add_argument("-f", "--formats", nargs="+", choices=FORMATS, help="only benchmark these formats")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="worker processes (default: 1)")
+    parser.add_argument("--limit", type=int, help="only the first N files")
+    parser.add_argument("--ocr-regions", action="store_true")
+    parser.add_argument("--target-dpi", type=int)
+    parser.add_argument("--deskew", action="store_true")
+    parser.add_argument("--denoise", action="store_true")
+    parser.add_argument("--single-pass", action="store_true",
+                        help="one Tesseract call per page instead of adaptive OCR, for comparison")
+    parser.add_argument("--compare", metavar="RESULT", help="earlier result JSON, or 'latest'")
+    parser.add_argument("--no-save", action="store_true", help="don't store this run in benchmarks/results")
+    args = parser.parse_args(argv)
+
+    if args.generate and not os.path.exists(os.path.join(args.corpus, "manifest.json")):
+        print(f"Generating {args.generate} invoices in {args.corpus}...")
+        generate_corpus(args.corpus, args.generate, args.seed, jobs=args.jobs)
+
+    records = load_corpus(args.corpus)
+    if args.formats:
+        records = [record for record in records if record["format"] in args.formats]
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print(f"No corpus files in {args.corpus}")
+        return 1
+
+    baseline = latest_result() if args.compare == "latest" else args.compare
+
+    preprocessing = {"deskew": args.deskew, "denoise": args.denoise}
+    if args.target_dpi:
+        preprocessing["target_dpi"] = args.target_dpi
+    result = run_benchmark(records, args.jobs, args.ocr_regions, preprocessing, single_pass=args.single_pass)
+    print_result(result)
+
+    if args.compare:
+        if baseline is None:
+            print("No earlier result to compare with")
+        else:
+            with open(baseline, "r", encoding="utf-8") as f:
+                compare_results(json.load(f), result)
+    if not args.no_save:
+        print("saved", save_result(result))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
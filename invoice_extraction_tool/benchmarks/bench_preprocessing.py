@@ -0,0 +1,114 @@
+"""Compare the original PIL/RGB preprocessing with the grayscale-decode pipeline.
+
+A phone-camera sized JPEG (4032x3024 by default, tagged 72 DPI the way phones
+write it) is built from a sample invoice. Each pipeline runs in a fresh
+process so peak RSS growth covers everything it allocated, including
+OpenCV's buffers (most precise on Linux, where the peak can be reset). Times are the best of ``--repeat`` runs.
+
+    python -m benchmarks.bench_preprocessing --width 4032 --height 3024
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+# The pipeline extract_text_from_image used before preprocessing.py
+def original_pipeline(data):
+    image = Image.open(io.BytesIO(data))
+    img_cv = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+    gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
+    return cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+
+
+def grayscale_pipeline(data):
+    from preprocessing import get_preprocessor
+
+    return get_preprocessor().from_source(data)
+
+
+PIPELINES = {"original": original_pipeline, "grayscale": grayscale_pipeline}
+
+
+def make_photo(width, height):
+    from sample_invoice import generate_sample_invoice
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "invoice.png")
+        generate_sample_invoice(path)
+        with Image.open(path) as page:
+            photo = page.convert("RGB").resize((min(width, height), max(width, height)))
+    buffer = io.BytesIO()
+    photo.save(buffer, "JPEG", quality=92, dpi=(72, 72))
+    return buffer.getvalue()
+
+
+def _reset_peak_rss():
+    # Linux can reset the high-water mark, so earlier import spikes don't hide the pipeline's peak
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _measure(name, data, repeat, results):
+    pipeline = PIPELINES[name]
+    # Warm imports and OpenCV on a tiny image before taking the baseline
+    tiny = io.BytesIO()
+    Image.new("RGB", (64, 64), "white").save(tiny, "JPEG")
+    pipeline(tiny.getvalue())
+    _reset_peak_rss()
+    baseline = _peak_rss_kb()
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        binary = pipeline(data)
+        best = min(best, time.perf_counter() - started)
+    results.put((name, best, _peak_rss_kb() - baseline, binary.shape))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=4032)
+    parser.add_argument("--height", type=int, default=3024)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    data = make_photo(args.width, args.height)
+    print(f"JPEG {len(data) / 1e6:.1f} MB, {max(args.width, args.height)}x{min(args.width, args.height)}")
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    for name in PIPELINES:
+        process = context.Process(target=_measure, args=(name, data, args.repeat, results))
+        process.start()
+        name, seconds, peak_kb, shape = results.get()
+        process.join()
+        print(f"{name:>10}: {seconds * 1e3:7.1f} ms  peak RSS +{peak_kb / 1024:6.1f} MB  output {shape[1]}x{shape[0]}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""Measure the job queue backends: submit, lease and complete throughput.
+
+For each backend (SQLite and directory), ``--jobs`` synthetic jobs are
+submitted, then ``--workers`` processes lease them ``--batch`` at a time,
+renew each lease once and complete every job, as cluster_extract workers
+do without the extraction. Reported: submitted jobs/s, and jobs/s
+through lease, heartbeat and complete per worker count. It checks that no
+job was handed out twice.
+
+    python -m benchmarks.bench_queue --jobs 5000 --workers 1 2 4 --batch 8
+"""
+import argparse
+import hashlib
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from job_queue import open_queue, shard_of
+
+SHARDS = 16
+
+
+def _drain(spec, owner, batch, results):
+    queue = open_queue(spec)
+    leased = []
+    while True:
+        jobs = queue.lease(owner, batch)
+        if not jobs:
+            break
+        queue.heartbeat(owner, [job.id for job in jobs])
+        for job in jobs:
+            queue.complete(job.id, owner, job.id)
+            leased.append(job.id)
+    queue.close()
+    results.put(leased)
+
+
+def bench_backend(label, spec_for, jobs, workers, batch):
+    entries = []
+    for index in range(jobs):
+        digest = hashlib.sha256(str(index).encode()).hexdigest()
+        entries.append((digest, shard_of(digest, SHARDS), f"/invoices/{index}.pdf", f"{index}.pdf"))
+    print(f"{label}")
+    for count in workers:
+        spec = spec_for(count)
+        queue = open_queue(spec)
+        started = time.perf_counter()
+        queue.submit(entries)
+        submitted = time.perf_counter() - started
+        queue.close()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_drain, args=(spec, f"w{n}", batch, results))
+                     for n in range(count)]
+        started = time.perf_counter()
+        for process in processes:
+            process.start()
+        leased = [job_id for _ in processes for job_id in results.get()]
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - started
+        duplicates = len(leased) - len(set(leased))
+        print(f"  {count} worker(s)  submit {jobs / submitted:8.0f} jobs/s  "
+              f"lease+complete {len(leased) / elapsed:7.0f} jobs/s  {len(set(leased))}/{jobs} jobs, "
+              f"{duplicates} leased twice")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=5000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--batch", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        bench_backend("SQLite", lambda count: os.path.join(directory, f"queue{count}.sqlite3"), args.jobs,
+                      args.workers, args.batch)
+        bench_backend("directory", lambda count: os.path.join(directory, f"queue{count}"), args.jobs,
+                      args.workers, args.batch)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""Compare full-page OCR with region-targeted OCR on generated invoices.
+
+Each sample invoice PNG is OCR'd both ways. The run reports CPU time per
+invoice (this process plus any tesseract child processes) and which fields
+came out differently from the regions.
+
+    python -m benchmarks.bench_region_ocr --images 10
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+from PIL import Image
+
+from extraction import extract_invoice_details, ocr_image
+from sample_invoice import generate_sample_invoice
+
+
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=1, help="threads OCR-ing regions of one page")
+    args = parser.parse_args(argv)
+
+    full_cpu = region_cpu = 0.0
+    differences = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(args.images):
+            path = os.path.join(tmp, f"invoice_{i}.png")
+            generate_sample_invoice(path)
+            with Image.open(path) as image:
+                image = image.convert("RGB")
+                started = cpu_seconds()
+                full_text = ocr_image(image)
+                full_cpu += cpu_seconds() - started
+                started = cpu_seconds()
+                region_text = ocr_image(image, regions=True, workers=args.workers)
+                region_cpu += cpu_seconds() - started
+
+            full = extract_invoice_details(full_text, path)
+            region = extract_invoice_details(region_text, path)
+            for field, value in full.items():
+                if field != "Invoice Items" and region[field] != value:
+                    differences[field] = differences.get(field, 0) + 1
+
+    print(f"full page {full_cpu / args.images * 1e3:8.1f} ms CPU/invoice  "
+          f"regions {region_cpu / args.images * 1e3:8.1f} ms CPU/invoice  "
+          f"ratio {region_cpu / full_cpu if full_cpu else 0:5.2f}")
+    print("fields differing from full-page OCR:", differences or "none")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
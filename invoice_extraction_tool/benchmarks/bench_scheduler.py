@@ -0,0 +1,116 @@
+"""Compare arrival-order and cost-ordered scheduling on a mixed corpus.
+
+The files of an invoice_corpus directory (text PDFs, scanned PDFs and
+images) are shuffled and run through BatchExtractor twice, without the
+extraction cache: once in arrival order with no memory budget (a cost model
+whose estimates are all zero), once with the default cost model and memory
+budget. Reported for each run: mean, p50 and p95 completion time of a file
+(from the start of the run, worker start-up included, until its result is
+out), the time until the last one, and how many tasks waited for memory.
+For the cost-ordered run the error of the seconds estimates is reported too.
+
+``--log`` keeps the cost-ordered run's scheduling log. ``--fit LOG``
+fits coefficients to such a log instead (see fit_cost_model) and writes
+them as JSON for ``--cost-model``:
+
+    python -m benchmarks.bench_scheduler corpus/ --jobs 4 --log schedule.jsonl
+    python -m benchmarks.bench_scheduler --fit schedule.jsonl -o cost_model.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from batch_extraction import BatchExtractor
+from batch_scheduler import CostModel, fit_cost_model, read_schedule_log
+from invoice_corpus import load_corpus
+
+PERCENTILES = (50, 95)
+
+# Arrival order: every estimate is zero, so the heap is ordered by arrival alone
+ARRIVAL_ORDER = CostModel(**{name: 0 for name in CostModel.DEFAULTS})
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def run_schedule(files, jobs, cost_model, memory_budget, log_path):
+    """Completion seconds of each file and the records of the run's scheduling log"""
+    extractor = BatchExtractor(max_workers=jobs, cache=None, cost_model=cost_model, memory_budget=memory_budget,
+                               schedule_log=log_path)
+    try:
+        started = time.perf_counter()
+        completions = [time.perf_counter() - started for _ in extractor.run(files, ordered=False)]
+    finally:
+        extractor.close()
+    return completions, read_schedule_log(log_path)
+
+
+def estimate_errors(records):
+    """Relative error of the seconds estimate of every finished task"""
+    return [abs(record["estimate"]["seconds"] - record["wall"]) / record["wall"] for record in records
+            if record.get("event") == "finish" and record.get("wall")]
+
+
+def print_run(label, completions, records):
+    holds = sum(1 for record in records if record.get("event") == "hold")
+    latencies = "  ".join(f"p{pct} {percentile(completions, pct):6.2f}s" for pct in PERCENTILES)
+    print(f"  {label:<14} mean {sum(completions) / len(completions):6.2f}s  {latencies}  "
+          f"last {max(completions):6.2f}s  held {holds}")
+
+
+def bench(corpus, count, jobs, seed, log_path=None):
+    records = load_corpus(corpus)
+    if not records:
+        print(f"No corpus files in {corpus}")
+        return 1
+    random.Random(seed).shuffle(records)
+    files = [(record["file"], record["path"]) for record in records[:count]]
+    print(f"{len(files)} files, {jobs} worker(s)")
+    with tempfile.TemporaryDirectory() as directory:
+        fifo_log = os.path.join(directory, "arrival.jsonl")
+        completions, fifo_records = run_schedule(files, jobs, ARRIVAL_ORDER, 0, fifo_log)
+        print_run("arrival order", completions, fifo_records)
+        cost_log = log_path or os.path.join(directory, "cost.jsonl")
+        if log_path and os.path.exists(log_path):
+            os.remove(log_path)
+        completions, cost_records = run_schedule(files, jobs, None, None, cost_log)
+        print_run("cost ordered", completions, cost_records)
+    errors = estimate_errors(cost_records)
+    if errors:
+        print("  seconds estimate error: " + "  ".join(f"p{pct} {percentile(errors, pct):.0%}" for pct in PERCENTILES))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("corpus", nargs="?", help="invoice_corpus directory")
+    parser.add_argument("--files", type=int, default=60, help="files to run (default: 60)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the arrival order")
+    parser.add_argument("--log", metavar="FILE", help="keep the cost-ordered run's scheduling log here")
+    parser.add_argument("--fit", metavar="LOG", help="fit a cost model to this scheduling log instead")
+    parser.add_argument("-o", "--output", help="write the fitted coefficients here (default: stdout)")
+    args = parser.parse_args(argv)
+
+    if args.fit:
+        fitted = fit_cost_model(read_schedule_log(args.fit))
+        text = json.dumps(fitted, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+        else:
+            print(text)
+        return 0
+    if not args.corpus:
+        parser.error("a corpus directory is needed unless --fit is given")
+    return bench(args.corpus, args.files, args.jobs, args.seed, args.log)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
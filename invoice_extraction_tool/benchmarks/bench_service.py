@@ -0,0 +1,148 @@
+"""Measure invoice_service throughput against worker count.
+
+A synthetic corpus is generated, then for each ``--workers`` count the
+service is started in-process on a free port with the extraction cache off,
+every file is uploaded by ``--clients`` concurrent clients, and the run ends
+when a local webhook stub has received every job's callback. Files/sec and
+the speed-up over the smallest worker count are reported; on a box with
+enough cores the speed-up should track the worker count.
+
+    python -m benchmarks.bench_service --count 200 --workers 1 2 4 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import invoice_service
+from invoice_corpus import FORMATS, generate_corpus
+
+
+class WebhookStub(ThreadingHTTPServer):
+    """Local callback receiver that counts deliveries"""
+
+    def __init__(self):
+        self.deliveries = []
+        self.received = threading.Condition()
+        super().__init__(("127.0.0.1", 0), _WebhookHandler)
+
+    def wait_for(self, count, timeout):
+        with self.received:
+            return self.received.wait_for(lambda: len(self.deliveries) >= count, timeout)
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.received:
+            self.server.deliveries.append(payload)
+            self.server.received.notify_all()
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_service(argv):
+    """Run invoice_service.serve on a background thread; returns (port, stop)"""
+    args = invoice_service.build_parser().parse_args(argv)
+    loop = asyncio.new_event_loop()
+    events = {}
+    started = threading.Event()
+
+    async def run():
+        events["ready"], events["stop"] = asyncio.Event(), asyncio.Event()
+        task = asyncio.ensure_future(invoice_service.serve(args, events["ready"], events["stop"]))
+        await events["ready"].wait()
+        started.set()
+        await task
+
+    thread = threading.Thread(target=loop.run_until_complete, args=(run(),), daemon=True)
+    thread.start()
+    started.wait()
+
+    def stop():
+        loop.call_soon_threadsafe(events["stop"].set)
+        thread.join()
+        loop.close()
+
+    return args.port, stop
+
+
+def upload(base_url, path, callback):
+    url = f"{base_url}/jobs?filename={os.path.basename(path)}&callback={callback}"
+    while True:
+        with open(path, "rb") as f:
+            request = urllib.request.Request(url, data=f.read(), method="POST")
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())["id"]
+        except urllib.error.HTTPError as e:
+            if e.code != 503:
+                raise
+            # Backpressure: wait as told and try again
+            time.sleep(float(e.headers.get("Retry-After", 1)))
+
+
+def run_once(paths, workers, clients, timeout):
+    stub = WebhookStub()
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    port, stop = start_service(["--port", "0", "--jobs", str(workers), "--no-cache",
+                                "--queue-size", str(len(paths))])
+    base_url = f"http://127.0.0.1:{port}"
+    callback = f"http://127.0.0.1:{stub.server_port}/hook"
+    try:
+        # The first job also pays for starting the worker processes
+        upload(base_url, paths[0], callback)
+        stub.wait_for(1, timeout)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            list(pool.map(lambda path: upload(base_url, path, callback), paths))
+        complete = stub.wait_for(len(paths) + 1, timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        stop()
+        stub.shutdown()
+    failed = sum(delivery["status"] != "done" for delivery in stub.deliveries)
+    return len(stub.deliveries) - 1, elapsed, failed, complete
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", help="existing invoice_corpus directory (default: generate one)")
+    parser.add_argument("--count", type=int, default=100, help="invoices to generate (default: 100)")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=["pdf-scan"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=8, help="concurrent uploaders (default: 8)")
+    parser.add_argument("--timeout", type=float, default=3600)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = args.corpus or directory
+        if not args.corpus:
+            generate_corpus(corpus, args.count, formats=args.formats)
+        paths = sorted(os.path.join(corpus, name) for name in os.listdir(corpus)
+                       if not name.endswith(".json"))
+        print(f"{len(paths)} files, {args.clients} clients")
+        print(f"  {'workers':>7} {'files/s':>9} {'speed-up':>9} {'failed':>7}")
+        baseline = None
+        for workers in args.workers:
+            delivered, elapsed, failed, complete = run_once(paths, workers, args.clients, args.timeout)
+            rate = delivered / elapsed
+            baseline = baseline or rate / workers
+            note = "" if complete else "  (timed out)"
+            print(f"  {workers:>7} {rate:>9.2f} {rate / baseline:>8.2f}x {failed:>7}{note}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""Measure cold import time, Tesseract discovery and app rerun overhead.
+
+Every measurement runs in a fresh interpreter (median of ``--repeat`` runs):
+
+- importing each entry-point module, and which heavy libraries it pulled in
+- the first ``detect_tesseract()`` of a process, with no discovery record
+  (a probe of the binary) and with the record left by a previous process
+- with Streamlit installed, a rerun of ``app.py`` after its first run
+
+    python -m benchmarks.bench_startup --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+TOOL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ("extraction", "batch_extraction", "invoice_extract", "app")
+HEAVY = ("cv2", "numpy", "pandas", "pdfplumber", "pytesseract", "PIL.Image", "tesserocr")
+
+_IMPORT = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+print(json.dumps({{"seconds": elapsed, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+_DETECT = """
+import json, time
+import extraction
+started = time.perf_counter()
+available = extraction.detect_tesseract()
+print(json.dumps({"seconds": time.perf_counter() - started, "available": available}))
+"""
+
+_RERUN = """
+import json, runpy, time
+runpy.run_path("app.py")
+started = time.perf_counter()
+runpy.run_path("app.py")
+print(json.dumps({"seconds": time.perf_counter() - started}))
+"""
+
+
+def _run(code, env=None):
+    completed = subprocess.run([sys.executable, "-c", code], cwd=TOOL_DIR, capture_output=True, text=True,
+                               env=dict(os.environ, **(env or {})))
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "failed")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def _median_ms(runs):
+    return statistics.median(run["seconds"] for run in runs) * 1e3
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    try:
+        import streamlit  # noqa: F401
+        has_streamlit = True
+    except ImportError:
+        has_streamlit = False
+
+    print("cold import")
+    for module in MODULES:
+        if module == "app" and not has_streamlit:
+            print(f"  {module:<18} skipped (streamlit not installed)")
+            continue
+        runs = [_run(_IMPORT.format(module=module, heavy=HEAVY)) for _ in range(args.repeat)]
+        heavy = ", ".join(runs[-1]["heavy"]) or "none"
+        print(f"  {module:<18} {_median_ms(runs):8.1f} ms   heavy libraries loaded: {heavy}")
+
+    with tempfile.TemporaryDirectory() as cache_home:
+        # Pointing XDG_CACHE_HOME at an empty directory means no discovery record yet
+        env = {"XDG_CACHE_HOME": cache_home}
+        first = _run(_DETECT, env)
+        cold = [first]
+        for _ in range(args.repeat - 1):
+            for name in os.listdir(os.path.join(cache_home, "invoice_extractor")) if first["available"] else []:
+                os.remove(os.path.join(cache_home, "invoice_extractor", name))
+            cold.append(_run(_DETECT, env))
+        warm = [_run(_DETECT, env) for _ in range(args.repeat)]
+    print(f"detect_tesseract (available: {first['available']})")
+    print(f"  {'first process':<18} {_median_ms(cold):8.1f} ms")
+    print(f"  {'later processes':<18} {_median_ms(warm):8.1f} ms")
+
+    if has_streamlit:
+        runs = [_run(_RERUN) for _ in range(args.repeat)]
+        print(f"app.py rerun         {_median_ms(runs):8.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Measure InvoiceStore ingest throughput and query latency.
+
+``--rows`` synthetic results (fields plus a few hundred bytes of invoice
+text) are written to a fresh database with a commit per row and with
+batched transactions, then each kind of lookup the app's stored invoice view
+issues is timed (median of ``--repeat`` runs).
+
+    python -m benchmarks.bench_store --rows 100000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+VENDORS = ["TechSupplies Inc.", "Office Solutions Ltd.", "Global Services Corp.", "Acme Paper Co.",
+           "Northwind Traders", "Contoso Hardware", "Fabrikam Logistics", "Initech Consulting"]
+WORDS = ["widget", "consulting", "hours", "license", "shipping", "paper", "toner", "support",
+         "maintenance", "cable", "monitor", "laptop", "installation", "subscription", "training"]
+
+
+def make_results(rows, seed=0):
+    from batch_extraction import BatchResult
+
+    rng = random.Random(seed)
+    for i in range(rows):
+        vendor = rng.choice(VENDORS)
+        details = {
+            "Invoice Number": f"INV-{i:07d}",
+            "Invoice Date": f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/{rng.choice([2023, 2024, 2025])}",
+            "Due Date": f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/2025",
+            "Vendor Name": vendor,
+            "Total Amount": f"{rng.uniform(10, 5000):.2f}",
+            "Tax Amount": f"{rng.uniform(1, 500):.2f}",
+            "Currency": "USD",
+            "Invoice Items": "",
+            "Source File": f"scan_{i:07d}.pdf",
+        }
+        lines = [f"{vendor}\nINVOICE\nInvoice #: {details['Invoice Number']}"]
+        lines += [f"{' '.join(rng.sample(WORDS, 3))} {rng.randint(1, 9)} ${rng.uniform(5, 900):.2f}"
+                  for _ in range(rng.randint(3, 10))]
+        lines.append(f"Total: ${details['Total Amount']}")
+        yield BatchResult(i, details["Source File"], details, elapsed=0.5, text="\n".join(lines),
+                          digest=f"{seed:04d}{i:060d}")
+
+
+def ingest(path, results, batch_size):
+    from invoice_store import InvoiceStore
+
+    started = time.perf_counter()
+    with InvoiceStore(path, batch_size=batch_size) as store:
+        for result in results:
+            store.add(result)
+    return time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--per-row", type=int, default=2000,
+                        help="rows written with a commit per row (kept small: it is slow)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    from invoice_store import InvoiceStore
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Generated up front so only the store is timed
+        results = list(make_results(args.rows))
+        per_row = ingest(os.path.join(directory, "per_row.sqlite3"), results[:args.per_row], 1)
+        batched = ingest(os.path.join(directory, "batched.sqlite3"), results, args.batch_size)
+        print("ingest")
+        print(f"  {'commit per row':<28} {args.per_row / per_row:10.0f} rows/s  ({args.per_row} rows)")
+        print(f"  {f'batches of {args.batch_size}':<28} {args.rows / batched:10.0f} rows/s  ({args.rows} rows)")
+
+        store = InvoiceStore(os.path.join(directory, "batched.sqlite3"))
+        middle = f"INV-{args.rows // 2:07d}"
+        queries = {
+            "invoice number": {"invoice_number": middle},
+            "vendor prefix": {"vendor": "acme"},
+            "invoice date range": {"date_from": "2024-03-01", "date_to": "2024-03-31"},
+            "total range": {"min_total": 4990, "max_total": 5000},
+            "full text": {"query": "toner installation"},
+            "full text + vendor": {"query": "laptop", "vendor": "north"},
+        }
+        print(f"first page of {50} (count + rows, median of {args.repeat})")
+        for label, filters in queries.items():
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                matching = store.count(**filters)
+                store.search(limit=50, **filters)
+                timings.append(time.perf_counter() - started)
+            print(f"  {label:<28} {statistics.median(timings) * 1e3:8.2f} ms  ({matching} matches)")
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            store.search(limit=50, offset=args.rows // 2)
+            timings.append(time.perf_counter() - started)
+        print(f"  {'page at offset ' + str(args.rows // 2):<28} {statistics.median(timings) * 1e3:8.2f} ms")
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
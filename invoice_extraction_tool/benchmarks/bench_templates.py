@@ -0,0 +1,168 @@
+"""Measure vendor layout templates: index lookup latency and template reads.
+
+``--templates`` random fingerprints are loaded into a TemplateIndex and
+matching a page against all of them is timed (median and p99 of
+``--repeat`` lookups).
+
+With ``--vendors N``, N synthetic vendors each get a fixed layout and
+``--invoices`` scanned invoices (random numbers, dates, items and scan
+artefacts, as in invoice_corpus). A template is learned from each vendor's
+first invoice and its true fields, the way the app learns one from a
+confirmed row, and the remaining invoices are read with and without
+templates. Reported: fingerprint distances to the invoice's own vendor's
+template and to the others' (what MAX_DISTANCE must separate), how many
+pages a template read (and how often the nearest one was another vendor's,
+which the vendor box turns away), OCR time per page and field accuracy
+both ways.
+
+    python -m benchmarks.bench_templates --templates 100 1000 10000 --vendors 5 --invoices 8
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_pipeline import SCORED_FIELDS, _normalise
+
+
+def bench_index(sizes, repeat, seed=0):
+    from vendor_templates import FINGERPRINT_BYTES, TemplateIndex
+
+    rng = random.Random(seed)
+    print(f"template index lookups ({repeat} runs)")
+    for size in sizes:
+        index = TemplateIndex({"id": number, "vendor": f"Vendor {number}",
+                               "fingerprint": rng.randbytes(FINGERPRINT_BYTES), "template": {}}
+                              for number in range(size))
+        queries = [rng.choice(index.templates)["fingerprint"] for _ in range(repeat // 2)]
+        queries += [rng.randbytes(FINGERPRINT_BYTES) for _ in range(repeat - len(queries))]
+        timings = []
+        hits = 0
+        for query in queries:
+            started = time.perf_counter()
+            hits += bool(index.match(query))
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        print(f"  {size:6d} templates  median {statistics.median(timings) * 1e3:6.3f} ms  "
+              f"p99 {timings[int(len(timings) * 0.99)] * 1e3:6.3f} ms  ({hits} of {len(queries)} matched)")
+
+
+def write_vendor_invoices(directory, vendors, invoices, seed=0):
+    """{vendor: [(path, fields), ...]} of scanned invoices, one fixed layout per vendor"""
+    from invoice_corpus import CORPUS_TODAY, RENDER_DPI, degrade, random_degradation
+    from sample_invoice import VENDORS, invoice_drawing, random_invoice, random_layout, render_invoice_image
+
+    rng = random.Random(seed)
+    written = {}
+    for number in range(vendors):
+        vendor = VENDORS[number % len(VENDORS)]
+        if number >= len(VENDORS):
+            vendor += f" {number // len(VENDORS) + 1}"
+        layout = random_layout(rng)
+        for index in range(invoices):
+            invoice = random_invoice(rng, layout, today=CORPUS_TODAY)
+            invoice["fields"]["Vendor Name"] = vendor
+            path = os.path.join(directory, f"vendor{number:02d}_{index:02d}.png")
+            degrade(render_invoice_image(invoice_drawing(invoice)), random_degradation(rng)).save(
+                path, dpi=(RENDER_DPI, RENDER_DPI))
+            written.setdefault(vendor, []).append((path, invoice["fields"]))
+    return written
+
+
+def _read(path, templates):
+    from extraction import extract_image_page, extract_invoice_details
+
+    started = time.perf_counter()
+    record = extract_image_page(path, ocr_workers=1, templates=templates)
+    elapsed = time.perf_counter() - started
+    details = extract_invoice_details(record["text"], os.path.basename(path), record["items"],
+                                      record.get("fields"))
+    return details, elapsed, record.get("template")
+
+
+def _score(details, fields):
+    return sum(_normalise(field, details.get(field)) == _normalise(field, fields[field])
+               for field in SCORED_FIELDS)
+
+
+def bench_vendors(vendors, invoices, seed=0):
+    from extraction import detect_tesseract
+    from invoice_store import InvoiceStore
+    from vendor_templates import MAX_DISTANCE, TemplateIndex, learn_from_source, source_fingerprint
+
+    if not detect_tesseract():
+        print("vendor templates: no Tesseract; skipped")
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        written = write_vendor_invoices(directory, vendors, invoices, seed)
+        store = InvoiceStore(os.path.join(directory, "invoices.db"))
+        learned = 0
+        for vendor, files in written.items():
+            path, fields = files[0]
+            try:
+                learn_from_source(store, os.path.basename(path), path, fields)
+                learned += 1
+            except ValueError as e:
+                print(f"  {vendor}: no template ({e})")
+        index = TemplateIndex(store.templates())
+        print(f"vendor templates: {learned} learned of {len(written)} vendors, "
+              f"{invoices - 1} more invoices each (MAX_DISTANCE {MAX_DISTANCE})")
+
+        own, others = [], []
+        plain = {"seconds": [], "right": 0}
+        templated = {"seconds": [], "right": 0, "hits": 0, "nearest_other": 0, "wrong_vendor": 0}
+        scored = 0
+        for vendor, files in written.items():
+            for path, fields in files[1:]:
+                fingerprint = source_fingerprint(path, "image")
+                for template in index.templates:
+                    distances = own if template["vendor"] == vendor else others
+                    distances.append(bin(int.from_bytes(fingerprint, "big")
+                                         ^ int.from_bytes(template["fingerprint"], "big")).count("1"))
+                matches = index.match(fingerprint)
+                details, elapsed, _ = _read(path, None)
+                plain["seconds"].append(elapsed)
+                plain["right"] += _score(details, fields)
+                details, elapsed, position = _read(path, [template["template"] for template, _ in matches])
+                templated["seconds"].append(elapsed)
+                templated["right"] += _score(details, fields)
+                templated["hits"] += position is not None
+                templated["nearest_other"] += bool(matches and matches[0][0]["vendor"] != vendor)
+                templated["wrong_vendor"] += position is not None and matches[position][0]["vendor"] != vendor
+                scored += 1
+        store.close()
+
+    fields = scored * len(SCORED_FIELDS)
+    if own:
+        print(f"  distance to own template     min {min(own):4d}  median {statistics.median(own):6.1f}  "
+              f"max {max(own):4d}")
+    if others:
+        print(f"  distance to other templates  min {min(others):4d}  median {statistics.median(others):6.1f}  "
+              f"max {max(others):4d}")
+    print(f"  full OCR        {statistics.mean(plain['seconds']) * 1e3:7.0f} ms/page  "
+          f"fields right {plain['right'] / fields:.1%}")
+    print(f"  with templates  {statistics.mean(templated['seconds']) * 1e3:7.0f} ms/page  "
+          f"fields right {templated['right'] / fields:.1%}  read by template {templated['hits']}/{scored}")
+    print(f"  nearest template another vendor's {templated['nearest_other']}/{scored}, "
+          f"read by another vendor's {templated['wrong_vendor']}/{scored}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--templates", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=1000)
+    parser.add_argument("--vendors", type=int, default=5, help="synthetic vendors to learn templates for (0: none)")
+    parser.add_argument("--invoices", type=int, default=8, help="invoices per vendor, the first one learned from")
+    args = parser.parse_args(argv)
+
+    bench_index(args.templates, args.repeat)
+    if args.vendors:
+        bench_vendors(args.vendors, max(2, args.invoices))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
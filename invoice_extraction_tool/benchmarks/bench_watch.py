@@ -0,0 +1,109 @@
+"""Measure how long the folder watcher takes to catch up on a large directory.
+
+``--files`` small files are spread over ``--dirs`` subdirectories and
+recorded in a fresh ledger as if an earlier run had ingested them. Then the
+startup scan is timed: with no directory mtimes recorded yet (every file is
+stat'ed and checked against the ledger), once they are recorded (unchanged
+directories aren't listed), after ``--new`` files land in one directory, and
+with ``--full-scan``. The first discovery without any ledger is timed too.
+No file is extracted; only how fast the watcher finds what to extract.
+
+    python -m benchmarks.bench_watch --files 100000 --dirs 100
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# A directory's mtime is only recorded once it is older than the watcher's clock-tick margin
+_PAST_SECONDS = 3600
+
+
+def write_tree(root, files, dirs):
+    """Paths of ``files`` small .pdf files spread over ``dirs`` subdirectories, all dated an hour ago"""
+    paths = []
+    past = time.time() - _PAST_SECONDS
+    for number in range(dirs):
+        directory = os.path.join(root, f"batch{number:04d}")
+        os.makedirs(directory)
+        for index in range(number * files // dirs, (number + 1) * files // dirs):
+            path = os.path.join(directory, f"invoice{index:07d}.pdf")
+            with open(path, "wb") as f:
+                f.write(b"%PDF-1.4\n")
+            paths.append(path)
+        os.utime(directory, (past, past))
+    os.utime(root, (past, past))
+    return paths
+
+
+def _scan(root, extractor, ledger, full=False):
+    from watch_folder import FolderWatcher
+
+    # Polling, so no inotify watches are set up
+    watcher = FolderWatcher(root, extractor, ledger, poll=1)
+    started = time.perf_counter()
+    watcher.scan(full=full)
+    return time.perf_counter() - started, watcher.waiting
+
+
+def _report(label, elapsed, found):
+    print(f"  {label:<24} {elapsed * 1e3:8.0f} ms  {found} files to ingest")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--dirs", type=int, default=100)
+    parser.add_argument("--new", type=int, default=100, help="files added to one directory before a rescan")
+    args = parser.parse_args(argv)
+
+    from batch_extraction import BatchExtractor
+    from invoice_store import InvoiceStore
+    from watch_folder import FolderWatcher, IngestLedger
+
+    with tempfile.TemporaryDirectory() as directory:
+        root = os.path.join(directory, "inbox")
+        started = time.perf_counter()
+        paths = write_tree(root, args.files, max(1, args.dirs))
+        print(f"{len(paths)} files in {args.dirs} directories written in {time.perf_counter() - started:.1f}s")
+
+        store = InvoiceStore(os.path.join(directory, "invoices.sqlite3"))
+        extractor = BatchExtractor(max_workers=1, store=store)
+        ledger = IngestLedger(os.path.join(directory, "invoices.watch.sqlite3"))
+        elapsed, found = _scan(root, extractor, ledger)
+        _report("no ledger", elapsed, found)
+
+        records = []
+        for path in paths:
+            info = os.stat(path)
+            records.append((path, info.st_size, info.st_mtime_ns, f"{len(records):064x}", "done", None))
+        ledger.record(records)
+
+        # Records the directory mtimes, as a watcher that caught up does
+        watcher = FolderWatcher(root, extractor, ledger, poll=1)
+        started = time.perf_counter()
+        watcher.run(once=True)
+        _report("ledger, no dir mtimes", time.perf_counter() - started, watcher.counts["done"])
+
+        elapsed, found = _scan(root, extractor, ledger)
+        _report("dir mtimes recorded", elapsed, found)
+
+        target = os.path.dirname(paths[0])
+        for index in range(args.new):
+            with open(os.path.join(target, f"new{index:05d}.pdf"), "wb") as f:
+                f.write(b"%PDF-1.4\n")
+        elapsed, found = _scan(root, extractor, ledger)
+        _report(f"{args.new} new in one dir", elapsed, found)
+
+        elapsed, found = _scan(root, extractor, ledger, full=True)
+        _report("--full-scan", elapsed, found)
+
+        ledger.close()
+        extractor.close()
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,429 @@
+"""cluster-extract: one batch of invoices extracted by workers on several machines.
+
+Examples:
+
+    python cluster_extract.py submit /srv/invoices/2026-10 --queue /srv/shared/queue --shards 4
+    python cluster_extract.py worker --queue /srv/shared/queue --results /srv/shared/results --shard 0 --jobs 8
+    python cluster_extract.py status --queue /srv/shared/queue
+    python cluster_extract.py collect --queue /srv/shared/queue --results /srv/shared/results -o results.jsonl
+    python cluster_extract.py run invoices/ --queue /tmp/queue.sqlite3 --results /tmp/results --workers 3 \\
+        -o results.jsonl
+
+``submit`` (the coordinator) hashes every file and queues one job per
+distinct content, in the shard its SHA-256 falls in (job_queue.py). Each
+node runs ``worker`` processes that lease a batch of jobs, extract them on
+a BatchExtractor pool and renew their leases with heartbeats meanwhile.
+The leases of a worker that dies expire and its jobs are queued again for
+the others. A worker leases jobs of its ``--shard`` first and of any shard
+once those run out, unless ``--no-steal`` is given.
+
+Results go to a content-addressed result store shared by every worker: an
+ExtractionCache directory keyed by file hash and extraction settings that
+is never evicted from. A worker looks each file up there before extracting
+it, so a file is OCR'd once anywhere in the cluster. That holds even when a
+lease expired while its worker was still busy and the job ran elsewhere too.
+``collect`` writes the results of every submitted name like
+invoice_extract.py does, optionally to the invoice store as well. ``run``
+does it all on one machine with local worker processes.
+
+The files, the queue and the result store must be visible to every node at
+the same paths. A directory queue works on NFS and SMB shares; a SQLite
+queue needs a filesystem with working locks.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+
+from archive_ingest import is_archive_name
+from batch_extraction import BatchExtractor, BatchResult
+from batch_scheduler import add_scheduling_arguments, scheduling_options
+from exporters import WRITERS, open_writer
+from extraction import DEFAULT_PDF_OCR_DPI, invoice_columns
+from extraction_cache import ExtractionCache, file_digest
+from invoice_extract import FORMAT_EXTENSIONS, ITEM_COLUMNS, item_rows, iter_input_paths
+from invoice_store import InvoiceStore, default_store_path
+from job_queue import DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS, open_queue, shard_of
+from preprocessing import DEFAULT_TARGET_DPI
+
+logger = logging.getLogger("cluster_extract")
+
+DEFAULT_SHARDS = 16
+# Seconds an idle worker waits before looking for jobs again
+DEFAULT_POLL_SECONDS = 2.0
+# Jobs queued per transaction while submitting
+_SUBMIT_BATCH = 500
+
+
+def result_store(directory):
+    """ExtractionCache over the shared results directory; nothing is ever evicted from it"""
+    return ExtractionCache(directory=directory, max_memory_items=16, max_disk_bytes=float("inf"), evict=False)
+
+
+def submit_files(queue, paths, shards=DEFAULT_SHARDS):
+    """Hash ``paths`` and queue a job per distinct content; returns (files submitted, new jobs, errors)"""
+    submitted = new = 0
+    errors = []
+    entries = []
+    for path in paths:
+        if is_archive_name(path):
+            errors.append(f"{path}: archives aren't sharded; unpack it or use invoice_extract.py")
+            continue
+        try:
+            digest = file_digest(path)
+        except OSError as e:
+            errors.append(f"Cannot read {path}: {e}")
+            continue
+        entries.append((digest, shard_of(digest, shards), os.path.abspath(path), path))
+        submitted += 1
+        if len(entries) >= _SUBMIT_BATCH:
+            new += queue.submit(entries)
+            entries = []
+    if entries:
+        new += queue.submit(entries)
+    return submitted, new, errors
+
+
+class ClusterWorker:
+    """Leases jobs from a queue and extracts them until stopped.
+
+    ``extractor`` should have the shared result store as its cache.
+    ``shards`` are leased first (None: any), and with ``steal`` any other
+    shard once they are empty. ``batch`` jobs are leased at a time, twice
+    the extractor's workers by default.
+    """
+
+    def __init__(self, queue, extractor, owner=None, shards=None, steal=True, batch=None,
+                 poll=DEFAULT_POLL_SECONDS):
+        if extractor.cache is None:
+            raise ValueError("the extractor needs the shared result store as its cache")
+        self.queue = queue
+        self.extractor = extractor
+        self.owner = owner or f"{socket.gethostname()}-{os.getpid()}"
+        self.shards = shards
+        self.steal = steal
+        self.batch = batch or extractor.max_workers * 2
+        self.poll = poll
+        self.counts = {"done": 0, "failed": 0, "lost": 0}
+        self._stop = threading.Event()
+
+    @property
+    def stopping(self):
+        return self._stop.is_set()
+
+    def stop(self):
+        """Stop once the jobs leased now are finished"""
+        self._stop.set()
+
+    def run(self, until_idle=False):
+        """Lease and extract jobs until stop(); with ``until_idle``, also once none are queued or leased"""
+        while not self._stop.is_set():
+            self.queue.requeue_expired()
+            jobs = self._lease()
+            if jobs:
+                self._extract(jobs)
+                continue
+            if until_idle:
+                counts = self.queue.counts()
+                if not counts["queued"] and not counts["leased"]:
+                    return
+            self._stop.wait(self.poll)
+
+    def _lease(self):
+        jobs = []
+        if self.shards is not None:
+            jobs = self.queue.lease(self.owner, self.batch, self.shards)
+        if not jobs and (self.shards is None or self.steal):
+            jobs = self.queue.lease(self.owner, self.batch)
+        return jobs
+
+    def _extract(self, jobs):
+        pending = {job.id for job in jobs}
+        lock = threading.Lock()
+        finished = threading.Event()
+
+        def heartbeat():
+            while not finished.wait(self.queue.lease_seconds / 3):
+                with lock:
+                    ids = list(pending)
+                try:
+                    held = self.queue.heartbeat(self.owner, ids)
+                except Exception as e:
+                    # The lease may still be renewed in time by the next beat
+                    logger.warning("Lease heartbeat failed: %s", e)
+                    continue
+                lost = set(ids) - held
+                if lost:
+                    logger.warning("Lost the lease on %d job(s); they may be extracted elsewhere too", len(lost))
+                    with lock:
+                        pending.difference_update(lost)
+
+        thread = threading.Thread(target=heartbeat, name="lease-heartbeat", daemon=True)
+        thread.start()
+        try:
+            for result in self.extractor.run([(job.name, job.path) for job in jobs], ordered=False):
+                job = jobs[result.index]
+                with lock:
+                    pending.discard(job.id)
+                self._finish(job, result)
+        finally:
+            finished.set()
+            thread.join()
+
+    def _finish(self, job, result):
+        error = "; ".join(result.errors)
+        key = None
+        if not error and result.digest != job.id:
+            error = f"{job.path} changed since it was submitted"
+        if not error:
+            key = self.extractor.result_key(job.id)
+            # put() keeps the value in memory even when the write fails, so look for the file
+            if not self.extractor.cache.on_disk(key):
+                error = f"The result of {job.path} couldn't be written to the result store"
+        if error:
+            outcome = "failed" if self.queue.fail(job.id, self.owner, error) else "lost"
+            logger.error("%s: %s", job.name, error)
+        else:
+            # False when another worker finished it first; the result is the same either way
+            self.queue.complete(job.id, self.owner, key)
+            outcome = "done"
+            logger.debug("%s%s", job.name, " (already in the result store)" if result.cached else "")
+        self.counts[outcome] += 1
+
+
+def collect(queue, store):
+    """``(name, job, result)`` for every submitted name of every done job.
+
+    ``result`` is the stored value (details, metadata, text and items), or
+    None if it is missing from the result store.
+    """
+    for job in queue.jobs("done"):
+        value = store.get(job.result)
+        for name in job.names:
+            yield name, job, value
+
+
+# Command line
+
+def _add_queue_arguments(parser, results=True):
+    parser.add_argument("--queue", required=True,
+                        help="job queue: a directory, or a SQLite file (*.sqlite3, *.db or sqlite:PATH)")
+    if results:
+        parser.add_argument("--results", required=True, metavar="DIR",
+                            help="shared result store directory (content-addressed, never evicted from)")
+    parser.add_argument("--lease", type=float, default=DEFAULT_LEASE_SECONDS, metavar="SECONDS",
+                        help=f"seconds a lease lasts without a heartbeat (default: {DEFAULT_LEASE_SECONDS})")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help="leases a job may lose to dead or hung workers before it fails "
+                             f"(default: {DEFAULT_MAX_ATTEMPTS})")
+
+
+def _add_worker_arguments(parser):
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="extraction processes per worker (default: CPU count)")
+    parser.add_argument("--batch", type=int, help="jobs leased at a time (default: twice --jobs)")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="seconds allowed per OCR/PDF task (default: 300)")
+    add_scheduling_arguments(parser)
+    parser.add_argument("--ocr-dpi", type=int, default=DEFAULT_PDF_OCR_DPI,
+                        help=f"resolution scanned PDF pages are rendered at for OCR (default: {DEFAULT_PDF_OCR_DPI})")
+    parser.add_argument("--ocr-regions", action="store_true",
+                        help="OCR only the header, invoice details and totals blocks, "
+                             "falling back to the full page when fields are missing")
+    parser.add_argument("--target-dpi", type=int, default=DEFAULT_TARGET_DPI,
+                        help=f"resolution images are normalised to before OCR (default: {DEFAULT_TARGET_DPI})")
+    parser.add_argument("--deskew", action="store_true", help="straighten rotated scans before OCR")
+    parser.add_argument("--denoise", action="store_true", help="median-filter images before thresholding")
+
+
+def _add_collect_arguments(parser):
+    parser.add_argument("-o", "--output", default="-", help="output file, or '-' for stdout (default)")
+    parser.add_argument("-f", "--format", choices=sorted(WRITERS),
+                        help="output format (default: from the output extension, else jsonl)")
+    parser.add_argument("--items", metavar="FILE",
+                        help="also write the line items, one row per item, to this file")
+    parser.add_argument("--store", nargs="?", const=default_store_path(), metavar="DB",
+                        help="also save the results to this SQLite invoice store "
+                             f"(default when given without a path: {default_store_path()})")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="cluster-extract",
+        description="Extract a batch of invoices with workers on several machines sharing a job queue.",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every file to stderr")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    submit = commands.add_parser("submit", help="hash files and queue one job per distinct content")
+    submit.add_argument("inputs", nargs="+",
+                        help="files, directories or glob patterns; '-' reads a file list from stdin")
+    submit.add_argument("--shards", type=int, default=DEFAULT_SHARDS,
+                        help=f"shards the jobs are split into by content hash (default: {DEFAULT_SHARDS})")
+    _add_queue_arguments(submit, results=False)
+
+    worker = commands.add_parser("worker", help="lease and extract jobs until stopped")
+    _add_queue_arguments(worker)
+    _add_worker_arguments(worker)
+    worker.add_argument("--shard", type=int, action="append",
+                        help="shard to lease jobs from first; may be repeated (default: any)")
+    worker.add_argument("--no-steal", dest="steal", action="store_false",
+                        help="only lease jobs of the --shard shards")
+    worker.add_argument("--name", help="worker name in the queue (default: host-pid)")
+    worker.add_argument("--until-idle", action="store_true", help="exit once no jobs are queued or leased")
+
+    status = commands.add_parser("status", help="count the jobs in each state")
+    _add_queue_arguments(status, results=False)
+
+    collect_parser = commands.add_parser("collect", help="write the results of the finished jobs")
+    _add_queue_arguments(collect_parser)
+    _add_collect_arguments(collect_parser)
+
+    run = commands.add_parser("run", help="submit, extract with local worker processes and collect")
+    run.add_argument("inputs", nargs="+",
+                     help="files, directories or glob patterns; '-' reads a file list from stdin")
+    run.add_argument("--workers", type=int, default=2, help="local worker processes (default: 2)")
+    _add_queue_arguments(run)
+    _add_worker_arguments(run)
+    _add_collect_arguments(run)
+    return parser
+
+
+def _submit(args, queue, shards):
+    files, new, errors = submit_files(queue, iter_input_paths(args.inputs), shards)
+    for message in errors:
+        logger.error(message)
+    logger.info("Submitted %d files: %d new jobs in %d shards", files, new, shards)
+    return errors
+
+
+def _work(args, queue):
+    extractor = BatchExtractor(max_workers=args.jobs, task_timeout=args.timeout, cache=result_store(args.results),
+                               pdf_ocr_dpi=args.ocr_dpi, ocr_regions=args.ocr_regions,
+                               preprocessing={"target_dpi": args.target_dpi, "deskew": args.deskew,
+                                              "denoise": args.denoise},
+                               **scheduling_options(args))
+    worker = ClusterWorker(queue, extractor, owner=args.name, shards=args.shard, steal=args.steal,
+                           batch=args.batch)
+
+    def on_signal(signum, frame):
+        if worker.stopping:
+            raise KeyboardInterrupt
+        logger.info("Stopping after the leased jobs (signal again to stop at once)")
+        worker.stop()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, on_signal)
+    try:
+        worker.run(until_idle=args.until_idle)
+    except KeyboardInterrupt:
+        logger.warning("Stopped; the leased jobs go to other workers once their leases expire")
+        extractor.close(wait_for_tasks=False)
+        return 130
+    finally:
+        extractor.close()
+    logger.info("%s: %d done, %d failed, %d lost", worker.owner, worker.counts["done"], worker.counts["failed"],
+                worker.counts["lost"])
+    return 0
+
+
+def _worker_argv(args, index):
+    # The worker command line of one of run's local workers
+    argv = [sys.executable, os.path.abspath(__file__)] + (["--verbose"] if args.verbose else [])
+    argv += ["worker", "--queue", args.queue, "--results", args.results,
+            "--lease", str(args.lease), "--max-attempts", str(args.max_attempts), "--jobs", str(args.jobs),
+            "--timeout", str(args.timeout), "--ocr-dpi", str(args.ocr_dpi), "--target-dpi", str(args.target_dpi),
+            "--shard", str(index), "--until-idle"]
+    for flag, value in (("--batch", args.batch), ("--file-timeout", args.file_timeout),
+                        ("--memory-budget-mb", args.memory_budget_mb), ("--schedule-log", args.schedule_log),
+                        ("--cost-model", args.cost_model)):
+        if value is not None:
+            argv += [flag, str(value)]
+    for flag, value in (("--ocr-regions", args.ocr_regions), ("--deskew", args.deskew),
+                        ("--denoise", args.denoise)):
+        if value:
+            argv.append(flag)
+    return argv
+
+
+def _collect(args, queue):
+    fmt = args.format or FORMAT_EXTENSIONS.get(os.path.splitext(args.output)[1].lower(), "jsonl")
+    writer = open_writer(fmt, args.output, invoice_columns)
+    items_writer = None
+    if args.items:
+        items_format = FORMAT_EXTENSIONS.get(os.path.splitext(args.items)[1].lower(), "jsonl")
+        items_writer = open_writer(items_format, args.items, ITEM_COLUMNS)
+    store = InvoiceStore(args.store) if args.store else None
+    written = missing = 0
+    try:
+        for index, (name, job, value) in enumerate(collect(queue, result_store(args.results))):
+            if value is None:
+                logger.error("%s: result %s is missing from the result store", name, job.result)
+                missing += 1
+                continue
+            writer.write(dict(value["details"], **{"Source File": name}))
+            if items_writer is not None:
+                for item_row in item_rows(name, value["items"]):
+                    items_writer.write(item_row)
+            if store is not None:
+                store.add(BatchResult(index, name, dict(value["details"], **{"Source File": name}),
+                                      cached=True, metadata=value["metadata"], text=value["text"], digest=job.id,
+                                      items=value["items"], key=job.result))
+            written += 1
+    finally:
+        writer.close()
+        if items_writer is not None:
+            items_writer.close()
+        if store is not None:
+            store.close()
+    failed = queue.jobs("failed")
+    for job in failed:
+        for name in job.names:
+            logger.error("%s: %s", name, job.error)
+    counts = queue.counts()
+    if counts["queued"] or counts["leased"]:
+        logger.warning("%d jobs are still queued and %d leased", counts["queued"], counts["leased"])
+    logger.info("Collected %d results (%d failed jobs, %d missing)", written, len(failed), missing)
+    return 1 if failed or missing or counts["queued"] or counts["leased"] else 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    with open_queue(args.queue, lease_seconds=args.lease, max_attempts=args.max_attempts) as queue:
+        if args.command == "submit":
+            return 1 if _submit(args, queue, args.shards) else 0
+        if args.command == "worker":
+            return _work(args, queue)
+        if args.command == "status":
+            queue.requeue_expired()
+            print(" ".join(f"{state} {count}" for state, count in queue.counts().items()))
+            return 0
+        if args.command == "collect":
+            return _collect(args, queue)
+
+        # run: one shard per local worker, so each starts on its own part of the batch
+        errors = _submit(args, queue, args.workers)
+        workers = [subprocess.Popen(_worker_argv(args, index)) for index in range(args.workers)]
+        try:
+            codes = [worker.wait() for worker in workers]
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.wait()
+            return 130
+        if any(codes):
+            logger.error("Worker exit codes: %s", codes)
+        return 1 if _collect(args, queue) or errors or any(codes) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""Duplicate invoice detection: same bytes, same-looking page, same invoice.
+
+The same invoice often arrives twice: re-uploaded, re-scanned, or forwarded
+as both a PDF and a PNG. With an invoice store, BatchExtractor checks each
+new file in three steps:
+
+1. exact: a stored file has the same SHA-256. The stored result is reused
+   and nothing is OCR'd.
+2. image: the first page's dHash and pHash are close to a stored page's.
+   The page is then only region-OCR'd (header, meta and totals blocks, with
+   the usual full-page fallback), which is all step 3 needs.
+3. fields: results are blocked on (vendor, invoice number, total). A result
+   whose block already holds another file is flagged as a duplicate of it.
+
+A close image hash alone never marks a duplicate or copies fields. Invoices
+printed from one template differ only in small text. On the synthetic
+corpus, different invoices of one layout are often at distance 0 in both
+64-bit hashes, while rescans of one invoice are a few bits apart. A page
+that looks known is a strong hint, but only the extracted fields can say
+which invoice it is.
+
+Hashes are looked up by multi-index hashing. The pHash is split into four
+16-bit bands and each band is indexed. Two hashes within 3 bits of each
+other agree exactly on at least one band, so a lookup is four index probes
+plus a Hamming check of the candidates (InvoiceStore.find_similar).
+"""
+import re
+
+HASH_BANDS = 4
+_BAND_BITS = 64 // HASH_BANDS
+
+# Largest Hamming distance (of 64 bits, in both hashes) for pages that look the same.
+# Rescans and PDF/PNG copies on the synthetic corpus stay within 8 bits of dHash and
+# 2 of pHash, so the pHash bands (exact below HASH_BANDS bits) find them all.
+DEFAULT_MAX_DISTANCE = 8
+
+# Longest side of the page image hashes are computed from
+_WORKING_SIDE = 512
+# Connected ink smaller than this (pixels at _WORKING_SIDE) is scan noise
+_MIN_INK_AREA = 4
+# Skew beyond this is left alone (likely a landscape page, not a rotated scan)
+_MAX_SKEW = 10.0
+
+_NON_ALNUM = re.compile(r"[^0-9a-z]")
+
+
+def _page_gray(source, kind):
+    """Grayscale first page (None for PDFs with a text layer), longest side at least _WORKING_SIDE"""
+    import cv2
+    import numpy as np
+    from preprocessing import _REDUCED_GRAYSCALE, _encoded_buffer, _header_info
+
+    if kind == "pdf":
+        import io
+        import pdfplumber
+
+        stream = io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source
+        with pdfplumber.open(stream) as pdf:
+            # Text-layer pages are never OCR'd, so there's nothing to save by hashing them
+            if not pdf.pages or pdf.pages[0].chars:
+                return None
+            page = pdf.pages[0]
+            # pdfium downsamples embedded scans without smoothing, dropping thin strokes;
+            # render at twice the size and let cv2.INTER_AREA do the reduction instead
+            resolution = 2 * 72 * _WORKING_SIDE / max(page.width, page.height)
+            return np.asarray(page.to_image(resolution=resolution).original.convert("L"))
+
+    buffer = _encoded_buffer(source)
+    info = _header_info(buffer)
+    flags = cv2.IMREAD_GRAYSCALE
+    if info is not None:
+        for factor, reduced in _REDUCED_GRAYSCALE:
+            if max(info[0], info[1]) >= 2 * _WORKING_SIDE * factor:
+                flags = getattr(cv2, reduced)
+                break
+    return cv2.imdecode(buffer, flags)
+
+
+def _bits(flags):
+    value = 0
+    for flag in flags:
+        value = (value << 1) | int(flag)
+    return value
+
+
+def normalized_page(source, kind):
+    """First page deskewed and cropped to its ink, as ``(gray, ink)`` arrays, or None.
+
+    ``source`` is a path, bytes or a binary file object; ``kind`` is "pdf"
+    or "image" (extraction.file_kind). The longest side is at most
+    _WORKING_SIDE; ``ink`` is the page's thresholded ink without specks of
+    scan noise. PDFs with a text layer and unreadable files give None. File
+    objects are left at their current position.
+    """
+    import cv2
+
+    position = None if isinstance(source, (str, bytes, bytearray, memoryview)) else source.tell()
+    try:
+        gray = _page_gray(source, kind)
+    except Exception:
+        # Unreadable files are reported by extraction itself
+        return None
+    finally:
+        if position is not None:
+            source.seek(position)
+    if gray is None or gray.size == 0:
+        return None
+
+    scale = _WORKING_SIDE / max(gray.shape)
+    if scale < 1:
+        gray = cv2.resize(gray, (max(1, round(gray.shape[1] * scale)), max(1, round(gray.shape[0] * scale))),
+                          interpolation=cv2.INTER_AREA)
+    ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+    # Drop specks of scan noise, which would stretch the crop to the page edges and hide
+    # the skew; a median filter would also erase the thin table rules
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    specks = stats[:, cv2.CC_STAT_AREA] < _MIN_INK_AREA
+    specks[0] = False
+    if specks.any():
+        ink[specks[labels]] = 0
+    points = cv2.findNonZero(ink)
+    if points is None:
+        return None
+    (_, _), (width, height), angle = cv2.minAreaRect(points)
+    # Same angle normalisation as Preprocessor._deskew
+    if width < height:
+        angle -= 90
+    if angle > 45:
+        angle -= 90
+    elif angle < -45:
+        angle += 90
+    if 0 < abs(angle) <= _MAX_SKEW:
+        rows, cols = gray.shape
+        matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, 1.0)
+        gray = cv2.warpAffine(gray, matrix, (cols, rows), flags=cv2.INTER_LINEAR, borderValue=255)
+        ink = cv2.warpAffine(ink, matrix, (cols, rows), flags=cv2.INTER_NEAREST, borderValue=0)
+    x, y, w, h = cv2.boundingRect(ink)
+    return gray[y:y + h, x:x + w], ink[y:y + h, x:x + w]
+
+
+def page_hashes(page):
+    """``(dhash, phash)`` of a normalized_page gray page as unsigned 64-bit ints"""
+    import cv2
+    import numpy as np
+
+    small = cv2.resize(page, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    dhash = _bits((small[:, 1:] > small[:, :-1]).ravel())
+    low = cv2.dct(cv2.resize(page, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32))[:8, :8].ravel()
+    phash = _bits(low > np.median(low[1:]))
+    return dhash, phash
+
+
+def image_hashes(source, kind):
+    """``(dhash, phash)`` of the first page as unsigned 64-bit ints, or None.
+
+    The page is deskewed and cropped to its ink first (normalized_page), so
+    margins, small rotations and scan noise barely move the hashes. PDFs
+    with a text layer and unreadable files give None.
+    """
+    normalized = normalized_page(source, kind)
+    if normalized is None:
+        return None
+    return page_hashes(normalized[0])
+
+
+def hamming(a, b):
+    """Number of differing bits between two hashes"""
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+def hash_bands(value):
+    """The HASH_BANDS 16-bit bands of a 64-bit hash, most significant first"""
+    mask = (1 << _BAND_BITS) - 1
+    return [(value >> (_BAND_BITS * (HASH_BANDS - 1 - band))) & mask for band in range(HASH_BANDS)]
+
+
+def match_key(details):
+    """Blocking key ``vendor|number|total cents`` of extracted fields, or None.
+
+    Vendor and invoice number are compared case-insensitively on letters and
+    digits only, so OCR spacing and punctuation don't split a block. Results
+    without an invoice number or total aren't blocked at all.
+    """
+    from invoice_store import amount_value
+
+    number = _NON_ALNUM.sub("", (details.get("Invoice Number") or "").lower())
+    total = amount_value(details.get("Total Amount"))
+    if not number or total is None:
+        return None
+    vendor = _NON_ALNUM.sub("", (details.get("Vendor Name") or "").lower())
+    return f"{vendor}|{number}|{round(total * 100)}"
@@ -0,0 +1,238 @@
+"""Row-at-a-time writers for extracted invoice data.
+
+Every writer takes the column list up front, accepts rows (dicts keyed by
+column name) one by one and holds at most a bounded chunk of them in memory.
+``export_to_file`` streams rows into a temporary file, which is how the app
+builds downloads without assembling a DataFrame or an in-memory workbook.
+
+Excel output prefers xlsxwriter's constant-memory mode when it is installed
+and falls back to openpyxl's write-only mode; Parquet needs pyarrow.
+"""
+import csv
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+
+# Rows buffered per CSV write and per Parquet row group
+DEFAULT_CHUNK_ROWS = 10000
+
+# File extension and MIME type of each format
+EXPORT_FORMATS = {
+    "xlsx": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": (".csv", "text/csv"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+    "jsonl": (".jsonl", "application/x-ndjson"),
+}
+
+
+def _cell(value):
+    return "" if value is None else str(value)
+
+
+class _StreamWriter:
+    def __init__(self, target, columns):
+        self.columns = list(columns)
+        if target == "-":
+            self._stream = sys.stdout
+            self._owns_stream = False
+        elif hasattr(target, "write"):
+            self._stream = target
+            self._owns_stream = False
+        else:
+            self._stream = open(target, "w", encoding="utf-8", newline="")
+            self._owns_stream = True
+
+    def flush(self):
+        self._stream.flush()
+
+    def close(self):
+        self.flush()
+        if self._owns_stream:
+            self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class JSONLWriter(_StreamWriter):
+    """One JSON object per line"""
+
+    def write(self, row):
+        record = {col: row.get(col, "") for col in self.columns}
+        self._stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class CSVWriter(_StreamWriter):
+    """CSV with a header row, written ``chunk_rows`` rows at a time"""
+
+    def __init__(self, target, columns, chunk_rows=DEFAULT_CHUNK_ROWS):
+        super().__init__(target, columns)
+        self.chunk_rows = chunk_rows
+        self._pending = []
+        self._writer = csv.writer(self._stream)
+        self._writer.writerow(self.columns)
+
+    def write(self, row):
+        self._pending.append([row.get(col, "") for col in self.columns])
+        if len(self._pending) >= self.chunk_rows:
+            self._write_pending()
+
+    def _write_pending(self):
+        self._writer.writerows(self._pending)
+        self._pending = []
+
+    def flush(self):
+        if self._pending:
+            self._write_pending()
+        super().flush()
+
+
+class XLSXWriter:
+    """Excel workbook streamed to disk row by row.
+
+    With ``engine`` "xlsxwriter" (the default when it is installed) the
+    workbook uses constant-memory mode: each row goes to a temporary file as
+    soon as the next one starts and strings are stored inline, so memory
+    stays flat however many rows are written. With "openpyxl" rows are
+    streamed to a temporary worksheet file by its write-only mode, though its
+    shared strings table still grows with the number of distinct values. The
+    workbook is assembled when the writer is closed.
+    """
+
+    def __init__(self, target, columns, engine=None):
+        if target == "-":
+            raise ValueError("XLSX output needs a file path, not stdout")
+        if engine is None:
+            engine = "xlsxwriter" if importlib.util.find_spec("xlsxwriter") else "openpyxl"
+        self.engine = engine
+        self.columns = list(columns)
+        self._target = target
+        self._row = 0
+        if engine == "xlsxwriter":
+            import xlsxwriter
+
+            # Cells are strings as extracted; don't let Excel reinterpret "00123" or "1e5"
+            self._workbook = xlsxwriter.Workbook(target, {"constant_memory": True, "strings_to_numbers": False,
+                                                          "strings_to_formulas": False, "strings_to_urls": False})
+            self._sheet = self._workbook.add_worksheet()
+        elif engine == "openpyxl":
+            from openpyxl import Workbook
+
+            self._workbook = Workbook(write_only=True)
+            self._sheet = self._workbook.create_sheet()
+        else:
+            raise ValueError(f"Unknown XLSX engine: {engine}")
+        self._append(self.columns)
+
+    def _append(self, values):
+        if self.engine == "xlsxwriter":
+            self._sheet.write_row(self._row, 0, values)
+        else:
+            self._sheet.append(values)
+        self._row += 1
+
+    def write(self, row):
+        self._append([_cell(row.get(col)) for col in self.columns])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._workbook is not None:
+            if self.engine == "xlsxwriter":
+                self._workbook.close()
+            else:
+                self._workbook.save(self._target)
+            self._workbook = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ParquetWriter:
+    """Parquet file of string columns, written by pyarrow one row group per ``chunk_rows`` rows.
+
+    ``flush`` doesn't end a row group (that would leave many tiny ones when
+    called after every row); the file is only readable once closed.
+    """
+
+    def __init__(self, target, columns, chunk_rows=DEFAULT_CHUNK_ROWS):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if target == "-":
+            raise ValueError("Parquet output needs a file path, not stdout")
+        self._pa = pa
+        self.columns = list(columns)
+        self.chunk_rows = chunk_rows
+        self._schema = pa.schema([(col, pa.string()) for col in self.columns])
+        self._writer = pq.ParquetWriter(target, self._schema, compression="snappy")
+        self._pending = {col: [] for col in self.columns}
+        self._count = 0
+
+    def write(self, row):
+        for col in self.columns:
+            self._pending[col].append(_cell(row.get(col)))
+        self._count += 1
+        if self._count >= self.chunk_rows:
+            self._write_group()
+
+    def _write_group(self):
+        self._writer.write_table(self._pa.Table.from_pydict(self._pending, schema=self._schema))
+        self._pending = {col: [] for col in self.columns}
+        self._count = 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._writer is not None:
+            if self._count:
+                self._write_group()
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+WRITERS = {
+    "jsonl": JSONLWriter,
+    "csv": CSVWriter,
+    "xlsx": XLSXWriter,
+    "parquet": ParquetWriter,
+}
+
+
+def open_writer(fmt, target, columns):
+    """Create the writer for ``fmt`` ('jsonl', 'csv', 'xlsx' or 'parquet')"""
+    try:
+        writer_class = WRITERS[fmt]
+    except KeyError:
+        raise ValueError(f"Unknown output format: {fmt}") from None
+    return writer_class(target, columns)
+
+
+def export_to_file(fmt, rows, columns, directory=None):
+    """Stream ``rows`` into a new temporary ``fmt`` file and return its path; the caller deletes it"""
+    fd, path = tempfile.mkstemp(prefix="invoice-export-", suffix=EXPORT_FORMATS[fmt][0], dir=directory)
+    os.close(fd)
+    try:
+        with open_writer(fmt, path, columns) as writer:
+            for row in rows:
+                writer.write(row)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
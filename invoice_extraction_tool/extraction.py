@@ -0,0 +1,436 @@
+"""Invoice text and field extraction, independent of the Streamlit UI.
+
+pdfplumber, PIL, OpenCV and the OCR engine are imported by the functions
+that use them, so importing this module (as the app, the CLI and every batch
+worker do) takes milliseconds.
+"""
+import os
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from adaptive_ocr import SETTINGS as ADAPTIVE_OCR_SETTINGS, read_page
+from field_extractor import get_field_extractor
+from line_items import SETTINGS as LINE_ITEMS_SETTINGS, find_line_items, format_items, pdf_page_items
+from ocr_backend import get_ocr_backend
+from preprocessing import Preprocessor, get_preprocessor
+from tracing import current_context, stage
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+PDF_EXTENSIONS = ('.pdf',)
+
+# Resolution scanned PDF pages are rendered at before OCR
+DEFAULT_PDF_OCR_DPI = 300
+
+# With region OCR, a page whose region text lacks any of these is OCR'd in full
+REGION_REQUIRED_FIELDS = ("Invoice Number", "Invoice Date", "Total Amount")
+
+# Define columns for the fields we want to extract
+invoice_columns = [
+    "Invoice Number", 
+    "Invoice Date", 
+    "Due Date", 
+    "Vendor Name", 
+    "Total Amount", 
+    "Tax Amount",
+    "Currency",
+    "Invoice Items",
+    "Source File"
+]
+
+# Check if tesseract is installed and log which OCR backend will run it
+def check_tesseract():
+    backend = get_ocr_backend()
+    if backend.available:
+        logger.info(f"Tesseract OCR {backend.version()} available through the {backend.name} backend")
+    return backend.available
+
+# Name of the OCR backend in use, e.g. 'tesserocr' or 'pytesseract'
+def ocr_backend_name():
+    return get_ocr_backend().name
+
+# Result of the tesseract check, computed once per process
+_tesseract_available = None
+
+# Check for tesseract; the binary found is remembered across processes by tesseract_discovery
+def detect_tesseract():
+    global _tesseract_available
+    if _tesseract_available is None:
+        _tesseract_available = check_tesseract()
+    return _tesseract_available
+
+# Settings that change extraction output; part of every cache key
+def extraction_settings(pdf_ocr_dpi=DEFAULT_PDF_OCR_DPI, ocr_regions=False, preprocessing=None):
+    return {
+        "tesseract": detect_tesseract(),
+        "ocr_backend": ocr_backend_name(),
+        "image_preprocessing": Preprocessor(**(preprocessing or {})).settings(),
+        "ocr_config": ADAPTIVE_OCR_SETTINGS,
+        "pdf_pages": "text-layer, ocr fallback",
+        "pdf_ocr_dpi": pdf_ocr_dpi,
+        "ocr_regions": ocr_regions,
+        "line_items": LINE_ITEMS_SETTINGS,
+    }
+
+# Classify a file by extension as 'image', 'pdf' or None when unsupported
+def file_kind(filename):
+    name = filename.lower()
+    if name.endswith(IMAGE_EXTENSIONS):
+        return "image"
+    if name.endswith(PDF_EXTENSIONS):
+        return "pdf"
+    return None
+
+# Bytes read from the start of a file to tell what it is
+SNIFF_BYTES = 1024
+
+# Classify a file by its first bytes as 'image', 'pdf' or None, whatever its name says
+def sniff_kind(head):
+    # PDF readers accept the header anywhere in the first kilobyte
+    if b"%PDF-" in head[:SNIFF_BYTES]:
+        return "pdf"
+    if head.startswith((b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff")):
+        return "image"
+    return None
+
+# First bytes of raw bytes, a binary file object or a file path
+def read_head(source, size=SNIFF_BYTES):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source[:size])
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return f.read(size)
+    position = source.tell()
+    source.seek(0)
+    head = source.read(size)
+    source.seek(position)
+    return head
+
+# Classify an input by its content, falling back to its name when the content isn't recognised
+def source_kind(name, source):
+    try:
+        kind = sniff_kind(read_head(source))
+    except OSError:
+        kind = None
+    return kind or file_kind(name)
+
+# Report an extraction problem to the caller, or log it when nobody is listening
+def _report_error(on_error, message):
+    if on_error is not None:
+        on_error(message)
+    else:
+        logger.error(message)
+
+# Read one PDF page; returns its record and, for scanned pages, the raster to OCR
+def _read_pdf_page(page, number, dpi):
+    with stage("pdf_text"):
+        text = page.extract_text() or ""
+    record = {"page": number, "strategy": "text", "text": text, "items": []}
+    if text.strip():
+        with stage("items"):
+            record["items"] = pdf_page_items(page, text)
+        return record, None
+    if not detect_tesseract():
+        record["strategy"] = "empty"
+        return record, None
+    record["strategy"] = "ocr"
+    with stage("pdf_render"):
+        return record, page.to_image(resolution=dpi).original
+
+# Line items of an OCR'd page from its word boxes; region OCR skips the table, so it has none
+def _ocr_items(words):
+    if not words:
+        return []
+    with stage("items"):
+        return find_line_items(words)
+
+# Fill in a page record from its OCR result: text, confidence and line items
+def _fill_ocr_record(record, result):
+    record["text"], record["confidence"], words = result
+    record["items"] = _ocr_items(words)
+
+# Read a first page through one of its candidate vendor templates (vendor_templates.py); False
+# when it reads back as none of them, and needs OCR as usual
+def _read_template_page(record, gray, preprocessor, templates):
+    from vendor_templates import read_with_templates
+
+    with stage("ocr"):
+        result = read_with_templates(gray, preprocessor, get_ocr_backend(), templates)
+    if result is None:
+        return False
+    record["strategy"] = "template"
+    record["template"], record["text"], record["confidence"], words, record["fields"] = result
+    record["items"] = _ocr_items(words)
+    return True
+
+# Fill in the OCR results of a page record once its job has finished
+def _resolve_pdf_page(record, future, on_error):
+    if future is not None:
+        try:
+            _fill_ocr_record(record, future.result())
+        except Exception as e:
+            _report_error(on_error, f"Error running OCR on PDF page {record['page']}: {e}")
+    return record
+
+# Generator over a range of PDF pages, OCR-ing pages that have no text layer
+def iter_pdf_pages(file, start=0, stop=None, dpi=DEFAULT_PDF_OCR_DPI, ocr_workers=None, on_error=None,
+                   ocr_regions=False, preprocessing=None, templates=None):
+    """Yield one ``{"page", "strategy", "text", "items"}`` dict per page, in page order.
+
+    Pages with a text layer keep the fast ``extract_text`` path ("text").
+    Scanned pages are rasterized at ``dpi`` and sent through the same
+    preprocessing and adaptive OCR as images ("ocr", with the page's OCR
+    ``confidence``), several pages at a time on ``ocr_workers`` threads (only
+    their field regions with ``ocr_regions``). ``items`` are the page's line
+    items (see line_items.py). Given candidate vendor ``templates``, a
+    scanned first page is read from the field boxes of the first one it
+    matches ("template", with the ``fields`` read from them and the
+    ``template``'s position). Without Tesseract pages stay empty ("empty").
+    Each page's parsed layout is released as soon as it has been read, so
+    memory stays flat however long the document is, and closing the
+    generator early stops reading the file.
+    """
+    import pdfplumber
+
+    ocr_workers = ocr_workers or min(4, os.cpu_count() or 1)
+    pending = deque()  # (page record, OCR future or None) in page order
+    executor = None
+    try:
+        try:
+            with stage("pdf_open"):
+                pdf = pdfplumber.open(file)
+            with pdf:
+                for number, page in enumerate(pdf.pages[start:stop], start=start + 1):
+                    try:
+                        record, image = _read_pdf_page(page, number, dpi)
+                    finally:
+                        # Drop pdfplumber's cached chars/layout objects for this page
+                        page.close()
+
+                    future = None
+                    if image is not None and templates and number == 1:
+                        preprocessor = get_preprocessor(**(preprocessing or {}))
+                        with stage("preprocess"):
+                            gray = preprocessor.gray_from_image(image, dpi)
+                        if not _read_template_page(record, gray, preprocessor, templates):
+                            _fill_ocr_record(record, ocr_gray(gray, preprocessor, ocr_regions))
+                        image = None
+                    if image is not None:
+                        # Rendering isn't thread-safe, so only the OCR runs on the threads
+                        if ocr_workers == 1:
+                            _fill_ocr_record(record, ocr_page_image(image, ocr_regions,
+                                                                    preprocessing=preprocessing, dpi=dpi))
+                        else:
+                            if executor is None:
+                                executor = ThreadPoolExecutor(max_workers=ocr_workers)
+                            # Run in a copy of this context so the page's stages are traced too
+                            future = executor.submit(current_context().run, ocr_page_image, image, ocr_regions,
+                                                     preprocessing=preprocessing, dpi=dpi)
+                    pending.append((record, future))
+                    del image
+
+                    # Hand pages over as soon as they are ready, keeping a couple of rasters per thread
+                    while pending and (pending[0][1] is None or pending[0][1].done()
+                                       or len(pending) > ocr_workers * 2):
+                        yield _resolve_pdf_page(*pending.popleft(), on_error)
+        except Exception as e:
+            _report_error(on_error, f"Error extracting text from PDF: {e}")
+        while pending:
+            yield _resolve_pdf_page(*pending.popleft(), on_error)
+    finally:
+        if executor is not None:
+            for _, future in pending:
+                if future is not None:
+                    future.cancel()
+            executor.shutdown()
+
+# Function to extract a range of PDF pages as a list of page records
+def extract_pdf_pages(file, start=0, stop=None, dpi=DEFAULT_PDF_OCR_DPI, ocr_workers=None, on_error=None,
+                      ocr_regions=False, preprocessing=None, templates=None):
+    return list(iter_pdf_pages(file, start, stop, dpi=dpi, ocr_workers=ocr_workers, on_error=on_error,
+                               ocr_regions=ocr_regions, preprocessing=preprocessing, templates=templates))
+
+# Function to extract text from a range of PDF pages
+def extract_text_from_pdf_pages(file, start=0, stop=None, dpi=DEFAULT_PDF_OCR_DPI, on_error=None,
+                                ocr_regions=False, preprocessing=None):
+    pages = iter_pdf_pages(file, start, stop, dpi=dpi, on_error=on_error, ocr_regions=ocr_regions,
+                           preprocessing=preprocessing)
+    return "".join(page["text"] + "\n" for page in pages)
+
+# Function to size up a PDF without extracting any text: its page count, first page size in
+# points and whether that page uses fonts (has a text layer, so no OCR), for costing it
+def pdf_layout(file):
+    import pdfplumber
+    from pdfminer.pdftypes import resolve1
+
+    with pdfplumber.open(file) as pdf:
+        if not pdf.pages:
+            return {"pages": 0, "width": 0.0, "height": 0.0, "text_layer": False}
+        page = pdf.pages[0]
+        resources = resolve1(page.page_obj.resources) or {}
+        return {"pages": len(pdf.pages), "width": float(page.width), "height": float(page.height),
+                "text_layer": bool(resolve1(resources.get("Font")))}
+
+# Function to extract text from PDF files
+def extract_text_from_pdf(file, dpi=DEFAULT_PDF_OCR_DPI, on_error=None, ocr_regions=False, preprocessing=None):
+    return extract_text_from_pdf_pages(file, dpi=dpi, on_error=on_error, ocr_regions=ocr_regions,
+                                       preprocessing=preprocessing)
+
+# Preprocessing for better OCR results: grayscale, resolution normalisation and Otsu threshold.
+# ``preprocessing`` holds Preprocessor options (target_dpi, deskew, denoise); the result is
+# a per-thread buffer that is reused by the next image of the same size
+def preprocess_for_ocr(image, preprocessing=None, dpi=None):
+    with stage("preprocess"):
+        return get_preprocessor(**(preprocessing or {})).from_image(image, dpi)
+
+# OCR only the header, meta and totals blocks of a binarized page; None when none were found
+def ocr_field_regions(binary, workers=1):
+    from layout_regions import find_text_regions, select_field_regions
+
+    with stage("layout"):
+        regions = select_field_regions(find_text_regions(binary))
+    if not regions:
+        return None
+    backend = get_ocr_backend()
+
+    def read(region):
+        return backend.image_to_string(region.crop(binary), psm=region.psm)
+
+    if workers > 1 and len(regions) > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(regions))) as pool:
+            texts = list(pool.map(read, regions))
+    else:
+        texts = [read(region) for region in regions]
+    return "".join(text.strip("\f\n") + "\n" for text in texts)
+
+# Run Tesseract on a PIL image (such as a rasterized PDF page)
+def ocr_image(image, regions=False, workers=1, preprocessing=None, dpi=None):
+    return ocr_page_image(image, regions, workers, preprocessing, dpi)[0]
+
+# OCR a PIL image adaptively; returns its text, mean word confidence and word boxes
+def ocr_page_image(image, regions=False, workers=1, preprocessing=None, dpi=None):
+    preprocessor = get_preprocessor(**(preprocessing or {}))
+    with stage("preprocess"):
+        gray = preprocessor.gray_from_image(image, dpi)
+    return ocr_gray(gray, preprocessor, regions, workers)
+
+# OCR a grayscale page: region OCR if asked for, otherwise (or when regions miss fields)
+# adaptive OCR. Returns the text, its mean word confidence and the word boxes (None for region text)
+def ocr_gray(gray, preprocessor, regions=False, workers=1):
+    if regions:
+        with stage("preprocess"):
+            binary = preprocessor.binarize(gray)
+        with stage("ocr"):
+            text = ocr_field_regions(binary, workers)
+            if text is not None:
+                matches, _ = get_field_extractor().find(text)
+                if all(matches[field] is not None for field in REGION_REQUIRED_FIELDS):
+                    return text, None, None
+                logger.debug("Region OCR missed required fields; falling back to full-page OCR")
+    with stage("ocr"):
+        return read_page(gray, preprocessor, get_ocr_backend())
+
+# Run Tesseract on a binarized page, optionally on its field regions only
+def ocr_binary(binary, regions=False, workers=1):
+    with stage("ocr"):
+        if regions:
+            text = ocr_field_regions(binary, workers)
+            if text is not None:
+                matches, _ = get_field_extractor().find(text)
+                if all(matches[field] is not None for field in REGION_REQUIRED_FIELDS):
+                    return text
+                logger.debug("Region OCR missed required fields; falling back to full-page OCR")
+        return get_ocr_backend().image_to_string(binary)
+
+# Function to extract text from image files with fallback
+def extract_text_from_image(file, on_error=None, ocr_regions=False, ocr_workers=None, preprocessing=None):
+    return extract_image_page(file, on_error, ocr_regions, ocr_workers, preprocessing)["text"]
+
+# Extract the text of an image file as a page record like iter_pdf_pages yields; with candidate
+# vendor templates, through the field boxes of the first one the page matches
+def extract_image_page(file, on_error=None, ocr_regions=False, ocr_workers=None, preprocessing=None,
+                       templates=None):
+    record = {"page": 1, "strategy": "empty", "text": "", "items": []}
+    try:
+        # If tesseract is available, decode straight to grayscale and OCR adaptively
+        if detect_tesseract():
+            preprocessor = get_preprocessor(**(preprocessing or {}))
+            with stage("decode"):
+                gray = preprocessor.decode(file)
+            if templates and _read_template_page(record, gray, preprocessor, templates):
+                return record
+            record["strategy"] = "ocr"
+            _fill_ocr_record(record, ocr_gray(gray, preprocessor, ocr_regions,
+                                              ocr_workers or min(4, os.cpu_count() or 1)))
+            return record
+        # Without Tesseract the image can't be read. Report it as an error, so the empty result is neither
+        # cached nor stored as a clean one and the file is extracted again once Tesseract is installed
+        _report_error(on_error, "Image text extraction requires Tesseract OCR. Install Tesseract to read images.")
+        return record
+    except Exception as e:
+        _report_error(on_error, f"Error extracting text from image: {e}")
+        return record
+
+# Function to extract invoice details using regex patterns; with line items found on the
+# pages, "Invoice Items" lists them instead of the text after the items label, and
+# ``fields`` read from a vendor template's boxes take the place of the parsed ones
+def extract_invoice_details(text, filename, items=None, fields=None):
+    with stage("parse"):
+        details = get_field_extractor().extract(text, filename, invoice_columns)
+    for field, value in (fields or {}).items():
+        if value:
+            details[field] = value
+    if items:
+        details["Invoice Items"] = format_items(items)
+    return details
+
+# Extract invoice details from page texts, reading no more pages than needed
+def extract_invoice_details_from_pages(pages, filename, items=None):
+    """Like extract_invoice_details on the joined pages, but stops pulling pages
+    once later pages can no longer change any field. Settledness is checked
+    after pages 2, 4, 8, ... so the checks cost O(n) in total. ``items`` may
+    still be filling up while ``pages`` is read.
+    """
+    extractor = get_field_extractor()
+    parts = []
+    length = 0
+    next_check = 2
+    try:
+        for count, page_text in enumerate(pages, start=1):
+            boundary = length
+            parts.append(page_text + "\n")
+            length += len(parts[-1])
+            if count == next_check:
+                next_check *= 2
+                if extractor.settled("".join(parts), boundary):
+                    break
+    finally:
+        close = getattr(pages, "close", None)
+        if close is not None:
+            close()
+    return extract_invoice_details("".join(parts), filename, items)
+
+# Extract invoice details from a PDF or image on disk; PDF pages are read only until every field is settled
+def extract_file(path, on_error=None, ocr_regions=False, preprocessing=None):
+    kind = source_kind(str(path), path)
+    filename = os.path.basename(str(path))
+    if kind == "image":
+        record = extract_image_page(path, on_error=on_error, ocr_regions=ocr_regions,
+                                    preprocessing=preprocessing)
+        return extract_invoice_details(record["text"], filename, record["items"])
+    if kind == "pdf":
+        records = iter_pdf_pages(path, on_error=on_error, ocr_regions=ocr_regions, preprocessing=preprocessing)
+        items = []
+
+        def pages():
+            try:
+                for record in records:
+                    items.extend(record["items"])
+                    yield record["text"]
+            finally:
+                # Stopping early closes the PDF instead of leaving it to the garbage collector
+                records.close()
+
+        return extract_invoice_details_from_pages(pages(), filename, items)
+    raise ValueError(f"Unsupported file type: {path}")
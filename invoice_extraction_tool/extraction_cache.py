@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Bump when the shape of cached values changes so stale entries are ignored
+CACHE_FORMAT_VERSION = 3
+
+DEFAULT_MEMORY_ITEMS = 256
+DEFAULT_DISK_BYTES = 512 * 1024 * 1024
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def default_cache_dir():
+    """Return the on-disk cache location, honouring INVOICE_EXTRACTOR_CACHE_DIR"""
+    override = os.environ.get("INVOICE_EXTRACTOR_CACHE_DIR")
+    if override:
+        return override
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "invoice_extractor", "extractions")
+
+
+def file_digest(source):
+    """SHA-256 hex digest of raw bytes, a binary file object or a file path"""
+    hasher = hashlib.sha256()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        hasher.update(source)
+    elif isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+    else:
+        position = source.tell()
+        source.seek(0)
+        for chunk in iter(lambda: source.read(_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+        source.seek(position)
+    return hasher.hexdigest()
+
+
+def cache_key(digest, settings):
+    """Combine a file digest with the OCR/preprocessing settings that produced the result"""
+    fingerprint = json.dumps(
+        {"format": CACHE_FORMAT_VERSION, "settings": settings},
+        sort_keys=True,
+        default=str,
+    )
+    settings_hash = hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:16]
+    return f"{digest}-{settings_hash}"
+
+
+class ExtractionCache:
+    """Two-tier (memory LRU + size-bounded disk) cache of extraction results.
+
+    Values must be JSON serialisable. The disk tier stores one file per key,
+    sharded by the first two characters of the key, and evicts the least
+    recently used entries once ``max_disk_bytes`` is exceeded.
+
+    With ``evict=False`` the disk tier is never evicted, so nothing is
+    tracked for it: the directory isn't scanned at start-up and reads don't
+    touch files. That suits a large directory shared by many processes.
+    """
+
+    def __init__(self, directory=None, max_memory_items=DEFAULT_MEMORY_ITEMS,
+                 max_disk_bytes=DEFAULT_DISK_BYTES, evict=True):
+        self.directory = directory if directory is not None else default_cache_dir()
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.evict = evict
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        # key -> size on disk, ordered from least to most recently used
+        self._disk_entries = OrderedDict()
+        self._disk_bytes = 0
+        self._disk_enabled = bool(self.directory) and max_disk_bytes > 0
+        if self._disk_enabled:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                if evict:
+                    self._load_disk_index()
+            except OSError:
+                self._disk_enabled = False
+
+    def _path_for(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def _scan_disk(self):
+        """(mtime, key, size) of every entry in the directory"""
+        entries = []
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, entry.name[:-5], stat.st_size))
+        return entries
+
+    def _load_disk_index(self):
+        for _, key, size in sorted(self._scan_disk()):
+            self._disk_entries[key] = size
+            self._disk_bytes += size
+
+    def get(self, key):
+        """Return the cached value for ``key`` or None"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+
+        value = self._read_disk(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        """Store ``value`` in both tiers"""
+        with self._lock:
+            self._remember(key, value)
+        self._write_disk(key, value)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._memory or key in self._disk_entries:
+                return True
+        return not self.evict and self.on_disk(key)
+
+    def on_disk(self, key):
+        """Whether ``key`` has been written to the disk tier (by this or another process)"""
+        return self._disk_enabled and os.path.exists(self._path_for(key))
+
+    def clear(self):
+        """Drop every cached entry from memory and disk"""
+        with self._lock:
+            self._memory.clear()
+            keys = list(self._disk_entries)
+            self._disk_entries.clear()
+            self._disk_bytes = 0
+        if self._disk_enabled and not self.evict:
+            try:
+                keys = [key for _, key, _ in self._scan_disk()]
+            except OSError:
+                pass
+        for key in keys:
+            self._remove_file(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_items": len(self._memory),
+                "disk_items": len(self._disk_entries),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key):
+        if not self._disk_enabled:
+            return None
+        path = self._path_for(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            if not self.evict:
+                return value
+            # Touch the file so eviction after a restart still follows access order
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            if key in self._disk_entries:
+                self._disk_entries.move_to_end(key)
+            else:
+                # Written by another process sharing the directory
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                self._disk_entries[key] = size
+                self._disk_bytes += size
+        return value
+
+    def _write_disk(self, key, value):
+        if not self._disk_enabled:
+            return
+        path = self._path_for(key)
+        payload = json.dumps(value, default=str).encode("utf-8")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        if not self.evict:
+            return
+
+        evicted = []
+        with self._lock:
+            self._disk_bytes -= self._disk_entries.pop(key, 0)
+            self._disk_entries[key] = len(payload)
+            self._disk_bytes += len(payload)
+            while self._disk_bytes > self.max_disk_bytes and len(self._disk_entries) > 1:
+                old_key, old_size = self._disk_entries.popitem(last=False)
+                self._disk_bytes -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            self._remove_file(old_key)
+
+    def _remove_file(self, key):
+        try:
+            os.remove(self._path_for(key))
+        except OSError:
+            pass
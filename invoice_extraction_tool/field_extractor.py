@@ -0,0 +1,296 @@
+"""Single-pass invoice field extraction.
+
+Every field pattern starts with a literal label ("Invoice", "Due", "Total",
+...). Instead of running each pattern over the whole text, one compiled
+keyword scanner finds every label occurrence in a single left-to-right pass
+and only the patterns that start with that label are tried, anchored at the
+hit. Because hits are visited in text order, the first anchored match of a
+pattern is the same match ``re.search`` would return, so results (including
+field priority order) are identical to searching pattern by pattern.
+"""
+import re
+
+_DATE = r'(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})'
+_AMOUNT = r'[\$\€\£]?\s*([\d,]+\.\d{2})'
+_NAME = r"([A-Za-z0-9\s\.,&\-\']+)(?=\n)"
+
+# Patterns per field, highest priority first
+FIELD_PATTERNS = [
+    ("Invoice Number", [
+        r'Invoice\s*(?:#|No|Number|Num)[:.\s]*([A-Z0-9\-_]+)',
+        r'Invoice\s*ID[:.\s]*([A-Z0-9\-_]+)',
+        r'Invoice[:.\s]*([A-Z0-9\-_]+)',
+    ]),
+    ("Invoice Date", [
+        r'Invoice\s*Date[:.\s]*' + _DATE,
+        r'Date[:.\s]*' + _DATE,
+        r'Date\s*Issued[:.\s]*' + _DATE,
+        r'Issued\s*Date[:.\s]*' + _DATE,
+    ]),
+    ("Due Date", [
+        r'Due\s*Date[:.\s]*' + _DATE,
+        r'Payment\s*Due[:.\s]*' + _DATE,
+    ]),
+    ("Vendor Name", [
+        r'Vendor\s*Name[:.\s]*' + _NAME,
+        r'Supplier[:.\s]*' + _NAME,
+        r'From[:.\s]*' + _NAME,
+        r'Seller[:.\s]*' + _NAME,
+    ]),
+    ("Total Amount", [
+        r'Total(?:\s*Amount)?[:.\s]*' + _AMOUNT,
+        r'Amount\s*Due[:.\s]*' + _AMOUNT,
+        r'Grand\s*Total[:.\s]*' + _AMOUNT,
+        r'Balance\s*Due[:.\s]*' + _AMOUNT,
+    ]),
+    ("Tax Amount", [
+        r'Tax(?:\s*Amount)?[:.\s]*' + _AMOUNT,
+        r'VAT[:.\s]*' + _AMOUNT,
+        r'GST[:.\s]*' + _AMOUNT,
+        r'Sales\s*Tax[:.\s]*' + _AMOUNT,
+    ]),
+    ("Currency", [
+        r'Currency[:.\s]*([A-Z]{3})',
+        r'[\$\€\£\¥]',  # Currency symbols
+    ]),
+]
+
+# Labels that open the line item block, highest priority first
+ITEM_LABELS = [
+    r'Item\s*Description',
+    r'Description\s*Quantity\s*Rate',
+    r'Product\s*Description',
+]
+
+# Words that close the line item block
+ITEM_TERMINATORS = ["Total", "Balance", "Due"]
+
+CURRENCY_SYMBOLS = {'$': 'USD', '€': 'EUR', '£': 'GBP', '¥': 'JPY'}
+
+# Header lines that are never the vendor name
+_NON_VENDOR_WORDS = ['invoice', 'bill', 'receipt', 'statement']
+
+_SYMBOL_KEYWORD = "symbol"
+
+# Bound on memoised scanners (one per set of still-relevant keywords)
+_MAX_SCANNERS = 512
+
+# Non-ASCII characters that re.IGNORECASE equates with ASCII letters but
+# str.lower() does not; texts containing them use the case-insensitive scanner
+_SPECIAL_CASE_FOLDS = re.compile('[\u0130\u0131\u017f\u212a]')
+
+
+def _leading_keyword(pattern):
+    match = re.match(r'[A-Za-z]+', pattern)
+    return match.group(0).lower() if match else _SYMBOL_KEYWORD
+
+
+class FieldExtractor:
+    """Compiled extractor for the fields in ``FIELD_PATTERNS`` plus line items"""
+
+    def __init__(self, field_patterns=FIELD_PATTERNS, item_labels=ITEM_LABELS,
+                 item_terminators=ITEM_TERMINATORS):
+        self.fields = [field for field, _ in field_patterns]
+        # keyword -> [(field index, priority, compiled pattern)] in priority order
+        self._anchored = {}
+        for field_index, (_, patterns) in enumerate(field_patterns):
+            for priority, pattern in enumerate(patterns):
+                self._anchored.setdefault(_leading_keyword(pattern), []).append(
+                    (field_index, priority, re.compile(pattern, re.IGNORECASE))
+                )
+        self._item_labels = {}
+        for priority, label in enumerate(item_labels):
+            self._item_labels.setdefault(_leading_keyword(label), []).append(
+                (priority, re.compile(label, re.IGNORECASE))
+            )
+        self._terminator = re.compile(
+            "|".join(re.escape(word) for word in item_terminators), re.IGNORECASE
+        )
+
+        keywords = set(self._anchored) | set(self._item_labels)
+        # Longest first, so a hit on "taxes" also covers patterns keyed on "tax"
+        self._keywords = sorted(keywords, key=lambda kw: (kw == _SYMBOL_KEYWORD, -len(kw), kw))
+        # keyword or symbol hit -> every keyword that is a prefix of it (itself included)
+        self._covered = {
+            kw: [k for k in self._keywords if kw.startswith(k)] for kw in self._keywords
+        }
+        for symbol in [_SYMBOL_KEYWORD] + list(CURRENCY_SYMBOLS):
+            self._covered[symbol] = [_SYMBOL_KEYWORD]
+        self._field_slots = [
+            [(priority, _leading_keyword(pattern)) for priority, pattern in enumerate(patterns)]
+            for _, patterns in field_patterns
+        ]
+        self._item_slots = [(priority, _leading_keyword(label)) for priority, label in enumerate(item_labels)]
+        self._live_counts = {kw: 0 for kw in self._keywords}
+        for slots in self._field_slots + [self._item_slots]:
+            for _, keyword in slots:
+                self._live_counts[keyword] += 1
+        self._scanners = {}
+
+    def _scanner(self, keywords, folded):
+        """Compiled alternation of ``keywords``, memoised per keyword set"""
+        cache_key = (keywords, folded)
+        scanner = self._scanners.get(cache_key)
+        if scanner is None:
+            # Case-insensitive alternations are slow in sre, so lower-cased
+            # text is scanned for lower-case keywords whenever that is exact.
+            # There the hit text is the keyword itself; otherwise named groups
+            # (which also slow sre down) identify it.
+            if folded:
+                alternatives = [re.escape(kw) for kw in self._keywords
+                                if kw in keywords and kw != _SYMBOL_KEYWORD]
+                symbols = r'[\$\€\£\¥]'
+            else:
+                alternatives = [f"(?P<{kw}>{re.escape(kw)})" for kw in self._keywords
+                                if kw in keywords and kw != _SYMBOL_KEYWORD]
+                symbols = rf"(?P<{_SYMBOL_KEYWORD}>[\$\€\£\¥])"
+            if _SYMBOL_KEYWORD in keywords:
+                alternatives.append(symbols)
+            flags = 0 if folded else re.IGNORECASE
+            scanner = re.compile("|".join(alternatives), flags) if alternatives else None
+            if len(self._scanners) >= _MAX_SCANNERS:
+                self._scanners.clear()
+            self._scanners[cache_key] = scanner
+        return scanner
+
+    def _search(self, text):
+        # Returns the best (priority, match) per field and the best line item
+        # block as (priority, start, end, terminator end)
+        field_count = len(self.fields)
+        best = [None] * field_count
+        item_best = None
+        terminator_memo = [-1, None]  # last query position and the span found from it
+
+        def next_terminator(pos):
+            query, answer = terminator_memo
+            if query >= 0 and query <= pos and (answer is None or pos <= answer[0]):
+                return answer
+            found = self._terminator.search(text, pos)
+            answer = found.span() if found else None
+            terminator_memo[0], terminator_memo[1] = pos, answer
+            return answer
+
+        # Patterns per keyword that could still change a result
+        live = dict(self._live_counts)
+        dead_keywords = []
+
+        def settle(slots, old, new):
+            # Patterns ranked from ``new`` up to (not including) ``old`` can no longer win
+            for priority, keyword in slots[new:old]:
+                live[keyword] -= 1
+                if live[keyword] == 0:
+                    dead_keywords.append(keyword)
+
+        folded = _SPECIAL_CASE_FOLDS.search(text) is None
+        haystack = text.lower() if folded else text
+        active = frozenset(self._keywords)
+        scanner = self._scanner(active, folded)
+        pos = 0
+        while scanner is not None:
+            hit_match = scanner.search(haystack, pos)
+            if hit_match is None:
+                break
+            pos = hit_match.start()
+            hit = hit_match.lastgroup or hit_match.group()
+            for keyword in self._covered[hit]:
+                for field_index, priority, pattern in self._anchored.get(keyword, ()):
+                    current = best[field_index]
+                    if current is not None and current[0] <= priority:
+                        continue
+                    match = pattern.match(text, pos)
+                    if match:
+                        old = current[0] if current is not None else len(self._field_slots[field_index])
+                        best[field_index] = (priority, match)
+                        settle(self._field_slots[field_index], old, priority)
+
+                for priority, label in self._item_labels.get(keyword, ()):
+                    if item_best is not None and item_best[0] <= priority:
+                        continue
+                    label_match = label.match(text, pos)
+                    if label_match:
+                        terminator = next_terminator(label_match.end())
+                        if terminator is not None:
+                            old = item_best[0] if item_best is not None else len(self._item_slots)
+                            item_best = (priority, label_match.end(), terminator[0], terminator[1])
+                            settle(self._item_slots, old, priority)
+
+            if dead_keywords:
+                # Stop looking for labels whose patterns can no longer change a result
+                active = active.difference(dead_keywords)
+                dead_keywords.clear()
+                scanner = self._scanner(active, folded)
+            pos += 1
+
+        return best, item_best
+
+    def find(self, text):
+        """Return ``(field_matches, items_text)``.
+
+        ``field_matches`` maps each field to the regex match of its highest
+        priority pattern (None when nothing matched); ``items_text`` is the raw
+        text between the first line item label and the following terminator,
+        or None.
+        """
+        best, item_best = self._search(text)
+        field_matches = {
+            field: (best[i][1] if best[i] is not None else None)
+            for i, field in enumerate(self.fields)
+        }
+        items_text = text[item_best[1]:item_best[2]] if item_best is not None else None
+        return field_matches, items_text
+
+    def settled(self, text, boundary):
+        """True when text appended after ``text`` can no longer change any field.
+
+        That holds once every field (and the line item block) has matched its
+        highest priority pattern entirely before ``boundary``, the start of the
+        most recently appended page.
+        """
+        best, item_best = self._search(text)
+        if item_best is None or item_best[0] != 0 or item_best[3] > boundary:
+            return False
+        return all(
+            entry is not None and entry[0] == 0 and entry[1].end() <= boundary
+            for entry in best
+        )
+
+    def extract(self, text, filename, columns):
+        """Build the invoice details dict for ``columns``, as extract_invoice_details does"""
+        details = {col: "" for col in columns}
+        details["Source File"] = filename
+
+        matches, items_text = self.find(text)
+        for field, match in matches.items():
+            if match is None:
+                continue
+            if field == "Currency":
+                symbol = match.group(0)
+                details[field] = CURRENCY_SYMBOLS.get(symbol) or match.group(1).strip()
+            else:
+                details[field] = match.group(1).strip()
+
+        # If no vendor name found, try to find it from the top of the invoice
+        if not details.get("Vendor Name"):
+            lines = text.split('\n')
+            for line in lines[:5]:
+                if line and not any(keyword in line.lower() for keyword in _NON_VENDOR_WORDS):
+                    details["Vendor Name"] = line.strip()
+                    break
+
+        # Simplify items text - just grab a few lines
+        items_text = items_text.strip() if items_text else ""
+        if items_text:
+            items_text = '\n'.join(items_text.split('\n')[:5])
+        details["Invoice Items"] = items_text
+        return details
+
+
+_default_extractor = None
+
+
+def get_field_extractor():
+    """Shared FieldExtractor, compiled on first use"""
+    global _default_extractor
+    if _default_extractor is None:
+        _default_extractor = FieldExtractor()
+    return _default_extractor
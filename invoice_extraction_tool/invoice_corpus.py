@@ -0,0 +1,234 @@
+"""Seeded synthetic invoice corpus with ground truth.
+
+Builds on sample_invoice's layout. Invoice ``i`` of a corpus is generated
+from ``Random(f"{seed}:{i}")``, so the same seed always gives the same files
+however many processes share the work. Each invoice is written in the
+requested formats:
+
+- ``png``: the rendered page with optional rotation, blur and noise
+- ``pdf-text``: a one-page PDF with a real text layer (no OCR needed)
+- ``pdf-scan``: the degraded page as a JPEG inside a PDF, like a scanner makes
+
+Every file gets a ``<name>.json`` sidecar holding the fields extraction
+should produce, the line items, the layout variation and the degradations
+applied. ``manifest.json`` records the parameters of the run.
+
+    python invoice_corpus.py corpus/ --count 2000 --seed 7 --jobs 8
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from PIL import Image, ImageChops, ImageFilter
+
+from sample_invoice import (
+    PAGE_WIDTH,
+    invoice_drawing,
+    random_invoice,
+    random_layout,
+    render_invoice_image,
+)
+
+FORMATS = ("png", "pdf-text", "pdf-scan")
+
+# Dates are relative to this so a seed always produces the same invoices
+CORPUS_TODAY = datetime(2025, 6, 30)
+
+# A4 in PDF points
+PDF_PAGE_WIDTH, PDF_PAGE_HEIGHT = 595.0, 842.0
+
+# Nominal DPI of the rendered page (PAGE_WIDTH pixels across an A4 page)
+RENDER_DPI = round(PAGE_WIDTH / (PDF_PAGE_WIDTH / 72))
+
+NO_DEGRADATION = {"rotation": 0.0, "blur": 0.0, "noise": 0.0}
+
+
+def _pdf_string(text):
+    # Helvetica with WinAnsiEncoding covers the symbols the layouts use (€ is 0x80)
+    data = text.encode("cp1252", errors="replace")
+    return b"(" + data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def write_text_pdf(path, ops):
+    """Write sample_invoice drawing operations as a single-page PDF with a text layer"""
+    scale = PDF_PAGE_WIDTH / PAGE_WIDTH
+    content = []
+    for op in ops:
+        if op[0] == "text":
+            _, x, y, value, size = op
+            # PIL positions the top of the text, PDF the baseline
+            baseline = PDF_PAGE_HEIGHT - (y + size * 0.8) * scale
+            content.append(b"BT /F1 %.2f Tf %.2f %.2f Td %s Tj ET"
+                           % (size * scale, x * scale, baseline, _pdf_string(value)))
+        else:
+            _, x1, y1, x2, y2, width = op
+            content.append(b"%.2f w %.2f %.2f m %.2f %.2f l S" % (
+                width * scale, x1 * scale, PDF_PAGE_HEIGHT - y1 * scale,
+                x2 * scale, PDF_PAGE_HEIGHT - y2 * scale))
+    stream = b"\n".join(content)
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.0f %.0f] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>" % (PDF_PAGE_WIDTH, PDF_PAGE_HEIGHT),
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    with open(path, "wb") as f:
+        f.write(out.getvalue())
+
+
+def random_degradation(rng):
+    """Scan/photo artefacts to apply to a rendered page"""
+    return {
+        "rotation": round(rng.uniform(-2.0, 2.0), 2) if rng.random() < 0.5 else 0.0,
+        "blur": round(rng.uniform(0.3, 1.2), 2) if rng.random() < 0.3 else 0.0,
+        "noise": round(rng.uniform(4, 18), 1) if rng.random() < 0.5 else 0.0,
+    }
+
+
+def degrade(image, degradation):
+    """Apply ``degradation`` (from random_degradation) to a page image"""
+    if degradation["rotation"]:
+        image = image.rotate(degradation["rotation"], resample=Image.BILINEAR, fillcolor="white")
+    if degradation["blur"]:
+        image = image.filter(ImageFilter.GaussianBlur(degradation["blur"]))
+    if degradation["noise"]:
+        # Gaussian noise centred on 128, added around each pixel
+        noise = Image.effect_noise(image.size, degradation["noise"]).convert(image.mode)
+        image = ImageChops.add(image, noise, 1.0, -128)
+    return image
+
+
+def _write_sidecar(path, record):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(record, f, ensure_ascii=False, indent=2)
+
+
+def generate_invoice(out_dir, index, seed, formats=FORMATS, vary_layout=True, degrade_pages=True):
+    """Generate invoice ``index`` of the corpus in each of ``formats``; returns the file names"""
+    rng = random.Random(f"{seed}:{index}")
+    layout = random_layout(rng) if vary_layout else None
+    invoice = random_invoice(rng, layout, today=CORPUS_TODAY)
+    ops = invoice_drawing(invoice)
+    degradation = random_degradation(rng) if degrade_pages else NO_DEGRADATION
+
+    page = None
+    written = []
+    for fmt in formats:
+        stem = f"invoice_{index:06d}_{fmt.replace('-', '_')}"
+        if fmt == "pdf-text":
+            name = stem + ".pdf"
+            write_text_pdf(os.path.join(out_dir, name), ops)
+            applied = NO_DEGRADATION
+        else:
+            if page is None:
+                page = degrade(render_invoice_image(ops), degradation)
+            applied = degradation
+            if fmt == "png":
+                name = stem + ".png"
+                page.save(os.path.join(out_dir, name), dpi=(RENDER_DPI, RENDER_DPI))
+            elif fmt == "pdf-scan":
+                name = stem + ".pdf"
+                # Fixed dates keep the file byte-identical for a given seed
+                page.convert("L").save(os.path.join(out_dir, name), "PDF", resolution=RENDER_DPI, quality=85,
+                                       creationDate=CORPUS_TODAY.timetuple(),
+                                       modDate=CORPUS_TODAY.timetuple())
+            else:
+                raise ValueError(f"Unknown corpus format: {fmt}")
+        _write_sidecar(os.path.join(out_dir, os.path.splitext(name)[0] + ".json"), {
+            "file": name,
+            "format": fmt,
+            "index": index,
+            "seed": seed,
+            "fields": invoice["fields"],
+            "items": invoice["items"],
+            "layout": invoice["layout"],
+            "degradation": applied,
+        })
+        written.append(name)
+    return written
+
+
+def _generate_range(out_dir, start, stop, seed, formats, vary_layout, degrade_pages):
+    return [name for index in range(start, stop)
+            for name in generate_invoice(out_dir, index, seed, formats, vary_layout, degrade_pages)]
+
+
+def generate_corpus(out_dir, count, seed=0, formats=FORMATS, jobs=None, vary_layout=True,
+                    degrade_pages=True, chunk_size=None):
+    """Generate ``count`` invoices under ``out_dir`` on ``jobs`` processes; returns the file names"""
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = jobs or os.cpu_count() or 1
+    # A few chunks per process keeps them all busy without per-invoice task overhead
+    chunk_size = chunk_size or max(1, min(25, count // (jobs * 4)))
+    ranges = [(start, min(start + chunk_size, count)) for start in range(0, count, chunk_size)]
+    args = (seed, tuple(formats), vary_layout, degrade_pages)
+    written = []
+    if jobs == 1:
+        for start, stop in ranges:
+            written.extend(_generate_range(out_dir, start, stop, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_generate_range, out_dir, start, stop, *args) for start, stop in ranges]
+            for future in futures:
+                written.extend(future.result())
+    _write_sidecar(os.path.join(out_dir, "manifest.json"), {
+        "count": count,
+        "seed": seed,
+        "formats": list(formats),
+        "vary_layout": vary_layout,
+        "degrade": degrade_pages,
+        "files": len(written),
+    })
+    return written
+
+
+def load_corpus(corpus_dir):
+    """Ground-truth sidecars of a corpus, sorted by file name"""
+    records = []
+    for name in sorted(os.listdir(corpus_dir)):
+        if name.endswith(".json") and name != "manifest.json":
+            with open(os.path.join(corpus_dir, name), "r", encoding="utf-8") as f:
+                record = json.load(f)
+            record["path"] = os.path.join(corpus_dir, record["file"])
+            records.append(record)
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic invoice corpus with ground truth.")
+    parser.add_argument("output", help="directory to write the corpus to")
+    parser.add_argument("-n", "--count", type=int, default=100, help="number of invoices (default: 100)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-f", "--formats", nargs="+", choices=FORMATS, default=list(FORMATS))
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--plain", action="store_true",
+                        help="only the original layout, without rotation, blur or noise")
+    args = parser.parse_args(argv)
+
+    written = generate_corpus(args.output, args.count, args.seed, args.formats, args.jobs,
+                              vary_layout=not args.plain, degrade_pages=not args.plain)
+    print(f"Wrote {len(written)} files for {args.count} invoices to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,290 @@
+"""invoice-extract: bulk invoice extraction from the command line.
+
+Examples:
+
+    python invoice_extract.py invoices/ -o results.jsonl
+    python invoice_extract.py "scans/**/*.png" --format csv -o results.csv --jobs 8
+    python invoice_extract.py deliveries/*.zip -o results.jsonl
+    find inbox -name '*.pdf' | python invoice_extract.py - -o results.xlsx --resume
+
+Nothing here imports Streamlit; the extraction itself comes from extraction.py
+and runs on the BatchExtractor process pool.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+
+from adaptive_ocr import REVIEW_CONFIDENCE
+from archive_ingest import expand_archives, is_archive_name
+from batch_extraction import BatchExtractor
+from batch_scheduler import add_scheduling_arguments, scheduling_options
+from exporters import WRITERS, open_writer
+from extraction import DEFAULT_PDF_OCR_DPI, file_kind, invoice_columns
+from extraction_cache import ExtractionCache
+from invoice_store import InvoiceStore, default_store_path
+from preprocessing import DEFAULT_TARGET_DPI
+from tracing import TraceCollector
+
+logger = logging.getLogger("invoice_extract")
+
+FORMAT_EXTENSIONS = {".jsonl": "jsonl", ".json": "jsonl", ".csv": "csv", ".xlsx": "xlsx", ".parquet": "parquet"}
+
+# Columns of the --items output, one row per line item
+ITEM_COLUMNS = ["Source File", "Line", "Description", "Quantity", "Unit Price", "Amount"]
+
+
+def iter_input_paths(inputs, stdin=None):
+    """Expand directories, globs and '-' (a newline separated list on stdin) into file paths.
+
+    Directories are walked recursively and only supported invoice files and
+    archives are kept from them; explicitly named files are passed through as
+    given.
+    """
+    seen = set()
+    for item in inputs:
+        if item == "-":
+            candidates = (line.strip() for line in (stdin or sys.stdin))
+            candidates = [c for c in candidates if c]
+        elif os.path.isdir(item):
+            candidates = []
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for name in sorted(files):
+                    if file_kind(name) is not None or is_archive_name(name):
+                        candidates.append(os.path.join(root, name))
+        elif glob.has_magic(item):
+            candidates = sorted(p for p in glob.glob(item, recursive=True) if os.path.isfile(p))
+        else:
+            candidates = [item]
+
+        for path in candidates:
+            if path not in seen:
+                seen.add(path)
+                yield path
+
+
+def item_rows(name, items):
+    """--items rows for the line items of one file"""
+    for line, item in enumerate(items, start=1):
+        yield {"Source File": name, "Line": line, "Description": item["description"],
+               "Quantity": item["quantity"], "Unit Price": item["unit_price"], "Amount": item["amount"]}
+
+
+class ResumeJournal:
+    """Append-only record of finished files, their rows and line items.
+
+    The journal lives next to the output file. On ``--resume`` its rows are
+    replayed into a fresh output and the files it lists are skipped, so an
+    interrupted run never leaves torn or duplicated rows behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = []
+        self.items = []
+        self.done = set()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn final line from an interrupted run
+                    continue
+                self.done.add(entry["path"])
+                self.rows.append(entry["row"])
+                # Journals written before line items were extracted have none
+                self.items.append(entry.get("items", []))
+
+    def open(self, append):
+        self._stream = open(self.path, "a" if append else "w", encoding="utf-8")
+
+    def record(self, path, row, items):
+        self._stream.write(json.dumps({"path": path, "row": row, "items": items}, ensure_ascii=False) + "\n")
+        self._stream.flush()
+
+    def close(self):
+        self._stream.close()
+
+
+def _with_names(paths):
+    # Workers open each file themselves, so only the paths cross the process boundary
+    for path in paths:
+        yield path, path
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="invoice-extract",
+        description="Extract invoice fields from PDFs and images without the Streamlit UI.",
+    )
+    parser.add_argument("inputs", nargs="+",
+                        help="files, directories, ZIP/TAR archives or glob patterns; "
+                             "'-' reads a file list from stdin")
+    parser.add_argument("-o", "--output", default="-",
+                        help="output file, or '-' for stdout (default)")
+    parser.add_argument("-f", "--format", choices=sorted(WRITERS),
+                        help="output format (default: from the output extension, else jsonl)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="seconds allowed per OCR/PDF task (default: 300)")
+    add_scheduling_arguments(parser)
+    parser.add_argument("--in-order", action="store_true",
+                        help="write results in input order; by default each is written as soon as it is done, "
+                             "so small files don't wait behind large ones")
+    parser.add_argument("--ocr-dpi", type=int, default=DEFAULT_PDF_OCR_DPI,
+                        help=f"resolution scanned PDF pages are rendered at for OCR (default: {DEFAULT_PDF_OCR_DPI})")
+    parser.add_argument("--ocr-regions", action="store_true",
+                        help="OCR only the header, invoice details and totals blocks, "
+                             "falling back to the full page when fields are missing")
+    parser.add_argument("--target-dpi", type=int, default=DEFAULT_TARGET_DPI,
+                        help=f"resolution images are normalised to before OCR (default: {DEFAULT_TARGET_DPI})")
+    parser.add_argument("--deskew", action="store_true", help="straighten rotated scans before OCR")
+    parser.add_argument("--denoise", action="store_true", help="median-filter images before thresholding")
+    parser.add_argument("--items", metavar="FILE",
+                        help="also write the line items, one row per item, to this file "
+                             "(format from its extension, else jsonl)")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip files finished by a previous interrupted run with the same output")
+    parser.add_argument("--cache-dir", help="extraction cache directory")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the extraction cache")
+    parser.add_argument("--store", nargs="?", const=default_store_path(), metavar="DB",
+                        help="also save results, raw text and metadata to this SQLite invoice store "
+                             f"(default when given without a path: {default_store_path()})")
+    parser.add_argument("--dedup", action="store_true",
+                        help="check files against the invoice store first: reuse results for files seen "
+                             "before, region-OCR scans that look like a stored page and flag invoices with "
+                             "a stored vendor, number and total (uses the default store unless --store is given)")
+    parser.add_argument("--templates", action="store_true",
+                        help="read scans laid out like a vendor template in the invoice store (learned from "
+                             "rows confirmed in the app) from the template's field boxes only (uses the "
+                             "default store unless --store is given)")
+    parser.add_argument("--trace", metavar="FILE", help="append per-file stage timings to this JSONL file")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write stage totals in the Prometheus text format to this file when done")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="sample worker stacks and write collapsed stacks of the slowest files to DIR")
+    parser.add_argument("--profile-slowest", type=int, default=5, metavar="N",
+                        help="how many of the slowest files --profile keeps (default: 5)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log progress to stderr")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(levelname)s %(message)s")
+
+    fmt = args.format or FORMAT_EXTENSIONS.get(os.path.splitext(args.output)[1].lower(), "jsonl")
+    if args.resume and args.output == "-":
+        logger.error("--resume needs an output file")
+        return 2
+
+    journal = None
+    if args.output != "-":
+        journal = ResumeJournal(args.output + ".progress")
+        if args.resume:
+            journal.load()
+            logger.info("Resuming: %d files already done", len(journal.done))
+
+    # The file list is streamed so huge directories don't have to be listed up front, and archives are
+    # read a member at a time as the workers need more; members are journaled under "archive/member"
+    archive_errors = []
+
+    def archive_error(message):
+        logger.error(message)
+        archive_errors.append(message)
+
+    files = ((name, source) for name, source in expand_archives(_with_names(iter_input_paths(args.inputs)),
+                                                                  on_error=archive_error)
+             if journal is None or name not in journal.done)
+
+    cache = None if args.no_cache else ExtractionCache(directory=args.cache_dir)
+    columns = invoice_columns
+    writer = open_writer(fmt, args.output, columns)
+    items_writer = None
+    if args.items:
+        items_format = FORMAT_EXTENSIONS.get(os.path.splitext(args.items)[1].lower(), "jsonl")
+        items_writer = open_writer(items_format, args.items, ITEM_COLUMNS)
+    if journal is not None:
+        for row, items in zip(journal.rows, journal.items):
+            writer.write(row)
+            if items_writer is not None:
+                for item_row in item_rows(row["Source File"], items):
+                    items_writer.write(item_row)
+        journal.open(append=args.resume)
+
+    if (args.dedup or args.templates) and not args.store:
+        args.store = default_store_path()
+    store = InvoiceStore(args.store) if args.store else None
+    processed = failed = 0
+    traces = TraceCollector(profile_slowest=args.profile_slowest, jsonl_path=args.trace)
+    extractor = BatchExtractor(max_workers=args.jobs, task_timeout=args.timeout, cache=cache,
+                               pdf_ocr_dpi=args.ocr_dpi, ocr_regions=args.ocr_regions,
+                               preprocessing={"target_dpi": args.target_dpi, "deskew": args.deskew,
+                                              "denoise": args.denoise},
+                               profile=bool(args.profile), store=store, dedup=args.dedup,
+                               templates=args.templates, **scheduling_options(args))
+    try:
+        for result in extractor.run(files, ordered=args.in_order):
+            traces.add(result.trace)
+            row = dict(result.details, **{"Source File": result.name})
+            writer.write(row)
+            writer.flush()
+            if items_writer is not None:
+                for item_row in item_rows(result.name, result.items):
+                    items_writer.write(item_row)
+                items_writer.flush()
+            processed += 1
+            for message in result.errors:
+                logger.error(message)
+            if result.errors:
+                failed += 1
+            elif journal is not None:
+                # Failed files are retried on the next --resume
+                journal.record(result.name, row, result.items)
+            duplicate = result.metadata.get("duplicate_of")
+            if duplicate is not None:
+                logger.warning("%s duplicates %s (%s match)", result.name, duplicate["file"], duplicate["match"])
+            confidence = result.metadata.get("ocr_confidence")
+            if confidence is not None and confidence < REVIEW_CONFIDENCE:
+                logger.warning("%s has low OCR confidence (%.0f); check its fields", result.name, confidence)
+            items_check = result.metadata.get("line_items")
+            if items_check is not None and items_check["balanced"] is False:
+                logger.warning("%s: line items add up to %.2f, not the total %s", result.name, items_check["sum"],
+                               result.details.get("Total Amount"))
+            logger.info("%s%s", result.name, " (cached)" if result.cached else "")
+    except KeyboardInterrupt:
+        logger.warning("Interrupted after %d files; rerun with --resume to continue", processed)
+        extractor.close(wait_for_tasks=False)
+        return 130
+    finally:
+        writer.close()
+        if items_writer is not None:
+            items_writer.close()
+        if journal is not None:
+            journal.close()
+        extractor.close()
+        # After the extractor, which saves each result to the store as it is yielded
+        if store is not None:
+            store.close()
+        traces.close()
+        if args.metrics:
+            traces.write_prometheus(args.metrics)
+        if args.profile:
+            for path in traces.write_profiles(args.profile):
+                logger.info("Profile written to %s", path)
+
+    logger.info("Processed %d files (%d with errors, %d archives rejected)", processed, failed, len(archive_errors))
+    return 1 if failed or archive_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
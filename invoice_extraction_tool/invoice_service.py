@@ -0,0 +1,483 @@
+"""invoice-service: HTTP API that queues invoices for the extraction pool.
+
+Examples:
+
+    python invoice_service.py --port 8080 --jobs 8 --store
+    curl --data-binary @invoice.pdf "http://localhost:8080/jobs?filename=invoice.pdf"
+    curl http://localhost:8080/jobs/<id>/result
+
+Endpoints:
+
+- ``POST /jobs?filename=NAME[&callback=URL]``: the request body is the file.
+  Answers 202 with the job (its ``id`` and status), 503 with Retry-After
+  while the queue is full or the service is shutting down, 413 above
+  ``--max-upload-mb`` and 415 for unsupported file types. The filename and
+  callback may also be sent as ``X-Filename`` and ``X-Callback-URL``.
+- ``GET /jobs/<id>``: job status (queued, running, done, failed or
+  cancelled).
+- ``GET /jobs/<id>/result``: status plus the extracted fields, line items,
+  errors and metadata; 409 until the job has finished.
+- ``DELETE /jobs/<id>``: cancel a job. A queued job is dropped at once, a
+  running one stops its OCR workers (answering 202 until it has); 409 once
+  it has finished.
+- ``GET /health``: queue length, running jobs and whether it is draining.
+
+A callback URL receives the same JSON as the result endpoint in a POST once
+the job finishes, retried with backoff if it fails. Uploads are streamed to
+a spool directory and extracted by a BatchExtractor, so the extraction
+cache, invoice store and duplicate detection work as in the CLI. On SIGTERM
+or SIGINT new jobs are refused, queued and running jobs finish and their
+callbacks are sent, then the process exits.
+
+Only the standard library is used; put a reverse proxy in front for TLS and
+authentication.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlsplit
+
+from batch_extraction import BatchExtractor
+from batch_scheduler import add_scheduling_arguments, scheduling_options
+from extraction import DEFAULT_PDF_OCR_DPI, file_kind
+from extraction_cache import ExtractionCache
+from invoice_store import InvoiceStore, default_store_path
+
+logger = logging.getLogger("invoice_service")
+
+DEFAULT_PORT = 8080
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_MAX_UPLOAD_MB = 200
+# Finished jobs kept for the status endpoints; the oldest are forgotten first
+DEFAULT_KEEP_FINISHED = 10000
+
+RETRY_AFTER_SECONDS = 5
+CALLBACK_ATTEMPTS = 4
+CALLBACK_TIMEOUT = 10
+
+_CHUNK_SIZE = 1024 * 1024
+_REQUEST_TIMEOUT = 30
+_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            409: "Conflict", 411: "Length Required", 413: "Payload Too Large",
+            415: "Unsupported Media Type", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+
+def _post_json(url, body, timeout):
+    request = urllib.request.Request(url, data=body, method="POST",
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        response.read()
+
+
+class Job:
+    """One uploaded file on its way through the queue"""
+
+    def __init__(self, name, path, callback=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.path = path
+        self.callback = callback
+        self.status = "queued"
+        self.submitted_at = _now()
+        self.started_at = None
+        self.finished_at = None
+        # None, "pending", "delivered" or "failed"
+        self.callback_status = "pending" if callback else None
+        self.result = None
+        # Set by DELETE; the extractor checks it between tasks and stops the running ones
+        self.cancel = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def to_dict(self, result=False):
+        record = {
+            "id": self.id,
+            "file": self.name,
+            "status": self.status,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.callback:
+            record["callback"] = self.callback_status
+        if result:
+            record["result"] = self.result
+        return record
+
+
+class ExtractionService:
+    """Bounded job queue in front of a BatchExtractor, plus the HTTP handler.
+
+    ``concurrency`` jobs are extracted at once (twice the extractor's worker
+    count by default, so the pool stays busy while finished jobs are handed
+    back); at most ``queue_size`` more wait in the queue.
+    """
+
+    def __init__(self, extractor, queue_size=DEFAULT_QUEUE_SIZE, concurrency=None, spool_dir=None,
+                 max_upload_bytes=DEFAULT_MAX_UPLOAD_MB * 1024 * 1024, keep_finished=DEFAULT_KEEP_FINISHED,
+                 callback_timeout=CALLBACK_TIMEOUT):
+        # asyncio.Queue(maxsize=0) is unbounded, and a full queue is what turns uploads away with 503
+        if queue_size < 1:
+            raise ValueError(f"queue_size must be at least 1, not {queue_size}")
+        self.extractor = extractor
+        self.queue_size = queue_size
+        self.concurrency = concurrency or extractor.max_workers * 2
+        self.spool_dir = spool_dir
+        self.max_upload_bytes = max_upload_bytes
+        self.keep_finished = keep_finished
+        self.callback_timeout = callback_timeout
+        self.draining = False
+        self.jobs = OrderedDict()
+        self._queue = None
+        self._consumers = []
+        self._callbacks = set()
+        self._running = 0
+        self._finished_ids = []
+        # BatchExtractor.run blocks, so each running job gets a thread of its own
+        self._threads = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="invoice-job")
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._consumers = [asyncio.ensure_future(self._consume()) for _ in range(self.concurrency)]
+
+    def submit(self, name, path, callback=None):
+        """Queue an already spooled file; raises asyncio.QueueFull when there's no room"""
+        job = Job(name, path, callback)
+        self._queue.put_nowait(job)
+        self.jobs[job.id] = job
+        return job
+
+    async def drain(self, timeout=None):
+        """Refuse new jobs, wait for queued and running ones and their callbacks, then stop"""
+        self.draining = True
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+            if self._callbacks:
+                await asyncio.wait_for(asyncio.gather(*self._callbacks), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Gave up waiting for %d queued and %d running jobs",
+                           self._queue.qsize(), self._running)
+        for consumer in self._consumers:
+            consumer.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+        self._threads.shutdown(wait=False, cancel_futures=True)
+
+    def health(self):
+        return {"status": "draining" if self.draining else "ok", "queued": self._queue.qsize(),
+                "running": self._running, "queue_size": self.queue_size, "concurrency": self.concurrency,
+                "workers": self.extractor.max_workers}
+
+    def _extract(self, job):
+        # Runs to the end so the extractor saves the result to the store before the job is reported done
+        for result in self.extractor.run([(job.name, job.path)], cancel=job.cancel):
+            pass
+        return result
+
+    def cancel(self, job):
+        """Cancel a queued or running job; a queued one is finished here, a running one by its consumer"""
+        job.cancel.set()
+        if job.status != "queued":
+            return
+        job.status = "cancelled"
+        job.result = {"details": {}, "items": [], "errors": [f"Cancelled before {job.name} was extracted"],
+                      "metadata": {}}
+        self._finish(job)
+
+    def _finish(self, job):
+        job.finished_at = _now()
+        try:
+            os.remove(job.path)
+        except OSError:
+            pass
+        self._forget_old_jobs(job)
+        logger.info("%s %s: %s", job.id, job.name, job.status)
+        if job.callback:
+            task = asyncio.ensure_future(self._notify(job))
+            self._callbacks.add(task)
+            task.add_done_callback(self._callbacks.discard)
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            if job.status == "cancelled":
+                # Cancelled while it waited; already finished by cancel()
+                self._queue.task_done()
+                continue
+            job.status = "running"
+            job.started_at = _now()
+            self._running += 1
+            try:
+                result = await loop.run_in_executor(self._threads, self._extract, job)
+            except Exception as e:
+                logger.exception("Job %s (%s) failed", job.id, job.name)
+                job.status = "failed"
+                job.result = {"details": {}, "items": [], "errors": [f"Extraction failed for {job.name}: {e}"],
+                              "metadata": {}}
+            else:
+                job.status = "done" if result.ok else "cancelled" if job.cancel.is_set() else "failed"
+                job.result = {"details": result.details, "items": result.items, "errors": result.errors,
+                              "metadata": result.metadata, "cached": result.cached, "elapsed": result.elapsed,
+                              "file_hash": result.digest}
+            finally:
+                self._running -= 1
+                self._queue.task_done()
+            self._finish(job)
+
+    def _forget_old_jobs(self, job):
+        self._finished_ids.append(job.id)
+        if len(self._finished_ids) > self.keep_finished * 2:
+            # Trimmed in bulk so each finished job costs O(1) on average
+            forgotten = self._finished_ids[:-self.keep_finished]
+            del self._finished_ids[:-self.keep_finished]
+            for job_id in forgotten:
+                self.jobs.pop(job_id, None)
+
+    async def _notify(self, job):
+        loop = asyncio.get_running_loop()
+        body = json.dumps(job.to_dict(result=True), default=str).encode("utf-8")
+        for attempt in range(CALLBACK_ATTEMPTS):
+            try:
+                # urllib blocks; the default executor keeps it off the event loop
+                await loop.run_in_executor(None, _post_json, job.callback, body, self.callback_timeout)
+            except (OSError, ValueError) as e:
+                logger.warning("Callback for job %s to %s failed (attempt %d): %s",
+                               job.id, job.callback, attempt + 1, e)
+                if attempt + 1 < CALLBACK_ATTEMPTS:
+                    await asyncio.sleep(2 ** attempt)
+            else:
+                job.callback_status = "delivered"
+                return
+        job.callback_status = "failed"
+
+    # HTTP
+
+    async def handle(self, reader, writer):
+        """asyncio.start_server callback: one request per connection"""
+        headers = {}
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), _REQUEST_TIMEOUT)
+            if not request_line:
+                return
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            while True:
+                line = await asyncio.wait_for(reader.readline(), _REQUEST_TIMEOUT)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            url = urlsplit(target)
+            status, payload, extra = await self._route(method, url.path, parse_qs(url.query), headers,
+                                                       reader, writer)
+        except (ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            status, payload, extra = 400, {"error": f"Bad request: {e}"}, {}
+        except ConnectionError:
+            writer.close()
+            return
+        except Exception as e:
+            logger.exception("Error handling a request")
+            status, payload, extra = 500, {"error": str(e)}, {}
+        body = json.dumps(payload, default=str).encode("utf-8")
+        head = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}", "Content-Type: application/json",
+                f"Content-Length: {len(body)}", "Connection: close"]
+        head += [f"{name}: {value}" for name, value in extra.items()]
+        try:
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, query, headers, reader, writer):
+        parts = [part for part in path.split("/") if part]
+        if parts == ["health"]:
+            return (200, self.health(), {}) if method == "GET" else (405, {"error": "Use GET"}, {"Allow": "GET"})
+        if parts == ["jobs"]:
+            if method != "POST":
+                return 405, {"error": "Use POST"}, {"Allow": "POST"}
+            return await self._create_job(query, headers, reader, writer)
+        if len(parts) in (2, 3) and parts[0] == "jobs" and parts[2:] in ([], ["result"]):
+            allowed = "GET, DELETE" if len(parts) == 2 else "GET"
+            if method not in allowed.split(", "):
+                return 405, {"error": f"Use {allowed}"}, {"Allow": allowed}
+            job = self.jobs.get(parts[1])
+            if job is None:
+                return 404, {"error": "Unknown job"}, {}
+            if method == "DELETE":
+                if job.finished:
+                    return 409, job.to_dict(), {}
+                self.cancel(job)
+                return (200 if job.finished else 202), job.to_dict(), {}
+            if len(parts) == 2:
+                return 200, job.to_dict(), {}
+            if not job.finished:
+                return 409, job.to_dict(), {"Retry-After": str(RETRY_AFTER_SECONDS)}
+            return 200, job.to_dict(result=True), {}
+        return 404, {"error": "Not found"}, {}
+
+    async def _create_job(self, query, headers, reader, writer):
+        busy = {"Retry-After": str(RETRY_AFTER_SECONDS)}
+        if self.draining:
+            return 503, {"error": "Shutting down"}, busy
+        # Checked before the upload is read, so a full queue costs the client nothing to find out
+        if self._queue.full():
+            return 503, {"error": "Queue full"}, busy
+        name = os.path.basename((query.get("filename") or [headers.get("x-filename", "")])[0])
+        if not name:
+            return 400, {"error": "Name the file with ?filename= or X-Filename"}, {}
+        if file_kind(name) is None:
+            return 415, {"error": f"Unsupported file type: {name}"}, {}
+        callback = (query.get("callback") or [headers.get("x-callback-url")])[0]
+        if callback and urlsplit(callback).scheme not in ("http", "https"):
+            return 400, {"error": "The callback must be an http(s) URL"}, {}
+        if "content-length" not in headers:
+            return 411, {"error": "Content-Length is required"}, {}
+        length = int(headers["content-length"])
+        if length < 0:
+            # read() with a negative size would read to EOF, past any limit
+            return 400, {"error": "Content-Length can't be negative"}, {}
+        if length > self.max_upload_bytes:
+            return 413, {"error": f"Larger than {self.max_upload_bytes} bytes"}, {}
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await writer.drain()
+
+        fd, path = tempfile.mkstemp(dir=self.spool_dir, suffix=os.path.splitext(name)[1])
+        try:
+            with os.fdopen(fd, "wb") as f:
+                remaining = length
+                while remaining:
+                    chunk = await asyncio.wait_for(reader.read(min(_CHUNK_SIZE, remaining)), _REQUEST_TIMEOUT)
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(b"", remaining)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            job = self.submit(name, path, callback)
+        except asyncio.QueueFull:
+            os.remove(path)
+            return 503, {"error": "Queue full"}, busy
+        except BaseException:
+            os.remove(path)
+            raise
+        return 202, job.to_dict(), {"Location": f"/jobs/{job.id}"}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="invoice-service",
+        description="Serve invoice extraction over HTTP with a job queue and a local worker pool.",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"port (default: {DEFAULT_PORT})")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                        help=f"jobs allowed to wait before uploads get 503 (default: {DEFAULT_QUEUE_SIZE})")
+    parser.add_argument("--max-upload-mb", type=float, default=DEFAULT_MAX_UPLOAD_MB,
+                        help=f"largest accepted upload (default: {DEFAULT_MAX_UPLOAD_MB})")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="seconds allowed per OCR/PDF task (default: 300)")
+    add_scheduling_arguments(parser)
+    parser.add_argument("--drain-timeout", type=float, default=600,
+                        help="seconds to wait for unfinished jobs on shutdown (default: 600)")
+    parser.add_argument("--ocr-dpi", type=int, default=DEFAULT_PDF_OCR_DPI,
+                        help=f"resolution scanned PDF pages are rendered at for OCR (default: {DEFAULT_PDF_OCR_DPI})")
+    parser.add_argument("--ocr-regions", action="store_true",
+                        help="OCR only the header, invoice details and totals blocks, "
+                             "falling back to the full page when fields are missing")
+    parser.add_argument("--spool-dir", help="where uploads are kept until extracted (default: system temp)")
+    parser.add_argument("--cache-dir", help="extraction cache directory")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the extraction cache")
+    parser.add_argument("--store", nargs="?", const=default_store_path(), metavar="DB",
+                        help="also save results to this SQLite invoice store "
+                             f"(default when given without a path: {default_store_path()})")
+    parser.add_argument("--dedup", action="store_true",
+                        help="check uploads against the invoice store for duplicates first "
+                             "(uses the default store unless --store is given)")
+    parser.add_argument("--templates", action="store_true",
+                        help="read scans matching a vendor template in the invoice store from its field boxes "
+                             "only (uses the default store unless --store is given)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every job to stderr")
+    return parser
+
+
+async def serve(args, ready=None, stop=None):
+    """Run the service until SIGTERM/SIGINT or ``stop`` is set, then drain.
+
+    ``ready`` and ``stop`` are asyncio.Events; ``ready`` is set once the
+    server listens, with the bound port in ``args.port``.
+    """
+    if (args.dedup or args.templates) and not args.store:
+        args.store = default_store_path()
+    store = InvoiceStore(args.store) if args.store else None
+    cache = None if args.no_cache else ExtractionCache(directory=args.cache_dir)
+    extractor = BatchExtractor(max_workers=args.jobs, task_timeout=args.timeout, cache=cache,
+                               pdf_ocr_dpi=args.ocr_dpi, ocr_regions=args.ocr_regions, store=store,
+                               dedup=args.dedup, templates=args.templates, **scheduling_options(args))
+    spool_dir = tempfile.mkdtemp(prefix="invoice-service-", dir=args.spool_dir)
+    service = ExtractionService(extractor, queue_size=args.queue_size, spool_dir=spool_dir,
+                                max_upload_bytes=int(args.max_upload_mb * 1024 * 1024))
+    await service.start()
+    stop = stop or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows, or not the main thread
+            pass
+    server = await asyncio.start_server(service.handle, args.host, args.port)
+    args.port = server.sockets[0].getsockname()[1]
+    logger.info("Listening on http://%s:%d with %d workers", args.host, args.port, extractor.max_workers)
+    if ready is not None:
+        ready.set()
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Draining: %d queued, %d running", service.health()["queued"], service.health()["running"])
+        started = time.perf_counter()
+        # Status requests are still answered while the queue drains
+        await service.drain(timeout=args.drain_timeout)
+        server.close()
+        await server.wait_closed()
+        extractor.close(wait_for_tasks=False)
+        if store is not None:
+            store.close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        logger.info("Stopped after draining for %.1fs", time.perf_counter() - started)
+    return service
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.queue_size < 1:
+        parser.error("--queue-size must be at least 1")
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    asyncio.run(serve(args))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
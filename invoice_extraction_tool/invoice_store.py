@@ -0,0 +1,661 @@
+"""Durable store of processed invoices with indexed and full-text search.
+
+Extracted rows used to live only in the Streamlit session. This module keeps
+every result in a SQLite database in WAL mode, so readers (the app's paged
+view, ad-hoc ``sqlite3`` queries) never block the writer, together with the
+text the fields were parsed from, the file's SHA-256 and the processing
+metadata. Invoice number, vendor, dates and amounts are indexed, and an
+FTS5 table over the raw text answers full-text searches. OCR'd invoices
+keep the confidence of their least readable page, so the ones that need a
+human look can be listed. Line items go to a ``line_items`` child table,
+one row per item keyed by (invoice_id, position), with typed quantity,
+unit price and amount.
+
+Writes are buffered and inserted ``batch_size`` rows per transaction; a
+commit per row would spend most of an ingest waiting on fsync. Re-processing
+a file (same content hash) replaces its row instead of adding another.
+Fields corrected by hand are written back with update_fields(), which
+recomputes the parsed dates and amounts and the dedup match key.
+
+Each row also carries what dedup.py needs to spot a repeat invoice: the
+first page's image hashes, with the pHash split into indexed bands, and the
+(vendor, invoice number, total) blocking key. Rows queued but not yet
+written are indexed in memory, so duplicates within one batch are found too.
+The cache key of the settings a row was extracted with is kept as well, so
+a stored result is only reused under the same OCR, region and template
+settings.
+
+Vendor layout templates (vendor_templates.py) learned from confirmed rows
+are kept in a ``templates`` table: the layout fingerprint and the field
+boxes as JSON. They are written at once, not batched, and read all together
+into a TemplateIndex. A re-learned template replaces the old row under a new
+id, so (count, highest id) changes with every write.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+
+from dedup import DEFAULT_MAX_DISTANCE, HASH_BANDS, hamming, hash_bands, match_key
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_PAGE_SIZE = 50
+
+# Extracted field -> column
+FIELD_COLUMNS = {
+    "Invoice Number": "invoice_number",
+    "Invoice Date": "invoice_date",
+    "Due Date": "due_date",
+    "Vendor Name": "vendor_name",
+    "Total Amount": "total_amount",
+    "Tax Amount": "tax_amount",
+    "Currency": "currency",
+    "Invoice Items": "invoice_items",
+    "Source File": "source_file",
+}
+
+# Sort keys accepted by search(), mapped to indexed columns
+SORT_COLUMNS = {
+    "processed_at": "processed_at",
+    "invoice_number": "invoice_number",
+    "vendor": "vendor_name",
+    "invoice_date": "invoice_date_iso",
+    "due_date": "due_date_iso",
+    "total": "total_value",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    id INTEGER PRIMARY KEY,
+    file_hash TEXT UNIQUE,
+    source_file TEXT NOT NULL,
+    invoice_number TEXT COLLATE NOCASE,
+    invoice_date TEXT,
+    due_date TEXT,
+    vendor_name TEXT COLLATE NOCASE,
+    total_amount TEXT,
+    tax_amount TEXT,
+    currency TEXT,
+    invoice_items TEXT,
+    invoice_date_iso TEXT,
+    due_date_iso TEXT,
+    total_value REAL,
+    tax_value REAL,
+    raw_text TEXT NOT NULL DEFAULT '',
+    metadata TEXT NOT NULL DEFAULT '{}',
+    errors TEXT NOT NULL DEFAULT '[]',
+    cached INTEGER NOT NULL DEFAULT 0,
+    elapsed REAL,
+    processed_at TEXT NOT NULL,
+    match_key TEXT,
+    duplicate_of TEXT,
+    dhash INTEGER,
+    phash INTEGER,
+    phash_band0 INTEGER,
+    phash_band1 INTEGER,
+    phash_band2 INTEGER,
+    phash_band3 INTEGER,
+    ocr_confidence REAL,
+    result_key TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS invoice_text USING fts5(
+    raw_text, content='invoices', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS invoices_text_insert AFTER INSERT ON invoices BEGIN
+    INSERT INTO invoice_text(rowid, raw_text) VALUES (new.id, new.raw_text);
+END;
+CREATE TRIGGER IF NOT EXISTS invoices_text_delete AFTER DELETE ON invoices BEGIN
+    INSERT INTO invoice_text(invoice_text, rowid, raw_text) VALUES ('delete', old.id, old.raw_text);
+END;
+CREATE TRIGGER IF NOT EXISTS invoices_text_update AFTER UPDATE OF raw_text ON invoices BEGIN
+    INSERT INTO invoice_text(invoice_text, rowid, raw_text) VALUES ('delete', old.id, old.raw_text);
+    INSERT INTO invoice_text(rowid, raw_text) VALUES (new.id, new.raw_text);
+END;
+CREATE TABLE IF NOT EXISTS line_items (
+    invoice_id INTEGER NOT NULL REFERENCES invoices(id),
+    position INTEGER NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    quantity REAL,
+    unit_price REAL,
+    amount REAL,
+    PRIMARY KEY (invoice_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS templates (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    vendor_name TEXT NOT NULL COLLATE NOCASE,
+    fingerprint BLOB NOT NULL,
+    template TEXT NOT NULL,
+    source_file TEXT,
+    created_at TEXT NOT NULL
+);
+"""
+
+# Created after _migrate(), as some index columns are missing from older databases.
+# The band indexes cover both hashes, so find_similar() checks candidates without reading their rows.
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS invoices_number ON invoices(invoice_number);
+CREATE INDEX IF NOT EXISTS invoices_vendor ON invoices(vendor_name);
+CREATE INDEX IF NOT EXISTS invoices_invoice_date ON invoices(invoice_date_iso);
+CREATE INDEX IF NOT EXISTS invoices_due_date ON invoices(due_date_iso);
+CREATE INDEX IF NOT EXISTS invoices_total ON invoices(total_value);
+CREATE INDEX IF NOT EXISTS invoices_processed ON invoices(processed_at);
+CREATE INDEX IF NOT EXISTS invoices_match_key ON invoices(match_key);
+CREATE INDEX IF NOT EXISTS invoices_ocr_confidence ON invoices(ocr_confidence) WHERE ocr_confidence IS NOT NULL;
+CREATE INDEX IF NOT EXISTS invoices_phash_band0 ON invoices(phash_band0, phash, dhash);
+CREATE INDEX IF NOT EXISTS invoices_phash_band1 ON invoices(phash_band1, phash, dhash);
+CREATE INDEX IF NOT EXISTS invoices_phash_band2 ON invoices(phash_band2, phash, dhash);
+CREATE INDEX IF NOT EXISTS invoices_phash_band3 ON invoices(phash_band3, phash, dhash);
+"""
+
+# Columns added to databases created before duplicate detection, OCR confidences and result keys
+_ADDED_COLUMNS = {
+    "match_key": "TEXT",
+    "duplicate_of": "TEXT",
+    "dhash": "INTEGER",
+    "phash": "INTEGER",
+    **{f"phash_band{band}": "INTEGER" for band in range(HASH_BANDS)},
+    "ocr_confidence": "REAL",
+    "result_key": "TEXT",
+}
+
+# Candidates read per pHash band in find_similar(); pages of one template can share a band by the thousand
+_SIMILAR_CANDIDATES = 64
+
+_STORED_COLUMNS = (
+    ["file_hash"] + list(FIELD_COLUMNS.values())
+    + ["invoice_date_iso", "due_date_iso", "total_value", "tax_value",
+       "raw_text", "metadata", "errors", "cached", "elapsed", "processed_at"]
+    + list(_ADDED_COLUMNS)
+)
+
+# Results served from the extraction cache carry no image hashes; keep the ones already stored
+_KEPT_IF_NULL = {"dhash", "phash"} | {f"phash_band{band}" for band in range(HASH_BANDS)}
+
+_INSERT = "INSERT INTO invoices ({columns}) VALUES ({marks}) ON CONFLICT(file_hash) DO UPDATE SET {updates}".format(
+    columns=", ".join(_STORED_COLUMNS),
+    marks=", ".join("?" * len(_STORED_COLUMNS)),
+    updates=", ".join(
+        f"{column} = COALESCE(excluded.{column}, {column})" if column in _KEPT_IF_NULL
+        else f"{column} = excluded.{column}"
+        for column in _STORED_COLUMNS[1:]
+    ),
+)
+
+# Items are written after their invoice row, which they find by file hash; re-processing replaces them
+_DELETE_ITEMS = "DELETE FROM line_items WHERE invoice_id = (SELECT id FROM invoices WHERE file_hash = ?)"
+_INSERT_ITEM = ("INSERT INTO line_items (invoice_id, position, description, quantity, unit_price, amount) "
+                "SELECT id, ?, ?, ?, ?, ? FROM invoices WHERE file_hash = ?")
+
+_ITEM_COLUMNS = ("description", "quantity", "unit_price", "amount")
+
+# Dates as the field extractor finds them: 1-2 digit day/month, 2 or 4 digit year
+_DATE = re.compile(r"(\d{1,2})([./-])(\d{1,2})\2(\d{4}|\d{2})")
+# Dates as corrected in the app's results grid
+_ISO_DATE = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+_AMOUNT_CHARS = re.compile(r"[^\d.\-]")
+
+
+def default_store_path():
+    """Database location, honouring INVOICE_EXTRACTOR_STORE"""
+    override = os.environ.get("INVOICE_EXTRACTOR_STORE")
+    if override:
+        return override
+    base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "invoice_extractor", "invoices.sqlite3")
+
+
+def iso_date(value):
+    """``YYYY-MM-DD`` for an extracted (or already ISO) date string, or None if it doesn't parse"""
+    text = (value or "").strip()
+    match = _ISO_DATE.fullmatch(text)
+    if match is not None:
+        try:
+            return date(*map(int, match.groups())).isoformat()
+        except ValueError:
+            return None
+    match = _DATE.fullmatch(text)
+    if match is None:
+        return None
+    first, separator, second, year = match.groups()
+    year = int(year) if len(year) == 4 else 2000 + int(year) if int(year) < 69 else 1900 + int(year)
+    # Dotted dates are day-first by convention; others are month-first unless that can't be a date
+    orders = [(second, first)] if separator == "." else [(first, second), (second, first)]
+    for month, day in orders:
+        try:
+            return date(year, int(month), int(day)).isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def amount_value(value):
+    """Float for an extracted amount such as ``$1,234.50``, or None"""
+    try:
+        return float(_AMOUNT_CHARS.sub("", value or ""))
+    except ValueError:
+        return None
+
+
+def fts_query(text):
+    """Quote each word of free text so FTS5 treats it as a term, not syntax"""
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+def _like_prefix(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def _row_values(result, processed_at):
+    details = result.details
+    image_hash = getattr(result, "image_hash", None)
+    duplicate_of = result.metadata.get("duplicate_of") or {}
+    values = [getattr(result, "digest", None)]
+    values += [details.get(field, "") or (result.name if field == "Source File" else "")
+               for field in FIELD_COLUMNS]
+    values += [
+        iso_date(details.get("Invoice Date")),
+        iso_date(details.get("Due Date")),
+        amount_value(details.get("Total Amount")),
+        amount_value(details.get("Tax Amount")),
+        getattr(result, "text", "") or "",
+        json.dumps(result.metadata, default=str),
+        json.dumps(result.errors),
+        int(bool(result.cached)),
+        result.elapsed,
+        processed_at,
+        match_key(details),
+        duplicate_of.get("file_hash"),
+    ]
+    if image_hash is None:
+        values += [None] * (2 + HASH_BANDS)
+    else:
+        dhash, phash = image_hash
+        values += [_signed(dhash), _signed(phash)] + hash_bands(phash)
+    values.append(result.metadata.get("ocr_confidence"))
+    values.append(getattr(result, "key", None))
+    return values
+
+
+class InvoiceStore:
+    """SQLite-backed store of extraction results.
+
+    Safe to share between threads (e.g. Streamlit sessions, whose reruns each
+    run on a new thread): they share one connection, used under a lock.
+    """
+
+    def __init__(self, path=None, batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path if path is not None else default_store_path()
+        self.batch_size = batch_size
+        self._pending = []
+        # (file hash, line items) of the queued rows that have a hash
+        self._pending_items = []
+        # Queued rows by file hash, match key and (band, value), for the find_* lookups
+        self._pending_hashes = {}
+        self._pending_keys = {}
+        self._pending_bands = {}
+        # Reentrant: add() flushes, and lookups check the queued rows, while holding it
+        self._lock = threading.RLock()
+        self._db = None
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._connection() as connection:
+            connection.executescript(_SCHEMA)
+            self._migrate(connection)
+            connection.executescript(_INDEXES)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @contextmanager
+    def _connection(self):
+        # The one connection, held under the lock so statements and transactions of threads don't interleave.
+        # A connection per thread would leak one for every short-lived thread until close().
+        with self._lock:
+            if self._db is None:
+                # Autocommit; writes open their own transactions in flush()
+                connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                             timeout=30)
+                connection.row_factory = sqlite3.Row
+                connection.execute("PRAGMA journal_mode=WAL")
+                # With WAL, NORMAL only risks the last transactions on power loss, never corruption
+                connection.execute("PRAGMA synchronous=NORMAL")
+                self._db = connection
+            yield self._db
+
+    @staticmethod
+    def _migrate(connection):
+        # Older databases: add the missing columns, and block the rows stored before duplicate detection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Read inside the transaction so two processes opening an old database don't both migrate it
+            columns = {row["name"] for row in connection.execute("PRAGMA table_info(invoices)")}
+            for column, declaration in _ADDED_COLUMNS.items():
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE invoices ADD COLUMN {column} {declaration}")
+            if "match_key" not in columns:
+                rows = connection.execute("SELECT id, vendor_name, invoice_number, total_amount FROM invoices")
+                connection.executemany("UPDATE invoices SET match_key = ? WHERE id = ?", [
+                    (match_key({"Vendor Name": row["vendor_name"], "Invoice Number": row["invoice_number"],
+                                "Total Amount": row["total_amount"]}), row["id"])
+                    for row in rows.fetchall()
+                ])
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def add(self, result):
+        """Queue a BatchResult; written once ``batch_size`` results are queued"""
+        processed_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        values = _row_values(result, processed_at)
+        entry = dict(zip(_STORED_COLUMNS, values))
+        entry["line_items"] = list(getattr(result, "items", None) or [])
+        with self._lock:
+            self._pending.append(values)
+            if entry["file_hash"] is not None:
+                self._pending_items.append((entry["file_hash"], entry["line_items"]))
+                self._pending_hashes[entry["file_hash"]] = entry
+            if entry["match_key"] is not None:
+                self._pending_keys.setdefault(entry["match_key"], entry)
+            if entry["phash"] is not None:
+                for band in range(HASH_BANDS):
+                    self._pending_bands.setdefault((band, entry[f"phash_band{band}"]), []).append(entry)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def add_many(self, results):
+        """Queue and write every result in ``results``"""
+        for result in results:
+            self.add(result)
+        self.flush()
+
+    def flush(self):
+        """Write queued results in a single transaction"""
+        with self._connection() as connection:
+            rows, self._pending = self._pending, []
+            items, self._pending_items = self._pending_items, []
+            self._pending_hashes, self._pending_keys, self._pending_bands = {}, {}, {}
+            if not rows:
+                return
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany(_INSERT, rows)
+                connection.executemany(_DELETE_ITEMS, [(file_hash,) for file_hash, _ in items])
+                connection.executemany(_INSERT_ITEM, [
+                    (position, item["description"] or "", item["quantity"], item["unit_price"], item["amount"],
+                     file_hash)
+                    for file_hash, file_items in items for position, item in enumerate(file_items, start=1)
+                ])
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def update_fields(self, file_hash, values):
+        """Overwrite extracted fields (``{field: text}``) of the invoice stored for ``file_hash``.
+
+        The parsed dates and amounts and the dedup match key are recomputed
+        from the corrected fields. Queued results are written first; returns
+        False if no invoice is stored for the hash.
+        """
+        unknown = set(values) - set(FIELD_COLUMNS)
+        if unknown:
+            raise KeyError(sorted(unknown)[0])
+        with self._connection() as connection:
+            self.flush()
+            row = connection.execute(
+                f"SELECT {', '.join(FIELD_COLUMNS.values())} FROM invoices WHERE file_hash = ?",
+                (file_hash,)).fetchone()
+            if row is None:
+                return False
+            details = {field: row[column] for field, column in FIELD_COLUMNS.items()}
+            details.update({field: "" if value is None else str(value) for field, value in values.items()})
+            updates = {FIELD_COLUMNS[field]: details[field] for field in values}
+            updates.update({
+                "invoice_date_iso": iso_date(details["Invoice Date"]),
+                "due_date_iso": iso_date(details["Due Date"]),
+                "total_value": amount_value(details["Total Amount"]),
+                "tax_value": amount_value(details["Tax Amount"]),
+                "match_key": match_key(details),
+            })
+            connection.execute(
+                f"UPDATE invoices SET {', '.join(f'{column} = ?' for column in updates)} WHERE file_hash = ?",
+                [*updates.values(), file_hash])
+            return True
+
+    def close(self):
+        """Flush queued results and close the connection (reopened if the store is used again)"""
+        self.flush()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def find_by_hash(self, file_hash, result_key=None):
+        """Stored (or queued) error-free result for a file's SHA-256, as get() returns it, or None.
+
+        With ``result_key`` (extraction_cache.cache_key of the hash and the
+        current settings) only a result extracted with those settings is
+        returned; rows stored before keys were kept have none and never match.
+        """
+        with self._lock:
+            entry = self._pending_hashes.get(file_hash)
+        if entry is not None:
+            if entry["errors"] == "[]" and result_key in (None, entry["result_key"]):
+                return self._record(entry)
+            return None
+        sql = "SELECT * FROM invoices WHERE file_hash = ? AND errors = '[]'"
+        params = [file_hash]
+        if result_key is not None:
+            sql += " AND result_key = ?"
+            params.append(result_key)
+        with self._connection() as connection:
+            row = connection.execute(sql, params).fetchone()
+            return None if row is None else self._record(row)
+
+    def find_by_match_key(self, key, exclude_hash=None):
+        """Earliest invoice in the dedup.match_key block ``key`` other than ``exclude_hash``, or None.
+
+        Returns a dict with ``id`` (None while only queued), ``Source File``
+        and ``file_hash``.
+        """
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT id, source_file, file_hash FROM invoices WHERE match_key = ? AND file_hash IS NOT ? "
+                "ORDER BY id LIMIT 1", (key, exclude_hash)).fetchone()
+            if row is None:
+                row = self._pending_keys.get(key)
+        if row is None or row["file_hash"] == exclude_hash:
+            return None
+        return {"id": row["id"] if "id" in row.keys() else None, "Source File": row["source_file"],
+                "file_hash": row["file_hash"]}
+
+    def find_similar(self, dhash, phash, max_distance=DEFAULT_MAX_DISTANCE, exclude_hash=None):
+        """A stored page whose dHash and pHash are both within ``max_distance`` bits, or None.
+
+        Candidates come from the pHash band indexes, so every page within
+        HASH_BANDS - 1 bits of pHash is found; farther ones only when they
+        happen to share a band. Returns a dict with ``id`` (None while only
+        queued), ``Source File``, ``file_hash`` and ``distance`` (the larger
+        of the two).
+        """
+        bands = hash_bands(phash)
+        with self._connection() as connection:
+            excluded = None
+            if exclude_hash is not None:
+                row = connection.execute("SELECT id FROM invoices WHERE file_hash = ?", (exclude_hash,)).fetchone()
+                excluded = row and row["id"]
+            for band, value in enumerate(bands):
+                best = None
+                for row_id, stored_dhash, stored_phash in connection.execute(
+                        f"SELECT id, dhash, phash FROM invoices WHERE phash_band{band} = ? LIMIT ?",
+                        (value, _SIMILAR_CANDIDATES)):
+                    distance = max(hamming(_unsigned(stored_dhash), dhash), hamming(_unsigned(stored_phash), phash))
+                    if row_id != excluded and distance <= max_distance and (best is None or distance < best[1]):
+                        best = (row_id, distance)
+                if best is not None:
+                    row = connection.execute("SELECT source_file, file_hash FROM invoices WHERE id = ?",
+                                             (best[0],)).fetchone()
+                    return {"id": best[0], "Source File": row["source_file"], "file_hash": row["file_hash"],
+                            "distance": best[1]}
+        with self._lock:
+            candidates = [entry for band, value in enumerate(bands)
+                          for entry in self._pending_bands.get((band, value), ())]
+        best = None
+        for entry in candidates:
+            distance = max(hamming(_unsigned(entry["dhash"]), dhash), hamming(_unsigned(entry["phash"]), phash))
+            if entry["file_hash"] != exclude_hash and distance <= max_distance and (
+                    best is None or distance < best["distance"]):
+                best = {"id": None, "Source File": entry["source_file"], "file_hash": entry["file_hash"],
+                        "distance": distance}
+        return best
+
+    def save_template(self, vendor, fingerprint, template, source_file=None, replaces=None):
+        """Store a vendor layout template in place of template ``replaces`` (if given); returns its id"""
+        created_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        with self._connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if replaces is not None:
+                    connection.execute("DELETE FROM templates WHERE id = ?", (replaces,))
+                template_id = connection.execute(
+                    "INSERT INTO templates (vendor_name, fingerprint, template, source_file, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (vendor, fingerprint, json.dumps(template), source_file, created_at)).lastrowid
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return template_id
+
+    def templates_version(self):
+        """Changes whenever a template is saved, for reloading a TemplateIndex only when needed"""
+        with self._connection() as connection:
+            return tuple(connection.execute("SELECT COUNT(*), MAX(id) FROM templates").fetchone())
+
+    def templates(self):
+        """Every stored vendor layout template, oldest first, as TemplateIndex takes them.
+
+        Dicts with ``id``, ``vendor``, ``fingerprint`` (bytes), ``template``
+        (the field boxes), ``source_file`` and ``created_at``.
+        """
+        with self._connection() as connection:
+            rows = connection.execute(
+                "SELECT id, vendor_name, fingerprint, template, source_file, created_at FROM templates ORDER BY id")
+            return [{"id": row["id"], "vendor": row["vendor_name"], "fingerprint": bytes(row["fingerprint"]),
+                     "template": json.loads(row["template"]), "source_file": row["source_file"],
+                     "created_at": row["created_at"]} for row in rows]
+
+    def _where(self, query=None, vendor=None, invoice_number=None, date_from=None, date_to=None,
+               min_total=None, max_total=None, max_confidence=None):
+        clauses, params = [], []
+        if query and query.strip():
+            clauses.append("invoices.id IN (SELECT rowid FROM invoice_text WHERE invoice_text MATCH ?)")
+            params.append(fts_query(query))
+        if vendor:
+            clauses.append("invoices.vendor_name LIKE ? ESCAPE '\\'")
+            params.append(_like_prefix(vendor))
+        if invoice_number:
+            clauses.append("invoices.invoice_number LIKE ? ESCAPE '\\'")
+            params.append(_like_prefix(invoice_number))
+        if date_from:
+            clauses.append("invoices.invoice_date_iso >= ?")
+            params.append(str(date_from))
+        if date_to:
+            clauses.append("invoices.invoice_date_iso <= ?")
+            params.append(str(date_to))
+        if min_total is not None:
+            clauses.append("invoices.total_value >= ?")
+            params.append(min_total)
+        if max_total is not None:
+            clauses.append("invoices.total_value <= ?")
+            params.append(max_total)
+        if max_confidence is not None:
+            clauses.append("invoices.ocr_confidence < ?")
+            params.append(max_confidence)
+        return " WHERE " + " AND ".join(clauses) if clauses else "", params
+
+    def count(self, **filters):
+        """Number of stored invoices matching the search() filters"""
+        where, params = self._where(**filters)
+        with self._connection() as connection:
+            return connection.execute(f"SELECT COUNT(*) FROM invoices{where}", params).fetchone()[0]
+
+    def search(self, limit=DEFAULT_PAGE_SIZE, offset=0, order_by="processed_at", descending=True, **filters):
+        """One page of stored invoices as dicts keyed by the extracted field names.
+
+        Filters: ``query`` (full-text over the raw text; rows then carry a
+        ``snippet``), ``vendor`` and ``invoice_number`` (case-insensitive
+        prefixes), ``date_from``/``date_to`` (invoice date, ISO strings or
+        dates), ``min_total``/``max_total`` and ``max_confidence`` (OCR'd
+        invoices whose confidence is below it, for review).
+        """
+        where, params = self._where(**filters)
+        column = SORT_COLUMNS[order_by]
+        direction = "DESC" if descending else "ASC"
+        columns = ", ".join(["id", "file_hash", "processed_at", "duplicate_of", "ocr_confidence"]
+                            + list(FIELD_COLUMNS.values()))
+        sql = (f"SELECT {columns} FROM invoices{where} "
+               f"ORDER BY {column} {direction}, id {direction} LIMIT ? OFFSET ?")
+        with self._connection() as connection:
+            records = [self._to_dict(row) for row in connection.execute(sql, params + [limit, offset])]
+            query = filters.get("query")
+            if records and query and query.strip():
+                # Snippets only for the page: building them for every match before sorting is far slower
+                by_id = {record["id"]: record for record in records}
+                marks = ", ".join("?" * len(by_id))
+                snippets = connection.execute(
+                    "SELECT rowid, snippet(invoice_text, 0, '[', ']', '…', 12) FROM invoice_text "
+                    f"WHERE invoice_text MATCH ? AND rowid IN ({marks})", [fts_query(query), *by_id])
+                for rowid, snippet in snippets:
+                    by_id[rowid]["snippet"] = snippet
+            return records
+
+    def get(self, invoice_id):
+        """Everything stored for one invoice, including raw text, metadata and line items, or None"""
+        with self._connection() as connection:
+            row = connection.execute("SELECT * FROM invoices WHERE id = ?", (invoice_id,)).fetchone()
+            return None if row is None else self._record(row)
+
+    def line_items(self, invoice_id):
+        """Line items of one invoice in order, as dicts like line_items.find_line_items returns"""
+        with self._connection() as connection:
+            rows = connection.execute(
+                f"SELECT {', '.join(_ITEM_COLUMNS)} FROM line_items WHERE invoice_id = ? ORDER BY position",
+                (invoice_id,))
+            return [dict(zip(_ITEM_COLUMNS, row)) for row in rows]
+
+    def _record(self, row):
+        record = self._to_dict(row)
+        for name in ("raw_text", "cached", "elapsed", "invoice_date_iso", "due_date_iso",
+                     "total_value", "tax_value", "result_key"):
+            record[name] = row[name]
+        record["metadata"] = json.loads(row["metadata"])
+        record["errors"] = json.loads(row["errors"])
+        # Queued rows carry their items; stored ones have them in the child table
+        record["line_items"] = row["line_items"] if isinstance(row, dict) else self.line_items(row["id"])
+        return record
+
+    @staticmethod
+    def _to_dict(row):
+        keys = row.keys()
+        record = {field: row[column] for field, column in FIELD_COLUMNS.items()}
+        for name in ("id", "file_hash", "processed_at", "duplicate_of", "ocr_confidence"):
+            if name in keys:
+                record[name] = row[name]
+        return record
@@ -0,0 +1,257 @@
+"""Column-oriented store for extracted invoice rows.
+
+Rows are appended to one Python list per column (amortised O(1)), and a
+pandas DataFrame is only materialised when something needs one, such as
+``st.dataframe`` or the Excel export. The frame is cached until the next
+append, and in-place row updates patch the cached frame instead of
+discarding it.
+
+The results grid never shows the whole table. view() returns the row
+indices matching a filter in a given sort order, cached until rows are
+added or cleared, so turning pages or editing costs the same at 50k rows
+as at 50; window() builds a DataFrame of only the rows on screen, and
+apply_edits() writes back only the cells that changed, logging each one in
+``edits``. A cached view keeps edited rows where they were until the filter
+or sort changes, as a spreadsheet does.
+
+Every cell keeps the text it was extracted as, which is what row(),
+iter_rows() and the exports return and what filters match. Columns of
+another dtype also keep the parsed value of each cell, converted as rows
+are added or updated: DataFrames hold those (missing where the text doesn't
+parse) and view() sorts by them.
+"""
+import math
+import re
+from datetime import date, datetime, timezone
+
+# Declared type of each extracted field; anything unlisted is a string
+FIELD_DTYPES = {
+    "Invoice Number": "string",
+    "Invoice Date": "datetime64[ns]",
+    "Due Date": "datetime64[ns]",
+    "Vendor Name": "string",
+    "Total Amount": "Float64",
+    "Tax Amount": "Float64",
+    "Currency": "string",
+    "Invoice Items": "string",
+    "Source File": "string",
+}
+
+# Joins a row's cells in its filter text, so a filter never matches across two cells
+_CELL_SEPARATOR = "\x1f"
+
+# Dates as the grid's date cells return them, e.g. 2024-03-05 or 2024-03-05T00:00:00
+_ISO_DATE = re.compile(r"(\d{4}-\d{2}-\d{2})(?:[T ][\d:.]*)?")
+
+
+def _date_value(text):
+    from invoice_store import iso_date
+
+    return iso_date(text)
+
+
+def _amount_value(text):
+    from invoice_store import amount_value
+
+    return amount_value(text)
+
+
+# Parses a cell's text into a value of each non-string dtype, returning None if it doesn't parse
+_CONVERTERS = {
+    "datetime64[ns]": _date_value,
+    "Float64": _amount_value,
+}
+
+
+def _cell_text(value, dtype):
+    """Text of a cell of ``dtype`` as written to the table; None and NaN become ''"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return "" if math.isnan(value) else f"{value:.2f}"
+    if isinstance(value, datetime):
+        # Including pandas Timestamps, which the grid's date cells may hold
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    text = str(value)
+    match = _ISO_DATE.fullmatch(text) if dtype == "datetime64[ns]" else None
+    return match.group(1) if match else text
+
+
+class InvoiceTable:
+    """Append-only columnar table with in-place row updates"""
+
+    def __init__(self, columns, dtypes=None):
+        self.columns = list(columns)
+        self.dtypes = {col: (dtypes or FIELD_DTYPES).get(col, "string") for col in self.columns}
+        for col, dtype in self.dtypes.items():
+            if dtype != "string" and dtype not in _CONVERTERS:
+                raise ValueError(f"Unsupported dtype for {col}: {dtype}")
+        self._data = {col: [] for col in self.columns}
+        # Parsed value of each cell of the columns that aren't strings
+        self._values = {col: [] for col, dtype in self.dtypes.items() if dtype != "string"}
+        self._frame = None
+        # Lower-cased text of each row, for filtering
+        self._search = []
+        # ((rows version, filter, sort column, descending), row indices) of the last view
+        self._view = None
+        # Bumped on every change, so derived data (like an export) knows when it is stale
+        self.version = 0
+        # Bumped only when rows are added or cleared; cached views last until then
+        self.rows_version = 0
+        # One dict per changed cell: Row, Source File, Column, Old, New, Edited At
+        self.edits = []
+
+    def __len__(self):
+        return len(self._data[self.columns[0]]) if self.columns else 0
+
+    @property
+    def empty(self):
+        return len(self) == 0
+
+    def append(self, row):
+        """Add one row (a dict keyed by column name; missing columns become '')"""
+        for col in self.columns:
+            value = row.get(col, "")
+            text = "" if value is None else str(value)
+            self._data[col].append(text)
+            if col in self._values:
+                self._values[col].append(_CONVERTERS[self.dtypes[col]](text))
+        self._search.append(self._row_text(len(self) - 1))
+        self._frame = None
+        self.version += 1
+        self.rows_version += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def row(self, index):
+        """Return row ``index`` as a dict"""
+        return {col: self._data[col][index] for col in self.columns}
+
+    def iter_rows(self):
+        """Yield every row as a dict, without building a DataFrame"""
+        for index in range(len(self)):
+            yield self.row(index)
+
+    def _row_text(self, index):
+        return _CELL_SEPARATOR.join(self._data[col][index] for col in self.columns).casefold()
+
+    def update_row(self, index, values):
+        """Overwrite some cells of row ``index`` in place"""
+        if not 0 <= index < len(self):
+            raise IndexError(f"Row {index} out of range")
+        self.version += 1
+        for col, value in values.items():
+            if col not in self._data:
+                raise KeyError(col)
+            text = "" if value is None else str(value)
+            self._data[col][index] = text
+            if col in self._values:
+                value = self._values[col][index] = _CONVERTERS[self.dtypes[col]](text)
+            else:
+                value = text
+            if self._frame is not None:
+                self._frame.at[index, col] = value
+        self._search[index] = self._row_text(index)
+
+    def apply_edits(self, changes):
+        """Write ``{row index: {column: value}}`` back, skipping cells that already hold the value.
+
+        Values may be text or, for typed columns, what the grid returns for
+        them (numbers, dates, ISO date strings). A typed cell whose parsed
+        value doesn't change keeps its text. Each changed cell is appended
+        to ``edits``; returns the new entries.
+        """
+        edited_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        applied = []
+        for index, values in changes.items():
+            current = self.row(index)
+            changed = {}
+            for col, value in values.items():
+                if col not in current:
+                    raise KeyError(col)
+                value = _cell_text(value, self.dtypes[col])
+                if col in self._values and value:
+                    same = _CONVERTERS[self.dtypes[col]](value) == self._values[col][index]
+                else:
+                    same = value == current[col]
+                if not same:
+                    changed[col] = value
+                    applied.append({"Row": index, "Source File": current.get("Source File", ""), "Column": col,
+                                    "Old": current[col], "New": value, "Edited At": edited_at})
+            if changed:
+                self.update_row(index, changed)
+        self.edits.extend(applied)
+        return applied
+
+    def view(self, text="", sort_by=None, descending=False):
+        """Indices of the rows containing ``text`` in any cell (ignoring case), ordered by ``sort_by``.
+
+        Without ``sort_by`` rows stay in the order they were added. Typed
+        columns (dates, amounts) sort by value, the others as case-insensitive
+        text; empty and unparseable cells come last either way. The result is cached until rows are added or cleared.
+        """
+        needle = (text or "").strip().casefold()
+        key = (self.rows_version, needle, sort_by, descending)
+        if self._view is not None and self._view[0] == key:
+            return self._view[1]
+        if needle:
+            rows = [index for index, row_text in enumerate(self._search) if needle in row_text]
+        else:
+            rows = list(range(len(self)))
+        if sort_by is not None:
+            if sort_by in self._values:
+                values = self._values[sort_by]
+                keyed = [(values[index], index) for index in rows]
+            else:
+                values = self._data[sort_by]
+                keyed = [(values[index].casefold() or None, index) for index in rows]
+            # Ties keep the order rows were added in, whichever way the sort goes
+            ordered = sorted(((value, index) for value, index in keyed if value is not None),
+                             key=lambda pair: pair[0], reverse=descending)
+            rows = [index for _, index in ordered] + [index for value, index in keyed if value is None]
+        elif descending:
+            rows.reverse()
+        self._view = (key, rows)
+        return rows
+
+    def _column(self, col):
+        """The values a DataFrame holds for ``col``: parsed for typed columns, else the text"""
+        return self._values.get(col, self._data[col])
+
+    def window(self, indices):
+        """DataFrame of just the rows ``indices``, indexed by them"""
+        import pandas as pd
+
+        return pd.DataFrame(
+            {col: pd.array([self._column(col)[index] for index in indices], dtype=self.dtypes[col])
+             for col in self.columns},
+            columns=self.columns,
+            index=pd.Index(indices, dtype="int64"),
+        )
+
+    def clear(self):
+        for values in self._data.values():
+            values.clear()
+        for values in self._values.values():
+            values.clear()
+        self._search.clear()
+        self._view = None
+        self.edits.clear()
+        self._frame = None
+        self.version += 1
+        self.rows_version += 1
+
+    def to_dataframe(self):
+        """The table as a DataFrame, built on first use after a change"""
+        if self._frame is None:
+            import pandas as pd
+
+            self._frame = pd.DataFrame(
+                {col: pd.array(self._column(col), dtype=self.dtypes[col]) for col in self.columns},
+                columns=self.columns,
+            )
+        return self._frame
@@ -0,0 +1,500 @@
+"""Leased job queues for extracting one batch of invoices on several machines.
+
+A job is one file's content: its id is the file's SHA-256, so a file
+submitted twice, or under several names, is one job. Each job belongs to a
+shard (``shard_of``, from the hash) that workers can prefer. A worker
+leases jobs for ``lease_seconds`` and renews the lease with heartbeats
+while it extracts them. A lease that isn't renewed in time (the worker
+crashed, hung or lost its network) expires, and ``requeue_expired`` puts
+the job back in the queue. A job whose lease expired ``max_attempts`` times
+fails instead, so one file that kills its worker can't take the cluster
+down one node at a time. Completing a job records the result store key
+of its result; failing one records why.
+
+Two backends implement JobQueue:
+
+- SQLiteJobQueue: one SQLite file. Fine for the workers of one machine and
+  for nodes sharing a filesystem whose locks SQLite can rely on; not
+  NFS, whose locking SQLite warns against.
+- FileJobQueue: a directory of marker files moved between state
+  directories with atomic renames, which works on NFS and SMB shares.
+
+open_queue picks one from a path: ``*.sqlite3``/``*.db`` (or a
+``sqlite:`` prefix) is SQLite, anything else a directory. Lease expiry
+compares the clocks of different machines, so they should be kept in sync
+(NTP) to well within ``lease_seconds``.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+DEFAULT_LEASE_SECONDS = 60
+DEFAULT_MAX_ATTEMPTS = 3
+
+STATES = ("queued", "leased", "done", "failed")
+
+
+def shard_of(digest, shards):
+    """Shard of a SHA-256 hex digest among ``shards``"""
+    return int(digest[:8], 16) % shards
+
+
+class Job:
+    """One file to extract: its SHA-256 (the job id), shard, path and the names it was submitted under"""
+
+    def __init__(self, job_id, shard, path, names, state="queued", attempts=0, owner=None, result=None,
+                 error=None):
+        self.id = job_id
+        self.shard = shard
+        self.path = path
+        self.names = names
+        self.state = state
+        self.attempts = attempts
+        self.owner = owner
+        # Result store key once done
+        self.result = result
+        self.error = error
+
+    @property
+    def name(self):
+        return self.names[0]
+
+    def __repr__(self):
+        return f"Job({self.id[:12]}, {self.name!r}, {self.state})"
+
+
+class JobQueue:
+    """What a queue backend provides; SQLiteJobQueue and FileJobQueue implement it.
+
+    Every method may be called from any process on any machine sharing the
+    queue, and from several threads of one process.
+    """
+
+    def __init__(self, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+    def submit(self, entries):
+        """Add ``(digest, shard, path, name)`` entries; returns how many new jobs they made.
+
+        An entry whose digest is already a job only adds its name to it.
+        """
+        raise NotImplementedError
+
+    def lease(self, owner, count, shards=None):
+        """Up to ``count`` queued jobs of ``shards`` (any shard if None), leased to ``owner``"""
+        raise NotImplementedError
+
+    def heartbeat(self, owner, job_ids):
+        """Renew ``owner``'s leases on ``job_ids``; returns the ids it still holds"""
+        raise NotImplementedError
+
+    def complete(self, job_id, owner, result):
+        """Mark a job done with its result store key; False if it had already been"""
+        raise NotImplementedError
+
+    def fail(self, job_id, owner, error):
+        """Mark a leased job failed; False if ``owner`` no longer held it"""
+        raise NotImplementedError
+
+    def requeue_expired(self):
+        """Queue again the jobs whose lease expired (failing those out of attempts); returns how many"""
+        raise NotImplementedError
+
+    def counts(self):
+        """``{state: number of jobs}`` for every state"""
+        raise NotImplementedError
+
+    def jobs(self, state=None):
+        """Jobs, all or those in ``state``"""
+        raise NotImplementedError
+
+
+_QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    shard INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    expires REAL,
+    result TEXT,
+    error TEXT,
+    submitted_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, shard);
+CREATE INDEX IF NOT EXISTS jobs_expires ON jobs(expires) WHERE state = 'leased';
+CREATE TABLE IF NOT EXISTS names (
+    name TEXT NOT NULL,
+    job TEXT NOT NULL,
+    PRIMARY KEY (name, job)
+);
+CREATE INDEX IF NOT EXISTS names_job ON names(job);
+"""
+
+
+class SQLiteJobQueue(JobQueue):
+    """Job queue in one SQLite database (WAL mode); every change is one IMMEDIATE transaction"""
+
+    def __init__(self, path, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        super().__init__(lease_seconds, max_attempts)
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Heartbeats come from another thread; the lock keeps the connection to one at a time
+        self._connection = sqlite3.connect(path, isolation_level=None, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_QUEUE_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def _transaction(self, body):
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                value = body(connection)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return value
+
+    def submit(self, entries):
+        now = time.time()
+
+        def body(connection):
+            new = 0
+            for digest, shard, path, name in entries:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO jobs (id, shard, path, submitted_at) VALUES (?, ?, ?, ?)",
+                    (digest, shard, path, now))
+                new += cursor.rowcount
+                connection.execute("INSERT OR IGNORE INTO names (name, job) VALUES (?, ?)", (name, digest))
+            return new
+
+        return self._transaction(body)
+
+    def lease(self, owner, count, shards=None):
+        expires = time.time() + self.lease_seconds
+
+        def body(connection):
+            if shards is None:
+                rows = connection.execute("SELECT id FROM jobs WHERE state = 'queued' ORDER BY rowid LIMIT ?",
+                                          (count,)).fetchall()
+            else:
+                marks = ", ".join("?" * len(shards))
+                rows = connection.execute(
+                    f"SELECT id FROM jobs WHERE state = 'queued' AND shard IN ({marks}) ORDER BY rowid LIMIT ?",
+                    (*shards, count)).fetchall()
+            ids = [row[0] for row in rows]
+            connection.executemany(
+                "UPDATE jobs SET state = 'leased', owner = ?, expires = ?, attempts = attempts + 1 WHERE id = ?",
+                [(owner, expires, job_id) for job_id in ids])
+            return self._load(connection, ids)
+
+        return self._transaction(body)
+
+    def heartbeat(self, owner, job_ids):
+        expires = time.time() + self.lease_seconds
+
+        def body(connection):
+            held = set()
+            for job_id in job_ids:
+                cursor = connection.execute(
+                    "UPDATE jobs SET expires = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                    (expires, job_id, owner))
+                if cursor.rowcount:
+                    held.add(job_id)
+            return held
+
+        return self._transaction(body)
+
+    def complete(self, job_id, owner, result):
+        # Whoever finishes first wins: results are addressed by content, so a lease lost meanwhile doesn't matter
+        def body(connection):
+            return connection.execute(
+                "UPDATE jobs SET state = 'done', owner = NULL, expires = NULL, result = ?, error = NULL, "
+                "finished_at = ? WHERE id = ? AND state != 'done'", (result, time.time(), job_id)).rowcount > 0
+
+        return self._transaction(body)
+
+    def fail(self, job_id, owner, error):
+        def body(connection):
+            return connection.execute(
+                "UPDATE jobs SET state = 'failed', owner = NULL, expires = NULL, error = ?, finished_at = ? "
+                "WHERE id = ? AND owner = ? AND state = 'leased'", (error, time.time(), job_id, owner)).rowcount > 0
+
+        return self._transaction(body)
+
+    def requeue_expired(self):
+        now = time.time()
+
+        def body(connection):
+            failed = connection.execute(
+                "UPDATE jobs SET state = 'failed', owner = NULL, expires = NULL, finished_at = ?, "
+                "error = 'Lease expired ' || attempts || ' times' "
+                "WHERE state = 'leased' AND expires < ? AND attempts >= ?", (now, now, self.max_attempts)).rowcount
+            requeued = connection.execute(
+                "UPDATE jobs SET state = 'queued', owner = NULL, expires = NULL WHERE state = 'leased' AND expires < ?",
+                (now,)).rowcount
+            return failed + requeued
+
+        return self._transaction(body)
+
+    def counts(self):
+        with self._lock:
+            rows = self._connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return dict(dict.fromkeys(STATES, 0), **dict(rows))
+
+    def jobs(self, state=None):
+        with self._lock:
+            if state is None:
+                ids = [row[0] for row in self._connection.execute("SELECT id FROM jobs ORDER BY rowid")]
+            else:
+                ids = [row[0] for row in self._connection.execute(
+                    "SELECT id FROM jobs WHERE state = ? ORDER BY rowid", (state,))]
+            return self._load(self._connection, ids)
+
+    def _load(self, connection, ids):
+        jobs = []
+        for job_id in ids:
+            row = connection.execute("SELECT shard, path, state, attempts, owner, result, error FROM jobs "
+                                     "WHERE id = ?", (job_id,)).fetchone()
+            names = [name for name, in connection.execute("SELECT name FROM names WHERE job = ? ORDER BY rowid",
+                                                          (job_id,))]
+            jobs.append(Job(job_id, *row[:2], names, *row[2:]))
+        return jobs
+
+
+class FileJobQueue(JobQueue):
+    """Job queue in a directory, for nodes that share it over NFS or SMB.
+
+    ``jobs/<id>.json`` holds a job's shard, path and names. Its state is an
+    empty marker file, renamed (atomically, so exactly one worker wins a
+    lease) between ``queued/<shard>/<id>~<attempts>`` and
+    ``leased/<id>~<attempts>~<owner>``. The marker's ctime is the lease's
+    last heartbeat: a rename sets it, and so does the heartbeat's utime.
+    Done and failed jobs get ``done/<id>.json`` or ``failed/<id>.json``
+    with the result key or the error. Only the coordinator submits, so the
+    job files have one writer.
+    """
+
+    def __init__(self, directory, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        super().__init__(lease_seconds, max_attempts)
+        self.directory = directory
+        for state in ("jobs",) + STATES:
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+    def _path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def _write_json(self, path, value):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+    def _read_json(self, path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _leases(self):
+        # (job id, attempts, owner, marker path) of every leased job
+        for entry in os.scandir(self._path("leased")):
+            job_id, _, rest = entry.name.partition("~")
+            attempts, _, owner = rest.partition("~")
+            if owner:
+                yield job_id, int(attempts), owner, entry.path
+
+    def _queued(self, shards):
+        # (job id, attempts, shard, marker path) of the queued jobs of ``shards``, oldest marker first
+        if shards is None:
+            shards = [int(name) for name in os.listdir(self._path("queued")) if name.isdigit()]
+        markers = []
+        for shard in shards:
+            try:
+                entries = list(os.scandir(self._path("queued", str(shard))))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                job_id, _, attempts = entry.name.partition("~")
+                if attempts.isdigit():
+                    try:
+                        markers.append((entry.stat().st_mtime, job_id, int(attempts), shard, entry.path))
+                    except FileNotFoundError:
+                        continue
+        markers.sort()
+        return [marker[1:] for marker in markers]
+
+    def submit(self, entries):
+        new = 0
+        for digest, shard, path, name in entries:
+            job_path = self._path("jobs", digest + ".json")
+            spec = self._read_json(job_path)
+            if spec is not None:
+                if name not in spec["names"]:
+                    spec["names"].append(name)
+                    self._write_json(job_path, spec)
+                continue
+            self._write_json(job_path, {"shard": shard, "path": path, "names": [name], "submitted_at": time.time()})
+            os.makedirs(self._path("queued", str(shard)), exist_ok=True)
+            # Created after the job file, so a worker never leases a job it can't read
+            open(self._path("queued", str(shard), f"{digest}~0"), "xb").close()
+            new += 1
+        return new
+
+    def lease(self, owner, count, shards=None):
+        if "~" in owner or os.sep in owner:
+            raise ValueError(f"Worker names can't contain '~' or '{os.sep}': {owner}")
+        jobs = []
+        for job_id, attempts, shard, marker in self._queued(shards):
+            if len(jobs) >= count:
+                break
+            leased = self._path("leased", f"{job_id}~{attempts + 1}~{owner}")
+            try:
+                os.rename(marker, leased)
+            except FileNotFoundError:
+                # Another worker leased it first
+                continue
+            if os.path.exists(self._path("done", job_id + ".json")):
+                # Completed by a worker whose lease had already expired
+                os.remove(leased)
+                continue
+            spec = self._read_json(self._path("jobs", job_id + ".json"))
+            jobs.append(Job(job_id, spec["shard"], spec["path"], spec["names"], "leased", attempts + 1, owner))
+        return jobs
+
+    def heartbeat(self, owner, job_ids):
+        wanted = set(job_ids)
+        held = set()
+        for job_id, _, lease_owner, marker in self._leases():
+            if job_id in wanted and lease_owner == owner:
+                try:
+                    os.utime(marker)
+                except FileNotFoundError:
+                    continue
+                held.add(job_id)
+        return held
+
+    def _release(self, job_id, owner=None):
+        # Remove the lease marker of a job (only ``owner``'s if given); True if there was one
+        released = False
+        for lease_id, _, lease_owner, marker in self._leases():
+            if lease_id == job_id and owner in (None, lease_owner):
+                try:
+                    os.remove(marker)
+                    released = True
+                except FileNotFoundError:
+                    pass
+        return released
+
+    def complete(self, job_id, owner, result):
+        done_path = self._path("done", job_id + ".json")
+        if os.path.exists(done_path):
+            self._release(job_id, owner)
+            return False
+        self._write_json(done_path, {"result": result, "finished_at": time.time()})
+        self._release(job_id)
+        return True
+
+    def fail(self, job_id, owner, error):
+        held = [marker for lease_id, _, lease_owner, marker in self._leases()
+                if lease_id == job_id and lease_owner == owner]
+        if not held:
+            return False
+        attempts = int(os.path.basename(held[0]).split("~")[1])
+        self._write_json(self._path("failed", job_id + ".json"),
+                         {"error": error, "attempts": attempts, "finished_at": time.time()})
+        self._release(job_id, owner)
+        return True
+
+    def requeue_expired(self):
+        deadline = time.time() - self.lease_seconds
+        moved = 0
+        for job_id, attempts, _, marker in list(self._leases()):
+            try:
+                if os.stat(marker).st_ctime >= deadline:
+                    continue
+            except FileNotFoundError:
+                continue
+            if attempts >= self.max_attempts:
+                try:
+                    os.remove(marker)
+                except FileNotFoundError:
+                    continue
+                self._write_json(self._path("failed", job_id + ".json"),
+                                 {"error": f"Lease expired {attempts} times", "attempts": attempts,
+                                  "finished_at": time.time()})
+            else:
+                spec = self._read_json(self._path("jobs", job_id + ".json"))
+                queued = self._path("queued", str(spec["shard"]))
+                os.makedirs(queued, exist_ok=True)
+                try:
+                    os.rename(marker, os.path.join(queued, f"{job_id}~{attempts}"))
+                except FileNotFoundError:
+                    continue
+            moved += 1
+        return moved
+
+    def counts(self):
+        counts = dict.fromkeys(STATES, 0)
+        counts["queued"] = len(self._queued(None))
+        counts["leased"] = sum(1 for _ in self._leases())
+        for state in ("done", "failed"):
+            counts[state] = sum(1 for name in os.listdir(self._path(state)) if name.endswith(".json"))
+        return counts
+
+    def jobs(self, state=None):
+        states = {}
+        for job_id, attempts, _, _ in self._queued(None):
+            states[job_id] = ("queued", attempts, None, None, None)
+        for job_id, attempts, owner, _ in self._leases():
+            states[job_id] = ("leased", attempts, owner, None, None)
+        for name in os.listdir(self._path("failed")):
+            record = self._read_json(self._path("failed", name)) if name.endswith(".json") else None
+            if record is not None:
+                states[name[:-5]] = ("failed", record["attempts"], None, None, record["error"])
+        for name in os.listdir(self._path("done")):
+            record = self._read_json(self._path("done", name)) if name.endswith(".json") else None
+            if record is not None:
+                states[name[:-5]] = ("done", 0, None, record["result"], None)
+        jobs = []
+        for name in sorted(os.listdir(self._path("jobs"))):
+            if not name.endswith(".json") or name[:-5] not in states:
+                continue
+            job_state = states[name[:-5]]
+            if state is not None and job_state[0] != state:
+                continue
+            spec = self._read_json(self._path("jobs", name))
+            if spec is not None:
+                jobs.append(Job(name[:-5], spec["shard"], spec["path"], spec["names"], *job_state))
+        return jobs
+
+
+def open_queue(spec, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """SQLiteJobQueue for ``sqlite:PATH``, ``*.sqlite3`` or ``*.db``; FileJobQueue for a directory otherwise"""
+    if spec.startswith("sqlite:"):
+        return SQLiteJobQueue(spec[len("sqlite:"):], lease_seconds, max_attempts)
+    if os.path.splitext(spec)[1].lower() in (".sqlite3", ".sqlite", ".db"):
+        return SQLiteJobQueue(spec, lease_seconds, max_attempts)
+    return FileJobQueue(spec, lease_seconds, max_attempts)
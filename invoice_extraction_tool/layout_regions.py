@@ -0,0 +1,154 @@
+"""Layout analysis for region-targeted OCR.
+
+Full-page OCR spends most of its time on the line item table, addresses and
+terms, while the fields we store sit in a few blocks: the header (vendor),
+the invoice meta block (number and dates) and the totals block. Text blocks
+are found on a downscaled copy of the binarized page with morphological
+closing and contour bounding boxes, labelled by where they sit on the page,
+and only the header, meta and totals zones are passed on for OCR.
+
+Each zone is OCR'd as one crop around all of its blocks rather than block by
+block, so labels and values that sit apart on a row ("Total:" ... "$1,234.00")
+still come out on one line for the field patterns.
+"""
+import cv2
+import numpy as np
+
+# Labels in reading order; blocks labelled "body" are not OCR'd
+REGION_LABELS = ("header", "meta", "totals")
+
+# Page fractions (of height, from the top) bounding the header and meta zones
+HEADER_ZONE = 0.15
+META_ZONE = 0.35
+# Totals blocks start right of this fraction of the width, below the meta zone
+TOTALS_LEFT = 0.4
+
+# Layout is found on a copy scaled by this much
+ANALYSIS_SCALE = 0.25
+# Horizontal gap (fraction of page width) still treated as the same row
+ROW_GAP = 0.15
+# Vertical gap (fraction of page height) still treated as the same block
+BLOCK_GAP = 0.015
+# Padding (pixels at full resolution) kept around each block for OCR
+REGION_PADDING = 12
+
+# Tesseract page segmentation modes: automatic layout, one block, one line
+PSM_AUTO = 3
+PSM_BLOCK = 6
+PSM_LINE = 7
+
+
+class TextRegion:
+    """A labelled block of text on the page, in full-resolution pixels"""
+
+    def __init__(self, label, x, y, width, height, lines, blocks=1):
+        self.label = label
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.lines = lines
+        self.blocks = blocks
+
+    @property
+    def psm(self):
+        if self.lines == 1:
+            return PSM_LINE
+        # Several blocks side by side need Tesseract's own column detection
+        return PSM_BLOCK if self.blocks == 1 else PSM_AUTO
+
+    def crop(self, image):
+        """View of ``image`` covering this region plus some padding"""
+        top = max(0, self.y - REGION_PADDING)
+        left = max(0, self.x - REGION_PADDING)
+        return image[top:self.y + self.height + REGION_PADDING, left:self.x + self.width + REGION_PADDING]
+
+    def __repr__(self):
+        return (f"TextRegion({self.label!r}, x={self.x}, y={self.y}, width={self.width}, "
+                f"height={self.height}, lines={self.lines}, blocks={self.blocks})")
+
+
+def _label(x, y, page_width, page_height):
+    if y < page_height * HEADER_ZONE:
+        return "header"
+    if y < page_height * META_ZONE:
+        return "meta"
+    if x >= page_width * TOTALS_LEFT:
+        return "totals"
+    return "body"
+
+
+# Morphological closing that doesn't grow shapes into the page border
+def _close(mask, kernel):
+    pad_y, pad_x = kernel.shape
+    padded = cv2.copyMakeBorder(mask, pad_y, pad_y, pad_x, pad_x, cv2.BORDER_CONSTANT, value=0)
+    closed = cv2.morphologyEx(padded, cv2.MORPH_CLOSE, kernel)
+    return closed[pad_y:pad_y + mask.shape[0], pad_x:pad_x + mask.shape[1]]
+
+
+def _boxes(mask):
+    contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    return [cv2.boundingRect(contour) for contour in contours]
+
+
+def find_text_regions(binary):
+    """Return every text block of a binarized page (dark text on white) as TextRegions, in reading order"""
+    page_height, page_width = binary.shape[:2]
+    # Area averaging keeps any cell that holds some ink, so small print survives the downscale
+    ink = cv2.resize(cv2.bitwise_not(binary), None, fx=ANALYSIS_SCALE, fy=ANALYSIS_SCALE,
+                     interpolation=cv2.INTER_AREA)
+    ink = cv2.threshold(ink, 32, 255, cv2.THRESH_BINARY)[1]
+    small_height, small_width = ink.shape
+
+    # Characters -> words -> rows, bridging gaps narrower than ROW_GAP
+    row_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, int(small_width * ROW_GAP)), 1))
+    rows = _close(ink, row_kernel)
+    row_boxes = [
+        (x, y, w, h) for x, y, w, h in _boxes(rows)
+        # Ruled lines are thin and very wide, specks are tiny
+        if h > 1 and w > 1 and w < h * 60
+    ]
+    if not row_boxes:
+        return []
+
+    # Rows -> blocks, bridging vertical gaps narrower than BLOCK_GAP
+    rows = np.zeros_like(ink)
+    for x, y, w, h in row_boxes:
+        rows[y:y + h, x:x + w] = 255
+    block_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(3, int(small_height * BLOCK_GAP))))
+    blocks = _close(rows, block_kernel)
+
+    scale = 1 / ANALYSIS_SCALE
+    regions = []
+    for x, y, w, h in _boxes(blocks):
+        lines = sum(
+            1 for rx, ry, rw, rh in row_boxes
+            if x <= rx + rw / 2 <= x + w and y <= ry + rh / 2 <= y + h
+        )
+        if lines == 0:
+            continue
+        full_x, full_y = int(x * scale), int(y * scale)
+        regions.append(TextRegion(
+            _label(full_x, full_y, page_width, page_height),
+            full_x, full_y, int(np.ceil(w * scale)), int(np.ceil(h * scale)), lines,
+        ))
+
+    order = {label: i for i, label in enumerate(REGION_LABELS + ("body",))}
+    regions.sort(key=lambda region: (order[region.label], region.y, region.x))
+    return regions
+
+
+def select_field_regions(regions):
+    """One region per field zone (header, meta, totals) spanning all of that zone's blocks"""
+    selected = []
+    for label in REGION_LABELS:
+        zone = [region for region in regions if region.label == label]
+        if not zone:
+            continue
+        left = min(region.x for region in zone)
+        top = min(region.y for region in zone)
+        right = max(region.x + region.width for region in zone)
+        bottom = max(region.y + region.height for region in zone)
+        selected.append(TextRegion(label, left, top, right - left, bottom - top,
+                                   sum(region.lines for region in zone), len(zone)))
+    return selected
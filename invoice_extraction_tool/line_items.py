@@ -0,0 +1,375 @@
+"""Line item tables as typed rows: description, quantity, unit price, amount.
+
+The "Invoice Items" field used to be the text after an "Item Description"
+label, cut to five lines. Here the table is rebuilt from where its words
+are on the page: pdfplumber's words for text-layer pages (or the cells of
+``extract_tables`` when the table is ruled) and Tesseract's word boxes for
+OCR'd pages.
+
+1. Words are grouped into rows by their vertical centres, corrected for the
+   skew of Tesseract's own text lines.
+2. The header is the first row naming a description column and at least
+   two of quantity, unit price and amount (HEADER_WORDS).
+3. The rows below it, up to the first totals row (TOTAL_WORDS), are the
+   body. Its numbers are clustered into columns by overlapping x extents,
+   so left-, right- and centre-aligned columns all work, and each cluster
+   takes the role of the header column it lines up with.
+4. A body row with a number in a quantity, price or amount column is an
+   item. A row with description text only, close below an item, continues
+   that item's description.
+
+Each page is read on its own, so a table running onto the next page needs
+its header repeated there (as printed invoices usually do). check_total()
+says whether the amounts add up to the invoice total, with or without tax.
+NumPy is imported on first use.
+"""
+import re
+
+# Header words (lower case, letters only) naming each column
+HEADER_WORDS = {
+    "description": ("description", "item", "items", "product", "service", "services", "details", "particulars"),
+    "quantity": ("qty", "quantity", "units", "hours", "hrs"),
+    "unit_price": ("price", "rate", "unit", "each"),
+    "amount": ("amount", "total", "ext", "extended"),
+}
+
+# First words of the rows that end a table
+TOTAL_WORDS = ("subtotal", "total", "tax", "vat", "gst", "balance", "amount", "payment")
+
+NUMERIC_ROLES = ("quantity", "unit_price", "amount")
+
+# Short description of the table reading for the extraction cache key
+SETTINGS = "header columns, clustered numbers"
+
+# Text-layer pages whose text has none of these are not searched for a table
+_HEADER_HINT = re.compile(r"description|item|product|service|particulars", re.IGNORECASE)
+
+_WORD_ROLES = {word: role for role, words in HEADER_WORDS.items() for word in words}
+_LETTERS = re.compile(r"[^a-z]")
+_NUMBER = re.compile(r"\(?-?[$€£¥]?-?\d[\d,.]*\)?")
+_CURRENCY = re.compile(r"[$€£¥]+")
+# OCR misreadings in numeric columns: a currency symbol as another character (€ as ©), digits as letters
+_MISREAD_SYMBOL = re.compile(r"^[^\d(\-$€£¥]")
+_DIGIT_LOOKALIKES = str.maketrans("OoIlSB", "001158")
+
+
+def _role(text):
+    return _WORD_ROLES.get(_LETTERS.sub("", text.lower()))
+
+
+def parse_number(text):
+    """Float for ``12``, ``$1,234.50``, ``1.234,50`` or ``(5.00)``, or None"""
+    text = (text or "").strip()
+    if not _NUMBER.fullmatch(text):
+        return None
+    negative = text.startswith("(") or "-" in text
+    digits = text.strip("()").replace("-", "")
+    digits = _CURRENCY.sub("", digits)
+    if "," in digits and ("." not in digits or digits.rfind(",") > digits.rfind(".")) and (
+            len(digits) - digits.rfind(",") == 3 or "." in digits):
+        # Decimal comma: 1.234,50 or 12,50
+        digits = digits.replace(".", "").replace(",", ".")
+    else:
+        digits = digits.replace(",", "")
+    try:
+        value = float(digits)
+    except ValueError:
+        return None
+    return -value if negative else value
+
+
+def _misread_number(text):
+    value = parse_number(_MISREAD_SYMBOL.sub("", text))
+    if value is None:
+        value = parse_number(text.translate(_DIGIT_LOOKALIKES))
+    return value
+
+
+def _item(description, values):
+    quantity = values.get("quantity")
+    unit_price = values.get("unit_price")
+    amount = values.get("amount")
+    if quantity is None and unit_price and amount is not None:
+        # A quantity OCR missed, when the amount is a whole multiple of the (rounded) unit price
+        count = round(amount / unit_price)
+        if count >= 1 and abs(count * unit_price - amount) <= 0.005 * (count + 1):
+            quantity = float(count)
+    return {
+        "description": description,
+        "quantity": quantity,
+        "unit_price": None if unit_price is None else round(unit_price, 2),
+        "amount": None if amount is None else round(amount, 2),
+    }
+
+
+def _is_total(text):
+    return _LETTERS.sub("", text.lower()) in TOTAL_WORDS
+
+
+def _row_centres(words, boxes):
+    import numpy as np
+
+    centres = boxes[:, 1] + boxes[:, 3] / 2
+    if "line" not in words[0]:
+        return centres
+    # Scans are rarely straight; Tesseract's lines give the slope to take out
+    lines = {}
+    for index, word in enumerate(words):
+        lines.setdefault((word["block"], word["par"], word["line"]), []).append(index)
+    slopes = []
+    for indexes in lines.values():
+        first, last = indexes[0], indexes[-1]
+        run = boxes[last, 0] - boxes[first, 0]
+        if run > 0:
+            slopes.append((centres[last] - centres[first]) / run)
+    if slopes:
+        centres = centres - np.median(slopes) * boxes[:, 0]
+    return centres
+
+
+def _rows(words, boxes):
+    """Word indexes grouped into rows, top to bottom, each sorted left to right"""
+    import numpy as np
+
+    centres = _row_centres(words, boxes)
+    order = np.argsort(centres, kind="stable")
+    tolerance = np.median(boxes[:, 3]) / 2
+    row_ids = np.concatenate(([0], np.cumsum(np.diff(centres[order]) > tolerance)))
+    rows = [[] for _ in range(int(row_ids[-1]) + 1)]
+    for row, index in zip(row_ids.tolist(), order.tolist()):
+        rows[row].append(index)
+    lefts = boxes[:, 0].tolist()
+    for row in rows:
+        row.sort(key=lefts.__getitem__)
+    return rows
+
+
+def _header_columns(row, words, boxes):
+    """``[(role, left, right)]`` of a header row, or None when the row isn't one"""
+    columns = []
+    for index in row:
+        role = _role(words[index]["text"])
+        if role is None:
+            continue
+        left, right = boxes[index, 0], boxes[index, 0] + boxes[index, 2]
+        if columns and columns[-1][0] == role:
+            # "Unit Price", "Line Total"
+            columns[-1] = (role, columns[-1][1], right)
+        else:
+            columns.append((role, left, right))
+    roles = {role for role, _, _ in columns}
+    if "description" not in roles or len(roles.intersection(NUMERIC_ROLES)) < 2:
+        return None
+    return columns
+
+
+def _cluster_roles(numbers, boxes, columns):
+    """Role of each numeric word, from clusters of overlapping x extents matched to header columns"""
+    import numpy as np
+
+    indexes = np.array(numbers)
+    lefts = boxes[indexes, 0]
+    rights = lefts + boxes[indexes, 2]
+    order = np.argsort(lefts, kind="stable")
+    reach = np.maximum.accumulate(rights[order])
+    cluster_ids = np.concatenate(([0], np.cumsum(lefts[order][1:] > reach[:-1])))
+
+    spans = np.array([(left, right) for _, left, right in columns])
+    roles = {}
+    for cluster in range(int(cluster_ids[-1]) + 1):
+        members = order[cluster_ids == cluster]
+        left, right = lefts[members].min(), rights[members].max()
+        overlap = np.minimum(right, spans[:, 1]) - np.maximum(left, spans[:, 0])
+        if overlap.max() > 0:
+            best = int(overlap.argmax())
+        else:
+            best = int(np.abs((spans[:, 0] + spans[:, 1]) / 2 - (left + right) / 2).argmin())
+        for member in members.tolist():
+            roles[numbers[member]] = columns[best][0]
+    return roles
+
+
+def _text_role(left, columns):
+    # Text belongs to the column whose span (widened to the next column) its left edge falls in
+    role = columns[0][0]
+    for index, (column_role, column_left, _) in enumerate(columns):
+        start = column_left if index == 0 else (columns[index - 1][2] + column_left) / 2
+        if left >= start:
+            role = column_role
+    return role
+
+
+def _boxes(words):
+    import numpy as np
+
+    return np.array([(word["left"], word["top"], word["width"], word["height"]) for word in words],
+                    dtype=np.float64)
+
+
+def table_header(words):
+    """``(left, top, right, bottom)`` of the line item table's header row among ``words``, or None"""
+    words = [word for word in words if word["text"].strip()]
+    if not words:
+        return None
+    boxes = _boxes(words)
+    for row in _rows(words, boxes):
+        if _header_columns(row, words, boxes) is not None:
+            cells = boxes[row]
+            return (float(cells[:, 0].min()), float(cells[:, 1].min()), float((cells[:, 0] + cells[:, 2]).max()),
+                    float((cells[:, 1] + cells[:, 3]).max()))
+    return None
+
+
+def find_line_items(words):
+    """Line items of one page from its word boxes.
+
+    ``words`` are dicts with ``text``, ``left``, ``top``, ``width`` and
+    ``height`` (as ocr_backend's ``image_to_data`` returns them; with
+    Tesseract's ``block``, ``par`` and ``line`` the rows are deskewed).
+    Returns ``[{"description", "quantity", "unit_price", "amount"}]`` with
+    floats (None where a column is missing), or [] when no table is found.
+    """
+    import numpy as np
+
+    words = [word for word in words if word["text"].strip()]
+    if not words:
+        return []
+    boxes = _boxes(words)
+    rows = _rows(words, boxes)
+
+    for header_index, row in enumerate(rows):
+        columns = _header_columns(row, words, boxes)
+        if columns is not None:
+            break
+    else:
+        return []
+
+    body = []
+    for row in rows[header_index + 1:]:
+        if _is_total(words[row[0]]["text"]):
+            break
+        body.append(row)
+    parsed = {index: parse_number(words[index]["text"]) for row in body for index in row}
+    numbers = [index for index, value in parsed.items() if value is not None]
+    if not numbers:
+        return []
+    number_roles = _cluster_roles(numbers, boxes, columns)
+
+    # Plain floats: indexing a NumPy array one element at a time is slow
+    lefts = boxes[:, 0].tolist()
+    tops = boxes[:, 1].tolist()
+    bottoms = (boxes[:, 1] + boxes[:, 3]).tolist()
+    height = float(np.median(boxes[:, 3]))
+    items = []
+    previous_bottom = None
+    for row in body:
+        description = []
+        values = {}
+        for index in row:
+            text = words[index]["text"]
+            role = number_roles.get(index)
+            if role is None:
+                if _CURRENCY.fullmatch(text):
+                    continue
+                role = _text_role(lefts[index], columns)
+            if role == "description":
+                description.append(text)
+            elif role in NUMERIC_ROLES:
+                value = parsed[index] if index in number_roles else _misread_number(text)
+                if value is not None:
+                    # The rightmost number wins if a column holds two
+                    values[role] = value
+        top = min(tops[index] for index in row)
+        bottom = max(bottoms[index] for index in row)
+        if values:
+            items.append(_item(" ".join(description), values))
+            previous_bottom = bottom
+        elif description and items and previous_bottom is not None and top - previous_bottom < height:
+            # A wrapped description
+            items[-1]["description"] = f"{items[-1]['description']} {' '.join(description)}".strip()
+            previous_bottom = bottom
+        else:
+            previous_bottom = None
+    return items
+
+
+def items_from_cells(table):
+    """Line items of a table given as rows of cell strings (pdfplumber ``extract_tables``)"""
+    items = []
+    roles = None
+    for cells in table:
+        cells = [(cell or "").strip() for cell in cells]
+        if roles is None:
+            candidate = [next((_role(word) for word in cell.split() if _role(word)), None) for cell in cells]
+            if "description" in candidate and len(set(candidate).intersection(NUMERIC_ROLES)) >= 2:
+                roles = candidate
+            continue
+        if cells and _is_total(cells[0].split()[0] if cells[0] else ""):
+            break
+        values = {role: parse_number(cell) for role, cell in zip(roles, cells) if role in NUMERIC_ROLES}
+        description = " ".join(cell for role, cell in zip(roles, cells) if role == "description" and cell)
+        if any(value is not None for value in values.values()):
+            items.append(_item(" ".join(description.split()), values))
+        elif description and items:
+            items[-1]["description"] += " " + " ".join(description.split())
+    return items
+
+
+def pdf_page_items(page, text=None):
+    """Line items of a pdfplumber page with a text layer.
+
+    Ruled tables are read from ``extract_tables`` cells, anything else from
+    the page's words. ``text`` (the page's extracted text) lets pages with
+    no table header skip the work.
+    """
+    if text is not None and not _HEADER_HINT.search(text):
+        return []
+    # Cell detection needs ruled columns; most invoices only rule rows, if anything
+    if any(edge["orientation"] == "v" for edge in page.edges):
+        for table in page.extract_tables():
+            items = items_from_cells(table)
+            if items:
+                return items
+    return find_line_items([
+        {"text": word["text"], "left": word["x0"], "top": word["top"],
+         "width": word["x1"] - word["x0"], "height": word["bottom"] - word["top"]}
+        for word in page.extract_words()
+    ])
+
+
+def check_total(items, details):
+    """Compare the items' amounts with the extracted "Total Amount".
+
+    Returns ``{"count", "sum", "balanced"}``, where ``balanced`` is True when
+    the amounts add up to the total or to the total less "Tax Amount",
+    False when they don't and None without a total. None when no item has
+    an amount.
+    """
+    amounts = [item["amount"] for item in items if item["amount"] is not None]
+    if not amounts:
+        return None
+    items_sum = round(sum(amounts), 2)
+    total = parse_number(details.get("Total Amount"))
+    tax = parse_number(details.get("Tax Amount"))
+    balanced = None
+    if total is not None:
+        # Each amount, the tax and the total were rounded to the cent on their own
+        tolerance = 0.005 * (len(amounts) + 2) + 1e-9
+        balanced = abs(items_sum - total) <= tolerance or (
+            tax is not None and abs(items_sum + tax - total) <= tolerance)
+    return {"count": len(items), "sum": items_sum, "balanced": balanced}
+
+
+def format_items(items):
+    """Items as "Invoice Items" text, one ``2 x Laptop Stand @ 45.00 = 90.00`` line each"""
+    lines = []
+    for item in items:
+        line = item["description"]
+        if item["quantity"] is not None:
+            line = f"{item['quantity']:g} x {line}"
+        if item["unit_price"] is not None:
+            line += f" @ {item['unit_price']:.2f}"
+        if item["amount"] is not None:
+            line += f" = {item['amount']:.2f}"
+        lines.append(line.strip())
+    return "\n".join(lines)
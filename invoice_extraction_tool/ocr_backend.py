@@ -0,0 +1,254 @@
+"""OCR engines behind one small interface.
+
+``pytesseract`` runs the ``tesseract`` binary once per image: it writes the
+image to a temp file, starts a process that loads the traineddata, and reads
+the text back from disk. On one-page invoices that fixed cost is most of the
+latency. When the optional ``tesserocr`` binding is installed, a pool of
+long-lived ``TessBaseAPI`` engines is kept warm in each process instead and
+images are handed over in memory.
+
+The backend is chosen once per process: ``INVOICE_EXTRACTOR_OCR_BACKEND`` may
+name one ("tesserocr" or "pytesseract"); by default the first one that works
+is used, and pytesseract is always the fallback. Checking the pytesseract
+backend only looks up the binary found by tesseract_discovery; pytesseract
+itself (which pulls in pandas when it is installed) is imported for the first
+OCR call.
+
+Besides plain text, both backends return word boxes with Tesseract's
+per-word confidence (``image_to_data``), which adaptive_ocr uses to decide
+what needs a second look. Both take an optional ``whitelist`` of the only
+characters Tesseract may read (vendor_templates reads known fields with one).
+"""
+import logging
+import os
+import queue
+import threading
+
+from tesseract_discovery import find_tesseract
+
+logger = logging.getLogger(__name__)
+
+BACKEND_ENV = "INVOICE_EXTRACTOR_OCR_BACKEND"
+
+DEFAULT_LANGUAGE = "eng"
+
+# Columns of Tesseract's TSV output, in order
+_TSV_COLUMNS = ("level", "page", "block", "par", "line", "word", "left", "top", "width", "height", "conf", "text")
+# TSV level of a word row
+_WORD_LEVEL = "5"
+
+
+def _parse_tsv(tsv):
+    """Word dicts (text, conf, box and block/par/line numbers) from Tesseract TSV output.
+
+    Rows of blocks, paragraphs and lines, the header row and words that are
+    only whitespace (Tesseract reports table rules as empty words) are left out.
+    """
+    words = []
+    for row in tsv.splitlines():
+        values = row.split("\t", len(_TSV_COLUMNS) - 1)
+        if len(values) < len(_TSV_COLUMNS) or values[0] != _WORD_LEVEL or not values[-1].strip():
+            continue
+        word = dict(zip(_TSV_COLUMNS, values))
+        for key in _TSV_COLUMNS[:-2]:
+            word[key] = int(word[key])
+        word["conf"] = float(word["conf"])
+        word["text"] = word["text"].strip()
+        words.append(word)
+    return words
+
+
+def _config(psm, whitelist):
+    # pytesseract splits the config like a shell would; whitelists never hold quotes or spaces
+    options = []
+    if psm is not None:
+        options.append(f"--psm {psm}")
+    if whitelist:
+        options.append(f"-c tessedit_char_whitelist={whitelist}")
+    return " ".join(options)
+
+
+class PytesseractBackend:
+    """Runs the tesseract binary through pytesseract for every image"""
+
+    name = "pytesseract"
+
+    def __init__(self, tesseract_cmd=None):
+        self.tesseract_cmd = tesseract_cmd
+        self._version = None
+        self._pytesseract = None
+        self.available = False
+        self.error = None
+
+    def _module(self):
+        if self._pytesseract is None:
+            import pytesseract
+
+            if self.tesseract_cmd:
+                pytesseract.pytesseract.tesseract_cmd = self.tesseract_cmd
+            self._pytesseract = pytesseract
+        return self._pytesseract
+
+    def check(self):
+        """Raise if no working tesseract binary can be found"""
+        found = find_tesseract(self.tesseract_cmd)
+        if found is None:
+            raise RuntimeError("tesseract is not installed or it's not in your PATH")
+        self.tesseract_cmd = found["path"]
+        self._version = found["version"]
+        self.available = True
+        return self
+
+    def version(self):
+        return self._version or str(self._module().get_tesseract_version())
+
+    def image_to_string(self, image, psm=None, whitelist=None):
+        return self._module().image_to_string(image, config=_config(psm, whitelist))
+
+    def image_to_data(self, image, psm=None, whitelist=None):
+        return _parse_tsv(self._module().image_to_data(image, config=_config(psm, whitelist)))
+
+    def close(self):
+        pass
+
+
+class TesserocrBackend:
+    """Pool of persistent TessBaseAPI engines from the tesserocr binding.
+
+    An engine is not thread-safe, so each call checks one out of the pool and
+    returns it afterwards; the pool grows to the number of threads OCR-ing at
+    once and the engines stay loaded for the life of the process.
+    """
+
+    name = "tesserocr"
+
+    def __init__(self, language=DEFAULT_LANGUAGE, tessdata_path=None):
+        import tesserocr
+
+        self._tesserocr = tesserocr
+        self.language = language
+        self.tessdata_path = tessdata_path
+        self._idle = queue.LifoQueue()
+        self._engines = []
+        self._lock = threading.Lock()
+        self.available = False
+        self.error = None
+
+    def _create_engine(self):
+        kwargs = {"lang": self.language}
+        if self.tessdata_path:
+            kwargs["path"] = self.tessdata_path
+        engine = self._tesserocr.PyTessBaseAPI(**kwargs)
+        with self._lock:
+            self._engines.append(engine)
+        return engine
+
+    def check(self):
+        """Start the first engine now, raising if the traineddata can't be loaded"""
+        self._idle.put(self._create_engine())
+        self.available = True
+        return self
+
+    def version(self):
+        return self._tesserocr.tesseract_version().split()[1]
+
+    def _recognize(self, image, psm, read, whitelist=None):
+        from PIL import Image
+
+        if not isinstance(image, Image.Image):
+            image = Image.fromarray(image)
+        try:
+            engine = self._idle.get_nowait()
+        except queue.Empty:
+            engine = self._create_engine()
+        try:
+            if psm is not None:
+                engine.SetPageSegMode(psm)
+            if whitelist:
+                engine.SetVariable("tessedit_char_whitelist", whitelist)
+            engine.SetImage(image)
+            return read(engine)
+        finally:
+            engine.Clear()
+            if psm is not None:
+                engine.SetPageSegMode(self._tesserocr.PSM.AUTO)
+            if whitelist:
+                engine.SetVariable("tessedit_char_whitelist", "")
+            self._idle.put(engine)
+
+    def image_to_string(self, image, psm=None, whitelist=None):
+        return self._recognize(image, psm, lambda engine: engine.GetUTF8Text(), whitelist)
+
+    def image_to_data(self, image, psm=None, whitelist=None):
+        # GetTSVText runs recognition itself when the image hasn't been recognized yet
+        return self._recognize(image, psm, lambda engine: _parse_tsv(engine.GetTSVText(0)), whitelist)
+
+    def close(self):
+        with self._lock:
+            engines, self._engines = self._engines, []
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                break
+        for engine in engines:
+            engine.End()
+
+
+# Tried in this order when no backend is requested
+BACKENDS = {
+    "tesserocr": TesserocrBackend,
+    "pytesseract": PytesseractBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def load_backend(preferred=None):
+    """Return the first backend that works, trying ``preferred`` (a name or 'auto') first.
+
+    When none works an unchecked pytesseract backend is returned with
+    ``available`` False, so callers still get the usual pytesseract errors.
+    """
+    preferred = (preferred or os.environ.get(BACKEND_ENV) or "auto").lower()
+    if preferred in BACKENDS:
+        names = [preferred] + [name for name in BACKENDS if name != preferred]
+    else:
+        names = list(BACKENDS)
+
+    error = None
+    for name in names:
+        try:
+            backend = BACKENDS[name]().check()
+        except Exception as e:
+            logger.debug("OCR backend %s unavailable: %s", name, e)
+            if name == preferred or error is None:
+                error = e
+            continue
+        if preferred in BACKENDS and name != preferred:
+            logger.warning("OCR backend %s unavailable, using %s", preferred, name)
+        return backend
+
+    fallback = PytesseractBackend()
+    fallback.error = error
+    return fallback
+
+
+def get_ocr_backend():
+    """The process-wide OCR backend, loaded on first use"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = load_backend()
+    return _backend
+
+
+def reset_ocr_backend():
+    """Drop the current backend so the next call picks again (e.g. after changing tesseract_cmd)"""
+    global _backend
+    with _backend_lock:
+        backend, _backend = _backend, None
+    if backend is not None:
+        backend.close()
@@ -0,0 +1,287 @@
+"""Image preprocessing for OCR: decode, normalise resolution, binarize.
+
+The original pipeline decoded to RGB with PIL, copied into numpy, converted
+RGB->BGR->gray and thresholded, holding several full-resolution copies of a
+photo at once and failing on RGBA, palette and CMYK files. Here encoded
+uploads go straight to an 8-bit grayscale array with ``cv2.imdecode``. When
+the page is larger than the target resolution, JPEGs are decoded at 1/2, 1/4
+or 1/8 scale and then resized to ``target_dpi``. Deskewing and denoising are
+optional stages, and the working buffers are kept per thread and reused for
+every image of the same size.
+
+OpenCV, numpy and PIL are imported on first use, so modules that only need
+``settings()`` or the defaults (such as the cache key) stay cheap to import.
+"""
+import io
+import threading
+
+DEFAULT_TARGET_DPI = 300
+
+# Without DPI metadata, assume the longest side is at most a letter/A4 page
+# height at the target resolution and only ever scale down to that
+_UNKNOWN_DPI_PAGE_INCHES = 11.7
+# DPI claiming a page longer than this is bogus (phones write 72 DPI on 4000px photos)
+_MAX_PAGE_INCHES = 17.0
+
+# Bytes handed to PIL to read dimensions and DPI without decoding pixels
+_HEADER_BYTES = 256 * 1024
+
+# Skew angles (degrees) outside this range are left alone
+_MIN_SKEW = 0.3
+_MAX_SKEW = 10.0
+
+# Adaptive thresholding, in pixels for pages near 300 DPI: Gaussian smoothing kernel, the
+# neighbourhood a pixel is compared with and how far below its mean ink must be, and the
+# area under which connected ink is taken for scan noise and dropped
+_ADAPTIVE_BLUR = 5
+_ADAPTIVE_BLOCK = 31
+_ADAPTIVE_OFFSET = 15
+_SPECK_AREA = 30
+
+# cv2.imdecode flags that decode grayscale at a reduced scale (JPEG decodes natively at it)
+_REDUCED_GRAYSCALE = ((8, "IMREAD_REDUCED_GRAYSCALE_8"),
+                      (4, "IMREAD_REDUCED_GRAYSCALE_4"),
+                      (2, "IMREAD_REDUCED_GRAYSCALE_2"))
+
+
+def _encoded_buffer(source):
+    """uint8 view (or, for unbuffered streams and paths, one copy) of an encoded image"""
+    import numpy as np
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return np.frombuffer(source, dtype=np.uint8)
+    if isinstance(source, str) or hasattr(source, "__fspath__"):
+        return np.fromfile(source, dtype=np.uint8)
+    getbuffer = getattr(source, "getbuffer", None)
+    if getbuffer is not None:
+        # BytesIO and Streamlit's UploadedFile expose their bytes without copying
+        return np.frombuffer(getbuffer(), dtype=np.uint8)
+    source.seek(0)
+    return np.frombuffer(source.read(), dtype=np.uint8)
+
+
+def _header_info(buffer):
+    """(width, height, dpi or None) from the image header, or None if PIL can't read it"""
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(buffer[:_HEADER_BYTES].tobytes())) as image:
+            dpi = image.info.get("dpi")
+            dpi = float(dpi[0]) if dpi and dpi[0] and float(dpi[0]) > 1 else None
+            return image.size[0], image.size[1], dpi
+    except Exception:
+        return None
+
+
+class Preprocessor:
+    """Turns uploads, paths or PIL images into binarized arrays ready for OCR.
+
+    ``target_dpi`` is the resolution pages are scaled to (down only when the
+    file carries no DPI), ``deskew`` straightens rotated scans and ``denoise``
+    applies a median filter before thresholding. The returned array may be a
+    reused buffer: it stays valid until the same thread preprocesses another
+    image of the same size.
+    """
+
+    def __init__(self, target_dpi=DEFAULT_TARGET_DPI, deskew=False, denoise=False):
+        self.target_dpi = target_dpi
+        self.deskew = deskew
+        self.denoise = denoise
+        self._buffers = {}
+
+    def settings(self):
+        """Description of this pipeline for cache keys"""
+        stages = ["gray", f"{self.target_dpi}dpi"]
+        if self.denoise:
+            stages.append("median3")
+        stages.append("otsu")
+        if self.deskew:
+            stages.append("deskew")
+        return "+".join(stages)
+
+    def _buffer(self, name, shape):
+        import numpy as np
+
+        key = (name, shape)
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            # Only the latest size is kept per stage, so a batch of mixed sizes doesn't pile up buffers
+            for old in [k for k in self._buffers if k[0] == name]:
+                del self._buffers[old]
+            buffer = self._buffers[key] = np.empty(shape, dtype=np.uint8)
+        return buffer
+
+    def _scale(self, width, height, dpi):
+        if dpi and max(width, height) / dpi <= _MAX_PAGE_INCHES:
+            return self.target_dpi / dpi
+        longest = _UNKNOWN_DPI_PAGE_INCHES * self.target_dpi
+        return min(1.0, longest / max(width, height))
+
+    def from_source(self, source):
+        """Binarize an encoded image given as bytes, a path or a binary file object"""
+        return self.binarize(self.decode(source))
+
+    def _reduction(self, scale):
+        # (factor, cv2 flag name) of the reduced decode that still covers a page scaled by ``scale``
+        for factor, reduced in _REDUCED_GRAYSCALE:
+            if scale <= 1 / factor:
+                return factor, reduced
+        return 1, "IMREAD_GRAYSCALE"
+
+    def decoded_size(self, head):
+        """``(decoded, scaled)`` pixel counts decode() works with, from the first bytes of an image file.
+
+        ``decoded`` is the array cv2 decodes to (JPEGs at 1/2, 1/4 or 1/8
+        scale when that's enough) and ``scaled`` the page at ``target_dpi``.
+        None when PIL can't read the header.
+        """
+        info = _header_info(memoryview(head))
+        if info is None:
+            return None
+        width, height, dpi = info
+        scale = self._scale(width, height, dpi)
+        # Only JPEG decodes natively at a reduced scale; other formats are decoded whole first
+        factor = self._reduction(scale)[0] if bytes(head[:3]) == b"\xff\xd8\xff" else 1
+        decoded = -(-width // factor) * -(-height // factor)
+        return decoded, max(1, round(width * scale)) * max(1, round(height * scale))
+
+    def decode(self, source):
+        """Grayscale array of an encoded image, already scaled to ``target_dpi``"""
+        import cv2
+
+        buffer = _encoded_buffer(source)
+        info = _header_info(buffer)
+        flags = cv2.IMREAD_GRAYSCALE
+        scale = None
+        if info is not None:
+            width, height, dpi = info
+            scale = self._scale(width, height, dpi)
+            flags = getattr(cv2, self._reduction(scale)[1])
+        gray = cv2.imdecode(buffer, flags)
+        if gray is None:
+            raise ValueError("Unsupported or corrupt image data")
+        if scale is not None:
+            size = (max(1, round(info[0] * scale)), max(1, round(info[1] * scale)))
+            if (gray.shape[0] > gray.shape[1]) != (size[1] > size[0]):
+                # EXIF orientation rotated the decoded image
+                size = size[::-1]
+            gray = self._resize(gray, size)
+        return gray
+
+    def from_image(self, image, dpi=None):
+        """Binarize a PIL image (such as a rasterized PDF page) or a numpy array"""
+        return self.binarize(self.gray_from_image(image, dpi))
+
+    def gray_from_image(self, image, dpi=None):
+        """Grayscale array of a PIL image or numpy array, scaled to ``target_dpi``"""
+        import cv2
+        import numpy as np
+        from PIL import Image
+
+        if isinstance(image, Image.Image):
+            if dpi is None:
+                dpi = image.info.get("dpi", (None,))[0]
+            if image.mode != "L":
+                image = image.convert("L")
+            gray = np.asarray(image)
+        else:
+            gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        height, width = gray.shape
+        scale = self._scale(width, height, float(dpi) if dpi and float(dpi) > 1 else None)
+        return self._resize(gray, (max(1, round(width * scale)), max(1, round(height * scale))))
+
+    def downscale(self, gray, dpi):
+        """A page decoded at ``target_dpi`` reduced to ``dpi`` (the page itself when that isn't lower)"""
+        import cv2
+
+        if dpi >= self.target_dpi:
+            return gray
+        scale = dpi / self.target_dpi
+        size = (max(1, round(gray.shape[1] * scale)), max(1, round(gray.shape[0] * scale)))
+        return cv2.resize(gray, size, dst=self._buffer("downscaled", (size[1], size[0])),
+                          interpolation=cv2.INTER_AREA)
+
+    def _resize(self, gray, size):
+        import cv2
+
+        if (gray.shape[1], gray.shape[0]) == size:
+            return gray
+        interpolation = cv2.INTER_AREA if size[0] < gray.shape[1] else cv2.INTER_CUBIC
+        return cv2.resize(gray, size, dst=self._buffer("resized", (size[1], size[0])),
+                          interpolation=interpolation)
+
+    def binarize(self, gray, adaptive=False, deskew=None, despeckle=True):
+        """Denoise, threshold and deskew a grayscale array at its final resolution.
+
+        ``adaptive`` smooths the page, thresholds each pixel against its
+        neighbourhood instead of one Otsu level for the page (which keeps
+        text in shadows and uneven lighting) and, unless ``despeckle`` is
+        False, drops specks of noise, so deskewing isn't thrown off by them.
+        Specks are as small as a full stop, so crops of single words are
+        better left alone. ``deskew`` overrides the preprocessor's setting.
+        """
+        import cv2
+
+        if self.denoise:
+            gray = cv2.medianBlur(gray, 3, dst=self._buffer("denoised", gray.shape))
+        if adaptive:
+            smooth = cv2.GaussianBlur(gray, (_ADAPTIVE_BLUR, _ADAPTIVE_BLUR), 0,
+                                      dst=self._buffer("smoothed", gray.shape))
+            binary = cv2.adaptiveThreshold(smooth, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                           _ADAPTIVE_BLOCK, _ADAPTIVE_OFFSET,
+                                           dst=self._buffer("adaptive", gray.shape))
+            if despeckle:
+                self._despeckle(binary)
+        else:
+            binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU,
+                                   dst=self._buffer("binary", gray.shape))[1]
+        if self.deskew if deskew is None else deskew:
+            binary = self._deskew(binary)
+        return binary
+
+    def _despeckle(self, binary):
+        import cv2
+
+        ink = cv2.bitwise_not(binary, dst=self._buffer("ink", binary.shape))
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+        specks = stats[:, cv2.CC_STAT_AREA] < _SPECK_AREA
+        # Label 0 is the background
+        specks[0] = False
+        if specks.any():
+            binary[specks[labels]] = 255
+
+    def _deskew(self, binary):
+        import cv2
+
+        ink = cv2.findNonZero(cv2.bitwise_not(binary, dst=self._buffer("ink", binary.shape)))
+        if ink is None:
+            return binary
+        (_, _), (width, height), angle = cv2.minAreaRect(ink)
+        # minAreaRect reports the box angle in (0, 90]; map it to the smallest rotation
+        if width < height:
+            angle -= 90
+        if angle > 45:
+            angle -= 90
+        elif angle < -45:
+            angle += 90
+        if not _MIN_SKEW <= abs(angle) <= _MAX_SKEW:
+            return binary
+        rows, cols = binary.shape
+        matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, 1.0)
+        return cv2.warpAffine(binary, matrix, (cols, rows), dst=self._buffer("deskewed", binary.shape),
+                              flags=cv2.INTER_NEAREST, borderValue=255)
+
+
+_local = threading.local()
+
+
+def get_preprocessor(target_dpi=DEFAULT_TARGET_DPI, deskew=False, denoise=False):
+    """This thread's Preprocessor for the given options, so its buffers are reused across a batch"""
+    preprocessors = getattr(_local, "preprocessors", None)
+    if preprocessors is None:
+        preprocessors = _local.preprocessors = {}
+    key = (target_dpi, deskew, denoise)
+    preprocessor = preprocessors.get(key)
+    if preprocessor is None:
+        preprocessor = preprocessors[key] = Preprocessor(target_dpi, deskew, denoise)
+    return preprocessor
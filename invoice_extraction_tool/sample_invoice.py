@@ -1,142 +1,241 @@
-import numpy as np
-import cv2
 from PIL import Image, ImageDraw, ImageFont
 import os
 import random
 from datetime import datetime, timedelta
 
-# Function to generate a sample invoice image for testing
-def generate_sample_invoice(output_path):
-    # Create a blank white image
-    width, height = 2100, 2970  # A4 size at 300 DPI
-    image = Image.new('RGB', (width, height), color='white')
-    draw = ImageDraw.Draw(image)
-    
-    # Try to load fonts
-    try:
-        header_font = ImageFont.truetype('Arial', 48)
-        title_font = ImageFont.truetype('Arial', 36)
-        normal_font = ImageFont.truetype('Arial', 24)
-    except IOError:
-        # Fall back to default font
-        header_font = ImageFont.load_default()
-        title_font = ImageFont.load_default()
-        normal_font = ImageFont.load_default()
-    
-    # Generate random invoice data
-    invoice_number = f"INV-{random.randint(1000, 9999)}"
-    
-    # Random date in the last 30 days
-    invoice_date = datetime.now() - timedelta(days=random.randint(1, 30))
-    invoice_date_str = invoice_date.strftime("%m/%d/%Y")
-    
-    # Due date is 30 days after invoice date
+# Canvas size of a generated invoice
+PAGE_WIDTH, PAGE_HEIGHT = 2100, 2970  # A4 size at 300 DPI
+
+# Font sizes used by the layout
+HEADER_SIZE = 48
+TITLE_SIZE = 36
+NORMAL_SIZE = 24
+
+VENDORS = ["TechSupplies Inc.", "Office Solutions Ltd.", "Global Services Corp.", "ProEquip Industries", "SmartBusiness LLC"]
+
+ITEM_CATALOG = [
+    ("Office Desk Chair", 1, 5, 80, 150),
+    ("Laptop Stand", 1, 10, 25, 60),
+    ("Wireless Mouse", 1, 20, 15, 40),
+    ("USB-C Hub", 1, 8, 30, 80),
+    ("Monitor", 1, 3, 200, 500),
+    ("Printer Paper", 1, 30, 4, 12),
+    ("Desk Lamp", 1, 6, 20, 70),
+    ("Ergonomic Keyboard", 1, 10, 40, 120),
+]
+
+CURRENCIES = {"$": "USD", "€": "EUR", "£": "GBP"}
+
+# The layout generate_sample_invoice has always drawn
+DEFAULT_LAYOUT = {
+    "number_label": "Invoice #:",
+    "date_label": "Invoice Date:",
+    "due_label": "Due Date:",
+    "date_format": "%m/%d/%Y",
+    "currency": "$",
+    "meta_position": "left",
+    "items": 5,
+    "tax_rate": 0.08,
+}
+
+# Choices random_layout picks from
+LAYOUT_CHOICES = {
+    "number_label": ["Invoice #:", "Invoice No:", "Invoice Number:"],
+    "date_label": ["Invoice Date:", "Date:"],
+    "due_label": ["Due Date:", "Payment Due:"],
+    "date_format": ["%m/%d/%Y", "%d/%m/%Y", "%m-%d-%Y", "%d.%m.%Y"],
+    "currency": list(CURRENCIES),
+    "meta_position": ["left", "right"],
+    "items": [2, 3, 4, 5, 6, 7, 8],
+    "tax_rate": [0.05, 0.08, 0.1, 0.2],
+}
+
+_fonts = {}
+
+# Load a font by pixel size, falling back to Pillow's bundled font
+def load_font(size):
+    if size not in _fonts:
+        for name in ('Arial', 'arial.ttf', 'DejaVuSans.ttf'):
+            try:
+                _fonts[size] = ImageFont.truetype(name, size)
+                break
+            except IOError:
+                continue
+        else:
+            try:
+                _fonts[size] = ImageFont.load_default(size)
+            except TypeError:
+                # Pillow < 10.1 only has the fixed bitmap font
+                _fonts[size] = ImageFont.load_default()
+    return _fonts[size]
+
+# Pick a random layout variation
+def random_layout(rng=random):
+    return {key: rng.choice(choices) for key, choices in LAYOUT_CHOICES.items()}
+
+# Generate random invoice data; returns the fields as extraction should find them plus the items
+def random_invoice(rng=random, layout=None, today=None):
+    layout = dict(DEFAULT_LAYOUT, **(layout or {}))
+    today = today or datetime.now()
+
+    invoice_number = f"INV-{rng.randint(1000, 9999)}"
+
+    # Random date in the last 30 days, due 30 days later
+    invoice_date = today - timedelta(days=rng.randint(1, 30))
     due_date = invoice_date + timedelta(days=30)
-    due_date_str = due_date.strftime("%m/%d/%Y")
-    
-    # Random vendor name
-    vendors = ["TechSupplies Inc.", "Office Solutions Ltd.", "Global Services Corp.", "ProEquip Industries", "SmartBusiness LLC"]
-    vendor_name = random.choice(vendors)
-    
-    # Random items
+
+    vendor_name = rng.choice(VENDORS)
+
+    if layout["items"] == DEFAULT_LAYOUT["items"]:
+        catalog = ITEM_CATALOG[:5]
+    else:
+        catalog = rng.sample(ITEM_CATALOG, layout["items"])
     items = [
-        ("Office Desk Chair", random.randint(1, 5), random.uniform(80, 150)),
-        ("Laptop Stand", random.randint(1, 10), random.uniform(25, 60)),
-        ("Wireless Mouse", random.randint(1, 20), random.uniform(15, 40)),
-        ("USB-C Hub", random.randint(1, 8), random.uniform(30, 80)),
-        ("Monitor", random.randint(1, 3), random.uniform(200, 500))
+        (description, rng.randint(low_qty, high_qty), rng.uniform(low_price, high_price))
+        for description, low_qty, high_qty, low_price, high_price in catalog
     ]
-    
+
     # Calculate totals
     subtotal = sum(qty * price for _, qty, price in items)
-    tax_rate = 0.08  # 8% tax
-    tax_amount = subtotal * tax_rate
+    tax_amount = subtotal * layout["tax_rate"]
     total_amount = subtotal + tax_amount
-    
+
+    return {
+        "layout": layout,
+        "fields": {
+            "Invoice Number": invoice_number,
+            "Invoice Date": invoice_date.strftime(layout["date_format"]),
+            "Due Date": due_date.strftime(layout["date_format"]),
+            "Vendor Name": vendor_name,
+            "Total Amount": f"{total_amount:.2f}",
+            "Tax Amount": f"{tax_amount:.2f}",
+            "Currency": CURRENCIES[layout["currency"]],
+        },
+        "items": [
+            {"description": description, "quantity": qty, "unit_price": f"{price:.2f}",
+             "amount": f"{qty * price:.2f}"}
+            for description, qty, price in items
+        ],
+        "subtotal": f"{subtotal:.2f}",
+    }
+
+# Drawing operations for an invoice on the PAGE_WIDTH x PAGE_HEIGHT canvas:
+# ("text", x, y, text, size) with (x, y) the top left, and ("line", x1, y1, x2, y2, width)
+def invoice_drawing(invoice):
+    layout = invoice["layout"]
+    fields = invoice["fields"]
+    symbol = layout["currency"]
+    width = PAGE_WIDTH
+    ops = []
+
+    def text(x, y, value, size):
+        ops.append(("text", x, y, value, size))
+
     # Draw invoice header
-    draw.text((100, 100), vendor_name, font=header_font, fill='black')
-    draw.text((100, 180), "123 Business St., Suite 456", font=normal_font, fill='black')
-    draw.text((100, 230), "Anytown, ST 12345", font=normal_font, fill='black')
-    draw.text((100, 280), "Phone: (555) 123-4567", font=normal_font, fill='black')
-    
+    vendor_name = fields["Vendor Name"]
+    text(100, 100, vendor_name, HEADER_SIZE)
+    text(100, 180, "123 Business St., Suite 456", NORMAL_SIZE)
+    text(100, 230, "Anytown, ST 12345", NORMAL_SIZE)
+    text(100, 280, "Phone: (555) 123-4567", NORMAL_SIZE)
+
     # Draw Invoice title
-    draw.text((width - 600, 100), "INVOICE", font=header_font, fill='black')
-    
+    text(width - 600, 100, "INVOICE", HEADER_SIZE)
+
     # Draw invoice details
+    meta_x = 100 if layout["meta_position"] == "left" else width - 900
     y_pos = 400
-    draw.text((100, y_pos), f"Invoice #: {invoice_number}", font=title_font, fill='black')
+    text(meta_x, y_pos, f"{layout['number_label']} {fields['Invoice Number']}", TITLE_SIZE)
     y_pos += 60
-    draw.text((100, y_pos), f"Invoice Date: {invoice_date_str}", font=title_font, fill='black')
+    text(meta_x, y_pos, f"{layout['date_label']} {fields['Invoice Date']}", TITLE_SIZE)
     y_pos += 60
-    draw.text((100, y_pos), f"Due Date: {due_date_str}", font=title_font, fill='black')
+    text(meta_x, y_pos, f"{layout['due_label']} {fields['Due Date']}", TITLE_SIZE)
     y_pos += 100
-    
+
     # Draw "Bill To" section
-    draw.text((100, y_pos), "Bill To:", font=title_font, fill='black')
+    text(100, y_pos, "Bill To:", TITLE_SIZE)
     y_pos += 60
-    draw.text((100, y_pos), "Sample Customer", font=normal_font, fill='black')
+    text(100, y_pos, "Sample Customer", NORMAL_SIZE)
     y_pos += 40
-    draw.text((100, y_pos), "456 Client Road", font=normal_font, fill='black')
+    text(100, y_pos, "456 Client Road", NORMAL_SIZE)
     y_pos += 40
-    draw.text((100, y_pos), "Clientville, ST 54321", font=normal_font, fill='black')
+    text(100, y_pos, "Clientville, ST 54321", NORMAL_SIZE)
     y_pos += 100
-    
+
     # Draw table header
     col1, col2, col3, col4 = 100, 1000, 1300, 1600
-    
-    draw.text((col1, y_pos), "Description", font=title_font, fill='black')
-    draw.text((col2, y_pos), "Quantity", font=title_font, fill='black')
-    draw.text((col3, y_pos), "Unit Price", font=title_font, fill='black')
-    draw.text((col4, y_pos), "Amount", font=title_font, fill='black')
-    
+
+    text(col1, y_pos, "Description", TITLE_SIZE)
+    text(col2, y_pos, "Quantity", TITLE_SIZE)
+    text(col3, y_pos, "Unit Price", TITLE_SIZE)
+    text(col4, y_pos, "Amount", TITLE_SIZE)
+
     y_pos += 50
-    draw.line([(100, y_pos), (width - 100, y_pos)], fill='black', width=2)
+    ops.append(("line", 100, y_pos, width - 100, y_pos, 2))
     y_pos += 30
-    
+
     # Draw table items
-    for description, qty, price in items:
-        amount = qty * price
-        
-        draw.text((col1, y_pos), description, font=normal_font, fill='black')
-        draw.text((col2, y_pos), str(qty), font=normal_font, fill='black')
-        draw.text((col3, y_pos), f"${price:.2f}", font=normal_font, fill='black')
-        draw.text((col4, y_pos), f"${amount:.2f}", font=normal_font, fill='black')
-        
+    for item in invoice["items"]:
+        text(col1, y_pos, item["description"], NORMAL_SIZE)
+        text(col2, y_pos, str(item["quantity"]), NORMAL_SIZE)
+        text(col3, y_pos, f"{symbol}{item['unit_price']}", NORMAL_SIZE)
+        text(col4, y_pos, f"{symbol}{item['amount']}", NORMAL_SIZE)
+
         y_pos += 60
-    
+
     # Draw totals
-    y_pos = 1500
-    draw.line([(col3 - 100, y_pos), (width - 100, y_pos)], fill='black', width=2)
+    y_pos = max(1500, y_pos + 40)
+    ops.append(("line", col3 - 100, y_pos, width - 100, y_pos, 2))
     y_pos += 50
-    
-    draw.text((col3 - 100, y_pos), "Subtotal:", font=title_font, fill='black')
-    draw.text((col4, y_pos), f"${subtotal:.2f}", font=title_font, fill='black')
+
+    text(col3 - 100, y_pos, "Subtotal:", TITLE_SIZE)
+    text(col4, y_pos, f"{symbol}{invoice['subtotal']}", TITLE_SIZE)
     y_pos += 60
-    
-    draw.text((col3 - 100, y_pos), f"Tax ({tax_rate*100:.0f}%):", font=title_font, fill='black')
-    draw.text((col4, y_pos), f"${tax_amount:.2f}", font=title_font, fill='black')
+
+    text(col3 - 100, y_pos, f"Tax ({layout['tax_rate']*100:.0f}%):", TITLE_SIZE)
+    text(col4, y_pos, f"{symbol}{fields['Tax Amount']}", TITLE_SIZE)
     y_pos += 60
-    
-    draw.line([(col3 - 100, y_pos), (width - 100, y_pos)], fill='black', width=2)
+
+    ops.append(("line", col3 - 100, y_pos, width - 100, y_pos, 2))
     y_pos += 50
-    
-    draw.text((col3 - 100, y_pos), "Total:", font=header_font, fill='black')
-    draw.text((col4, y_pos), f"${total_amount:.2f}", font=header_font, fill='black')
-    
+
+    text(col3 - 100, y_pos, "Total:", HEADER_SIZE)
+    text(col4, y_pos, f"{symbol}{fields['Total Amount']}", HEADER_SIZE)
+
     # Draw payment terms
-    y_pos = 2000
-    draw.text((100, y_pos), "Payment Terms:", font=title_font, fill='black')
+    y_pos = max(2000, y_pos + 150)
+    text(100, y_pos, "Payment Terms:", TITLE_SIZE)
     y_pos += 60
-    draw.text((100, y_pos), "Net 30 days. Please make checks payable to " + vendor_name, font=normal_font, fill='black')
-    
+    text(100, y_pos, "Net 30 days. Please make checks payable to " + vendor_name, NORMAL_SIZE)
+    return ops
+
+# Render drawing operations to a white RGB page
+def render_invoice_image(ops):
+    image = Image.new('RGB', (PAGE_WIDTH, PAGE_HEIGHT), color='white')
+    draw = ImageDraw.Draw(image)
+    for op in ops:
+        if op[0] == "text":
+            _, x, y, value, size = op
+            draw.text((x, y), value, font=load_font(size), fill='black')
+        else:
+            _, x1, y1, x2, y2, line_width = op
+            draw.line([(x1, y1), (x2, y2)], fill='black', width=line_width)
+    return image
+
+# Function to generate a sample invoice image for testing; returns what was drawn
+def generate_sample_invoice(output_path, rng=None, layout=None, today=None, quiet=False):
+    invoice = random_invoice(rng or random, layout, today)
+    image = render_invoice_image(invoice_drawing(invoice))
+
     # Save the image
     image.save(output_path)
-    print(f"Sample invoice created at: {output_path}")
+    if not quiet:
+        print(f"Sample invoice created at: {output_path}")
+    return invoice
 
 if __name__ == "__main__":
     os.makedirs('sample_invoices', exist_ok=True)
-    
+
     # Generate a few sample invoices
     for i in range(3):
         filename = f"sample_invoices/invoice_{i+1}.png"
-        generate_sample_invoice(filename)
\ No newline at end of file
+        generate_sample_invoice(filename)
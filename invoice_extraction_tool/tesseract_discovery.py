@@ -0,0 +1,116 @@
+"""Find the tesseract binary once and remember it across processes.
+
+Checking for tesseract used to mean running ``tesseract --version`` (and
+sometimes a second probe) in every process: on each app start, in every
+batch worker and on every CLI run. The first process that finds a working
+binary records its path and version under the user cache directory; later
+processes trust that record without running anything, as long as the file
+at that path still has the same size and modification time.
+"""
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+
+# Where tesseract usually lives when it isn't on PATH
+PLATFORM_PATHS = {
+    "Windows": [
+        r"C:\Program Files\Tesseract-OCR\tesseract.exe",
+        r"C:\Program Files (x86)\Tesseract-OCR\tesseract.exe",
+    ],
+    "Linux": ["/usr/bin/tesseract", "/usr/local/bin/tesseract"],
+    "Darwin": ["/usr/local/bin/tesseract", "/opt/homebrew/bin/tesseract"],
+}
+
+# Seconds allowed for ``tesseract --version``
+_PROBE_TIMEOUT = 15
+
+_found = None
+_searched = False
+_lock = threading.Lock()
+
+
+def discovery_cache_path():
+    """File the discovered binary is recorded in"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "invoice_extractor", "tesseract.json")
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _probe(path):
+    """Version reported by the binary at ``path``, or None if it doesn't run"""
+    try:
+        completed = subprocess.run([path, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   timeout=_PROBE_TIMEOUT)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    output = completed.stdout.decode("utf-8", errors="replace").split()
+    # "tesseract 5.3.0" (some builds print "tesseract v5.3.0...")
+    if completed.returncode != 0 or len(output) < 2 or output[0] != "tesseract":
+        return None
+    return output[1].lstrip("v")
+
+
+def _candidates(preferred):
+    paths = [preferred, shutil.which("tesseract")] + PLATFORM_PATHS.get(platform.system(), [])
+    seen = set()
+    for path in paths:
+        if path and path not in seen and os.path.isfile(path):
+            seen.add(path)
+            yield path
+
+
+def _load_record():
+    try:
+        with open(discovery_cache_path(), "r", encoding="utf-8") as f:
+            record = json.load(f)
+        if _stamp(record["path"]) == record["stamp"]:
+            return {"path": record["path"], "version": record["version"]}
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def _save_record(found):
+    path = discovery_cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(dict(found, stamp=_stamp(found["path"])), f)
+        os.replace(tmp_path, path)
+    except OSError:
+        # A read-only home only means the next process probes again
+        pass
+
+
+def find_tesseract(preferred=None, refresh=False):
+    """``{"path", "version"}`` of a working tesseract binary, or None.
+
+    ``preferred`` (e.g. a user-configured path) is tried before PATH and the
+    usual install locations. The result is kept for the life of the process;
+    ``refresh`` ignores both that and the persisted record and probes again.
+    """
+    global _found, _searched
+    with _lock:
+        if _searched and not refresh:
+            return _found
+        found = None if refresh else _load_record()
+        if found is not None and preferred and os.path.abspath(preferred) != os.path.abspath(found["path"]):
+            found = None
+        if found is None:
+            for path in _candidates(preferred):
+                version = _probe(path)
+                if version is not None:
+                    found = {"path": os.path.abspath(path), "version": version}
+                    _save_record(found)
+                    break
+        _found, _searched = found, True
+        return found
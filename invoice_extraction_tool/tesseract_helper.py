@@ -4,16 +4,18 @@ import platform
 import subprocess
 import sys
 import pytesseract
+from ocr_backend import BACKEND_ENV, get_ocr_backend, reset_ocr_backend
+from tesseract_discovery import discovery_cache_path, find_tesseract
 
 def check_tesseract_installation():
     """Check if Tesseract OCR is installed and available"""
-    try:
-        # Try to get the tesseract version
-        version = pytesseract.get_tesseract_version()
-        st.success(f"✅ Tesseract OCR v{version} is installed and working correctly")
+    backend = get_ocr_backend()
+    if backend.available:
+        st.success(f"✅ Tesseract OCR v{backend.version()} is installed and working correctly "
+                   f"({backend.name} backend)")
         return True
-    except Exception as e:
-        st.error(f"❌ Tesseract OCR is not installed or not properly configured: {e}")
+    else:
+        st.error(f"❌ Tesseract OCR is not installed or not properly configured: {backend.error}")
         
         # Provide platform-specific installation instructions
         system = platform.system()
@@ -125,8 +127,14 @@ def main():
         
         # Show configuration details
         st.subheader("Configuration Details")
-        tesseract_path = pytesseract.pytesseract.tesseract_cmd
-        st.code(f"Tesseract Path: {tesseract_path}")
+        backend = get_ocr_backend()
+        st.code(f"OCR Backend: {backend.name}")
+        if backend.name == "pytesseract":
+            st.info("Install the `tesserocr` package to keep Tesseract engines loaded between images "
+                    f"instead of starting a process per image (set {BACKEND_ENV} to choose explicitly).")
+        found = find_tesseract()
+        tesseract_path = found["path"] if found else pytesseract.pytesseract.tesseract_cmd
+        st.code(f"Tesseract Path: {tesseract_path}\nRemembered in: {discovery_cache_path()}")
         
         # Get available languages
         try:
@@ -142,9 +150,14 @@ def main():
         if binary_path:
             st.info("Trying to configure pytesseract with the found path...")
             try:
-                pytesseract.pytesseract.tesseract_cmd = binary_path
-                version = pytesseract.get_tesseract_version()
-                st.success(f"Successfully configured! Tesseract v{version} is now accessible.")
+                # Probe again so this process and later ones use the binary that was found
+                found = find_tesseract(binary_path, refresh=True)
+                if found is None:
+                    raise RuntimeError(f"{binary_path} --version did not run")
+                pytesseract.pytesseract.tesseract_cmd = found["path"]
+                reset_ocr_backend()
+                st.success(f"Successfully configured! Tesseract v{found['version']} is now accessible "
+                           f"({get_ocr_backend().name} backend).")
             except Exception as e:
                 st.error(f"Configuration failed: {e}")
                 
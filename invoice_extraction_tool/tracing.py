@@ -0,0 +1,380 @@
+"""Per-file, per-stage timing and resource use of the extraction pipeline.
+
+Extraction code marks its stages with ``stage("ocr")`` and friends; while a
+file is being traced (inside ``trace_file`` or ``use_trace``), each stage
+records wall time, CPU time (including Tesseract child processes) and the
+change in resident memory. Stages nest: time spent in an inner stage is not
+counted again for the outer one. Outside a trace ``stage`` costs next to
+nothing.
+
+The stages are ``pdf_open``, ``pdf_text`` (pdfplumber's text layer),
+``pdf_render`` (rasterizing scanned pages), ``decode``, ``preprocess``,
+``layout``, ``ocr``, ``items`` (line item tables) and ``parse``.
+
+A TraceCollector gathers finished traces for the Streamlit performance panel
+and writes them out as a JSONL trace and a Prometheus text-format file.
+Sampling profiles (``trace_file(..., profile=True)``) are kept for the
+slowest files only and written as collapsed stacks, which flamegraph.pl and
+speedscope read.
+"""
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from functools import wraps
+
+STAGES = ("pdf_open", "pdf_text", "pdf_render", "decode", "preprocess", "layout", "ocr", "items", "parse")
+
+# Seconds between profiler samples
+DEFAULT_SAMPLE_INTERVAL = 0.005
+# Deepest stack the profiler records
+_MAX_STACK_DEPTH = 64
+
+# File duration buckets (seconds) of the Prometheus histogram
+FILE_SECONDS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_trace = contextvars.ContextVar("invoice_trace", default=None)
+_open_span = contextvars.ContextVar("invoice_trace_span", default=None)
+
+try:
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = None
+
+
+def _rss_bytes():
+    """Current resident set size, or 0 where /proc isn't available"""
+    if _PAGE_SIZE is None:
+        return 0
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def _cpu_seconds():
+    # Children cover pytesseract's tesseract processes once they have been waited for
+    times = os.times()
+    return time.process_time() + times.children_user + times.children_system
+
+
+class _Sampler(threading.Thread):
+    """Samples one thread's Python stack every ``interval`` seconds"""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name="invoice-trace-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < _MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return dict(self.samples)
+
+
+class FileTrace:
+    """Stage timings of one file; ``stages`` maps stage -> calls, wall, cpu and memory"""
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.wall = 0.0
+        self.profile = None
+        self.cached = False
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, stage, wall, cpu, memory, calls=1):
+        with self._lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = {"calls": 0, "wall": 0.0, "cpu": 0.0, "memory": 0}
+            entry["calls"] += calls
+            entry["wall"] += wall
+            entry["cpu"] += cpu
+            # Largest growth of resident memory seen across the stage's calls
+            entry["memory"] = max(entry["memory"], memory)
+
+    def merge(self, other):
+        """Fold in a trace dict from another process (see to_dict)"""
+        for stage, entry in other["stages"].items():
+            self.add(stage, entry["wall"], entry["cpu"], entry["memory"], entry["calls"])
+        if other.get("profile"):
+            self.profile = Counter(self.profile or {})
+            self.profile.update(other["profile"])
+
+    def finish(self, wall=None):
+        self.wall = time.perf_counter() - self._started if wall is None else wall
+
+    def to_dict(self):
+        record = {
+            "file": self.name,
+            "wall": self.wall,
+            "cached": self.cached,
+            "stages": {stage: dict(entry) for stage, entry in self.stages.items()},
+        }
+        if self.profile:
+            record["profile"] = dict(self.profile)
+        return record
+
+
+class _Span:
+    __slots__ = ("child_wall", "child_cpu")
+
+    def __init__(self):
+        self.child_wall = 0.0
+        self.child_cpu = 0.0
+
+
+@contextmanager
+def stage(name):
+    """Record the enclosed block as stage ``name`` of the file being traced"""
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    parent = _open_span.get()
+    span = _Span()
+    token = _open_span.set(span)
+    rss = _rss_bytes()
+    cpu = _cpu_seconds()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - started
+        cpu = _cpu_seconds() - cpu
+        _open_span.reset(token)
+        if parent is not None:
+            parent.child_wall += wall
+            parent.child_cpu += cpu
+        trace.add(name, max(0.0, wall - span.child_wall), max(0.0, cpu - span.child_cpu),
+                  max(0, _rss_bytes() - rss))
+
+
+def traced(name):
+    """Decorator recording every call of a function as stage ``name``"""
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def use_trace(trace):
+    """Record stages run in the enclosed block into an existing FileTrace"""
+    token = _trace.set(trace)
+    span_token = _open_span.set(None)
+    try:
+        yield trace
+    finally:
+        _open_span.reset(span_token)
+        _trace.reset(token)
+
+
+@contextmanager
+def trace_file(name, profile=False, interval=DEFAULT_SAMPLE_INTERVAL):
+    """Trace the enclosed block as the processing of file ``name``; yields its FileTrace.
+
+    With ``profile`` the calling thread's stack is also sampled every
+    ``interval`` seconds into ``trace.profile`` (collapsed stack -> samples).
+    """
+    trace = FileTrace(name)
+    sampler = None
+    if profile:
+        sampler = _Sampler(threading.get_ident(), interval)
+        sampler.start()
+    try:
+        with use_trace(trace):
+            yield trace
+    finally:
+        if sampler is not None:
+            trace.profile = sampler.stop()
+        trace.finish()
+
+
+def current_context():
+    """Context to run pool tasks in so their stages land in the current trace"""
+    return contextvars.copy_context()
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+class TraceCollector:
+    """Aggregates finished file traces for display and export.
+
+    Totals per stage cover every trace added. The last ``keep`` traces are
+    held for percentiles and the JSONL export, and profiles are kept for the
+    ``profile_slowest`` slowest files. With ``jsonl_path`` each trace is also
+    appended to that file as it is added.
+    """
+
+    def __init__(self, keep=1000, profile_slowest=5, jsonl_path=None):
+        self.recent = deque(maxlen=keep)
+        self.totals = {}
+        self.files = Counter()
+        self.file_seconds = [0] * (len(FILE_SECONDS_BUCKETS) + 1)
+        self.file_seconds_sum = 0.0
+        self.profile_slowest = profile_slowest
+        self._slowest = []  # min-heap of (wall, sequence, record) with profiles
+        self._sequence = itertools.count()
+        self._jsonl = open(jsonl_path, "a", encoding="utf-8") if jsonl_path else None
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        """Add a FileTrace or its to_dict()"""
+        record = record.to_dict() if isinstance(record, FileTrace) else dict(record)
+        with self._lock:
+            profile = record.pop("profile", None)
+            self.recent.append(record)
+            self.files["cached" if record.get("cached") else "extracted"] += 1
+            if not record.get("cached"):
+                bucket = next((i for i, bound in enumerate(FILE_SECONDS_BUCKETS) if record["wall"] <= bound),
+                              len(FILE_SECONDS_BUCKETS))
+                self.file_seconds[bucket] += 1
+                self.file_seconds_sum += record["wall"]
+            for name, entry in record["stages"].items():
+                total = self.totals.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "memory": 0})
+                total["calls"] += entry["calls"]
+                total["wall"] += entry["wall"]
+                total["cpu"] += entry["cpu"]
+                total["memory"] = max(total["memory"], entry["memory"])
+            if profile and self.profile_slowest:
+                item = (record["wall"], next(self._sequence), dict(record, profile=profile))
+                if len(self._slowest) < self.profile_slowest:
+                    heapq.heappush(self._slowest, item)
+                else:
+                    heapq.heappushpop(self._slowest, item)
+            if self._jsonl is not None:
+                self._jsonl.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self._jsonl.flush()
+
+    def stage_summary(self):
+        """One row per stage: calls, total and per-file wall/CPU seconds and peak memory growth"""
+        with self._lock:
+            per_file = {}
+            for record in self.recent:
+                for name, entry in record["stages"].items():
+                    per_file.setdefault(name, []).append(entry["wall"])
+            rows = []
+            for name in sorted(self.totals, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)):
+                total = self.totals[name]
+                walls = sorted(per_file.get(name, [0.0]))
+                rows.append({
+                    "stage": name,
+                    "calls": total["calls"],
+                    "wall_s": round(total["wall"], 3),
+                    "cpu_s": round(total["cpu"], 3),
+                    "p50_ms": round(walls[len(walls) // 2] * 1e3, 1),
+                    "p95_ms": round(walls[min(len(walls) - 1, int(len(walls) * 0.95))] * 1e3, 1),
+                    "max_mem_mb": round(total["memory"] / 2 ** 20, 1),
+                })
+            return rows
+
+    def slowest(self, count=10):
+        """The ``count`` slowest recent (uncached) file traces, slowest first"""
+        with self._lock:
+            records = [record for record in self.recent if not record.get("cached")]
+        return heapq.nlargest(count, records, key=lambda record: record["wall"])
+
+    def profiles(self):
+        """Traces of the slowest profiled files, slowest first, each with its ``profile``"""
+        with self._lock:
+            return [record for _, _, record in sorted(self._slowest, reverse=True)]
+
+    def jsonl_text(self):
+        with self._lock:
+            return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in self.recent)
+
+    def prometheus_text(self):
+        """Totals in the Prometheus text exposition format"""
+        with self._lock:
+            lines = []
+
+            def metric(name, kind, help_text, samples):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+
+            stages = sorted(self.totals.items())
+            metric("invoice_extraction_stage_seconds_total", "counter", "Wall time spent in each extraction stage",
+                   [(_labels(stage=name), round(total["wall"], 6)) for name, total in stages])
+            metric("invoice_extraction_stage_cpu_seconds_total", "counter",
+                   "CPU time (including Tesseract processes) spent in each extraction stage",
+                   [(_labels(stage=name), round(total["cpu"], 6)) for name, total in stages])
+            metric("invoice_extraction_stage_calls_total", "counter", "Times each extraction stage ran",
+                   [(_labels(stage=name), total["calls"]) for name, total in stages])
+            metric("invoice_extraction_stage_memory_bytes", "gauge",
+                   "Largest resident memory growth seen during one call of each stage",
+                   [(_labels(stage=name), total["memory"]) for name, total in stages])
+            metric("invoice_extraction_files_total", "counter", "Files processed, by whether the cache answered",
+                   [(_labels(cached=str(kind == "cached").lower()), count)
+                    for kind, count in sorted(self.files.items())])
+            buckets = []
+            cumulative = 0
+            for bound, count in zip(FILE_SECONDS_BUCKETS + ("+Inf",), self.file_seconds):
+                cumulative += count
+                buckets.append((_labels(le=bound), cumulative))
+            metric("invoice_extraction_file_seconds", "histogram", "Wall time to extract one uncached file", [])
+            lines.extend(f"invoice_extraction_file_seconds_bucket{labels} {value}" for labels, value in buckets)
+            lines.append(f"invoice_extraction_file_seconds_sum {round(self.file_seconds_sum, 6)}")
+            lines.append(f"invoice_extraction_file_seconds_count {cumulative}")
+            return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write prometheus_text() atomically, as node_exporter's textfile collector expects"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".invoice-metrics-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def write_profiles(self, directory):
+        """Write each kept profile as ``<n>-<file>.folded`` collapsed stacks; returns the paths"""
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for rank, record in enumerate(self.profiles(), start=1):
+            path = os.path.join(directory, f"{rank:02d}-{os.path.basename(record['file'])}.folded")
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, samples in sorted(record["profile"].items()):
+                    f.write(f"{stack} {samples}\n")
+            paths.append(path)
+        return paths
+
+    def close(self):
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
@@ -0,0 +1,447 @@
+"""Vendor layout templates: read a known layout from its field boxes alone.
+
+Most invoices come from a few vendors whose layout never changes, yet each
+one is OCR'd as a whole page and parsed by the generic field patterns. A
+template records where one vendor's fields sit on the first page. A page
+that matches it is OCR'd only in those boxes, each with a whitelist of the
+characters its field can hold, plus the line item table, and its fields are
+taken from the boxes instead of the pattern cascade.
+
+Layout fingerprint: the first page is deskewed and cropped to its ink
+(dedup.normalized_page), text rows and blocks are found by morphological
+closing, and the top of the page (header, invoice details, bill-to and the
+table header, FINGERPRINT_ZONE page widths deep, so the number of line
+items doesn't move it) is scaled to a FINGERPRINT_COLUMNS x FINGERPRINT_ROWS
+grid with one bit per cell covered by a block. A TemplateIndex compares a
+fingerprint with every template at once by Hamming distance in NumPy (10,000
+templates take about half a millisecond) and returns the few nearest within
+MAX_DISTANCE. Vendors using the same invoicing software share a layout, so
+they are tried in turn, the vendor box first: a wrong one costs a line of OCR.
+
+Boxes are kept relative to the top left corner of the page's ink, in units
+of the ink's width, so scan margins and resolution don't matter.
+
+Templates are learned from a confirmed row (the "Confirmed" column of the app's results grid).
+The page is OCR'd in full, each confirmed value is found among the words,
+and its box is widened to its neighbours on the line so longer values
+still fit. A template's read is only trusted if every box reads back as
+its field:
+- the vendor name must be close to the template's;
+- dates and invoice numbers must have the learned shape (INV-1234 and
+  INV-98765 share one);
+- amounts must read as amounts;
+- line items, when there are any, must add up to the total.
+Otherwise the page is OCR'd in full as before. Text-layer PDFs are never
+OCR'd, so they have no use for templates.
+"""
+import difflib
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Fingerprint grid over the top FINGERPRINT_ZONE page widths of the ink
+FINGERPRINT_COLUMNS = 32
+FINGERPRINT_ROWS = 16
+FINGERPRINT_ZONE = 0.3
+FINGERPRINT_BYTES = FINGERPRINT_COLUMNS * FINGERPRINT_ROWS // 8  # a multiple of 8: TemplateIndex reads 64-bit words
+
+# Largest Hamming distance (of FINGERPRINT_BYTES * 8 bits) at which a page is read with a template; copies
+# of one layout under different scan artefacts and values measured up to about 20 (bench_templates)
+MAX_DISTANCE = 32
+
+# Templates tried per page, nearest first: vendors sharing one invoicing system share a layout
+MAX_CANDIDATES = 3
+
+# Horizontal gap (fraction of the width) still treated as the same row, vertical gap as the same block
+ROW_GAP = 0.15
+BLOCK_GAP = 0.02
+
+# Fields read from boxes, by how their value is checked
+FIELD_KINDS = {
+    "Vendor Name": "name",
+    "Invoice Number": "code",
+    "Invoice Date": "date",
+    "Due Date": "date",
+    "Total Amount": "amount",
+    "Tax Amount": "amount",
+}
+
+# Labels that pick out a field's value when it appears more than once (a total equal to the subtotal)
+_FIELD_LABELS = {
+    "Vendor Name": re.compile(r"(?i)vendor|from|seller"),
+    "Invoice Number": re.compile(r"(?i)invoice|no\b|number|#"),
+    "Invoice Date": re.compile(r"(?i)(?<!due )date|issued"),
+    "Due Date": re.compile(r"(?i)due"),
+    "Total Amount": re.compile(r"(?i)(?<!sub)total|amount due|balance"),
+    "Tax Amount": re.compile(r"(?i)tax|vat|gst"),
+}
+
+# A vendor box must read at least this close to the template's vendor name (and a name or code
+# OCR'd while learning to the confirmed value)
+MIN_NAME_SIMILARITY = 0.8
+
+# Space kept between a widened box and the neighbouring words, and above and below a value,
+# as fractions of the line height
+BOX_GAP = 0.5
+BOX_MARGIN = 0.35
+
+# Tesseract page segmentation modes: automatic layout for learning and the table, one line for a field
+PSM_AUTO = 3
+PSM_LINE = 7
+
+# Values as the field patterns capture them (field_extractor._DATE and _AMOUNT)
+_DATE_VALUE = re.compile(r"\d{1,2}[/\-.]\d{1,2}[/\-.]\d{2,4}")
+_AMOUNT_VALUE = re.compile(r"[\d,]+\.\d{2}")
+_CURRENCY_SYMBOLS = "$€£¥"
+_NON_ALNUM = re.compile(r"[^0-9a-z]")
+_SHAPE_RUNS = re.compile(r"(A|9)\1+")
+
+# Characters pytesseract's config can't carry; Tesseract never reads a space as a character anyway
+_UNSAFE = set("'\"\\ \t")
+
+
+def _shape(value):
+    # INV-1234 -> A-9: letters and digits, runs collapsed, punctuation kept
+    shape = "".join("9" if c.isdigit() else "A" if c.isalpha() else c for c in value.replace(" ", ""))
+    return _SHAPE_RUNS.sub(r"\1", shape)
+
+
+def _whitelist(kind, value):
+    chars = set()
+    for c in value:
+        if c.isdigit():
+            chars.update("0123456789")
+        elif c.isalpha():
+            chars.update(chr(code) for code in range(ord("A"), ord("Z") + 1))
+            chars.update(chr(code) for code in range(ord("a"), ord("z") + 1))
+        else:
+            chars.add(c)
+    if kind == "amount":
+        chars.update("0123456789.,-" + _CURRENCY_SYMBOLS)
+    return "".join(sorted(chars - _UNSAFE))
+
+
+def layout_fingerprint(ink):
+    """FINGERPRINT_BYTES of layout from a normalized_page ink array (ink white on black)"""
+    import cv2
+    import numpy as np
+    from layout_regions import _close
+
+    width = ink.shape[1]
+    depth = max(1, round(width * FINGERPRINT_ZONE))
+    zone = ink[:depth]
+    if zone.shape[0] < depth:
+        # A short page: the rest of the zone is blank
+        zone = cv2.copyMakeBorder(zone, 0, depth - zone.shape[0], 0, 0, cv2.BORDER_CONSTANT, value=0)
+    rows = _close(zone, cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, int(width * ROW_GAP)), 1)))
+    blocks = _close(rows, cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(3, int(width * BLOCK_GAP)))))
+    cells = cv2.resize(blocks, (FINGERPRINT_COLUMNS, FINGERPRINT_ROWS), interpolation=cv2.INTER_AREA)
+    return np.packbits(cells >= 128).tobytes()
+
+
+def source_fingerprint(source, kind):
+    """Layout fingerprint of a file's first page, or None (text-layer PDFs, unreadable files)"""
+    from dedup import normalized_page
+
+    normalized = normalized_page(source, kind)
+    if normalized is None:
+        return None
+    return layout_fingerprint(normalized[1])
+
+
+class TemplateIndex:
+    """Templates matched by layout fingerprint.
+
+    ``templates`` are dicts as InvoiceStore.templates() returns them: ``id``,
+    ``vendor``, ``fingerprint`` (bytes) and ``template``.
+    """
+
+    def __init__(self, templates=()):
+        import numpy as np
+
+        self.templates = list(templates)
+        # 64-bit words, XORed with a fingerprint and popcounted a row at a time
+        fingerprints = b"".join(template["fingerprint"] for template in self.templates)
+        self._fingerprints = np.frombuffer(fingerprints, dtype=np.uint64).reshape(len(self.templates),
+                                                                                   FINGERPRINT_BYTES // 8)
+        self._popcount = getattr(np, "bitwise_count", None)
+        if self._popcount is None:
+            # NumPy < 2.0: set bits of every 16-bit value
+            table = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+            table = table[np.arange(65536) & 255] + table[np.arange(65536) >> 8]
+            self._popcount = lambda words: table[words.view(np.uint16)]
+
+    def __len__(self):
+        return len(self.templates)
+
+    def match(self, fingerprint, max_distance=MAX_DISTANCE, limit=MAX_CANDIDATES):
+        """``[(template, distance), ...]`` of up to ``limit`` templates within ``max_distance`` bits, nearest first"""
+        import numpy as np
+
+        if not self.templates or fingerprint is None:
+            return []
+        query = np.frombuffer(fingerprint, dtype=np.uint64)
+        distances = self._popcount(np.bitwise_xor(self._fingerprints, query)).sum(axis=1, dtype=np.int64)
+        if len(distances) > limit:
+            nearest = np.argpartition(distances, limit)[:limit]
+        else:
+            nearest = np.arange(len(distances))
+        nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+        return [(self.templates[i], int(distances[i])) for i in nearest if distances[i] <= max_distance]
+
+
+def _frame(binary):
+    # (left, top, width) of the page's ink, or None for a blank page
+    import cv2
+
+    points = cv2.findNonZero(cv2.bitwise_not(binary))
+    if points is None:
+        return None
+    left, top, width, _ = cv2.boundingRect(points)
+    return left, top, width
+
+
+def _crop(binary, box, frame):
+    left, top, width = frame
+    x0, y0, x1, y1 = (round(value * width) for value in box)
+    x0, y0 = max(0, left + x0), max(0, top + y0)
+    return binary[y0:top + y1, x0:left + x1], x0, y0
+
+
+def _comparable(kind, text):
+    if kind == "amount":
+        match = _AMOUNT_VALUE.search(text)
+        return match.group(0).replace(",", "") if match else None
+    if kind == "date":
+        match = _DATE_VALUE.search(text)
+        return match.group(0) if match else None
+    return _NON_ALNUM.sub("", text.lower())
+
+
+def _locate(lines, field, value):
+    """``(line, first, last)`` word indexes where ``value`` is written, or None.
+
+    The shortest run of words that reads as the value wins, and among runs
+    on several lines (a total equal to the subtotal) one after its label.
+    Names and codes OCR'd with a wrong character are found when no run
+    reads exactly as the value.
+    """
+    kind = FIELD_KINDS[field]
+    wanted = _comparable(kind, value)
+    if not wanted:
+        return None
+
+    def exact(text):
+        return text == wanted
+
+    def close(text):
+        return difflib.SequenceMatcher(None, text, wanted).ratio() >= MIN_NAME_SIMILARITY
+
+    for same in (exact, close) if kind in ("name", "code") else (exact,):
+        found = []
+        for line in lines:
+            for size in range(1, len(line) + 1):
+                spans = [first for first in range(len(line) - size + 1)
+                         if same(_comparable(kind, " ".join(word["text"] for word in line[first:first + size])))]
+                if spans:
+                    found.extend((line, first, first + size - 1) for first in spans)
+                    break
+        for line, first, last in found:
+            if _FIELD_LABELS[field].search(" ".join(word["text"] for word in line[:first])):
+                return line, first, last
+        if found:
+            return found[0]
+    return None
+
+
+def _field_box(line, first, last, frame, page_width):
+    left, top, width = frame
+    height = max(word["height"] for word in line)
+    x0 = line[first]["left"]
+    x1 = line[last]["left"] + line[last]["width"]
+    # Widen up to the neighbours, so shorter and longer values still fit
+    x0 = line[first - 1]["left"] + line[first - 1]["width"] + height * BOX_GAP if first > 0 else x0 - height
+    x1 = line[last + 1]["left"] - height * BOX_GAP if last + 1 < len(line) else min(page_width, x1 + 4 * height)
+    y0 = min(word["top"] for word in line[first:last + 1]) - height * BOX_MARGIN
+    y1 = max(word["top"] + word["height"] for word in line[first:last + 1]) + height * BOX_MARGIN
+    return [round((x0 - left) / width, 4), round((y0 - top) / width, 4),
+            round((x1 - left) / width, 4), round((y1 - top) / width, 4)]
+
+
+def learn_template(gray, preprocessor, backend, details):
+    """A template for a grayscale first page whose fields are ``details`` (confirmed by a person).
+
+    Raises ValueError when the vendor name or another confirmed field can't
+    be found on the page.
+    """
+    from adaptive_ocr import _lines
+    from line_items import table_header
+
+    vendor = (details.get("Vendor Name") or "").strip()
+    if not vendor:
+        raise ValueError("a template needs the vendor name")
+    # Binarized as read_with_templates does it, so the boxes line up
+    binary = preprocessor.binarize(gray, deskew=True)
+    frame = _frame(binary)
+    if frame is None:
+        raise ValueError("the page is blank")
+    words = backend.image_to_data(binary, psm=PSM_AUTO)
+    lines = [sorted(line, key=lambda word: word["left"]) for line in _lines(words).values()]
+
+    fields = {}
+    missing = []
+    for field, kind in FIELD_KINDS.items():
+        value = (details.get(field) or "").strip()
+        if not value:
+            continue
+        found = _locate(lines, field, value)
+        if found is None:
+            missing.append(field)
+            continue
+        line, first, last = found
+        read = " ".join(word["text"] for word in line[first:last + 1])
+        fields[field] = {
+            "box": _field_box(line, first, last, frame, binary.shape[1]),
+            "whitelist": _whitelist(kind, value + read),
+            "shape": _shape(_comparable(kind, value) if kind == "date" else value),
+        }
+    if missing:
+        raise ValueError(f"{', '.join(missing)} not found on the page")
+
+    items = None
+    header = table_header(words)
+    totals = [fields[field]["box"][1] for field in ("Total Amount", "Tax Amount") if field in fields]
+    if header is not None:
+        left, top, width = frame
+        header_top = (header[1] - top) / width
+        below = [value for value in totals if value > header_top]
+        # Down to the first totals box, or as far again as the table header is from the top
+        bottom = min(below) if below else 2 * header_top
+        margin = (header[3] - header[1]) * BOX_MARGIN / width
+        items = [0.0, round(header_top - margin, 4), 1.0, round(bottom, 4)]
+    return {"vendor": vendor, "currency": details.get("Currency") or "", "fields": fields, "items": items}
+
+
+def _read_field(kind, text, spec, template):
+    if kind == "name":
+        similarity = difflib.SequenceMatcher(None, _comparable(kind, text), _comparable(kind, template["vendor"]))
+        return template["vendor"] if similarity.ratio() >= MIN_NAME_SIMILARITY else None
+    if kind == "amount":
+        match = _AMOUNT_VALUE.search(text)
+        return match.group(0) if match else None
+    if kind == "date":
+        match = _DATE_VALUE.search(text)
+        value = match.group(0) if match else None
+    else:
+        value = text.replace(" ", "")
+    return value if value and _shape(value) == spec["shape"] else None
+
+
+def read_with_templates(gray, preprocessor, backend, templates):
+    """``(position, text, confidence, words, fields)`` of a grayscale first page read through a template.
+
+    ``templates`` are tried in order (TemplateIndex.match gives them
+    nearest first) and ``position`` is that of the one that read the page.
+    Only the field boxes and the line item table are OCR'd; the vendor box
+    comes first, so another vendor's template costs one line of OCR.
+    ``words`` are the table's (page coordinates) and ``fields`` the values
+    read from the boxes. None when no template's boxes read back as its
+    fields: the page then needs full OCR.
+    """
+    # Otsu, like the fast pass of adaptive OCR: the adaptive threshold's despeckling drops full stops
+    binary = preprocessor.binarize(gray, deskew=True)
+    frame = _frame(binary)
+    if frame is None:
+        return None
+    for position, template in enumerate(templates):
+        result = _read_template(binary, frame, backend, template)
+        if result is not None:
+            return (position,) + result
+    return None
+
+
+def _read_template(binary, frame, backend, template):
+    from adaptive_ocr import _lines, _text, confidence
+    from line_items import check_total, find_line_items
+
+    fields = {}
+    text = ""
+    confidences = []
+    for field, spec in template["fields"].items():
+        crop, _, _ = _crop(binary, spec["box"], frame)
+        if crop.size == 0:
+            return None
+        read = backend.image_to_data(crop, psm=PSM_LINE, whitelist=spec["whitelist"])
+        line = " ".join(word["text"] for word in read)
+        value = _read_field(FIELD_KINDS[field], line, spec, template)
+        if value is None:
+            logger.debug("Template %s: %s read as %r", template["vendor"], field, line)
+            return None
+        fields[field] = value
+        # Labelled the way the field patterns look for them
+        text += f"{field}: {line}\n"
+        confidences.extend(read)
+    if template.get("currency"):
+        fields["Currency"] = template["currency"]
+
+    words = []
+    if template.get("items"):
+        crop, x0, y0 = _crop(binary, template["items"], frame)
+        if crop.size:
+            words = [dict(word, left=word["left"] + x0, top=word["top"] + y0)
+                     for word in backend.image_to_data(crop, psm=PSM_AUTO)]
+            confidences.extend(words)
+            check = check_total(find_line_items(words), fields)
+            if check is not None and check["balanced"] is False:
+                logger.debug("Template %s: line items don't add up to the total", template["vendor"])
+                return None
+            text += "\n" + _text(_lines(words))
+    return text, confidence(confidences), words, fields
+
+
+def _first_page_gray(source, kind, preprocessor):
+    from extraction import DEFAULT_PDF_OCR_DPI
+
+    if kind == "image":
+        return preprocessor.decode(source)
+    import io
+    import pdfplumber
+
+    with pdfplumber.open(io.BytesIO(source) if isinstance(source, bytes) else source) as pdf:
+        if not pdf.pages:
+            raise ValueError("the PDF has no pages")
+        page = pdf.pages[0]
+        if page.chars:
+            raise ValueError("the PDF has a text layer and is already read without OCR")
+        image = page.to_image(resolution=DEFAULT_PDF_OCR_DPI).original
+    return preprocessor.gray_from_image(image, DEFAULT_PDF_OCR_DPI)
+
+
+def learn_from_source(store, name, source, details, preprocessing=None):
+    """Learn and store a template from a file whose fields ``details`` a person confirmed.
+
+    ``source`` is a path, bytes or a binary file object. A template of the
+    same vendor with a matching layout is replaced rather than joined by a
+    second one. Returns the template's id; raises ValueError when the file
+    can't give a template (text-layer PDFs, fields not found on the page).
+    """
+    from extraction import source_kind
+    from ocr_backend import get_ocr_backend
+    from preprocessing import get_preprocessor
+
+    if hasattr(source, "read"):
+        source.seek(0)
+        source = source.read()
+    kind = source_kind(name, source)
+    if kind is None:
+        raise ValueError(f"{name} is not a PDF or image")
+    preprocessor = get_preprocessor(**(preprocessing or {}))
+    template = learn_template(_first_page_gray(source, kind, preprocessor), preprocessor, get_ocr_backend(),
+                             details)
+    fingerprint = source_fingerprint(source, kind)
+    if fingerprint is None:
+        raise ValueError(f"{name} has no layout to fingerprint")
+    replaced = next((match["id"] for match, _ in TemplateIndex(store.templates()).match(fingerprint)
+                     if match["vendor"].lower() == template["vendor"].lower()), None)
+    return store.save_template(template["vendor"], fingerprint, template, source_file=name, replaces=replaced)
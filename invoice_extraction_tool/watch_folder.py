@@ -0,0 +1,711 @@
+"""invoice-watch: ingest the invoices dropped into a directory, each file once.
+
+Examples:
+
+    python watch_folder.py /srv/scans/inbox --jobs 8
+    python watch_folder.py /mnt/share/inbox --poll 10 --store invoices.sqlite3
+    python watch_folder.py /srv/scans/inbox --once      # catch up, then exit
+
+New and changed PDFs, images and ZIP/TAR archives anywhere under the
+directory are extracted on a BatchExtractor pool and saved to the invoice
+store. On Linux the directories are watched with inotify (through libc, no
+extra package); ``--poll`` rescans every few seconds instead, which is what
+network shares need: inotify never hears about files other NFS or SMB
+clients write. When inotify can't be used (another OS, or the watch limit
+``fs.inotify.max_user_watches`` is reached) the watcher falls back to
+polling by itself.
+
+A file is taken once its size and mtime have held still for ``--settle``
+seconds, so half-copied scans are left alone; empty files wait until they
+have content. Ready files are extracted ``--batch`` at a time, and each
+batch is one transaction in the store.
+
+A ledger (SQLite, next to the store) keeps every file's path, size, mtime,
+SHA-256 and outcome. A file whose size and mtime match its ledger row is
+never opened again, and one whose content was already ingested (a copy, a
+rename, a touched file) is recorded without extraction. Files that failed
+are only retried once they change, or on startup with ``--retry-failed``.
+The ledger is committed after the store: a crash in between replays that
+batch on restart, and the store replaces rows by content hash, so no
+invoice is stored twice.
+
+Catching up after a restart doesn't stat every file. The ledger also keeps
+each directory's mtime, which changes whenever an entry is added, removed or
+renamed in it; directories whose mtime is unchanged are not listed, and only
+the new or changed files of the others are hashed. A directory's mtime is
+recorded once every file found in it is in the ledger, and never while it is
+too recent to tell apart from a change in the same clock tick. A file
+rewritten in place doesn't touch its directory: while the watcher runs,
+inotify reports it and polling stats every file every
+``--full-scan-interval`` seconds, but after downtime only ``--full-scan``
+finds it. ``python -m benchmarks.bench_watch`` measures catch-up scans.
+
+SIGTERM or SIGINT lets the current batch finish and be recorded, then the
+watcher exits; a second signal stops at once.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import heapq
+import logging
+import os
+import select
+import signal
+import sqlite3
+import stat
+import struct
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from adaptive_ocr import REVIEW_CONFIDENCE
+from archive_ingest import expand_archives, is_archive_name
+from batch_extraction import BatchExtractor
+from batch_scheduler import add_scheduling_arguments, scheduling_options
+from extraction import DEFAULT_PDF_OCR_DPI, file_kind
+from extraction_cache import ExtractionCache, file_digest
+from invoice_store import InvoiceStore, default_store_path
+from preprocessing import DEFAULT_TARGET_DPI
+
+logger = logging.getLogger("watch_folder")
+
+DEFAULT_SETTLE_SECONDS = 2.0
+DEFAULT_BATCH_FILES = 32
+DEFAULT_POLL_SECONDS = 5.0
+DEFAULT_FULL_SCAN_SECONDS = 3600.0
+
+# Longest wait for inotify events before files still settling and the stop flag are looked at again
+_TICK_SECONDS = 1.0
+# A directory mtime this recent may share its clock tick with a change not seen yet; it isn't recorded
+_RECENT_MTIME_NS = 2 * 10 ** 9
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+# struct inotify_event without its name: wd, mask, cookie, len
+_EVENT = struct.Struct("iIII")
+_READ_BYTES = 64 * 1024
+
+_LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    file_hash TEXT,
+    status TEXT NOT NULL,
+    detail TEXT,
+    processed_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files(directory);
+CREATE INDEX IF NOT EXISTS files_done_hash ON files(file_hash) WHERE status = 'done';
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories(parent);
+"""
+
+
+def default_ledger_path(store_path):
+    """Ledger location for an invoice store: ``invoices.sqlite3`` -> ``invoices.watch.sqlite3``"""
+    root, extension = os.path.splitext(os.path.abspath(store_path))
+    return f"{root}.watch{extension or '.sqlite3'}"
+
+
+def is_watched_name(name):
+    """True for the file names the watcher picks up: invoices and archives, but no hidden files"""
+    return not name.startswith(".") and (file_kind(name) is not None or is_archive_name(name))
+
+
+class IngestLedger:
+    """SQLite record of the files the watcher has taken and the directories it has listed.
+
+    ``files`` rows hold a file's size, mtime, SHA-256 and status ("done" or
+    "failed", with the errors as ``detail``); ``directories`` rows the mtime a
+    directory had when everything in it was recorded (NULL until then) and
+    its parent, so unchanged directories can be walked without listing them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_LEDGER_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def files_in(self, directory):
+        """``{path: (size, mtime_ns, status)}`` of the recorded files directly in ``directory``"""
+        rows = self._connection.execute("SELECT path, size, mtime_ns, status FROM files WHERE directory = ?",
+                                        (directory,))
+        return {path: (size, mtime_ns, status) for path, size, mtime_ns, status in rows}
+
+    def file(self, path):
+        """``(size, mtime_ns, status)`` recorded for ``path``, or None"""
+        return self._connection.execute("SELECT size, mtime_ns, status FROM files WHERE path = ?",
+                                        (path,)).fetchone()
+
+    def find_done(self, file_hash):
+        """Path of an ingested file with this SHA-256, or None"""
+        row = self._connection.execute("SELECT path FROM files WHERE file_hash = ? AND status = 'done' LIMIT 1",
+                                       (file_hash,)).fetchone()
+        return None if row is None else row[0]
+
+    def record(self, entries):
+        """Write ``(path, size, mtime_ns, file_hash, status, detail)`` entries in one transaction"""
+        processed_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        connection = self._connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT OR REPLACE INTO files (path, directory, size, mtime_ns, file_hash, status, detail, "
+                "processed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(path, os.path.dirname(path), size, mtime_ns, file_hash, status, detail, processed_at)
+                 for path, size, mtime_ns, file_hash, status, detail in entries])
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def directory_mtime(self, path):
+        """mtime recorded for a directory, or None if it was never completely recorded"""
+        row = self._connection.execute("SELECT mtime_ns FROM directories WHERE path = ?", (path,)).fetchone()
+        return None if row is None else row[0]
+
+    def subdirectories(self, path):
+        return [row[0] for row in self._connection.execute("SELECT path FROM directories WHERE parent = ?",
+                                                           (path,))]
+
+    def add_directories(self, parent, paths):
+        """Remember directories found in ``parent`` (None for the watched root); known ones are kept"""
+        self._connection.executemany("INSERT OR IGNORE INTO directories (path, parent) VALUES (?, ?)",
+                                     [(path, parent) for path in paths])
+
+    def set_directory_mtime(self, path, mtime_ns):
+        self._connection.execute("UPDATE directories SET mtime_ns = ? WHERE path = ?", (mtime_ns, path))
+
+    def forget_directory(self, path):
+        """Drop a directory that is gone, and every directory under it"""
+        prefix = os.path.join(path, "")
+        self._connection.execute("DELETE FROM directories WHERE path = ? OR substr(path, 1, ?) = ?",
+                                 (path, len(prefix), prefix))
+
+
+class Inotify:
+    """inotify watches on directories, through libc.
+
+    Raises OSError when inotify isn't available, and from add() when the
+    watch limit is reached.
+    """
+
+    def __init__(self):
+        name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(name, use_errno=True) if name else None
+        if libc is None or not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available on this system")
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1: {os.strerror(error)}")
+        # watch descriptor -> directory, and the directories watched
+        self._paths = {}
+        self._watched = set()
+
+    def add(self, directory):
+        if directory in self._watched:
+            return
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"Cannot watch {directory}: {os.strerror(error)}")
+        self._paths[wd] = directory
+        self._watched.add(directory)
+
+    def read(self, timeout):
+        """``(events, overflow)`` after waiting up to ``timeout`` seconds.
+
+        ``events`` are ``(path, is_directory)`` of entries created, written
+        or moved into a watched directory; ``overflow`` is True when the
+        kernel queue overflowed and events were lost.
+        """
+        events, overflow = [], False
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return events, overflow
+        while True:
+            try:
+                data = os.read(self.fd, _READ_BYTES)
+            except BlockingIOError:
+                return events, overflow
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b"\0")
+                offset += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                elif mask & IN_IGNORED:
+                    # The directory was removed (or unmounted)
+                    self._watched.discard(self._paths.pop(wd, None))
+                elif name and wd in self._paths:
+                    events.append((os.path.join(self._paths[wd], os.fsdecode(name)), bool(mask & IN_ISDIR)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher:
+    """Feeds the invoices that appear under ``directory`` through ``extractor``, each file once.
+
+    ``extractor`` is a BatchExtractor with an invoice store and ``ledger`` an
+    IngestLedger. Files are taken once they've held still for ``settle``
+    seconds and extracted ``batch_files`` at a time. ``poll`` is the number
+    of seconds between scans, or None to use inotify where it works; when
+    polling, every file is stat'ed every ``full_scan_interval`` seconds.
+    ``full_scan`` stats every file on startup too, and ``retry_failed``
+    retries the files that failed before. ``on_result(result)`` hears about
+    every BatchResult.
+    """
+
+    def __init__(self, directory, extractor, ledger, settle=DEFAULT_SETTLE_SECONDS, batch_files=DEFAULT_BATCH_FILES,
+                 poll=None, full_scan_interval=DEFAULT_FULL_SCAN_SECONDS, full_scan=False, retry_failed=False,
+                 on_result=None):
+        if extractor.store is None:
+            raise ValueError("the watcher needs an extractor with an invoice store to ingest into")
+        if not os.path.isdir(directory):
+            raise ValueError(f"{directory} is not a directory")
+        self.directory = os.path.abspath(directory)
+        self.extractor = extractor
+        self.ledger = ledger
+        self.settle = settle
+        self.batch_files = max(1, batch_files)
+        self.poll = poll
+        self.full_scan_interval = full_scan_interval
+        self.full_scan = full_scan
+        self.retry_failed = retry_failed
+        self.on_result = on_result
+        self.counts = {"done": 0, "failed": 0, "copies": 0}
+        # path -> (size, mtime_ns, due) of files waiting to settle or for a batch, and a heap of (due, path)
+        self._pending = {}
+        self._due = []
+        # directory -> [mtime_ns, files found in it that aren't in the ledger yet]
+        self._directories = {}
+        self._inotify = None
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Finish the current batch, then return from run()"""
+        self._stop.set()
+
+    @property
+    def stopping(self):
+        return self._stop.is_set()
+
+    @property
+    def waiting(self):
+        """Number of files found and not ingested yet"""
+        return len(self._pending)
+
+    def _watch(self, directory):
+        if self._inotify is None:
+            return
+        try:
+            self._inotify.add(directory)
+        except OSError as e:
+            logger.warning("%s; polling every %ss instead", e, DEFAULT_POLL_SECONDS)
+            self._inotify.close()
+            self._inotify = None
+            self.poll = DEFAULT_POLL_SECONDS
+
+    def scan(self, top=None, full=False):
+        """Track the new and changed files under ``top`` (the watched directory by default).
+
+        Directories whose mtime is the one recorded are not listed unless
+        ``full``; their subdirectories are still visited.
+        """
+        top = self.directory if top is None else top
+        if top == self.directory:
+            self.ledger.add_directories(None, [top])
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            # Watched before it is listed, so nothing created meanwhile is missed
+            self._watch(directory)
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                self.ledger.forget_directory(directory)
+                continue
+            entry = self._directories.get(directory)
+            known = entry[0] if entry is not None else self.ledger.directory_mtime(directory)
+            if known == mtime_ns and not full:
+                stack.extend(self.ledger.subdirectories(directory))
+                continue
+            stack.extend(self._list(directory, mtime_ns))
+
+    def _list(self, directory, mtime_ns):
+        recorded = self.ledger.files_in(directory)
+        subdirectories, found = [], set()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not entry.name.startswith("."):
+                                subdirectories.append(entry.path)
+                            continue
+                        if not is_watched_name(entry.name) or not entry.is_file():
+                            continue
+                        info = entry.stat()
+                    except OSError:
+                        # Removed while listing
+                        continue
+                    if self._changed(entry.path, info, recorded.get(entry.path)):
+                        self._track(entry.path, info.st_size, info.st_mtime_ns)
+                        found.add(entry.path)
+        except OSError as e:
+            logger.warning("Cannot list %s: %s", directory, e)
+            return []
+        self.ledger.add_directories(directory, subdirectories)
+        self._note_directory(directory, mtime_ns, found)
+        return subdirectories
+
+    def _changed(self, path, info, record):
+        if path in self._pending:
+            # Already waiting; a new size or mtime restarts its settle time
+            return True
+        if record is None or tuple(record[:2]) != (info.st_size, info.st_mtime_ns):
+            return True
+        return record[2] == "failed" and self.retry_failed
+
+    def _note_directory(self, directory, mtime_ns, found):
+        entry = self._directories.setdefault(directory, [mtime_ns, set()])
+        entry[0] = mtime_ns
+        entry[1].update(found)
+
+    def _commit_directories(self):
+        # Only called right after the inotify queue is drained: every change up to a directory's
+        # mtime has been seen by then
+        now = time.time_ns()
+        for directory, (mtime_ns, unrecorded) in list(self._directories.items()):
+            if not unrecorded and now - mtime_ns > _RECENT_MTIME_NS:
+                self.ledger.set_directory_mtime(directory, mtime_ns)
+                del self._directories[directory]
+
+    def _track(self, path, size, mtime_ns):
+        current = self._pending.get(path)
+        if current is not None and current[:2] == (size, mtime_ns):
+            return
+        due = time.monotonic() + self.settle
+        self._pending[path] = (size, mtime_ns, due)
+        heapq.heappush(self._due, (due, path))
+
+    def _resolve(self, path, size=None, mtime_ns=None):
+        current = self._pending.get(path)
+        if current is not None and size is not None and current[:2] != (size, mtime_ns):
+            # Written again while it was being extracted; it waits to settle once more
+            return
+        self._pending.pop(path, None)
+        entry = self._directories.get(os.path.dirname(path))
+        if entry is not None:
+            entry[1].discard(path)
+
+    def _on_event(self, path, is_directory):
+        directory, name = os.path.split(path)
+        if name.startswith("."):
+            return
+        found = set()
+        if is_directory:
+            self.ledger.add_directories(directory, [path])
+            self.scan(path)
+        elif is_watched_name(name):
+            try:
+                info = os.stat(path)
+            except OSError:
+                return
+            if not stat.S_ISREG(info.st_mode) or not self._changed(path, info, self.ledger.file(path)):
+                return
+            self._track(path, info.st_size, info.st_mtime_ns)
+            found.add(path)
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            return
+        # Keeps the directory's recorded mtime current, so the next catch-up can skip it
+        self._note_directory(directory, mtime_ns, found)
+
+    def _read_events(self, timeout):
+        if self._inotify is None:
+            return
+        events, overflow = self._inotify.read(timeout)
+        for path, is_directory in events:
+            self._on_event(path, is_directory)
+        if overflow:
+            logger.warning("inotify queue overflowed; rescanning %s", self.directory)
+            self.scan(full=True)
+
+    def _take_ready(self, limit):
+        """Up to ``limit`` ``(path, size, mtime_ns)`` whose size and mtime held still for ``settle`` seconds"""
+        ready = []
+        now = time.monotonic()
+        while self._due and self._due[0][0] <= now and len(ready) < limit:
+            due, path = heapq.heappop(self._due)
+            current = self._pending.get(path)
+            if current is None or current[2] != due:
+                # Gone, or re-tracked with a later due time
+                continue
+            try:
+                info = os.stat(path)
+            except OSError:
+                self._resolve(path)
+                continue
+            if (info.st_size, info.st_mtime_ns) != current[:2] or not info.st_size:
+                # Still being written (or empty so far)
+                del self._pending[path]
+                self._track(path, info.st_size, info.st_mtime_ns)
+                continue
+            ready.append((path, info.st_size, info.st_mtime_ns))
+        return ready
+
+    def _process(self, batch):
+        entries = []
+        extract = {}
+        copies = []
+        for path, size, mtime_ns in batch:
+            try:
+                digest = file_digest(path)
+            except OSError:
+                self._resolve(path)
+                continue
+            original = next((other for other, (_, _, other_digest) in extract.items() if other_digest == digest),
+                            None) or self.ledger.find_done(digest)
+            if original is not None:
+                # Same bytes as a file already ingested: a copy, a rename or a touched file
+                copies.append((path, size, mtime_ns, digest, original))
+            else:
+                extract[path] = (size, mtime_ns, digest)
+
+        errors = {path: [] for path in extract}
+        current = [None]
+
+        def sources():
+            for path in extract:
+                current[0] = path
+                yield path, path
+
+        def archive_error(message):
+            # Raised while the archive being expanded is the last file handed out
+            errors[current[0]].append(message)
+
+        # In the order they finish; the ledger is only written once the batch is done
+        for result in self.extractor.run(expand_archives(sources(), on_error=archive_error), ordered=False):
+            errors[_source_of(result.name, errors)].extend(result.errors)
+            if self.on_result is not None:
+                self.on_result(result)
+
+        # The extractor flushed the store when its run ended, so the ledger never gets ahead of it
+        for path, (size, mtime_ns, digest) in extract.items():
+            status = "failed" if errors[path] else "done"
+            entries.append((path, size, mtime_ns, digest, status, "; ".join(errors[path]) or None))
+            self.counts[status] += 1
+        outcomes = {entry[0]: entry for entry in entries}
+        for path, size, mtime_ns, digest, original in copies:
+            status = outcomes[original][4] if original in outcomes else "done"
+            detail = None if original == path else f"same content as {original}"
+            entries.append((path, size, mtime_ns, digest, status, detail))
+            self.counts["copies"] += original != path
+        self.ledger.record(entries)
+        for path, size, mtime_ns, *_ in entries:
+            self._resolve(path, size, mtime_ns)
+        logger.info("Ingested %d files (%d failed so far, %d copies skipped); %d waiting",
+                    len(entries), self.counts["failed"], self.counts["copies"], len(self._pending))
+
+    def run(self, once=False):
+        """Catch up on the directory, then ingest files as they arrive until stop() is called.
+
+        With ``once``, returns as soon as every file found is ingested
+        (empty files aren't waited for).
+        """
+        if self.poll is None:
+            try:
+                self._inotify = Inotify()
+            except OSError as e:
+                logger.warning("%s; polling every %ss instead", e, DEFAULT_POLL_SECONDS)
+                self.poll = DEFAULT_POLL_SECONDS
+        started = time.perf_counter()
+        self.scan(full=self.full_scan)
+        # Failed files are retried on startup only, not every time their directory changes
+        self.retry_failed = False
+        logger.info("Watching %s (%s): %d files to catch up on, found in %.2fs", self.directory,
+                    "inotify" if self._inotify is not None else f"polling every {self.poll}s",
+                    len(self._pending), time.perf_counter() - started)
+        last_scan = last_full_scan = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                self._read_events(0)
+                self._commit_directories()
+                batch = self._take_ready(self.batch_files)
+                if batch:
+                    self._process(batch)
+                    continue
+                if once and all(size == 0 for size, _, _ in self._pending.values()):
+                    break
+                now = time.monotonic()
+                timeout = _TICK_SECONDS if not self._due else min(_TICK_SECONDS, max(0.0, self._due[0][0] - now))
+                if self._inotify is not None:
+                    self._read_events(timeout)
+                    continue
+                timeout = min(timeout, max(0.0, last_scan + self.poll - now))
+                if self._stop.wait(timeout):
+                    break
+                now = time.monotonic()
+                if now - last_scan >= self.poll:
+                    full = now - last_full_scan >= self.full_scan_interval
+                    self.scan(full=full)
+                    last_scan = now
+                    if full:
+                        last_full_scan = now
+        finally:
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+        self._commit_directories()
+
+
+def _source_of(name, paths):
+    # Archive members are named "archive.zip/member/path"; walk up to the archive
+    while name not in paths:
+        parent = os.path.dirname(name)
+        if parent == name:
+            raise KeyError(name)
+        name = parent
+    return name
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="invoice-watch",
+        description="Watch a directory and extract every invoice that lands in it, each file once.",
+    )
+    parser.add_argument("directory", help="directory to watch, with its subdirectories")
+    parser.add_argument("--store", default=default_store_path(), metavar="DB",
+                        help=f"SQLite invoice store results go to (default: {default_store_path()})")
+    parser.add_argument("--ledger", metavar="DB",
+                        help="SQLite ledger of ingested files (default: next to the store, e.g. invoices.watch.sqlite3)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH_FILES,
+                        help=f"files extracted and stored per batch (default: {DEFAULT_BATCH_FILES})")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE_SECONDS,
+                        help="seconds a file's size and mtime must hold still before it is taken "
+                             f"(default: {DEFAULT_SETTLE_SECONDS:g})")
+    parser.add_argument("--poll", type=float, nargs="?", const=DEFAULT_POLL_SECONDS, metavar="SECONDS",
+                        help="rescan every SECONDS instead of using inotify, e.g. on network shares "
+                             f"(default when given without a value: {DEFAULT_POLL_SECONDS:g})")
+    parser.add_argument("--full-scan-interval", type=float, default=DEFAULT_FULL_SCAN_SECONDS, metavar="SECONDS",
+                        help="when polling, stat every file this often to find files rewritten in place "
+                             f"(default: {DEFAULT_FULL_SCAN_SECONDS:g})")
+    parser.add_argument("--full-scan", action="store_true",
+                        help="stat every file on startup, not only those in directories changed since the last run")
+    parser.add_argument("--retry-failed", action="store_true", help="retry files that failed before on startup")
+    parser.add_argument("--once", action="store_true", help="ingest what is there, then exit")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="seconds allowed per OCR/PDF task (default: 300)")
+    add_scheduling_arguments(parser)
+    parser.add_argument("--ocr-dpi", type=int, default=DEFAULT_PDF_OCR_DPI,
+                        help=f"resolution scanned PDF pages are rendered at for OCR (default: {DEFAULT_PDF_OCR_DPI})")
+    parser.add_argument("--ocr-regions", action="store_true",
+                        help="OCR only the header, invoice details and totals blocks, "
+                             "falling back to the full page when fields are missing")
+    parser.add_argument("--target-dpi", type=int, default=DEFAULT_TARGET_DPI,
+                        help=f"resolution images are normalised to before OCR (default: {DEFAULT_TARGET_DPI})")
+    parser.add_argument("--deskew", action="store_true", help="straighten rotated scans before OCR")
+    parser.add_argument("--denoise", action="store_true", help="median-filter images before thresholding")
+    parser.add_argument("--cache-dir", help="extraction cache directory")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the extraction cache")
+    parser.add_argument("--dedup", action="store_true",
+                        help="check files against the invoice store for duplicates first")
+    parser.add_argument("--templates", action="store_true",
+                        help="read scans matching a vendor template in the invoice store from its field boxes only")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every file to stderr")
+    return parser
+
+
+def _log_result(result):
+    for message in result.errors:
+        logger.error(message)
+    duplicate = result.metadata.get("duplicate_of")
+    if duplicate is not None:
+        logger.warning("%s duplicates %s (%s match)", result.name, duplicate["file"], duplicate["match"])
+    confidence = result.metadata.get("ocr_confidence")
+    if confidence is not None and confidence < REVIEW_CONFIDENCE:
+        logger.warning("%s has low OCR confidence (%.0f); check its fields", result.name, confidence)
+    logger.debug("%s%s", result.name, " (cached)" if result.cached else "")
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    store = InvoiceStore(args.store)
+    ledger = IngestLedger(args.ledger or default_ledger_path(args.store))
+    cache = None if args.no_cache else ExtractionCache(directory=args.cache_dir)
+    extractor = BatchExtractor(max_workers=args.jobs, task_timeout=args.timeout, cache=cache,
+                               pdf_ocr_dpi=args.ocr_dpi, ocr_regions=args.ocr_regions,
+                               preprocessing={"target_dpi": args.target_dpi, "deskew": args.deskew,
+                                              "denoise": args.denoise},
+                               store=store, dedup=args.dedup, templates=args.templates,
+                               **scheduling_options(args))
+    try:
+        watcher = FolderWatcher(args.directory, extractor, ledger, settle=args.settle, batch_files=args.batch,
+                                poll=args.poll, full_scan_interval=args.full_scan_interval,
+                                full_scan=args.full_scan, retry_failed=args.retry_failed, on_result=_log_result)
+    except ValueError as e:
+        logger.error(str(e))
+        return 2
+
+    def on_signal(signum, frame):
+        if watcher.stopping:
+            raise KeyboardInterrupt
+        logger.info("Stopping after the current batch (signal again to stop at once)")
+        watcher.stop()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, on_signal)
+    try:
+        watcher.run(once=args.once)
+    except KeyboardInterrupt:
+        logger.warning("Stopped mid-batch; its files are extracted again on the next start")
+        extractor.close(wait_for_tasks=False)
+        return 130
+    finally:
+        extractor.close()
+        store.close()
+        ledger.close()
+    logger.info("Stopped: %d ingested, %d failed, %d copies skipped, %d waiting", watcher.counts["done"],
+                watcher.counts["failed"], watcher.counts["copies"], watcher.waiting)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())